@@ -20,8 +20,10 @@ from django.urls import reverse, reverse_lazy
 from django.shortcuts import render, redirect
 from django.views.generic import DetailView, ListView, FormView, TemplateView, View
 from django.http import Http404, HttpResponse, HttpResponseServerError, HttpResponseRedirect
+from django.db import transaction
+import numpy as np
 
-from core.models import Frame, Block, Candidate, SourceMeasurement
+from core.models import Frame, Block, Candidate, SourceMeasurement, detections_array_dtypes
 from core.frames import find_images_for_block
 from core.views import generate_new_candidate
 
@@ -70,6 +72,11 @@ class ProcessCandidates(View):
             return HttpResponseServerError("There was a problem", content_type="text/plain")
 
 def analyser_to_source_measurement(block, cand_ids, blockcandidate):
+    """Creates or updates the SourceMeasurements for the detections of the
+    Candidates with ids <cand_ids> in <block>. The Candidate with id
+    <blockcandidate> is assigned to the Block's Body, the others to new
+    discovery candidate Bodys. All the SourceMeasurements are written in a
+    single transaction and nothing is saved if any candidate fails."""
 
     red_frames = Frame.objects.filter(block=block, frameid__isnull=False, frametype=Frame.BANZAI_RED_FRAMETYPE).order_by('midpoint')
     ql_frames = Frame.objects.filter(block=block, frameid__isnull=False, frametype=Frame.BANZAI_QL_FRAMETYPE).order_by('midpoint')
@@ -77,41 +84,56 @@ def analyser_to_source_measurement(block, cand_ids, blockcandidate):
         frames = red_frames
     else:
         frames = ql_frames
-    if not frames:
+    frames_list = list(frames)
+    if not frames_list:
         return False
-    for cand_id in cand_ids:
-        cand = Candidate.objects.get(id=cand_id)
-        # If this candidate (cand_id) is the intended target of the Block, use
-        # that. Otherwise generate a new Body/asteroid candidate
-        discovery = False
-        if str(cand_id) == str(blockcandidate):
-            body = block.body
-        else:
-            body = generate_new_candidate(frames)
-            discovery = True
-        if not body:
-            return False
-        detections = cand.unpack_dets()
-        if len(detections) != frames.count():
-            return False
-        for det in detections:
-            frame = frames[int(det[1])-1]
-            params = {
-                'body'  : body,
-                'frame' : frame
-            }
-            sm, created = SourceMeasurement.objects.get_or_create(**params)
+    det_dtype = detections_array_dtypes()
+    with transaction.atomic():
+        measures = {}
+        fetched_bodies = set()
+        for cand_id in cand_ids:
+            cand = Candidate.objects.get(id=cand_id)
+            # If this candidate (cand_id) is the intended target of the Block, use
+            # that. Otherwise generate a new Body/asteroid candidate
+            discovery = False
+            if str(cand_id) == str(blockcandidate):
+                body = block.body
+            else:
+                body = generate_new_candidate(frames)
+                discovery = True
+            if not body:
+                transaction.set_rollback(True)
+                return False
+            detections = np.asarray(cand.unpack_dets(), dtype=det_dtype)
+            if len(detections) != len(frames_list):
+                transaction.set_rollback(True)
+                return False
+            # Fetch all the existing measurements for this Body in one go
+            if body.pk not in fetched_bodies:
+                for sm in SourceMeasurement.objects.filter(body=body, frame__in=frames_list):
+                    measures.setdefault((body.pk, sm.frame_id), sm)
+                fetched_bodies.add(body.pk)
             # Convert the detections RA's (in decimal hours) into decimal degrees
             # before storing
-            sm.obs_ra = det[4] * 15.0
-            sm.obs_dec = det[5]
-            sm.obs_mag = det[8]
-            sm.aperture_size = det[14]
-            if discovery:
-                # Add discovery asterisk to the first detection
-                sm.flags = '*'
-                discovery = False
-            sm.save()
+            ra_degs = (detections['ra'] * 15.0).tolist()
+            for i, frame_number in enumerate(detections['frame_number'].tolist()):
+                frame = frames_list[frame_number-1]
+                sm = measures.get((body.pk, frame.pk))
+                if sm is None:
+                    sm = SourceMeasurement(body=body, frame=frame)
+                    measures[(body.pk, frame.pk)] = sm
+                sm.obs_ra = ra_degs[i]
+                sm.obs_dec = detections['dec'][i].item()
+                sm.obs_mag = detections['mag'][i].item()
+                sm.aperture_size = detections['area'][i].item()
+                if discovery:
+                    # Add discovery asterisk to the first detection
+                    sm.flags = '*'
+                    discovery = False
+        new_measures = [sm for sm in measures.values() if sm.pk is None]
+        existing_measures = [sm for sm in measures.values() if sm.pk is not None]
+        SourceMeasurement.objects.bulk_create(new_measures)
+        SourceMeasurement.objects.bulk_update(existing_measures, ['obs_ra', 'obs_dec', 'obs_mag', 'aperture_size', 'flags'])
     return True
 
 def check_for_source_measurements(blockid):
@@ -0,0 +1,211 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2014-2019 LCO
+
+ephem_cache.py -- Two-tier cache for computed ephemerides.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import logging
+import hashlib
+import copy
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import RLock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.core.cache.backends.filebased import FileBasedCache
+
+logger = logging.getLogger(__name__)
+
+# Body fields that determine the result of an ephemeris computation. Any
+# change to these (i.e. a new revision of the orbit) produces a new key.
+ELEMENT_FIELDS = ('elements_type', 'epochofel', 'orbinc', 'longascnode',
+                  'argofperih', 'eccentricity', 'meandist', 'meananom',
+                  'perihdist', 'epochofperih', 'abs_mag', 'slope',
+                  'ra', 'dec', 'vmag')
+
+
+def elements_hash(orbelems):
+    """Returns a short hash of the orbital elements in <orbelems> (a dictionary
+    as returned by model_to_dict(Body)), which changes whenever the orbit does."""
+
+    element_str = '|'.join([str(orbelems.get(field, None)) for field in ELEMENT_FIELDS])
+
+    return hashlib.md5(element_str.encode('utf-8')).hexdigest()
+
+
+def time_bucket(d, bucket_size):
+    """Truncates datetime <d> to a multiple of <bucket_size> seconds since the
+    start of the day. A <bucket_size> of 0 or None returns <d> unchanged."""
+
+    if not bucket_size:
+        return d
+    midnight = datetime(d.year, d.month, d.day)
+    secs = (d - midnight).total_seconds()
+    secs = int(secs // bucket_size) * bucket_size
+
+    return midnight + timedelta(seconds=secs)
+
+
+class EphemerisCache(object):
+    """Cache of computed ephemerides with an in-process LRU tier of <maxsize>
+    entries and an optional backing tier in the Django cache named
+    <backing_alias> (e.g. a FileBasedCache or memcached shared between
+    processes). Entries are keyed on (body id, elements hash, site code, time
+    grid, ...) and all entries for a Body can be dropped with invalidate().
+    Hit/miss counts for both tiers are available from stats().
+    Batch jobs can add a file-based backing tier with use_backing_dir()
+    when none is configured."""
+
+    def __init__(self, maxsize=2048, backing_alias=None, timeout=7*86400):
+        self.maxsize = maxsize
+        self.backing_alias = backing_alias
+        self.timeout = timeout
+        self._backing_cache = None
+        self._entries = OrderedDict()
+        self._body_keys = {}
+        self._lock = RLock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.backing_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache size and hit/miss counts"""
+
+        lookups = self.hits + self.backing_hits + self.misses
+        hit_rate = 0.0
+        if lookups > 0:
+            hit_rate = (self.hits + self.backing_hits) / lookups
+        return {'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'backing_hits': self.backing_hits,
+                'misses': self.misses,
+                'hit_rate': hit_rate
+                }
+
+    @property
+    def backing(self):
+        if self._backing_cache is not None:
+            return self._backing_cache
+        if self.backing_alias:
+            try:
+                return caches[self.backing_alias]
+            except InvalidCacheBackendError:
+                logger.warning("Ephemeris cache backend '%s' not configured" % self.backing_alias)
+                self.backing_alias = None
+        return None
+
+    def use_backing_dir(self, location, max_entries=100000):
+        """Uses a file-based backing tier in the directory <location> if
+        there isn't already a backing tier configured (so that e.g. a cron
+        job reuses the results of previous runs). Returns the backing tier."""
+
+        if self.backing is None and location:
+            self._backing_cache = FileBasedCache(location, {'TIMEOUT': self.timeout,
+                                                            'OPTIONS': {'MAX_ENTRIES': max_entries}})
+        return self.backing
+
+    def _generation(self, body_id):
+        """Returns the invalidation generation of <body_id> in the backing tier
+        (entries can't be deleted by pattern from a Django cache, so this is
+        bumped instead to orphan them)"""
+
+        backing = self.backing
+        if backing is None or body_id is None:
+            return 0
+        return backing.get('neox_ephem_gen_%s' % body_id, 0)
+
+    def _backing_key(self, key):
+        key_str = '|'.join([str(k) for k in key])
+        key_hash = hashlib.md5(key_str.encode('utf-8')).hexdigest()
+        return 'neox_ephem_%s_%d_%s' % (key[0], self._generation(key[0]), key_hash)
+
+    def get(self, key):
+        """Returns a copy of the value stored under <key> (whose first item
+        must be the Body id) or None if it isn't in either tier"""
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self._entries[key])
+        backing = self.backing
+        if backing is not None:
+            value = backing.get(self._backing_key(key))
+            if value is not None:
+                with self._lock:
+                    self.backing_hits += 1
+                self._store(key, value)
+                return copy.deepcopy(value)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value, timeout=None):
+        """Stores <value> under <key> in both tiers. The backing tier entry
+        expires after [timeout] seconds (defaults to the cache's timeout)"""
+
+        self._store(key, copy.deepcopy(value))
+        backing = self.backing
+        if backing is not None:
+            backing.set(self._backing_key(key), value, timeout or self.timeout)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._body_keys.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, _ = self._entries.popitem(last=False)
+                body_keys = self._body_keys.get(old_key[0])
+                if body_keys:
+                    body_keys.discard(old_key)
+
+    def invalidate(self, body_id):
+        """Drops all the cached ephemerides of Body <body_id>"""
+
+        with self._lock:
+            for key in self._body_keys.pop(body_id, set()):
+                self._entries.pop(key, None)
+        backing = self.backing
+        if backing is not None and body_id is not None:
+            gen_key = 'neox_ephem_gen_%s' % body_id
+            backing.set(gen_key, backing.get(gen_key, 0) + 1, None)
+
+    def clear(self):
+        """Empties the in-process tier"""
+
+        with self._lock:
+            self._entries.clear()
+            self._body_keys.clear()
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """Returns the value under <key>, calling func(*args, **kwargs) and
+        storing the result if it's not cached"""
+
+        value = self.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            self.set(key, value)
+        return value
+
+
+ephem_cache = EphemerisCache(maxsize=getattr(settings, 'EPHEM_CACHE_SIZE', 2048),
+                             backing_alias=getattr(settings, 'EPHEM_CACHE_ALIAS', None),
+                             timeout=getattr(settings, 'EPHEM_CACHE_TIMEOUT', 7*86400))
@@ -17,6 +17,7 @@ GNU General Public License for more details.
 
 import logging
 from datetime import datetime, timedelta, time
+from functools import lru_cache
 from math import sin, cos, tan, asin, acos, atan2, degrees, radians, pi, sqrt, fabs, exp, log10, ceil, log
 from socket import timeout
 
@@ -27,6 +28,7 @@ except ImportError:
 
 from numpy import array, concatenate, zeros
 from numpy import sqrt as np_sqrt
+import numpy as np
 import copy
 from itertools import groupby
 import re
@@ -40,9 +42,12 @@ from astropy.table import Column
 from astropy.time import Time
 
 # Local imports
-from astrometrics.time_subs import datetime2mjd_utc, datetime2mjd_tdb, mjd_utc2mjd_tt, ut1_minus_utc, round_datetime
+from astrometrics.time_subs import datetime2mjd_utc, datetime2mjd_tdb, mjd_utc2mjd_tt, ut1_minus_utc, round_datetime,\
+    get_semester_dates
 # from astsubs import mpc_8lineformat
 import astrometrics.site_config as cfg
+from astrometrics.ephem_cache import ephem_cache, elements_hash, time_bucket
+from astrometrics.horizons_cache import horizons_cache
 
 
 logger = logging.getLogger(__name__)
@@ -512,6 +517,584 @@ def compute_sky_motion(sky_vel, delta, dbg=True):
     return total_motion, sky_pa, ra_motion, dec_motion
 
 
+# Fields of the structured array returned by compute_ephem_batch(). The first
+# fields mirror the keys of the dictionary returned by compute_ephem(), the
+# Moon and hour angle fields are those needed by format_emp_line()
+EPHEM_BATCH_DTYPE = [('date', 'datetime64[us]'),
+                     ('ra', 'f8'),
+                     ('dec', 'f8'),
+                     ('mag', 'f8'),
+                     ('mag_dot', 'f8'),
+                     ('sky_motion', 'f8'),
+                     ('sky_motion_pa', 'f8'),
+                     ('altitude', 'f8'),
+                     ('southpole_sep', 'f8'),
+                     ('sun_sep', 'f8'),
+                     ('earth_obj_dist', 'f8'),
+                     ('geocnt_a_pos', 'f8', (3,)),
+                     ('heliocnt_e_pos', 'f8', (3,)),
+                     ('ltt', 'f8'),
+                     ('sun_obj_dist', 'f8'),
+                     ('moon_alt', 'f8'),
+                     ('moon_sep', 'f8'),
+                     ('moon_phase', 'f8'),
+                     ('hour_angle', 'f8'),
+                     ]
+
+
+def datetimes2mjd_utc(dates):
+    """Vectorized version of datetime2mjd_utc(); converts a sequence (or array)
+    of UTC datetimes into a NumPy array of MJD(UTC)"""
+
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    mjd_utc = (dates - np.datetime64('1858-11-17T00:00:00', 'us')) / np.timedelta64(1, 'D')
+
+    return mjd_utc
+
+
+def compute_earth_pv_batch(mjd_tt, node_spacing=0.25):
+    """Compute the heliocentric position (AU) and velocity (AU/day) of the
+    Earth for each of the times in the <mjd_tt> array (MJD(TT)).
+    sla_epv() is the most expensive part of the ephemeris, so it is only
+    evaluated at nodes every <node_spacing> days spanning the times and the
+    positions are cubic Hermite interpolated (using the velocities) between
+    these. The interpolation error is < 1e-10 AU for the default spacing.
+    Returns a (N, 3) position array and a (N, 3) velocity array."""
+
+    mjd_tt = np.atleast_1d(np.asarray(mjd_tt, dtype=float))
+    start = np.floor(mjd_tt.min() / node_spacing) * node_spacing
+    num_nodes = int(np.ceil((mjd_tt.max() - start) / node_spacing)) + 1
+    nodes = start + np.arange(max(num_nodes, 2)) * node_spacing
+    if len(nodes) >= len(mjd_tt):
+        # Fewer times than nodes; no point interpolating
+        pv = [S.sla_epv(t) for t in mjd_tt]
+        e_pos = np.array([p[0] for p in pv])
+        e_vel = np.array([p[1] for p in pv])
+        return e_pos, e_vel
+
+    pv = [S.sla_epv(t) for t in nodes]
+    node_pos = np.array([p[0] for p in pv])
+    node_vel = np.array([p[1] for p in pv])
+
+    index = np.clip(((mjd_tt - start) // node_spacing).astype(int), 0, len(nodes) - 2)
+    s = ((mjd_tt - nodes[index]) / node_spacing)[:, np.newaxis]
+    h = node_spacing
+    p0 = node_pos[index]
+    p1 = node_pos[index+1]
+    v0 = node_vel[index]
+    v1 = node_vel[index+1]
+
+    e_pos = (2*s**3 - 3*s**2 + 1) * p0 + (s**3 - 2*s**2 + s) * h * v0 + \
+        (-2*s**3 + 3*s**2) * p1 + (s**3 - s**2) * h * v1
+    e_vel = (6*s**2 - 6*s) * p0 / h + (3*s**2 - 4*s + 1) * v0 + \
+        (-6*s**2 + 6*s) * p1 / h + (3*s**2 - 2*s) * v1
+
+    return e_pos, e_vel
+
+
+def _alt_from_hourangle(hour_angle, dec, site_lat):
+    """Vectorized altitude (in radians) from hour angle and declination (both
+    radians) at the site latitude <site_lat>. No refraction is applied."""
+
+    sin_alt = np.sin(site_lat) * np.sin(dec) + np.cos(site_lat) * np.cos(dec) * np.cos(hour_angle)
+    return np.arcsin(np.clip(sin_alt, -1.0, 1.0))
+
+
+def compute_site_ephem_batch(dates, sitecode):
+    """Computes the target-independent parts of an ephemeris (time scales,
+    observer's heliocentric position & velocity, local sidereal time and the
+    Moon's position, altitude and phase) for the <sitecode> at each of the
+    UTC datetimes in <dates>.
+    The results are cached (and the arrays made read-only) so that repeated
+    calls from compute_ephem_batch() for many targets at the same site and
+    times only do this work once.
+    Returns a dictionary of arrays and site parameters."""
+
+    mjd_utc = datetimes2mjd_utc(dates)
+
+    return _site_ephem_batch(tuple(mjd_utc), str(sitecode).upper())
+
+
+@lru_cache(maxsize=32)
+def _site_ephem_batch(mjd_utc, sitecode):
+
+    mjd_utc = np.array(mjd_utc, dtype=float)
+    mjd_tt = np.array([mjd_utc2mjd_tt(mjd) for mjd in mjd_utc])
+    mjd_tt_mid = mjd_tt[len(mjd_tt) // 2]
+
+    # UT1-UTC is currently always zero; evaluate once for the window
+    dut = ut1_minus_utc(mjd_utc[0])
+
+    # Precession-nutation changes by < 0.2"/day so evaluate once for the
+    # middle of the window
+    rmat = S.sla_prenut(2000.0, mjd_tt_mid)
+
+    (site_name, site_long, site_lat, site_hgt) = get_sitepos(sitecode)
+
+    # Local apparent sidereal time
+    gmst = np.array([S.sla_gmst(mjd + (dut/86400.0)) for mjd in mjd_utc])
+    last = gmst + site_long + S.sla_eqeqx(mjd_tt_mid)
+
+    if site_name == '?' or site_name == 'Geocenter':
+        if site_name == '?':
+            logger.warning("WARN: No site co-ordinates found, computing for geocenter")
+        obs_pos = np.zeros((len(mjd_utc), 3))
+        obs_vel = np.zeros((len(mjd_utc), 3))
+    else:
+        # Vectorized version of sla_pvobs(); velocities are AU/s
+        sidereal_rate = 7.292115855306589e-5
+        (obs_r, obs_z) = S.sla_geoc(site_lat, site_hgt)
+        obs_pos = np.column_stack((obs_r * np.cos(last), obs_r * np.sin(last), np.full(last.shape, obs_z)))
+        obs_vel = np.column_stack((-sidereal_rate * obs_r * np.sin(last), sidereal_rate * obs_r * np.cos(last),
+                                  np.zeros(last.shape)))
+        # Transpose of precession/nutation matrix to go from true equator and
+        # equinox of date to J2000.0 (row vectors so v.rmat == rmat^T.v)
+        obs_pos = obs_pos.dot(rmat)
+        obs_vel = obs_vel.dot(rmat)
+
+    # Heliocentric Earth position and velocity (converted to AU/s), then add
+    # topocentric offset
+    e_pos_hel, e_vel_hel = compute_earth_pv_batch(mjd_tt)
+    e_pos_hel = e_pos_hel + obs_pos
+    e_vel_hel = e_vel_hel/86400.0 + obs_vel
+
+    # Moon position, altitude and phase (TT is close enough to TDB here)
+    moon = np.array([S.sla_rdplan(mjd, 3, site_long, site_lat) for mjd in mjd_tt])
+    sun = np.array([S.sla_rdplan(mjd, 0, site_long, site_lat) for mjd in mjd_tt])
+    moon_ra = moon[:, 0]
+    moon_dec = moon[:, 1]
+    moon_alt = np.degrees(_alt_from_hourangle(last - moon_ra, moon_dec, site_lat))
+    cosphi = np.sin(sun[:, 1]) * np.sin(moon_dec) + np.cos(sun[:, 1]) * np.cos(moon_dec) * np.cos(sun[:, 0] - moon_ra)
+    moon_phase = (1.0 - cosphi) / 2.0
+
+    site_ephem = {'site_name': site_name,
+                  'site_long': site_long,
+                  'site_lat': site_lat,
+                  'site_hgt': site_hgt,
+                  'mjd_utc': mjd_utc,
+                  'mjd_tt': mjd_tt,
+                  'last': last,
+                  'e_pos_hel': e_pos_hel,
+                  'e_vel_hel': e_vel_hel,
+                  'moon_ra': moon_ra,
+                  'moon_dec': moon_dec,
+                  'moon_alt': moon_alt,
+                  'moon_phase': moon_phase,
+                  # Mean to apparent place parameters for the hour angle
+                  'amprms': S.sla_mappa(2000.0, mjd_tt_mid),
+                  # J2000 equatorial to ecliptic of date rotation matrix
+                  'eclmat': S.sla_dmxm(S.sla_ecmat(mjd_tt_mid), S.sla_prec(2000.0, S.sla_epj(mjd_tt_mid))),
+                  }
+    for value in site_ephem.values():
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+    return site_ephem
+
+
+def _prepare_elements(orbelems, mjd_tt, perturb):
+    """Converts the dictionary of orbital elements <orbelems> into the form
+    needed by propagate_orbits() (via perturb_elements(), perturbing to <mjd_tt>
+    if <perturb> is True), performing the same checks as compute_ephem().
+    Returns a dictionary of the elements or None if they are not usable."""
+
+# Check if we even have a non-blank set of elements before proceeding
+    if orbelems.get('epochofel', None) is None:
+        logger.warning("No epoch of elements (epochofel) found in orbelems, cannot compute ephemeris")
+        return None
+    if orbelems.get('epochofperih', None) is None and orbelems.get('elements_type', None) == 'MPC_COMET':
+        logger.warning("No epoch of perihelion (epochofperih) found for this comet, cannot compute ephemeris")
+        return None
+
+# Compute epoch of the elements as a MJD
+    try:
+        epochofel = datetime.strptime(orbelems['epochofel'], '%Y-%m-%d %H:%M:%S')
+    except TypeError:
+        epochofel = orbelems['epochofel']
+    epoch_mjd = datetime2mjd_utc(epochofel)
+
+    comet = False
+    jform = 2
+    if 'elements_type' in orbelems and str(orbelems['elements_type']).upper() == 'MPC_COMET':
+        comet = True
+        jform = 3
+
+    # Convert orbital elements into radians and perturb if requested
+    p_orbelems, p_epoch_mjd, j = perturb_elements(orbelems, epoch_mjd, mjd_tt, comet, perturb)
+
+    if j != 0:
+        logger.error("Perturbing error=%s" % j)
+        return None
+
+    # Check we have everything we need before computing positions
+    if p_orbelems['Inc'] is None or p_orbelems['LongNode'] is None or p_orbelems['ArgPeri'] is None\
+            or p_orbelems['SemiAxisOrQ'] is None or p_orbelems['Ecc'] is None:
+        logger.error("Missing parameter for %s (%s)" % (orbelems.get('name'), orbelems.get('provisional_name')))
+        logger.error(p_orbelems)
+        return None
+
+    elements = {'jform': jform,
+                'epoch': p_epoch_mjd,
+                'incl': p_orbelems['Inc'],
+                'node': p_orbelems['LongNode'],
+                'argperi': p_orbelems['ArgPeri'],
+                'aorq': p_orbelems['SemiAxisOrQ'],
+                'ecc': p_orbelems['Ecc'],
+                'meananom': 0.0 if comet is True else p_orbelems['MeanAnom'],
+                'H': p_orbelems['H'] if p_orbelems['H'] is not None else np.nan,
+                'G': p_orbelems['G'] if p_orbelems['G'] is not None else np.nan,
+                'comet': comet
+                }
+    return elements
+
+
+def _solve_kepler(mean_anom, ecc, hyperbolic):
+    """Vectorized Newton-Raphson solution of Kepler's equation for the
+    eccentric anomaly (elliptical orbits) or the hyperbolic anomaly
+    (<hyperbolic> True) given the mean anomaly <mean_anom> (radians)."""
+
+    anom = np.where(hyperbolic, np.arcsinh(mean_anom / ecc), mean_anom + ecc * np.sin(mean_anom))
+    for i in range(50):
+        delta_anom = np.where(hyperbolic,
+                              (ecc * np.sinh(anom) - anom - mean_anom) / (ecc * np.cosh(anom) - 1.0),
+                              (anom - ecc * np.sin(anom) - mean_anom) / (1.0 - ecc * np.cos(anom)))
+        anom = anom - delta_anom
+        if np.all(np.abs(delta_anom) < 1e-14):
+            break
+
+    return anom
+
+
+def propagate_orbits(mjd_tt, jform, epoch, incl, node, argperi, aorq, ecc, meananom):
+    """Vectorized two-body equivalent of sla_planel() for arrays of times and
+    orbital elements (which are broadcast against each other). <jform> is the
+    SLALIB element form (2=minor planet, 3=comet), angles are in radians, <aorq>
+    is the semi-major axis or perihelion distance (AU) and <epoch> the MJD(TT)
+    of the elements (or perihelion for comets).
+    Near-parabolic orbits (0.99 < e < 1.01) and anything else the Kepler solver
+    can't handle are passed to sla_planel().
+    Returns the heliocentric J2000 equatorial position and velocity as a (N, 6)
+    array (AU, AU/s) and a (N,) array of status values (as for sla_planel())"""
+
+    # Gaussian gravitational constant
+    gcon = 0.01720209895
+    # sin, cos of J2000 mean obliquity (IAU 1976)
+    se = 0.3977771559319137
+    ce = 0.9174820620691818
+
+    mjd_tt, jform, epoch, incl, node, argperi, aorq, ecc, meananom = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(x, dtype=float)) for x in (mjd_tt, jform, epoch, incl, node, argperi, aorq, ecc, meananom)])
+    num = len(mjd_tt)
+    pv = np.zeros((num, 6))
+    status = np.zeros(num, dtype=int)
+
+    comet = jform == 3
+    elliptical = (ecc >= 0.0) & (ecc < 0.99) & ((jform == 2) | comet)
+    hyperbolic = (ecc > 1.01) & comet
+    vectorized = (elliptical | hyperbolic) & (aorq > 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        semi_axis = np.where(comet, aorq / np.abs(1.0 - ecc), aorq)
+        mean_motion = gcon / semi_axis**1.5
+        mean_anom = np.where(comet, 0.0, meananom) + mean_motion * (mjd_tt - epoch)
+        mean_anom = np.where(hyperbolic, mean_anom, np.remainder(mean_anom + pi, 2.0*pi) - pi)
+        anom = _solve_kepler(mean_anom, ecc, hyperbolic)
+
+        # Position and velocity (AU/day) in the orbital plane
+        velocity_scale = np.sqrt(gcon * gcon * semi_axis)
+        ecc_factor = np.sqrt(np.abs(1.0 - ecc * ecc))
+        cos_anom = np.where(hyperbolic, np.cosh(anom), np.cos(anom))
+        sin_anom = np.where(hyperbolic, np.sinh(anom), np.sin(anom))
+        x = np.where(hyperbolic, semi_axis * (ecc - cos_anom), semi_axis * (cos_anom - ecc))
+        y = semi_axis * ecc_factor * sin_anom
+        r = np.where(hyperbolic, semi_axis * (ecc * cos_anom - 1.0), semi_axis * (1.0 - ecc * cos_anom))
+        vx = -velocity_scale * sin_anom / r
+        vy = velocity_scale * ecc_factor * cos_anom / r
+
+    vectorized &= np.isfinite(x) & np.isfinite(y) & np.isfinite(vx) & np.isfinite(vy)
+
+    # Rotate from orbital plane to J2000 ecliptic and then to equatorial
+    cw, sw = np.cos(argperi), np.sin(argperi)
+    cn, sn = np.cos(node), np.sin(node)
+    ci, si = np.cos(incl), np.sin(incl)
+    p_vec = np.column_stack((cw*cn - sw*sn*ci, cw*sn + sw*cn*ci, sw*si))
+    q_vec = np.column_stack((-sw*cn - cw*sn*ci, -sw*sn + cw*cn*ci, cw*si))
+    pos_ecl = x[:, np.newaxis] * p_vec + y[:, np.newaxis] * q_vec
+    vel_ecl = (vx[:, np.newaxis] * p_vec + vy[:, np.newaxis] * q_vec) / 86400.0
+    for offset, vec in ((0, pos_ecl), (3, vel_ecl)):
+        pv[:, offset] = vec[:, 0]
+        pv[:, offset+1] = vec[:, 1] * ce - vec[:, 2] * se
+        pv[:, offset+2] = vec[:, 1] * se + vec[:, 2] * ce
+
+    for i in np.flatnonzero(~vectorized):
+        (pv[i], status[i]) = S.sla_planel(mjd_tt[i], int(jform[i]), epoch[i], incl[i], node[i],
+                                          argperi[i], aorq[i], ecc[i], meananom[i], 0.0)
+
+    return pv, status
+
+
+def _compute_ephem_rows(mjd_tt, site_ephem, site_rows, elements):
+    """Computes the ephemeris quantities for each row; <mjd_tt> are the times,
+    <site_rows> index the arrays of <site_ephem> (from compute_site_ephem_batch())
+    for each row and <elements> is a dictionary of arrays of the elements from
+    _prepare_elements(). Returns a structured array of EPHEM_BATCH_DTYPE (with
+    the 'date' field unset) and a boolean array of which rows are valid."""
+
+# Light travel time for 1 AU (in sec)
+    tau = 499.004783806
+
+    e_pos_hel = site_ephem['e_pos_hel'][site_rows]
+    e_vel_hel = site_ephem['e_vel_hel'][site_rows]
+    propagate_args = [elements[key] for key in ('jform', 'epoch', 'incl', 'node', 'argperi', 'aorq', 'ecc', 'meananom')]
+
+    num_rows = len(mjd_tt)
+    r3 = np.full(num_rows, -100.)
+    delta = np.zeros(num_rows)
+    ltt = np.zeros(num_rows)
+    pv = np.zeros((num_rows, 6))
+    status = np.zeros(num_rows, dtype=int)
+
+    # Iterate for light travel time; only the rows which haven't converged
+    # are recomputed
+    todo = np.abs(delta - r3) > .01
+    while todo.any():
+        r3[todo] = delta[todo]
+        pv[todo], status[todo] = propagate_orbits(mjd_tt[todo] - (ltt[todo]/86400.0),
+                                                  *[arg[todo] for arg in propagate_args])
+        pos = pv[:, 0:3] - e_pos_hel
+        delta = np.sqrt((pos*pos).sum(axis=1))
+        ltt = tau * delta
+        todo = (np.abs(delta - r3) > .01) & (status == 0)
+
+    good = status == 0
+    if not good.all():
+        for bad_status in np.unique(status[~good]):
+            logger.error("Position (sla_planel) error={} for {} rows".format(bad_status, (status == bad_status).sum()))
+    ltt = ltt[:, np.newaxis]
+
+    pos = pv[:, 0:3] - e_pos_hel
+    vel = pv[:, 3:6] - e_vel_hel
+    delta_dot = ((vel*pos).sum(axis=1)/delta)*86400.0
+
+# Correct position for planetary aberration
+    pos = pos - (ltt * vel)
+
+# Convert Cartesian to RA, Dec
+    ra = np.remainder(np.arctan2(pos[:, 1], pos[:, 0]), 2.0*pi)
+    dec = np.arctan2(pos[:, 2], np.hypot(pos[:, 0], pos[:, 1]))
+
+# Compute r, the Sun-Target distance. Correct for light travel time first
+    cpos = pv[:, 0:3] - (ltt * pv[:, 3:6])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.sqrt((cpos*cpos).sum(axis=1))
+        r_dot = ((pv[:, 3:6]*cpos).sum(axis=1)/r)*86400.0
+    ltt = ltt[:, 0]
+
+# Compute R, the Earth-Sun distance. (Only actually need R^2 for the mag. formula)
+    es_Rsq = (e_pos_hel*e_pos_hel).sum(axis=1)
+
+    comet = elements['comet']
+    abs_mag = elements['H']
+    slope = elements['G']
+    # Mirrors the `if H and G` test in compute_ephem()
+    has_mag = np.isfinite(abs_mag) & np.isfinite(slope) & (abs_mag != 0) & (slope != 0)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+# Compute sky motion (vectorized compute_relative_velocity_vectors() and
+# compute_sky_motion())
+        j2000_vel = vel*86400.0 - e_vel_hel
+        unit_pos = pos / delta[:, np.newaxis]
+        length = np.hypot(unit_pos[:, 0], unit_pos[:, 1])
+        sky_vel1 = (unit_pos[:, 1]*j2000_vel[:, 0] - unit_pos[:, 0]*j2000_vel[:, 1]) / length
+        sky_vel2 = -unit_pos[:, 2]*(unit_pos[:, 0]*j2000_vel[:, 0] + unit_pos[:, 1]*j2000_vel[:, 1]) / length + \
+            length*j2000_vel[:, 2]
+        ra_motion = -np.degrees(sky_vel1) / delta * 60.0 / 24.0
+        dec_motion = np.degrees(sky_vel2) / delta * 60.0 / 24.0
+        sky_pa = 180.0 + np.degrees(np.arctan2(-ra_motion, -dec_motion))
+        total_motion = np.hypot(ra_motion, dec_motion)
+
+        # See compute_ephem() for the comet magnitude formula
+        comet_mag = abs_mag + 5.0 * np.log10(delta) + 2.5 * slope * np.log10(r)
+        comet_mag_dot = 5.0 * delta_dot / log(10) / delta + 2.5 * slope * r_dot / log(10) / r
+
+        # Compute phase angle, beta (Sun-Target-Earth angle)
+        beta = np.arccos(np.clip((r*r+delta*delta-es_Rsq)/(2.0*r*delta), -1.0, 1.0))
+
+        phi1 = np.exp(-3.33 * (np.tan(beta/2.0))**0.63)
+        phi2 = np.exp(-1.87 * (np.tan(beta/2.0))**1.22)
+
+        beta_dot = -1 / np.sqrt(1 - (np.cos(beta)) ** 2) * (r * (delta ** 2 - r ** 2 + es_Rsq) * delta_dot - delta * (delta ** 2 - r ** 2 - es_Rsq) * r_dot) / \
+            (2 * delta * delta * r * r)
+        phi1_dot = phi1 * -3.33 * 0.63 * (np.tan(beta/2.0))**(0.63-1) * 0.5 * beta_dot * (np.cos(beta/2.0))**(-2)
+        phi2_dot = phi1 * -1.87 * 1.22 * (np.tan(beta/2.0))**(1.22-1) * 0.5 * beta_dot * (np.cos(beta/2.0))**(-2)
+
+        phi_sum = (1.0 - slope)*phi1 + slope*phi2
+        ast_mag = abs_mag + 5.0 * np.log10(r * delta) - 2.5 * np.log10(phi_sum)
+        ast_mag_dot = 5 * (delta * r_dot + r * delta_dot) / (r * delta * log(10)) - \
+            2.5 * ((1.0 - slope)*phi1_dot + slope*phi2_dot) / (log(10) * phi_sum)
+
+        # Effective separation between the object and the Sun (see compute_ephem())
+        sun_ra = np.remainder(np.arctan2(-e_pos_hel[:, 1], -e_pos_hel[:, 0]), 2.0*pi)
+        sun_dec = np.arctan2(-e_pos_hel[:, 2], np.hypot(e_pos_hel[:, 0], e_pos_hel[:, 1]))
+        lon_new = ra - sun_ra
+        lon_new = np.arctan2(np.sin(lon_new-pi/2) * np.cos(sun_dec) - np.tan(dec) * np.sin(sun_dec), np.cos(lon_new-pi/2)) + pi/2
+        separation = np.where(comet, 0.0, np.abs(np.remainder(lon_new + pi, 2.0*pi) - pi))
+
+    mag = np.where(comet, comet_mag, ast_mag)
+    mag_dot = np.where(comet, comet_mag_dot, ast_mag_dot)
+    bad_mag = has_mag & good & ~comet & ~np.isfinite(ast_mag)
+    if bad_mag.any():
+        logger.error("Error computing magnitude for %d rows" % bad_mag.sum())
+    no_mag = ~has_mag | bad_mag
+    mag[no_mag] = -99.0
+    mag_dot[no_mag] = 0.0
+
+    # Altitude, hour angle and Moon separation
+    last = site_ephem['last'][site_rows]
+    site_lat = site_ephem['site_lat']
+    alt_deg = np.degrees(_alt_from_hourangle(last - ra, dec, site_lat))
+    app_ra = np.array([S.sla_mapqkz(ra_i, dec_i, site_ephem['amprms'])[0] for ra_i, dec_i in zip(ra, dec)])
+    hour_angle = np.remainder(last - app_ra + pi, 2.0*pi) - pi
+    moon_ra = site_ephem['moon_ra'][site_rows]
+    moon_dec = site_ephem['moon_dec'][site_rows]
+    cos_moon_sep = np.sin(dec) * np.sin(moon_dec) + np.cos(dec) * np.cos(moon_dec) * np.cos(ra - moon_ra)
+    moon_sep = np.degrees(np.arccos(np.clip(cos_moon_sep, -1.0, 1.0)))
+
+    emp = np.zeros(num_rows, dtype=EPHEM_BATCH_DTYPE)
+    emp['ra'] = ra
+    emp['dec'] = dec
+    emp['mag'] = mag
+    emp['mag_dot'] = mag_dot
+    emp['sky_motion'] = total_motion
+    emp['sky_motion_pa'] = sky_pa
+    emp['altitude'] = alt_deg
+    emp['southpole_sep'] = 90.0 + np.degrees(dec)
+    emp['sun_sep'] = separation
+    emp['earth_obj_dist'] = delta
+    emp['geocnt_a_pos'] = pos.dot(np.transpose(site_ephem['eclmat']))
+    emp['heliocnt_e_pos'] = e_pos_hel.dot(np.transpose(site_ephem['eclmat']))
+    emp['ltt'] = ltt
+    emp['sun_obj_dist'] = r
+    emp['moon_alt'] = site_ephem['moon_alt'][site_rows]
+    emp['moon_sep'] = moon_sep
+    emp['moon_phase'] = site_ephem['moon_phase'][site_rows]
+    emp['hour_angle'] = hour_angle
+
+    return emp, good
+
+
+def compute_ephem_batch(dates, orbelems, sitecode, perturb=True):
+    """Vectorized version of compute_ephem() to compute the ephemeris of an
+    asteroid or comet from the dictionary of orbital elements <orbelems> at
+    the site <sitecode> for a sequence (or NumPy array) of UTC datetimes <dates>.
+
+    The target-independent quantities (precession-nutation, site position,
+    sidereal time, Earth position and the Moon) are computed once per window
+    by compute_site_ephem_batch() and shared between targets. If <perturb> is
+    True, the elements are perturbed once to the middle of the window rather
+    than at every time; the change in the osculating elements over a night is
+    negligible other than for the very closest approaches.
+
+    OUTPUT:
+    A NumPy structured array (with the EPHEM_BATCH_DTYPE fields) with one row per
+    time; rows where the position could not be computed are omitted. The fields
+    have the same meanings and units as the compute_ephem() dictionary plus:
+        'moon_alt':       Moon's altitude (degrees)
+        'moon_sep':       Angular distance from the Moon (degrees)
+        'moon_phase':     Moon's illuminated fraction (0..1)
+        'hour_angle':     Target's hour angle (radians)
+    """
+
+    empty_emp = np.zeros(0, dtype=EPHEM_BATCH_DTYPE)
+    dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[us]'))
+    if len(dates) == 0:
+        return empty_emp
+
+    site_ephem = compute_site_ephem_batch(dates, sitecode)
+    mjd_tt = site_ephem['mjd_tt']
+
+    # Convert orbital elements into radians and perturb (once) if requested
+    elements = _prepare_elements(orbelems, mjd_tt[len(mjd_tt) // 2], perturb)
+    if elements is None:
+        return empty_emp
+    elements = {key: np.full(len(mjd_tt), value) for key, value in elements.items()}
+
+    emp, good = _compute_ephem_rows(mjd_tt, site_ephem, np.arange(len(mjd_tt)), elements)
+    emp['date'] = dates
+
+    return emp[good]
+
+
+def compute_ephem_many(d, orbelems_list, sitecode='500', perturb=False):
+    """Computes the ephemeris of many asteroids and comets (from the list of
+    orbital element dictionaries, <orbelems_list>) for a single UTC datetime
+    <d> at site <sitecode>, propagating all of the orbits together.
+    Returns a NumPy structured array (with the EPHEM_BATCH_DTYPE fields; see
+    compute_ephem_batch()) with one row per entry in <orbelems_list>. Rows for
+    which the ephemeris could not be computed have NaN for the 'ra' and 'dec'.
+    """
+
+    emp = np.zeros(len(orbelems_list), dtype=EPHEM_BATCH_DTYPE)
+    emp['ra'] = np.nan
+    emp['dec'] = np.nan
+    if len(orbelems_list) == 0:
+        return emp
+
+    site_ephem = compute_site_ephem_batch([d, ], sitecode)
+    mjd_tt = site_ephem['mjd_tt'][0]
+
+    all_elements = [_prepare_elements(orbelems, mjd_tt, perturb) for orbelems in orbelems_list]
+    rows = np.array([elements is not None for elements in all_elements])
+    if not rows.any():
+        return emp
+    elements = {key: np.array([e[key] for e in all_elements if e is not None]) for key in
+                ('jform', 'epoch', 'incl', 'node', 'argperi', 'aorq', 'ecc', 'meananom', 'H', 'G', 'comet')}
+
+    num_rows = rows.sum()
+    row_emp, good = _compute_ephem_rows(np.full(num_rows, mjd_tt), site_ephem, np.zeros(num_rows, dtype=int), elements)
+    row_emp['ra'][~good] = np.nan
+    row_emp['dec'][~good] = np.nan
+    emp[rows] = row_emp
+    emp['date'] = np.datetime64(d, 'us')
+
+    return emp
+
+
+def ephem_batch_to_list(emp):
+    """Converts the structured array returned by compute_ephem_batch() (or
+    compute_ephem_many()) into a list of compute_ephem()-style dictionaries
+    (with datetimes for 'date'). Rows without a valid position become {}"""
+
+    emp_list = []
+    for row in emp:
+        if np.isnan(row['ra']):
+            emp_list.append({})
+            continue
+        emp_line = {name: row[name].item() for name in emp.dtype.names if row[name].ndim == 0}
+        emp_line['geocnt_a_pos'] = list(row['geocnt_a_pos'])
+        emp_line['heliocnt_e_pos'] = list(row['heliocnt_e_pos'])
+        emp_list.append(emp_line)
+
+    return emp_list
+
+
+def compute_airmass_batch(dates, ra, dec, sitecode):
+    """Vectorized airmass of the positions <ra>, <dec> (radians; arrays or
+    scalars) from <sitecode> at each of the UTC datetimes in <dates>, using the
+    same formula as SLALIB's sla_airmas(). No refraction is applied.
+    Returns a NumPy array of airmasses."""
+
+    dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[us]'))
+    if len(dates) == 0:
+        return np.zeros(0)
+    site_ephem = compute_site_ephem_batch(dates, sitecode)
+    altitude = _alt_from_hourangle(site_ephem['last'] - ra, dec, site_ephem['site_lat'])
+    zenith_distance = np.minimum(np.abs(pi/2.0 - altitude), 1.52)
+    seczm1 = 1.0 / np.cos(zenith_distance) - 1.0
+
+    return 1.0 + seczm1 * (0.9981833 - seczm1 * (0.002875 + 0.0008083 * seczm1))
+
+
 def calc_moon_sep(obsdate, obj_ra, obj_dec, site_code):
 
     # Get site and mount parameters
@@ -554,11 +1137,13 @@ def format_emp_line(emp_line, site_code):
 #                         Date  RA Dec Mag   Motion P.A  Alt Mphase Msep Malt   Score HA
         blk_row_format = "%-16s|%s|%s|%04.1f|%5.2f|%5.1f|%+d|%04.2f|%3d|%+02.2d|%+04d|%s"
 
-# get moon info
-        moon_alt, moon_obj_sep, moon_phase = calc_moon_sep(emp_line['date'], emp_line['ra'], emp_line['dec'], site_code)
-
-# Compute H.A.
-        ha = compute_hourangle(emp_line['date'], site_long, site_lat, site_hgt, emp_line['ra'], emp_line['dec'])
+# get moon info and compute H.A. (unless already provided by compute_ephem_batch())
+        if 'moon_sep' in emp_line and 'hour_angle' in emp_line:
+            moon_alt, moon_obj_sep, moon_phase = emp_line['moon_alt'], emp_line['moon_sep'], emp_line['moon_phase']
+            ha = emp_line['hour_angle']
+        else:
+            moon_alt, moon_obj_sep, moon_phase = calc_moon_sep(emp_line['date'], emp_line['ra'], emp_line['dec'], site_code)
+            ha = compute_hourangle(emp_line['date'], site_long, site_lat, site_hgt, emp_line['ra'], emp_line['dec'])
         ha_in_deg = degrees(ha)
 # Check HA is in limits, skip this slot if not
         if ha_in_deg >= ha_pos_limit or ha_in_deg <= ha_neg_limit:
@@ -584,8 +1169,9 @@ def format_emp_line(emp_line, site_code):
 
 def call_compute_ephem(elements, dark_start, dark_end, site_code, ephem_step_size, alt_limit=0, perturb=True):
     """Wrapper for compute_ephem to enable use within plan_obs (or other codes)
-    by making repeated calls for datetimes from <dark_start> -> <dark_end> spaced
-    by <ephem_step_size> seconds. The results are assembled into a list of tuples
+    by computing the ephemeris for datetimes from <dark_start> -> <dark_end> spaced
+    by <ephem_step_size> seconds. Orbital elements are computed in one go by
+    compute_ephem_batch(). The results are assembled into a list of tuples
     in the same format as returned by read_findorb_ephem()
     Returns [[ DATE, RA, Dec, Mag, Motion, P.A, Alt, MoonPhase, MoonSep, MoonAlt, Score, HA ]]
     """
@@ -600,17 +1186,19 @@ def call_compute_ephem(elements, dark_start, dark_end, site_code, ephem_step_siz
         step_size_secs = ephem_step_size
     ephem_time = round_datetime(dark_start, step_size_secs / 60, False)
 
-    full_emp = []
+    ephem_times = []
     while ephem_time < dark_end:
-        if 'epochofel' in elements:
-            emp_line = compute_ephem(ephem_time, elements, site_code, dbg=False, perturb=perturb, display=False)
-        elif 'ra' in elements and 'dec' in elements:
-            emp_line = compute_sidereal_ephem(ephem_time, elements, site_code)
-        else:
-            break
-        full_emp.append(emp_line)
+        ephem_times.append(ephem_time)
         ephem_time = ephem_time + timedelta(seconds=step_size_secs)
 
+    full_emp = []
+    if 'epochofel' in elements:
+        emp_batch = compute_ephem_batch(ephem_times, elements, site_code, perturb=perturb)
+        full_emp = ephem_batch_to_list(emp_batch)
+    elif 'ra' in elements and 'dec' in elements:
+        for ephem_time in ephem_times:
+            full_emp.append(compute_sidereal_ephem(ephem_time, elements, site_code))
+
     # Get subset of ephemeris when it's dark and object is up
     visible_emp = dark_and_object_up(full_emp, dark_start, dark_end, slot_length, alt_limit)
     emp = []
@@ -620,6 +1208,31 @@ def call_compute_ephem(elements, dark_start, dark_end, site_code, ephem_step_siz
     return emp
 
 
+def cached_compute_ephem(d, orbelems, sitecode, perturb=True, bucket_size=None):
+    """Cached version of compute_ephem(). The ephemeris is looked up in (or
+    stored to) the ephemeris cache keyed on the Body id and elements in
+    <orbelems>, the <sitecode> and time <d>. If [bucket_size] (in seconds) is
+    given, <d> is first truncated to a multiple of this so that nearby times
+    share the same (slightly earlier) ephemeris line."""
+
+    d = time_bucket(d, bucket_size)
+    key = (orbelems.get('id', None), elements_hash(orbelems), str(sitecode), 'ephem', d, perturb)
+
+    return ephem_cache.get_or_compute(key, compute_ephem, d, orbelems, sitecode, dbg=False, perturb=perturb, display=False)
+
+
+def cached_call_compute_ephem(elements, dark_start, dark_end, site_code, ephem_step_size, alt_limit=0, perturb=True):
+    """Cached version of call_compute_ephem(), keyed on the Body id and
+    elements in <elements>, the <site_code> and the time grid defined by
+    <dark_start>, <dark_end> and <ephem_step_size>."""
+
+    key = (elements.get('id', None), elements_hash(elements), str(site_code), 'call_ephem',
+           dark_start, dark_end, str(ephem_step_size), alt_limit, perturb)
+
+    return ephem_cache.get_or_compute(key, call_compute_ephem, elements, dark_start, dark_end, site_code,
+                                      ephem_step_size, alt_limit=alt_limit, perturb=perturb)
+
+
 def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_limit=0, include_moon=False):
     """Calls JPL HORIZONS for the specified <obj_name> producing an ephemeris
     from <start> to <end> for the MPC site code <site_code> with step size
@@ -657,12 +1270,6 @@ def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_li
     to the table.
     """
 
-    # Define quantities we want back from HORIZONS
-    horizons_quantities = '1,3,4,9,19,20,23,24,38,42,33'
-
-    eph = Horizons(id=obj_name, id_type='smallbody', epochs={'start' : start.strftime("%Y-%m-%d %H:%M"),
-            'stop' : end.strftime("%Y-%m-%d %H:%M"), 'step' : ephem_step_size}, location=site_code)
-
     airmass_limit = 99
     if alt_limit > 0:
         airmass_limit = S.sla_airmas(radians(90.0 - alt_limit))
@@ -670,15 +1277,39 @@ def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_li
     ha_lowlimit, ha_hilimit, alt_limit = get_mountlimits(site_code)
     ha_limit = max(abs(ha_lowlimit), abs(ha_hilimit)) / 15.0
     should_skip_daylight = True
-    ephem = None
     if len(site_code) >= 1 and site_code[0] == '-':
         # Radar site
         should_skip_daylight = False
+
+    # Raw tables are cached (see astrometrics.horizons_cache) so repeated or
+    # contained requests don't go back to JPL
+    ephem = horizons_cache.get_or_fetch(fetch_horizons_ephem, obj_name, start, end, site_code, ephem_step_size,
+                                        skip_daylight=should_skip_daylight, airmass_lessthan=airmass_limit,
+                                        max_hour_angle=ha_limit)
+    if ephem is not None:
+        ephem = convert_horizons_table(ephem, include_moon)
+    return ephem
+
+
+def fetch_horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', skip_daylight=True,
+                         airmass_lessthan=99, max_hour_angle=0):
+    """Queries JPL HORIZONS for the ephemeris of <obj_name> from <start> to
+    <end> for the MPC site code <site_code> with step size [ephem_step_size],
+    filtered by [skip_daylight], [airmass_lessthan] and [max_hour_angle].
+    Returns the unmodified AstroPy Table from astroquery or None if the query
+    failed. See horizons_ephem() for the normal (cached) interface."""
+
+    # Define quantities we want back from HORIZONS
+    horizons_quantities = '1,3,4,9,19,20,23,24,38,42,33'
+
+    eph = Horizons(id=obj_name, id_type='smallbody', epochs={'start' : start.strftime("%Y-%m-%d %H:%M"),
+            'stop' : end.strftime("%Y-%m-%d %H:%M"), 'step' : ephem_step_size}, location=site_code)
+
+    ephem = None
     try:
         ephem = eph.ephemerides(quantities=horizons_quantities,
-            skip_daylight=should_skip_daylight, airmass_lessthan=airmass_limit,
-            max_hour_angle=ha_limit)
-        ephem = convert_horizons_table(ephem, include_moon)
+            skip_daylight=skip_daylight, airmass_lessthan=airmass_lessthan,
+            max_hour_angle=max_hour_angle)
     except ConnectionError as e:
         logger.error("Unable to connect to HORIZONS")
     except requests.exceptions.ConnectionError as e:
@@ -701,9 +1332,8 @@ def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_li
                         eph = Horizons(id=horizons_id, id_type='id', epochs={'start' : start.strftime("%Y-%m-%d %H:%M:%S"),
                             'stop' : end.strftime("%Y-%m-%d %H:%M:%S"), 'step' : ephem_step_size}, location=site_code)
                         ephem = eph.ephemerides(quantities=horizons_quantities,
-                            skip_daylight=should_skip_daylight, airmass_lessthan=airmass_limit,
-                            max_hour_angle=ha_limit)
-                        ephem = convert_horizons_table(ephem, include_moon)
+                            skip_daylight=skip_daylight, airmass_lessthan=airmass_lessthan,
+                            max_hour_angle=max_hour_angle)
                     except ValueError as e:
                         logger.warning("Error querying HORIZONS. Error message: {}".format(e))
                 else:
@@ -713,6 +1343,90 @@ def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_li
     return ephem
 
 
+# Maximum number of discrete epochs to send to HORIZONS in one query (they
+# are sent as a list in the URL)
+HORIZONS_MAX_EPOCHS = 50
+
+
+def fetch_horizons_epochs(obj_name, start, end, site_code, ephem_step_size='epochs', epochs=()):
+    """Queries JPL HORIZONS for the ephemeris of <obj_name> for the MPC site
+    code <site_code> at each of the discrete JDs (UTC) in <epochs> (<start>,
+    <end> and <ephem_step_size> are only used to identify the request in the
+    cache).
+    Returns the unmodified AstroPy Table from astroquery or None if the query
+    failed. See horizons_positions() for the normal (cached) interface."""
+
+    epochs = list(epochs)
+    ephem = None
+    try:
+        eph = Horizons(id=obj_name, id_type='smallbody', epochs=epochs, location=site_code)
+        ephem = eph.ephemerides()
+    except (ConnectionError, requests.exceptions.ConnectionError):
+        logger.error("Unable to connect to HORIZONS")
+    except timeout as sock_e:
+        logger.warning(f"HORIZONS retrieval failed with socket Error {sock_e.errno}: {sock_e.strerror}")
+    except ValueError as e:
+        horizons_id = None
+        if e.args and len(e.args) > 0 and 'No ephemeris meets criteria.' not in e.args[0]:
+            horizons_id = determine_horizons_id(e.args[0].split('\n'), obj_name)
+        if horizons_id:
+            try:
+                eph = Horizons(id=horizons_id, id_type='id', epochs=epochs, location=site_code)
+                ephem = eph.ephemerides()
+            except ValueError as e:
+                logger.warning("Error querying HORIZONS. Error message: {}".format(e))
+        else:
+            logger.warning("Error querying HORIZONS. Error message: {}".format(e))
+    return ephem
+
+
+def horizons_positions(obj_name, dates, site_code, chunk_size=HORIZONS_MAX_EPOCHS):
+    """Calls JPL HORIZONS for the positions of <obj_name> from the MPC site
+    code <site_code> at each of the datetimes in <dates>. The epochs are sent
+    as lists of up to [chunk_size] per query (rather than one query per
+    epoch) and each chunk is cached (see astrometrics.horizons_cache).
+    Returns NumPy arrays of RA, Dec (radians) and V magnitude (or T-mag for
+    comets), which are NaN for any dates that couldn't be retrieved."""
+
+    dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[us]'))
+    ra = np.full(len(dates), np.nan)
+    dec = np.full(len(dates), np.nan)
+    mag = np.full(len(dates), np.nan)
+    if len(dates) == 0:
+        return ra, dec, mag
+
+    # Query each distinct time only once, in time order
+    unique_dates, date_rows = np.unique(dates, return_inverse=True)
+    jds = Time(unique_dates.astype(datetime), scale='utc').jd
+    unique_ra = np.full(len(unique_dates), np.nan)
+    unique_dec = np.full(len(unique_dates), np.nan)
+    unique_mag = np.full(len(unique_dates), np.nan)
+    for start in range(0, len(unique_dates), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        chunk_dates = unique_dates[chunk].astype(datetime)
+        ephem = horizons_cache.get_or_fetch(fetch_horizons_epochs, obj_name, chunk_dates[0], chunk_dates[-1],
+                                            site_code, 'epochs', epochs=tuple(jds[chunk]))
+        if ephem is None or len(ephem) == 0:
+            logger.warning("No HORIZONS positions for %s from %s between %s and %s" % (obj_name, site_code,
+                                                                                     chunk_dates[0], chunk_dates[-1]))
+            continue
+        mag_column = 'V' if 'V' in ephem.colnames else 'Tmag'
+        ephem_jds = np.asarray(ephem['datetime_jd'])
+        ephem_mags = np.ma.filled(np.ma.asarray(ephem[mag_column], dtype=float), np.nan)
+        # Match the returned rows back up with the requested epochs (to within a second)
+        for i, jd in enumerate(jds[chunk]):
+            matches = np.flatnonzero(np.abs(ephem_jds - jd) < 1.0/86400.0)
+            if len(matches) > 0:
+                unique_ra[start+i] = radians(ephem['RA'][matches[0]])
+                unique_dec[start+i] = radians(ephem['DEC'][matches[0]])
+                unique_mag[start+i] = ephem_mags[matches[0]]
+    ra = unique_ra[date_rows]
+    dec = unique_dec[date_rows]
+    mag = unique_mag[date_rows]
+
+    return ra, dec, mag
+
+
 def convert_horizons_table(ephem, include_moon=False):
     """Modifies a passed table <ephem> from the `astroquery.jplhorizons.ephemerides()
     to add a 'datetime' column, rate columns and adss moon phase and separation
@@ -918,14 +1632,32 @@ def determine_darkness_times(site_code, utc_date=datetime.utcnow(), sun_zd=105,
     altitude (intermediate between nautical (-12) and astronomical (-18)
     darkness, which has been chosen as more appropriate for fainter asteroids.
     This can be overridden by passing a different value for [sun_zd].
+    The results only depend on the site and the date and are memoized (see
+    also darkness_times_table() to precompute them for a whole semester).
     """
-    # Check if current date is greater than the end of the last night's astro darkness
-    # Add 1 hour to this to give a bit of slack at the end and not suddenly jump
-    # into the next day
     try:
         utc_date = utc_date.replace(hour=0, minute=0, second=0, microsecond=0)
     except TypeError:
         utc_date = datetime.combine(utc_date, time())
+
+    dark_times = _darkness_table.get((str(site_code), utc_date, sun_zd))
+    if dark_times is None:
+        dark_times = _darkness_times(site_code, utc_date, sun_zd)
+    return dark_times
+
+
+# Darkness times loaded by darkness_times_table(), keyed on (site code, date, sun_zd)
+_darkness_table = {}
+
+
+@lru_cache(maxsize=4096)
+def _darkness_times(site_code, utc_date, sun_zd):
+    """Memoized worker for determine_darkness_times(). <utc_date> must be a
+    datetime at 00:00 UTC"""
+
+    # Check if current date is greater than the end of the last night's astro darkness
+    # Add 1 hour to this to give a bit of slack at the end and not suddenly jump
+    # into the next day
     (start_of_darkness, end_of_darkness) = astro_darkness(site_code, utc_date, sun_zd=sun_zd)
     end_of_darkness = end_of_darkness+timedelta(hours=1)
     logger.debug("Start,End of darkness=%s %s", start_of_darkness, end_of_darkness)
@@ -945,6 +1677,40 @@ def determine_darkness_times(site_code, utc_date=datetime.utcnow(), sun_zd=105,
     return dark_start, dark_end
 
 
+# Darkness times and nightly summaries don't change so are kept for (at least) a semester
+LONG_TERM_CACHE_TIMEOUT = 200 * 86400
+
+
+def darkness_times_table(site_code, start_date=None, end_date=None, sun_zd=105):
+    """Precomputes the darkness times at <site_code> for every night from
+    [start_date] to [end_date] (defaulting to the semester containing
+    [start_date], which itself defaults to UTC now).
+    Returns a dictionary of (dark_start, dark_end) tuples keyed by the
+    datetime of 00:00 UTC of each date. Subsequent calls to
+    determine_darkness_times() for these dates are then lookups.
+    The times are also kept in the ephemeris cache, so if that has a backing
+    tier (see EphemerisCache.use_backing_dir()), each night is only computed
+    once however many runs ask for it."""
+
+    start_date = start_date or datetime.utcnow()
+    if end_date is None:
+        start_date, end_date = get_semester_dates(start_date)
+    utc_date = datetime(start_date.year, start_date.month, start_date.day)
+
+    darkness_times = {}
+    while utc_date <= end_date:
+        key = (None, 'darkness', str(site_code), utc_date, sun_zd)
+        dark_times = ephem_cache.get(key)
+        if dark_times is None:
+            dark_times = determine_darkness_times(site_code, utc_date, sun_zd)
+            ephem_cache.set(key, dark_times, timeout=LONG_TERM_CACHE_TIMEOUT)
+        _darkness_table[(str(site_code), utc_date, sun_zd)] = tuple(dark_times)
+        darkness_times[utc_date] = tuple(dark_times)
+        utc_date += timedelta(days=1)
+
+    return darkness_times
+
+
 def astro_darkness(sitecode, utc_date, round_ad=True, sun_zd=105):
 
     accurate = True
@@ -1398,6 +2164,17 @@ def compute_score(obj_alt, moon_alt, moon_sep, alt_limit=25.0):
     return score
 
 
+def radec_to_unit_vectors(ra, dec):
+    """Converts arrays of <ra>, <dec> (in degrees) into an (N, 3) array of
+    Cartesian unit vectors"""
+
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    cos_dec = np.cos(dec)
+
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
 def arcmins_to_radians(arcmin):
     return (arcmin/60.0)*(pi/180.0)
 
@@ -2114,9 +2891,39 @@ def determine_sites_to_schedule(sched_date=datetime.utcnow()):
     return sites
 
 
+def nightly_visibility(site_code, orbelems, utc_date, ephem_step_size='5 m', alt_limit=30):
+    """Summarizes the visibility of the object described by <orbelems> from
+    <site_code> on the night of <utc_date>. The summary is memoized in the
+    ephemeris cache for this revision of the Body's elements so only new
+    nights (or new orbits) need to be computed.
+    Returns a dictionary with 'dark_and_up_time' (hours), 'first_emp' (the
+    first formatted ephemeris line when the target is up and it's dark),
+    'last_moon_alt' (Moon altitude at the end of this period) and 'max_alt',
+    or an empty dictionary if the target is never up when it's dark."""
+
+    dark_start, dark_end = determine_darkness_times(site_code, utc_date)
+    key = (orbelems.get('id', None), elements_hash(orbelems), str(site_code), 'night',
+           dark_start, dark_end, str(ephem_step_size), alt_limit)
+    summary = ephem_cache.get(key)
+    if summary is None:
+        emp = call_compute_ephem(orbelems, dark_start, dark_end, site_code, ephem_step_size, alt_limit=alt_limit)
+        dark_and_up_time, emp_dark_and_up, set_time = compute_dark_and_up_time(emp)
+        summary = {}
+        if emp_dark_and_up != []:
+            summary = {'dark_and_up_time': dark_and_up_time,
+                       'first_emp': emp_dark_and_up[0],
+                       'last_moon_alt': emp_dark_and_up[-1][9],
+                       'max_alt': compute_max_altitude(emp_dark_and_up)
+                       }
+        ephem_cache.set(key, summary, timeout=LONG_TERM_CACHE_TIMEOUT)
+
+    return summary
+
+
 def monitor_long_term_scheduling(site_code, orbelems, utc_date=datetime.utcnow(), date_range=30, dark_and_up_time_limit=3.0, slot_length=20, ephem_step_size='5 m'):
     """Determine when it's best to observe Yarkovsky & radar/ARM
-    targets in the future"""
+    targets in the future. The nightly visibility is memoized per Body
+    revision by nightly_visibility()."""
 
     visible_dates = []
     emp_visible_dates = []
@@ -2125,35 +2932,34 @@ def monitor_long_term_scheduling(site_code, orbelems, utc_date=datetime.utcnow()
     delta_date = 0
     while delta_date <= date_range:
 
-        dark_start, dark_end = determine_darkness_times(site_code, utc_date)
-        emp = call_compute_ephem(orbelems, dark_start, dark_end, site_code, ephem_step_size, alt_limit=30)
+        night = nightly_visibility(site_code, orbelems, utc_date, ephem_step_size, alt_limit=30)
 
-        dark_and_up_time, emp_dark_and_up, set_time = compute_dark_and_up_time(emp)
-
-        if emp_dark_and_up != []:
+        if night:
+            first_emp = night['first_emp']
+            dark_and_up_time = night['dark_and_up_time']
 
-            obj_mag = float(emp_dark_and_up[0][3])
+            obj_mag = float(first_emp[3])
 
-            moon_alt_start = int(emp_dark_and_up[0][9])
-            moon_alt_end = int(emp_dark_and_up[-1][9])
+            moon_alt_start = int(first_emp[9])
+            moon_alt_end = int(night['last_moon_alt'])
             moon_up = False
             if moon_alt_start >= 30 or moon_alt_end >= 30:
                 moon_up = True
 
-            moon_phase = float(emp_dark_and_up[0][7])
+            moon_phase = float(first_emp[7])
 
-            score = int(emp_dark_and_up[0][10])
+            score = int(first_emp[10])
 
-            max_alt = compute_max_altitude(emp_dark_and_up)
+            max_alt = night['max_alt']
 
             if dark_and_up_time >= dark_and_up_time_limit and obj_mag <= 21.5 and moon_up is True and moon_phase <= 0.85 and score > 0:
-                visible_dates.append(emp_dark_and_up[0][0][0:10])
-                emp_visible_dates.append(emp_dark_and_up[0])
+                visible_dates.append(first_emp[0][0:10])
+                emp_visible_dates.append(first_emp)
                 dark_and_up_time_all.append(dark_and_up_time)
                 max_alt_all.append(max_alt)
             elif dark_and_up_time >= dark_and_up_time_limit and obj_mag <= 21.5 and moon_up is False:
-                visible_dates.append(emp_dark_and_up[0][0][0:10])
-                emp_visible_dates.append(emp_dark_and_up[0])
+                visible_dates.append(first_emp[0][0:10])
+                emp_visible_dates.append(first_emp)
                 dark_and_up_time_all.append(dark_and_up_time)
                 max_alt_all.append(max_alt)
 
@@ -2273,7 +3079,7 @@ def get_visibility(ra, dec, date, site_code, step_size='30 m', alt_limit=30, qui
             else:
                 vis_time = 0
         else:
-            emp = call_compute_ephem(body_elements, dark_start, dark_end, site, step_size, perturb=False)
+            emp = cached_call_compute_ephem(body_elements, dark_start, dark_end, site, step_size, perturb=False)
             emp_dark_and_up = dark_and_object_up(emp, dark_start, dark_end, 0, alt_limit=alt_limit)
             vis_time, emp_dark_and_up, set_time = compute_dark_and_up_time(emp_dark_and_up, step_size)
             if emp_dark_and_up:
@@ -0,0 +1,239 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2014-2019 LCO
+
+horizons_cache.py -- Local cache of JPL HORIZONS ephemeris tables.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+import re
+import gzip
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from threading import RLock
+
+from astropy.table import Table
+from django.conf import settings
+
+from astrometrics.time_subs import datetime2mjd_utc
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FORMAT = '%Y%m%dT%H%M'
+SEGMENT_SUFFIX = '.ecsv.gz'
+STEP_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+
+def step_seconds(ephem_step_size):
+    """Returns the number of seconds in a HORIZONS step size string e.g. '5m',
+    '1h' or None if it's not a fixed time step (e.g. a number of intervals)"""
+
+    match = re.match(r'^\s*(\d+)\s*([mhd])\w*\s*$', str(ephem_step_size))
+    if match is None:
+        return None
+    return int(match.group(1)) * STEP_UNITS[match.group(2)]
+
+
+def truncate_to_minute(d):
+    """HORIZONS is queried to the minute so truncate <d> to match"""
+
+    return d.replace(second=0, microsecond=0)
+
+
+class HorizonsCache(object):
+    """Cache of (raw) ephemeris tables returned by HORIZONS, keyed on the
+    object, site, step size and query options, with an in-process LRU tier
+    of <maxsize> tables and an optional on-disk tier in <cache_dir>. Each
+    cached time range is stored as a compressed ECSV table under a directory
+    named after the hash of the key, and a request for a time range within a
+    cached range (on the same time grid) is sliced from it locally.
+
+    Tables are fetched with <fetcher> (when set), which allows tests and
+    offline use to replace the network. If <offline> is True, the fetcher is
+    never called and cached entries don't expire; otherwise entries older than
+    <timeout> seconds are ignored."""
+
+    def __init__(self, cache_dir=None, fetcher=None, timeout=86400, offline=False, maxsize=32):
+        self.cache_dir = cache_dir
+        self.fetcher = fetcher
+        self.timeout = timeout
+        self.offline = offline
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache size and hit/miss counts"""
+
+        return {'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'fetches': self.fetches
+                }
+
+    @staticmethod
+    def series_key(obj_name, site_code, ephem_step_size, **options):
+        """Returns the hash identifying the ephemerides for <obj_name> from
+        <site_code> with step size <ephem_step_size> and query <options>"""
+
+        key_str = '|'.join([str(obj_name), str(site_code), str(ephem_step_size)] +
+                           ['%s=%s' % (k, options[k]) for k in sorted(options)])
+        return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    def _expired(self, stored_time):
+        return not self.offline and self.timeout is not None and time.time() - stored_time > self.timeout
+
+    def _segments(self, series):
+        """Returns a list of (start, end) of the stored ranges of <series>"""
+
+        segments = set()
+        with self._lock:
+            for key, (stored_time, table) in list(self._entries.items()):
+                if key[0] == series:
+                    if self._expired(stored_time):
+                        del self._entries[key]
+                    else:
+                        segments.add(key[1:])
+        if self.cache_dir:
+            try:
+                filenames = os.listdir(os.path.join(self.cache_dir, series))
+            except OSError:
+                filenames = []
+            for filename in filenames:
+                if not filename.endswith(SEGMENT_SUFFIX):
+                    continue
+                try:
+                    start, end = filename[:-len(SEGMENT_SUFFIX)].split('_')
+                    segment = (datetime.strptime(start, SEGMENT_FORMAT), datetime.strptime(end, SEGMENT_FORMAT))
+                except ValueError:
+                    continue
+                filepath = os.path.join(self.cache_dir, series, filename)
+                if not self._expired(os.path.getmtime(filepath)):
+                    segments.add(segment)
+        return sorted(segments)
+
+    def _segment_path(self, series, start, end):
+        filename = '%s_%s%s' % (start.strftime(SEGMENT_FORMAT), end.strftime(SEGMENT_FORMAT), SEGMENT_SUFFIX)
+        return os.path.join(self.cache_dir, series, filename)
+
+    def _store(self, key, table, stored_time=None):
+        with self._lock:
+            self._entries[key] = (stored_time or time.time(), table)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _load(self, series, start, end):
+        key = (series, start, end)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[1]
+        filepath = self._segment_path(series, start, end)
+        try:
+            with gzip.open(filepath, 'rt') as fh:
+                table = Table.read(fh.read(), format='ascii.ecsv')
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read cached HORIZONS ephemeris %s: %s" % (filepath, e))
+            return None
+        self._store(key, table, os.path.getmtime(filepath))
+        return table
+
+    def get(self, obj_name, start, end, site_code, ephem_step_size, **options):
+        """Returns a copy of the cached table for <obj_name> between <start>
+        and <end> (sliced from a larger cached range if needed) or None"""
+
+        series = self.series_key(obj_name, site_code, ephem_step_size, **options)
+        start = truncate_to_minute(start)
+        end = truncate_to_minute(end)
+        step = step_seconds(ephem_step_size)
+        for seg_start, seg_end in self._segments(series):
+            if (seg_start, seg_end) == (start, end):
+                table = self._load(series, seg_start, seg_end)
+                if table is not None:
+                    self.hits += 1
+                    return table.copy()
+            elif step and seg_start <= start and end <= seg_end \
+                    and (start - seg_start).total_seconds() % step == 0:
+                table = self._load(series, seg_start, seg_end)
+                if table is not None:
+                    self.hits += 1
+                    # Pad by a second to allow for rounding of the JDs
+                    start_jd = datetime2mjd_utc(start) + 2400000.5 - 1.0/86400.0
+                    end_jd = datetime2mjd_utc(end) + 2400000.5 + 1.0/86400.0
+                    mask = (table['datetime_jd'] >= start_jd) & (table['datetime_jd'] <= end_jd)
+                    return table[mask]
+        self.misses += 1
+        return None
+
+    def put(self, table, obj_name, start, end, site_code, ephem_step_size, **options):
+        """Stores <table> as the ephemeris for <obj_name> between <start> and
+        <end> in both tiers"""
+
+        series = self.series_key(obj_name, site_code, ephem_step_size, **options)
+        start = truncate_to_minute(start)
+        end = truncate_to_minute(end)
+        table = table.copy()
+        # Metadata from the query isn't needed and may not serialize
+        table.meta.clear()
+        self._store((series, start, end), table)
+        if self.cache_dir:
+            filepath = self._segment_path(series, start, end)
+            tmp_filepath = filepath + '.%d.tmp' % os.getpid()
+            try:
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                with gzip.open(tmp_filepath, 'wt') as fh:
+                    table.write(fh, format='ascii.ecsv')
+                os.replace(tmp_filepath, filepath)
+            except (OSError, ValueError) as e:
+                logger.warning("Could not write cached HORIZONS ephemeris %s: %s" % (filepath, e))
+
+    def get_or_fetch(self, fetcher, obj_name, start, end, site_code, ephem_step_size, **options):
+        """Returns the cached table for the request or calls
+        fetcher(obj_name, start, end, site_code, ephem_step_size, **options)
+        (or self.fetcher if set) and caches the result if it's not None"""
+
+        table = self.get(obj_name, start, end, site_code, ephem_step_size, **options)
+        if table is not None:
+            return table
+        if self.offline:
+            logger.warning("No cached HORIZONS ephemeris for %s at %s and offline" % (obj_name, site_code))
+            return None
+        fetcher = self.fetcher or fetcher
+        self.fetches += 1
+        table = fetcher(obj_name, start, end, site_code, ephem_step_size, **options)
+        if table is not None and len(table) > 0:
+            self.put(table, obj_name, start, end, site_code, ephem_step_size, **options)
+        return table
+
+    def clear(self):
+        """Empties the in-process tier"""
+
+        with self._lock:
+            self._entries.clear()
+
+
+horizons_cache = HorizonsCache(cache_dir=getattr(settings, 'HORIZONS_CACHE_DIR', None),
+                               timeout=getattr(settings, 'HORIZONS_CACHE_TIMEOUT', 86400),
+                               offline=getattr(settings, 'HORIZONS_CACHE_OFFLINE', False))
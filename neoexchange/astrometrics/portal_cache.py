@@ -0,0 +1,130 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2014-2019 LCO
+
+portal_cache.py -- Short-lived cache of LCO observation portal lookups.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import time
+import logging
+from threading import Lock, Event
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def is_not_none(value):
+    return value is not None
+
+
+class PortalCache(object):
+    """Cache of responses from the observation portal (e.g. the instruments
+    and telescope states endpoints) which change rarely within a scheduling
+    run. Entries are keyed on a tuple whose first item is the name of the
+    lookup (e.g. 'instruments') and expire after <timeout> seconds.
+    Concurrent requests for the same key are coalesced so only one of them
+    goes to the portal and the rest wait for its result.
+
+    Lookups are made with the fetcher passed to get_or_fetch() unless
+    <fetchers> has an entry for the name of the lookup, which allows tests
+    and offline use to replace the portal."""
+
+    def __init__(self, timeout=600, fetchers=None):
+        self.timeout = timeout
+        self.fetchers = fetchers or {}
+        self._entries = {}
+        self._in_flight = {}
+        self._lock = Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetches = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache size and hit/miss counts"""
+
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'fetches': self.fetches
+                }
+
+    def _expired(self, stored_time):
+        return self.timeout is not None and time.time() - stored_time > self.timeout
+
+    def get(self, key):
+        """Returns the cached value for <key> or None"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self.hits += 1
+                return entry[1]
+        return None
+
+    def get_or_fetch(self, key, fetcher, *args, cache_if=is_not_none, **kwargs):
+        """Returns the cached value for <key> or calls fetcher(*args, **kwargs)
+        (or the stand-in in self.fetchers) and caches the result if
+        cache_if(result) is True (by default, if it's not None). If another
+        thread is already fetching <key>, this waits for its result instead.
+        The cached value is shared so must not be modified by the caller."""
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and not self._expired(entry[0]):
+                    self.hits += 1
+                    return entry[1]
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    in_flight = self._in_flight[key] = Event()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            # Wait for the other request then go round again to pick up its
+            # result (or make the request ourselves if it failed)
+            in_flight.wait()
+
+        try:
+            fetcher = self.fetchers.get(key[0], fetcher)
+            self.fetches += 1
+            value = fetcher(*args, **kwargs)
+            if cache_if(value):
+                with self._lock:
+                    self._entries[key] = (time.time(), value)
+            else:
+                logger.debug("Not caching %s response for %s" % (key[0], key[1:]))
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.set()
+        return value
+
+    def invalidate(self, name=None):
+        """Drops the cached responses for the lookup <name> (or all)"""
+
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if name is None or key[0] == name:
+                    del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+
+
+portal_cache = PortalCache(timeout=getattr(settings, 'PORTAL_CACHE_TIMEOUT', 600))
@@ -52,6 +52,7 @@ from astrometrics.time_subs import parse_neocp_decimal_date, jd_utc2datetime, da
 from astrometrics.ephem_subs import build_filter_blocks, MPC_site_code_to_domes, compute_ephem, perturb_elements,\
     LCOGT_site_codes, get_sitecam_params
 from core.urlsubs import get_telescope_states
+from astrometrics.portal_cache import portal_cache
 
 logger = logging.getLogger(__name__)
 
@@ -1574,7 +1575,9 @@ def get_site_status(site_code):
     site_codes = cfg.valid_site_codes
     lco_codes = {mpc_code: lco_code.lower().replace('-', '.') for lco_code, mpc_code in site_codes.items()}
 
-    response = get_telescope_states()
+    # Telescope states are shared by all sites so only fetched once per
+    # cache period (empty responses from failed requests aren't kept)
+    response = portal_cache.get_or_fetch(('telescope_states', ), get_telescope_states, cache_if=len)
 
     if len(response) > 0:
         key = lco_codes.get(site_code, None)
@@ -2478,11 +2481,11 @@ def fetch_filter_list(site, spec):
         telescope=telid.lower(),
         instrument_type=camid
     )
-    response = requests.get(request_url, timeout=20, verify=True)
-
-    resp = {}
-    if response.status_code in [200, 201]:
-        resp = response.json()
+    # Many targets share a site and instrument when scheduling so the
+    # responses are cached (see fetch_instruments())
+    resp = portal_cache.get_or_fetch(('instruments', request_url), fetch_instruments, request_url)
+    if resp is None:
+        resp = {}
 
     fetch_error = ''
     data_out = []
@@ -2499,6 +2502,21 @@ def fetch_filter_list(site, spec):
     return data_out, fetch_error
 
 
+def fetch_instruments(request_url):
+    """Fetches the instruments from the observation portal endpoint at
+    <request_url>. Returns the decoded JSON response or None if the request
+    failed (so it isn't cached)"""
+
+    response = requests.get(request_url, timeout=20, verify=True)
+
+    resp = None
+    if response.status_code in [200, 201]:
+        resp = response.json()
+    else:
+        logger.warning("Instruments request failed with status %d" % response.status_code)
+    return resp
+
+
 def parse_filter_file(resp, spec):
     """Parses the returned json dictionary and pull out the list of approved filters
     """
@@ -0,0 +1,296 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from mock import Mock, patch
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.forms.models import model_to_dict
+
+from astrometrics.ephem_cache import EphemerisCache, ephem_cache, elements_hash, time_bucket
+from astrometrics.ephem_subs import cached_call_compute_ephem, cached_compute_ephem, call_compute_ephem, \
+    compute_ephem, darkness_times_table
+from core.models import Body
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                 'ephem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                           'LOCATION': 'test_ephem_cache'}
+                 }
+
+
+class TestTimeBucket(SimpleTestCase):
+
+    def test_no_bucket(self):
+        d = datetime(2015, 4, 21, 3, 7, 42)
+
+        self.assertEqual(d, time_bucket(d, None))
+
+    def test_5min_bucket(self):
+        expected_d = datetime(2015, 4, 21, 3, 5, 0)
+
+        d = time_bucket(datetime(2015, 4, 21, 3, 7, 42), 300)
+
+        self.assertEqual(expected_d, d)
+
+    def test_on_boundary(self):
+        expected_d = datetime(2015, 4, 21, 3, 0, 0)
+
+        d = time_bucket(expected_d, 3600)
+
+        self.assertEqual(expected_d, d)
+
+
+class TestElementsHash(SimpleTestCase):
+
+    def setUp(self):
+        self.elements = {'id': 1,
+                         'provisional_name': 'N999r0q',
+                         'epochofel': datetime(2015, 3, 19, 0, 0, 0),
+                         'meananom': 325.2636,
+                         'eccentricity': 0.1896865,
+                         }
+
+    def test_unrelated_field(self):
+        expected_hash = elements_hash(self.elements)
+
+        self.elements['provisional_name'] = 'N999foo'
+
+        self.assertEqual(expected_hash, elements_hash(self.elements))
+
+    def test_new_elements(self):
+        old_hash = elements_hash(self.elements)
+
+        self.elements['epochofel'] = datetime(2015, 4, 19, 0, 0, 0)
+        self.elements['meananom'] = 354.1
+
+        self.assertNotEqual(old_hash, elements_hash(self.elements))
+
+
+class TestEphemerisCache(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = EphemerisCache(maxsize=3)
+
+    def test_miss(self):
+        expected_stats = {'size': 0, 'maxsize': 3, 'hits': 0, 'backing_hits': 0, 'misses': 1, 'hit_rate': 0.0}
+
+        self.assertEqual(None, self.cache.get((1, 'abc', 'V37')))
+        self.assertEqual(expected_stats, self.cache.stats())
+
+    def test_hit(self):
+        expected_stats = {'size': 1, 'maxsize': 3, 'hits': 1, 'backing_hits': 0, 'misses': 0, 'hit_rate': 1.0}
+        self.cache.set((1, 'abc', 'V37'), [1, 2, 3])
+
+        self.assertEqual([1, 2, 3], self.cache.get((1, 'abc', 'V37')))
+        self.assertEqual(expected_stats, self.cache.stats())
+
+    def test_returns_copy(self):
+        self.cache.set((1, 'abc', 'V37'), [[1, 2], [3, 4]])
+
+        value = self.cache.get((1, 'abc', 'V37'))
+        value[0].append(42)
+
+        self.assertEqual([[1, 2], [3, 4]], self.cache.get((1, 'abc', 'V37')))
+
+    def test_lru_eviction(self):
+        for i in range(3):
+            self.cache.set((i, 'abc', 'V37'), i)
+        # Touch the oldest entry so the next one is evicted instead
+        self.cache.get((0, 'abc', 'V37'))
+        self.cache.set((3, 'abc', 'V37'), 3)
+
+        self.assertEqual(3, self.cache.stats()['size'])
+        self.assertEqual(0, self.cache.get((0, 'abc', 'V37')))
+        self.assertEqual(None, self.cache.get((1, 'abc', 'V37')))
+        self.assertEqual(3, self.cache.get((3, 'abc', 'V37')))
+
+    def test_invalidate(self):
+        self.cache.set((1, 'abc', 'V37'), 1)
+        self.cache.set((1, 'abc', 'K91'), 2)
+        self.cache.set((2, 'def', 'V37'), 3)
+
+        self.cache.invalidate(1)
+
+        self.assertEqual(1, self.cache.stats()['size'])
+        self.assertEqual(None, self.cache.get((1, 'abc', 'V37')))
+        self.assertEqual(3, self.cache.get((2, 'def', 'V37')))
+
+    def test_get_or_compute(self):
+        func = Mock(return_value={'ra': 1.0})
+
+        value1 = self.cache.get_or_compute((1, 'abc', 'V37'), func, 42, foo='bar')
+        value2 = self.cache.get_or_compute((1, 'abc', 'V37'), func, 42, foo='bar')
+
+        self.assertEqual({'ra': 1.0}, value1)
+        self.assertEqual(value1, value2)
+        func.assert_called_once_with(42, foo='bar')
+        self.assertEqual(1, self.cache.stats()['misses'])
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_backing_tier(self):
+        cache = EphemerisCache(maxsize=3, backing_alias='ephem')
+        cache.set((1, 'abc', 'V37'), [1, 2, 3])
+        cache.clear()
+
+        self.assertEqual([1, 2, 3], cache.get((1, 'abc', 'V37')))
+        self.assertEqual(1, cache.stats()['backing_hits'])
+        # Now back in the in-process tier
+        self.assertEqual([1, 2, 3], cache.get((1, 'abc', 'V37')))
+        self.assertEqual(1, cache.stats()['hits'])
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_backing_tier_invalidate(self):
+        cache = EphemerisCache(maxsize=3, backing_alias='ephem')
+        cache.set((1, 'abc', 'V37'), [1, 2, 3])
+
+        cache.invalidate(1)
+
+        self.assertEqual(None, cache.get((1, 'abc', 'V37')))
+        self.assertEqual(0, cache.stats()['backing_hits'])
+
+    def test_backing_dir(self):
+        cache_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        cache = EphemerisCache(maxsize=3)
+        self.assertNotEqual(None, cache.use_backing_dir(cache_dir))
+        cache.set((1, 'abc', 'V37'), [1, 2, 3])
+
+        # A new process (cache) with the same directory sees the entry
+        cache2 = EphemerisCache(maxsize=3)
+        cache2.use_backing_dir(cache_dir)
+
+        self.assertEqual([1, 2, 3], cache2.get((1, 'abc', 'V37')))
+        self.assertEqual(1, cache2.stats()['backing_hits'])
+
+    def test_no_backing_dir(self):
+        cache = EphemerisCache(maxsize=3)
+
+        self.assertEqual(None, cache.use_backing_dir(''))
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_backing_dir_configured(self):
+        cache = EphemerisCache(maxsize=3, backing_alias='ephem')
+
+        self.assertIs(cache.backing, cache.use_backing_dir('/wibble'))
+
+    def test_darkness_times_kept(self):
+        cache_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        start = datetime(2017, 1, 6, 0, 0, 0)
+        cache = EphemerisCache(maxsize=100)
+        cache.use_backing_dir(cache_dir)
+        with patch('astrometrics.ephem_subs.ephem_cache', cache):
+            darkness_times = darkness_times_table('V37', start, start + timedelta(days=2))
+
+        # A later run only reads them back
+        cache2 = EphemerisCache(maxsize=100)
+        cache2.use_backing_dir(cache_dir)
+        with patch('astrometrics.ephem_subs.ephem_cache', cache2), \
+                patch('astrometrics.ephem_subs.determine_darkness_times') as mock_darkness:
+            darkness_times2 = darkness_times_table('V37', start, start + timedelta(days=2))
+
+        mock_darkness.assert_not_called()
+        self.assertEqual(darkness_times, darkness_times2)
+        self.assertEqual(3, cache2.stats()['backing_hits'])
+
+    def test_bad_backing_alias(self):
+        cache = EphemerisCache(maxsize=3, backing_alias='wibble')
+        cache.set((1, 'abc', 'V37'), 1)
+
+        self.assertEqual(1, cache.get((1, 'abc', 'V37')))
+        self.assertEqual(None, cache.backing_alias)
+
+
+class TestCachedEphem(TestCase):
+
+    def setUp(self):
+        params = {'provisional_name': 'N999r0q',
+                  'abs_mag': 21.0,
+                  'slope': 0.15,
+                  'epochofel': datetime(2015, 3, 19, 0, 0, 0),
+                  'meananom': 325.2636,
+                  'argofperih': 85.19251,
+                  'longascnode': 147.81325,
+                  'orbinc': 8.34739,
+                  'eccentricity': 0.1896865,
+                  'meandist': 1.2176312,
+                  'elements_type': 'MPC_MINOR_PLANET',
+                  'origin': 'M',
+                  'active': True,
+                  }
+        self.body = Body.objects.create(**params)
+        self.dark_start = datetime(2015, 4, 21, 3, 0, 0)
+        self.dark_end = datetime(2015, 4, 21, 9, 0, 0)
+        ephem_cache.clear()
+        ephem_cache.reset_stats()
+
+    def test_call_compute_ephem(self):
+        elements = model_to_dict(self.body)
+        expected_emp = call_compute_ephem(elements, self.dark_start, self.dark_end, 'V37', '5 m', perturb=False)
+
+        emp = cached_call_compute_ephem(elements, self.dark_start, self.dark_end, 'V37', '5 m', perturb=False)
+        emp2 = cached_call_compute_ephem(elements, self.dark_start, self.dark_end, 'V37', '5 m', perturb=False)
+
+        self.assertEqual(expected_emp, emp)
+        self.assertEqual(expected_emp, emp2)
+        self.assertEqual(1, ephem_cache.stats()['misses'])
+        self.assertEqual(1, ephem_cache.stats()['hits'])
+
+    def test_different_site(self):
+        elements = model_to_dict(self.body)
+
+        emp = cached_call_compute_ephem(elements, self.dark_start, self.dark_end, 'V37', '5 m', perturb=False)
+        emp2 = cached_call_compute_ephem(elements, self.dark_start, self.dark_end, 'K91', '5 m', perturb=False)
+
+        self.assertNotEqual(emp, emp2)
+        self.assertEqual(2, ephem_cache.stats()['misses'])
+
+    def test_compute_ephem_bucket(self):
+        elements = model_to_dict(self.body)
+        expected_emp_line = compute_ephem(self.dark_start, elements, 'V37', perturb=False)
+
+        emp_line = cached_compute_ephem(self.dark_start + timedelta(minutes=3), elements, 'V37', perturb=False, bucket_size=300)
+        emp_line2 = cached_compute_ephem(self.dark_start + timedelta(minutes=4), elements, 'V37', perturb=False, bucket_size=300)
+
+        self.assertEqual(expected_emp_line, emp_line)
+        self.assertEqual(expected_emp_line, emp_line2)
+        self.assertEqual(1, ephem_cache.stats()['hits'])
+
+    def test_body_position_and_distances(self):
+        expected_emp_line = compute_ephem(self.dark_start, model_to_dict(self.body), '500', perturb=False)
+
+        position = self.body.compute_position(self.dark_start)
+        distances = self.body.compute_distances(self.dark_start)
+
+        self.assertEqual(expected_emp_line['ra'], position[0])
+        self.assertEqual(expected_emp_line['earth_obj_dist'], distances[0])
+        self.assertEqual(1, ephem_cache.stats()['misses'])
+        self.assertEqual(1, ephem_cache.stats()['hits'])
+
+    def test_invalidate_on_save(self):
+        elements = model_to_dict(self.body)
+        cached_compute_ephem(self.dark_start, elements, 'V37', perturb=False)
+        self.assertEqual(1, ephem_cache.stats()['size'])
+
+        self.body.meananom = 330.0
+        self.body.save()
+
+        self.assertEqual(0, ephem_cache.stats()['size'])
+        emp_line = cached_compute_ephem(self.dark_start, model_to_dict(self.body), 'V37', perturb=False)
+        self.assertEqual(compute_ephem(self.dark_start, model_to_dict(self.body), 'V37', perturb=False), emp_line)
+        self.assertEqual(2, ephem_cache.stats()['misses'])
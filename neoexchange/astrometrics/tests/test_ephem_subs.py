@@ -26,6 +26,7 @@ from django.forms.models import model_to_dict
 
 # Import module to test
 from astrometrics.ephem_subs import *
+from astrometrics.ephem_cache import ephem_cache
 from core.models import Body
 from astrometrics.time_subs import datetime2mjd_utc, mjd_utc2mjd_tt
 import astrometrics.site_config as cfg
@@ -678,6 +679,243 @@ class TestComputeEphemerides(TestCase):
             self.fail("compute_ephem raised ValueError unexpectedly")
 
 
+class TestComputeEphemBatch(SimpleTestCase):
+    """Tests `compute_ephem_batch()` against `compute_ephem()`"""
+
+    def setUp(self):
+        self.elements = {'provisional_name': 'N999r0q',
+                         'name': None,
+                         'abs_mag': 21.0,
+                         'slope': 0.15,
+                         'epochofel': datetime(2015, 3, 19, 0, 0, 0),
+                         'meananom': 325.2636,
+                         'argofperih': 85.19251,
+                         'longascnode': 147.81325,
+                         'orbinc': 8.34739,
+                         'eccentricity': 0.1896865,
+                         'meandist': 1.2176312,
+                         'elements_type': 'MPC_MINOR_PLANET',
+                         }
+        self.comet_elements = {'provisional_name': '',
+                               'name': '67P',
+                               'abs_mag': 11.1,
+                               'slope': 4.8,
+                               'epochofel': datetime(2015, 8, 6, 0, 0),
+                               'epochofperih': datetime(2015, 8, 13, 2, 1, 19),
+                               'meananom': None,
+                               'argofperih': 12.796,
+                               'longascnode': 50.1355,
+                               'orbinc': 7.0402,
+                               'eccentricity': 0.640872,
+                               'meandist': 3.461895,
+                               'perihdist': 1.2432627,
+                               'elements_type': 'MPC_COMET',
+                               }
+        start = datetime(2015, 4, 21, 3, 0, 0)
+        self.dates = [start + timedelta(minutes=30 * i) for i in range(13)]
+
+        self.precision = 6
+
+    def compare_ephems(self, elements, site_code):
+        emp = compute_ephem_batch(self.dates, elements, site_code, perturb=False)
+
+        self.assertEqual(len(self.dates), len(emp))
+        for emp_line, d in zip(emp, self.dates):
+            expected_line = compute_ephem(d, elements, site_code, perturb=False)
+            self.assertEqual(d, emp_line['date'].item())
+            self.assertAlmostEqual(expected_line['ra'], emp_line['ra'], self.precision+2)
+            self.assertAlmostEqual(expected_line['dec'], emp_line['dec'], self.precision+2)
+            self.assertAlmostEqual(expected_line['mag'], emp_line['mag'], self.precision)
+            self.assertAlmostEqual(expected_line['mag_dot'], emp_line['mag_dot'], self.precision)
+            self.assertAlmostEqual(expected_line['sky_motion'], emp_line['sky_motion'], self.precision)
+            self.assertAlmostEqual(expected_line['sky_motion_pa'], emp_line['sky_motion_pa'], self.precision)
+            self.assertAlmostEqual(expected_line['altitude'], emp_line['altitude'], 3)
+            # compute_ephem() goes via the rounded sexagesimal Dec. for this
+            self.assertAlmostEqual(expected_line['southpole_sep'], emp_line['southpole_sep'], delta=0.0025)
+            self.assertAlmostEqual(expected_line['sun_sep'], emp_line['sun_sep'], self.precision)
+            self.assertAlmostEqual(expected_line['earth_obj_dist'], emp_line['earth_obj_dist'], self.precision+2)
+            self.assertAlmostEqual(expected_line['sun_obj_dist'], emp_line['sun_obj_dist'], self.precision+2)
+            self.assertAlmostEqual(expected_line['ltt'], emp_line['ltt'], self.precision)
+            for i in range(3):
+                self.assertAlmostEqual(expected_line['geocnt_a_pos'][i], emp_line['geocnt_a_pos'][i], self.precision)
+                self.assertAlmostEqual(expected_line['heliocnt_e_pos'][i], emp_line['heliocnt_e_pos'][i], self.precision)
+
+    def test_asteroid(self):
+        self.compare_ephems(self.elements, 'V37')
+
+    def test_asteroid_geocenter(self):
+        self.compare_ephems(self.elements, '500')
+
+    def test_comet(self):
+        self.compare_ephems(self.comet_elements, 'K91')
+
+    def test_moon_and_hourangle(self):
+        site_code = 'Q63'
+        (site_name, site_long, site_lat, site_hgt) = get_sitepos(site_code)
+
+        emp = compute_ephem_batch(self.dates, self.elements, site_code, perturb=False)
+
+        for emp_line, d in zip(emp, self.dates):
+            moon_alt, moon_obj_sep, moon_phase = calc_moon_sep(d, emp_line['ra'], emp_line['dec'], site_code)
+            ha = compute_hourangle(d, site_long, site_lat, site_hgt, emp_line['ra'], emp_line['dec'])
+            self.assertAlmostEqual(moon_alt, emp_line['moon_alt'], 2)
+            self.assertAlmostEqual(moon_obj_sep, emp_line['moon_sep'], 3)
+            self.assertAlmostEqual(moon_phase, emp_line['moon_phase'], 4)
+            self.assertAlmostEqual(ha, emp_line['hour_angle'], 5)
+
+    def test_perturbed_close_to_unbatched(self):
+        emp = compute_ephem_batch(self.dates, self.elements, 'V37', perturb=True)
+
+        for emp_line, d in zip(emp, self.dates):
+            expected_line = compute_ephem(d, self.elements, 'V37', perturb=True)
+            # Within 0.05 arcsec
+            sep = degrees(S.sla_dsep(expected_line['ra'], expected_line['dec'], emp_line['ra'], emp_line['dec'])) * 3600.0
+            self.assertLess(sep, 0.05)
+
+    def test_no_epoch(self):
+        del self.elements['epochofel']
+
+        emp = compute_ephem_batch(self.dates, self.elements, 'V37')
+
+        self.assertEqual(0, len(emp))
+        self.assertEqual('ra', emp.dtype.names[1])
+
+    def test_no_dates(self):
+        emp = compute_ephem_batch([], self.elements, 'V37')
+
+        self.assertEqual(0, len(emp))
+
+    def test_to_list(self):
+        emp = compute_ephem_batch(self.dates[0:2], self.elements, 'V37', perturb=False)
+
+        emp_list = ephem_batch_to_list(emp)
+
+        self.assertEqual(2, len(emp_list))
+        self.assertEqual(self.dates[0], emp_list[0]['date'])
+        self.assertEqual(emp['ra'][1], emp_list[1]['ra'])
+        self.assertEqual(3, len(emp_list[1]['geocnt_a_pos']))
+
+
+class TestComputeEphemMany(SimpleTestCase):
+    """Tests `compute_ephem_many()` against `compute_ephem()`"""
+
+    def setUp(self):
+        # Use the same elements as for compute_ephem_batch()
+        TestComputeEphemBatch.setUp(self)
+
+    def test_many_bodies(self):
+        d = datetime(2015, 4, 21, 3, 0, 0)
+        bad_elements = self.elements.copy()
+        bad_elements['epochofel'] = None
+        orbelems_list = [self.elements, bad_elements, self.comet_elements]
+
+        emp = compute_ephem_many(d, orbelems_list, 'V37')
+
+        self.assertEqual(len(orbelems_list), len(emp))
+        self.assertTrue(np.isnan(emp[1]['ra']))
+        for i in (0, 2):
+            expected_line = compute_ephem(d, orbelems_list[i], 'V37', perturb=False)
+            self.assertEqual(d, emp[i]['date'].item())
+            for key in ('ra', 'dec', 'earth_obj_dist', 'sun_obj_dist'):
+                self.assertAlmostEqual(expected_line[key], emp[i][key], self.precision+2)
+            for key in ('mag', 'mag_dot', 'sky_motion', 'sky_motion_pa', 'sun_sep'):
+                self.assertAlmostEqual(expected_line[key], emp[i][key], self.precision)
+            self.assertAlmostEqual(expected_line['altitude'], emp[i]['altitude'], 3)
+
+        emp_list = ephem_batch_to_list(emp)
+        self.assertEqual({}, emp_list[1])
+        self.assertEqual(emp[2]['mag'], emp_list[2]['mag'])
+
+    def test_no_bodies(self):
+        emp = compute_ephem_many(datetime(2015, 4, 21, 3, 0, 0), [])
+
+        self.assertEqual(0, len(emp))
+
+
+class TestPropagateOrbits(SimpleTestCase):
+
+    def setUp(self):
+        # (jform, epoch, incl, node, argperi, aorq, ecc, meananom)
+        self.elements = [(2, 57100.0, 0.15, 2.5, 1.5, 1.2176312, 0.1896865, 5.7),
+                         (2, 57100.0, 0.5, 0.3, 4.0, 2.7, 0.05, 0.1),
+                         (2, 57100.0, 1.2, 5.0, 2.0, 0.9, 0.7, 3.0),
+                         (3, 57247.0, 0.12, 0.87, 0.22, 1.2432627, 0.640872, 0.0),
+                         (3, 57160.0, 2.1, 0.43, 4.2, 0.25316879, 1.1938645, 0.0),
+                         (3, 57300.0, 0.8, 1.0, 1.0, 0.5, 0.9999, 0.0),
+                         ]
+        self.mjd_tt = 57133.25
+
+    def test_against_slalib(self):
+        elements = np.array(self.elements)
+
+        pv, status = propagate_orbits(self.mjd_tt, *elements.T)
+
+        for i, elem in enumerate(self.elements):
+            (expected_pv, expected_status) = S.sla_planel(self.mjd_tt, elem[0], *elem[1:], 0.0)
+            self.assertEqual(expected_status, status[i])
+            for j in range(6):
+                self.assertAlmostEqual(expected_pv[j], pv[i][j], 10)
+
+    def test_many_times(self):
+        mjd_tt = self.mjd_tt + np.arange(0, 10.0, 0.5)
+
+        pv, status = propagate_orbits(mjd_tt, *self.elements[0])
+
+        self.assertEqual((len(mjd_tt), 6), pv.shape)
+        for i, t in enumerate(mjd_tt):
+            (expected_pv, expected_status) = S.sla_planel(t, self.elements[0][0], *self.elements[0][1:], 0.0)
+            for j in range(6):
+                self.assertAlmostEqual(expected_pv[j], pv[i][j], 10)
+
+    def test_bad_ecc(self):
+        pv, status = propagate_orbits(self.mjd_tt, 2, 57100.0, 0.15, 2.5, 1.5, 1.2, 1.5, 5.7)
+
+        self.assertEqual(-2, status[0])
+
+
+class TestComputeEarthPVBatch(SimpleTestCase):
+
+    def test_interpolated(self):
+        mjd_tt = 57133.0 + np.arange(0, 1.0, 5.0/1440.0)
+
+        e_pos, e_vel = compute_earth_pv_batch(mjd_tt)
+
+        self.assertEqual((len(mjd_tt), 3), e_pos.shape)
+        for i in range(0, len(mjd_tt), 17):
+            (expected_pos, expected_vel, bary_pos, bary_vel) = S.sla_epv(mjd_tt[i])
+            for j in range(3):
+                self.assertAlmostEqual(expected_pos[j], e_pos[i][j], 10)
+                self.assertAlmostEqual(expected_vel[j], e_vel[i][j], 8)
+
+    def test_single_time(self):
+        (expected_pos, expected_vel, bary_pos, bary_vel) = S.sla_epv(57133.25)
+
+        e_pos, e_vel = compute_earth_pv_batch([57133.25, ])
+
+        self.assertEqual(list(expected_pos), list(e_pos[0]))
+        self.assertEqual(list(expected_vel), list(e_vel[0]))
+
+
+class TestComputeAirmassBatch(SimpleTestCase):
+
+    def test_matches_slalib(self):
+        start = datetime(2015, 4, 21, 0, 0, 0)
+        dates = [start + timedelta(minutes=20 * i) for i in range(24)]
+        ra = np.full(len(dates), radians(210.0))
+        dec = np.full(len(dates), radians(-35.0))
+
+        airmass = compute_airmass_batch(dates, ra, dec, 'K91')
+
+        site_name, site_long, site_lat, site_hgt = get_sitepos('K91')
+        for d, a, r, dc in zip(dates, airmass, ra, dec):
+            azimuth, altitude = moon_alt_az(d, r, dc, site_long, site_lat, site_hgt)
+            if altitude > radians(20.0):
+                self.assertAlmostEqual(S.sla_airmas(radians(90) - altitude), a, 3)
+
+    def test_empty(self):
+        self.assertEqual(0, len(compute_airmass_batch([], [], [], 'K91')))
+
+
 class TestDarkAndObjectUp(TestCase):
 
     @classmethod
@@ -987,6 +1225,59 @@ class TestLongTermScheduling(TestCase):
 
         self.assertEqual(expected_returned_params, returned_params)
 
+    def test_LongTermScheduling_reuses_nights(self):
+        site_code = 'V37'
+        body_elements = model_to_dict(self.body)
+        ephem_cache.clear()
+        ephem_cache.reset_stats()
+
+        first_params = monitor_long_term_scheduling(site_code, body_elements, utc_date=datetime(2017, 1, 6, 0, 0, 00), date_range=5)
+        self.assertEqual(6, ephem_cache.stats()['misses'])
+        # Only the 2 new nights at the end should need computing
+        returned_params = monitor_long_term_scheduling(site_code, body_elements, utc_date=datetime(2017, 1, 6, 0, 0, 00), date_range=7)
+
+        self.assertEqual(8, ephem_cache.stats()['misses'])
+        self.assertEqual(6, ephem_cache.stats()['hits'])
+        self.assertEqual(first_params[0], returned_params[0][0:2])
+
+    def test_nightly_visibility(self):
+        site_code = 'V37'
+        body_elements = model_to_dict(self.body)
+        expected_first_emp = ['2017 01 06 01:20', '02 13 50.14', '+31 54 14.0', '21.0', ' 4.69', '240.8', '+79', '0.52', ' 31', '+62', '+059', '-00:47']
+
+        night = nightly_visibility(site_code, body_elements, datetime(2017, 1, 6, 0, 0, 00))
+
+        self.assertEqual(expected_first_emp, night['first_emp'])
+        self.assertEqual(5.25, night['dark_and_up_time'])
+        self.assertEqual(88, night['max_alt'])
+
+    def test_nightly_visibility_never_up(self):
+        site_code = 'K92'
+        body_elements = model_to_dict(self.body)
+
+        night = nightly_visibility(site_code, body_elements, datetime(2017, 1, 6, 0, 0, 00))
+
+        self.assertEqual({}, night)
+
+    def test_darkness_times_table(self):
+        site_code = 'V37'
+        start = datetime(2017, 1, 6, 0, 0, 0)
+
+        darkness_times = darkness_times_table(site_code, start, start + timedelta(days=5))
+
+        self.assertEqual(6, len(darkness_times))
+        for date, dark_times in darkness_times.items():
+            self.assertEqual(determine_darkness_times(site_code, date), dark_times)
+
+    def test_darkness_times_table_semester(self):
+        site_code = 'K91'
+
+        darkness_times = darkness_times_table(site_code, datetime(2017, 1, 6, 3, 0, 0))
+
+        self.assertEqual(182, len(darkness_times))
+        self.assertEqual(datetime(2016, 10, 1), min(darkness_times))
+        self.assertEqual(datetime(2017, 3, 31), max(darkness_times))
+
     def test_LongTermScheduling_with_body_no_dark_and_up_emp(self):
         site_code = 'K92'
         body_elements = model_to_dict(self.body)
@@ -0,0 +1,242 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from math import radians
+from mock import Mock, patch
+
+import numpy as np
+from django.test import SimpleTestCase
+from astropy.table import Table, MaskedColumn
+import astropy.units as u
+
+from astrometrics.horizons_cache import HorizonsCache, step_seconds
+from astrometrics.ephem_subs import horizons_ephem, horizons_positions
+
+
+def make_horizons_table(obj_name, start, end, site_code, ephem_step_size, **options):
+    """Local stand-in for fetch_horizons_ephem() that returns a table with
+    the same layout as the raw astroquery response"""
+
+    step = timedelta(seconds=step_seconds(ephem_step_size))
+    dates = []
+    d = start.replace(second=0, microsecond=0)
+    while d <= end:
+        dates.append(d)
+        d += step
+    num_rows = len(dates)
+    table = Table()
+    table['targetname'] = [obj_name, ] * num_rows
+    table['datetime_str'] = [d.strftime("%Y-%b-%d %H:%M") for d in dates]
+    table['datetime_jd'] = [(d - datetime(1858, 11, 17)).total_seconds() / 86400.0 + 2400000.5 for d in dates]
+    table['datetime_jd'].unit = u.d
+    table['solar_presence'] = MaskedColumn([''] * num_rows, mask=[True] * num_rows)
+    table['RA'] = [150.0 + i * 0.01 for i in range(num_rows)]
+    table['RA'].unit = u.deg
+    table['DEC'] = [-30.0 + i * 0.005 for i in range(num_rows)]
+    table['DEC'].unit = u.deg
+    table['RA_rate'] = [36.0] * num_rows
+    table['RA_rate'].unit = u.arcsec / u.hour
+    table['DEC_rate'] = [-18.0] * num_rows
+    table['DEC_rate'].unit = u.arcsec / u.hour
+    table['V'] = MaskedColumn([18.5] * num_rows, unit=u.mag)
+    table.meta['query'] = object()
+    return table
+
+
+def make_horizons_epochs_table(obj_name, start, end, site_code, ephem_step_size, epochs=()):
+    """Local stand-in for fetch_horizons_epochs() that returns a table with
+    one row per epoch"""
+
+    num_rows = len(epochs)
+    table = Table()
+    table['targetname'] = [obj_name, ] * num_rows
+    table['datetime_jd'] = list(epochs)
+    table['datetime_jd'].unit = u.d
+    table['RA'] = [150.0 + (jd - 2460085.0) for jd in epochs]
+    table['RA'].unit = u.deg
+    table['DEC'] = [-30.0 + (jd - 2460085.0) for jd in epochs]
+    table['DEC'].unit = u.deg
+    table['V'] = MaskedColumn([18.5] * num_rows, unit=u.mag)
+    return table
+
+
+class TestStepSeconds(SimpleTestCase):
+
+    def test_steps(self):
+        self.assertEqual(60, step_seconds('1m'))
+        self.assertEqual(300, step_seconds('5m'))
+        self.assertEqual(3600, step_seconds('1h'))
+        self.assertEqual(86400, step_seconds('1d'))
+        self.assertEqual(None, step_seconds('10'))
+
+
+class TestHorizonsCache(SimpleTestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.fetcher = Mock(side_effect=make_horizons_table)
+        self.cache = HorizonsCache(cache_dir=self.test_dir, fetcher=self.fetcher)
+        self.start = datetime(2023, 5, 20, 0, 0, 0)
+        self.end = datetime(2023, 5, 20, 12, 0, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_repeat_request(self):
+        table1 = self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h', skip_daylight=True)
+        table2 = self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h', skip_daylight=True)
+
+        self.assertEqual(1, self.fetcher.call_count)
+        self.assertEqual(13, len(table2))
+        self.assertEqual(list(table1['RA']), list(table2['RA']))
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    def test_different_options(self):
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h', skip_daylight=True)
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h', skip_daylight=False)
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'K91', '1h', skip_daylight=True)
+
+        self.assertEqual(3, self.fetcher.call_count)
+
+    def test_contained_request(self):
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+
+        table = self.cache.get_or_fetch(None, '12345', self.start + timedelta(hours=3), self.start + timedelta(hours=5), 'V37', '1h')
+
+        self.assertEqual(1, self.fetcher.call_count)
+        self.assertEqual(['2023-May-20 03:00', '2023-May-20 04:00', '2023-May-20 05:00'], list(table['datetime_str']))
+
+    def test_contained_request_off_grid(self):
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+
+        table = self.cache.get_or_fetch(None, '12345', self.start + timedelta(minutes=30), self.start + timedelta(hours=5), 'V37', '1h')
+
+        self.assertEqual(2, self.fetcher.call_count)
+        self.assertEqual('2023-May-20 00:30', table['datetime_str'][0])
+
+    def test_disk_tier(self):
+        table1 = self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+        self.cache.clear()
+
+        table2 = self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+
+        self.assertEqual(1, self.fetcher.call_count)
+        self.assertEqual(1, len(os.listdir(self.test_dir)))
+        self.assertEqual(list(table1['DEC']), list(table2['DEC']))
+        self.assertEqual(u.arcsec / u.hour, table2['RA_rate'].unit)
+        self.assertTrue(table2['solar_presence'].mask.all())
+
+    def test_expired(self):
+        self.cache.timeout = -1
+
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+
+        self.assertEqual(2, self.fetcher.call_count)
+
+    def test_offline(self):
+        self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+        offline_cache = HorizonsCache(cache_dir=self.test_dir, fetcher=self.fetcher, timeout=-1, offline=True)
+
+        table = offline_cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+        missing = offline_cache.get_or_fetch(None, '54321', self.start, self.end, 'V37', '1h')
+
+        self.assertEqual(1, self.fetcher.call_count)
+        self.assertEqual(13, len(table))
+        self.assertEqual(None, missing)
+
+    def test_failed_fetch_not_cached(self):
+        self.fetcher.side_effect = [None, make_horizons_table('12345', self.start, self.end, 'V37', '1h')]
+
+        self.assertEqual(None, self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h'))
+        table = self.cache.get_or_fetch(None, '12345', self.start, self.end, 'V37', '1h')
+
+        self.assertEqual(13, len(table))
+        self.assertEqual(2, self.fetcher.call_count)
+
+
+class TestCachedHorizonsEphem(SimpleTestCase):
+
+    def setUp(self):
+        self.fetcher = Mock(side_effect=make_horizons_table)
+        self.cache = HorizonsCache(fetcher=self.fetcher)
+        self.start = datetime(2023, 5, 20, 0, 0, 0)
+        self.end = datetime(2023, 5, 20, 2, 0, 0)
+
+    def test_converted(self):
+        with patch('astrometrics.ephem_subs.horizons_cache', self.cache):
+            ephem = horizons_ephem('12345', self.start, self.end, 'V37', '5m')
+            ephem2 = horizons_ephem('12345', self.start, self.end, 'V37', '5m')
+
+        self.assertEqual(1, self.fetcher.call_count)
+        self.assertEqual(25, len(ephem2))
+        self.assertEqual(u.arcsec / u.min, ephem2['RA_rate'].unit)
+        self.assertAlmostEqual(0.6, ephem2['RA_rate'][0], 10)
+        self.assertIn('mean_rate', ephem2.colnames)
+        self.assertEqual(datetime(2023, 5, 20, 0, 5), ephem2['datetime'][1].datetime)
+        self.assertEqual(list(ephem['mean_rate']), list(ephem2['mean_rate']))
+
+
+class TestHorizonsPositions(SimpleTestCase):
+
+    def setUp(self):
+        self.fetcher = Mock(side_effect=make_horizons_epochs_table)
+        self.cache = HorizonsCache(fetcher=self.fetcher)
+        start = datetime(2023, 5, 20, 12, 0, 0)
+        self.dates = [start + timedelta(minutes=i) for i in range(120)]
+
+    def test_chunked(self):
+        with patch('astrometrics.ephem_subs.horizons_cache', self.cache):
+            ra, dec, mag = horizons_positions('12345', self.dates, 'V37', chunk_size=50)
+
+        self.assertEqual(3, self.fetcher.call_count)
+        self.assertEqual([50, 50, 20], [len(call[1]['epochs']) for call in self.fetcher.call_args_list])
+        self.assertEqual(120, len(ra))
+        self.assertAlmostEqual(radians(150.0), ra[0], 8)
+        self.assertAlmostEqual(radians(150.0 + 119.0/1440.0), ra[-1], 8)
+        self.assertAlmostEqual(radians(-30.0 + 60.0/1440.0), dec[60], 8)
+        self.assertEqual([18.5] * 120, list(mag))
+
+    def test_cached(self):
+        with patch('astrometrics.ephem_subs.horizons_cache', self.cache):
+            ra, dec, mag = horizons_positions('12345', self.dates, 'V37')
+            ra2, dec2, mag2 = horizons_positions('12345', self.dates, 'V37')
+
+        self.assertEqual(3, self.fetcher.call_count)
+        self.assertEqual(list(ra), list(ra2))
+
+    def test_repeated_dates(self):
+        dates = self.dates[0:3] + self.dates[0:3]
+
+        with patch('astrometrics.ephem_subs.horizons_cache', self.cache):
+            ra, dec, mag = horizons_positions('12345', dates, 'V37')
+
+        self.assertEqual(3, len(self.fetcher.call_args[1]['epochs']))
+        self.assertEqual(list(ra[0:3]), list(ra[3:6]))
+
+    def test_failed(self):
+        self.fetcher.side_effect = None
+        self.fetcher.return_value = None
+
+        with patch('astrometrics.ephem_subs.horizons_cache', self.cache):
+            ra, dec, mag = horizons_positions('12345', self.dates[0:10], 'V37')
+
+        self.assertEqual(10, len(ra))
+        self.assertTrue(np.isnan(ra).all())
+        self.assertTrue(np.isnan(dec).all())
@@ -0,0 +1,169 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+from threading import Thread, Event
+from mock import Mock, patch
+
+from django.test import SimpleTestCase
+
+from astrometrics.portal_cache import PortalCache, portal_cache
+from astrometrics.sources_subs import fetch_filter_list, get_site_status
+
+
+class TestPortalCache(SimpleTestCase):
+
+    def setUp(self):
+        self.fetcher = Mock(return_value={'wibble': 1})
+        self.cache = PortalCache()
+
+    def test_repeat_request(self):
+        value1 = self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+        value2 = self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+
+        self.fetcher.assert_called_once_with('url1')
+        self.assertEqual({'wibble': 1}, value2)
+        self.assertIs(value1, value2)
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    def test_different_keys(self):
+        self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+        self.cache.get_or_fetch(('instruments', 'url2'), self.fetcher, 'url2')
+
+        self.assertEqual(2, self.fetcher.call_count)
+
+    def test_expired(self):
+        self.cache.timeout = -1
+
+        self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+        self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+
+        self.assertEqual(2, self.fetcher.call_count)
+
+    def test_failure_not_cached(self):
+        self.fetcher.side_effect = [None, {'wibble': 2}]
+
+        self.assertEqual(None, self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1'))
+        self.assertEqual({'wibble': 2}, self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1'))
+        self.assertEqual(2, self.fetcher.call_count)
+
+    def test_exception_not_cached(self):
+        self.fetcher.side_effect = [ValueError('Boom'), {'wibble': 2}]
+
+        with self.assertRaises(ValueError):
+            self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+        self.assertEqual({'wibble': 2}, self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1'))
+
+    def test_cache_if(self):
+        self.fetcher.return_value = {}
+
+        self.cache.get_or_fetch(('telescope_states', ), self.fetcher, cache_if=len)
+        self.cache.get_or_fetch(('telescope_states', ), self.fetcher, cache_if=len)
+
+        self.assertEqual(2, self.fetcher.call_count)
+
+    def test_stand_in(self):
+        stand_in = Mock(return_value={'local': True})
+        cache = PortalCache(fetchers={'instruments': stand_in})
+
+        value = cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+
+        self.fetcher.assert_not_called()
+        stand_in.assert_called_once_with('url1')
+        self.assertEqual({'local': True}, value)
+
+    def test_invalidate(self):
+        self.cache.get_or_fetch(('instruments', 'url1'), self.fetcher, 'url1')
+        self.cache.get_or_fetch(('telescope_states', ), self.fetcher)
+
+        self.cache.invalidate('instruments')
+
+        self.assertEqual(None, self.cache.get(('instruments', 'url1')))
+        self.assertEqual({'wibble': 1}, self.cache.get(('telescope_states', )))
+
+    def test_coalesced(self):
+        started = Event()
+        release = Event()
+
+        def slow_fetcher(url):
+            started.set()
+            release.wait(5)
+            return {'url': url}
+
+        fetcher = Mock(side_effect=slow_fetcher)
+        results = []
+
+        def lookup():
+            results.append(self.cache.get_or_fetch(('instruments', 'url1'), fetcher, 'url1'))
+
+        threads = [Thread(target=lookup) for i in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(1, fetcher.call_count)
+        self.assertEqual([{'url': 'url1'}] * 4, results)
+
+
+class TestCachedPortalLookups(SimpleTestCase):
+
+    def setUp(self):
+        portal_cache.clear()
+        self.addCleanup(portal_cache.clear)
+
+    @patch('astrometrics.sources_subs.requests.get')
+    def test_filter_list(self, mock_get):
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {
+            '1M0-SCICAM-SINISTRO': {'optical_elements': {'filters': [{'code': 'w', 'schedulable': True},
+                                                                     {'code': 'rp', 'schedulable': True},
+                                                                     {'code': 'air', 'schedulable': False}]}}}
+
+        for i in range(40):
+            filter_list, fetch_error = fetch_filter_list('K92', False)
+        fetch_filter_list('V37', False)
+
+        self.assertEqual(2, mock_get.call_count)
+        self.assertIn('w', filter_list)
+        self.assertNotIn('air', filter_list)
+        self.assertEqual('', fetch_error)
+
+    @patch('astrometrics.sources_subs.requests.get')
+    def test_filter_list_failed(self, mock_get):
+        mock_get.return_value.status_code = 500
+
+        filter_list, fetch_error = fetch_filter_list('K92', False)
+        fetch_filter_list('K92', False)
+
+        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual([], filter_list)
+        self.assertIn('not schedulable', fetch_error)
+
+    @patch('astrometrics.sources_subs.get_telescope_states')
+    def test_site_status(self, mock_states):
+        mock_states.return_value = {'cpt.doma.1m0a': [{'event_type': 'AVAILABLE', 'event_reason': ''}],
+                                    'lsc.domb.1m0a': [{'event_type': 'OFFLINE', 'event_reason': 'Weather'}]}
+
+        status1 = get_site_status('K91')
+        status2 = get_site_status('W86')
+        status3 = get_site_status('V37')
+
+        mock_states.assert_called_once_with()
+        self.assertEqual((True, ''), status1)
+        self.assertEqual((False, 'Weather'), status2)
+        self.assertEqual((False, 'Not available for scheduling'), status3)
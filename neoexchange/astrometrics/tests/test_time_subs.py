@@ -52,6 +52,29 @@ class TestJD2datetime(SimpleTestCase):
         self.assertEqual(expected_dt, dt)
 
 
+class TestJD2ISOStrings(SimpleTestCase):
+
+    def test_jds(self):
+        jds = [2457290.449504, 2457290.267925, 2457652.799609]
+        expected_strings = [jd_utc2datetime(jd).strftime("%Y-%m-%d %H:%M:%S") for jd in jds]
+
+        iso_strings = jd_utc2isostrings(jds)
+
+        self.assertEqual(expected_strings, iso_strings.tolist())
+        self.assertEqual('2015-09-24 22:47:17', iso_strings[0])
+
+    def test_round_to_next_minute(self):
+        jd = 2457290.5 + (59.7/86400.0)
+
+        iso_strings = jd_utc2isostrings([jd, ])
+
+        self.assertEqual(['2015-09-25 00:01:00'], iso_strings.tolist())
+        self.assertEqual(jd_utc2datetime(jd).strftime("%Y-%m-%d %H:%M:%S"), iso_strings[0])
+
+    def test_empty(self):
+        self.assertEqual([], jd_utc2isostrings([]).tolist())
+
+
 class TestDT2DecimalDay(SimpleTestCase):
 
     def test_microday1(self):
@@ -19,6 +19,8 @@ from math import degrees
 import time
 import logging
 
+import numpy as np
+
 try:
     import pyslalib.slalib as S
 except:
@@ -229,6 +231,18 @@ def jd_utc2datetime(jd):
     return dt
 
 
+def jd_utc2isostrings(jds):
+    """Converts an array of Julian dates <jds> into an array of UTC strings of
+    the form 'YYYY-MM-DD HH:MM:SS' (rounded to the nearest second). This is
+    the vectorized equivalent of calling jd_utc2datetime() and strftime() on
+    each element."""
+
+    jds = np.asarray(jds, dtype=np.float64)
+    unix_secs = np.rint((jds - 2440587.5) * 86400.0).astype(np.int64)
+    iso_strings = np.datetime_as_string(unix_secs.astype('datetime64[s]'), unit='s')
+    return np.char.replace(iso_strings, 'T', ' ')
+
+
 def mjd_utc2datetime(mjd):
     """Converts a passed Modified Julian date to a Python datetime object. 'None' is
     returned if the conversion was not possible."""
@@ -18,11 +18,15 @@ import os
 import sys
 from hashlib import md5
 import glob
+import json
 import logging
+from threading import RLock
 from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
 
 
 import requests
+from requests.adapters import HTTPAdapter
 from tenacity import retry, wait_exponential, stop_after_attempt
 from django.conf import settings
 from django.core.management.base import CommandError
@@ -184,19 +188,146 @@ def fetch_observations(tracking_num):
 
 def fetch_archive_frames(auth_header, archive_url, frames):
 
-    data = lco_api_call(archive_url, auth_header)
-    if data is not None and data.get('count', 0) > 0:
+    while archive_url:
+        data = lco_api_call(archive_url, auth_header)
+        if data is None or data.get('count', 0) <= 0:
+            break
         frames += data['results']
-        if data['next']:
-            fetch_archive_frames(auth_header, data['next'], frames)
+        archive_url = data['next']
 
     return frames
 
 
-def check_for_existing_file(filename, archive_md5=None, dbg=False, verbose=False):
+def file_md5(filename, chunk_size=1024*1024):
+    """Returns the MD5 sum of <filename>, reading it in chunks of <chunk_size>
+    bytes rather than all at once"""
+
+    checksum = md5()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def filename_red_level(filename):
+    """Returns the reduction level (e.g. '91') from a LCO format <filename>
+    or '' if it can't be determined"""
+
+    chunks = os.path.basename(filename).split('.')[0].split('-')
+    if len(chunks) == 5 and chunks[4][1:3].isdigit():
+        return chunks[4][1:3]
+    return ''
+
+
+class DataManifest(object):
+    """Manifest of the files in data directory <path>, recording the size,
+    modification time, MD5 sum and reduction level of each, so the MD5 sum of a
+    file is only computed once (and again only if its size or mtime change).
+    The manifest is stored as JSON in the directory (MANIFEST_NAME)."""
+
+    MANIFEST_NAME = '.neox_manifest.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_file = os.path.join(path, self.MANIFEST_NAME)
+        self.entries = {}
+        self.changed = False
+        self._lock = RLock()
+        try:
+            with open(self.manifest_file, 'r') as fh:
+                self.entries = json.load(fh).get('files', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read manifest {}: {}".format(self.manifest_file, e))
+
+    def _stat(self, filename):
+        try:
+            st = os.stat(os.path.join(self.path, filename))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def lookup(self, filename):
+        """Returns the recorded MD5 sum of <filename> (a name within the
+        directory) if the file is unchanged since it was recorded, else None"""
+
+        stat = self._stat(filename)
+        with self._lock:
+            entry = self.entries.get(filename)
+        if stat is None or entry is None:
+            return None
+        if entry['size'] != stat[0] or entry['mtime'] != stat[1]:
+            return None
+        return entry['md5']
+
+    def add(self, filename, md5sum=None):
+        """Records <filename> (computing its MD5 sum if [md5sum] isn't given)
+        and returns the MD5 sum (or None if the file doesn't exist)"""
+
+        stat = self._stat(filename)
+        if stat is None:
+            return None
+        if md5sum is None:
+            md5sum = file_md5(os.path.join(self.path, filename))
+        with self._lock:
+            self.entries[filename] = {'size': stat[0],
+                                      'mtime': stat[1],
+                                      'md5': md5sum,
+                                      'red_lvl': filename_red_level(filename)
+                                      }
+            self.changed = True
+        return md5sum
+
+    def md5(self, filename):
+        """Returns the MD5 sum of <filename>, only reading the file if it's not
+        in the manifest or has changed since it was recorded"""
+
+        md5sum = self.lookup(filename)
+        if md5sum is None:
+            md5sum = self.add(filename)
+        return md5sum
+
+    def update(self, filenames, num_workers=4):
+        """Computes (in parallel, using [num_workers] threads) the MD5 sums of
+        any of <filenames> that exist but aren't up to date in the manifest"""
+
+        needed = [f for f in filenames if self._stat(f) is not None and self.lookup(f) is None]
+        if len(needed) > 1 and num_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(num_workers, len(needed))) as executor:
+                list(executor.map(self.add, needed))
+        else:
+            for filename in needed:
+                self.add(filename)
+        return len(needed)
+
+    def save(self):
+        """Writes the manifest back to disk if it has changed"""
+
+        with self._lock:
+            if not self.changed:
+                return
+            # Drop entries for files that have gone away
+            self.entries = {f: e for f, e in self.entries.items() if self._stat(f) is not None}
+            tmp_file = self.manifest_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as fh:
+                    json.dump({'version': 1, 'files': self.entries}, fh)
+                os.replace(tmp_file, self.manifest_file)
+                self.changed = False
+            except OSError as e:
+                logger.warning("Could not write manifest {}: {}".format(self.manifest_file, e))
+
+
+def check_for_existing_file(filename, archive_md5=None, dbg=False, verbose=False, manifest=None):
     """Tries to determine whether a higher reduction level of the file exists. If it does, True is
-    returned otherwise False is returned"""
+    returned otherwise False is returned. MD5 sums of existing files are taken from the
+    DataManifest [manifest] (or the directory's manifest if not given), only reading
+    the file if it isn't up to date in the manifest; it is up to the caller to save()
+    the manifest afterwards."""
     path = os.path.dirname(filename)
+    if manifest is None:
+        manifest = DataManifest(path)
     uncomp_filepath = os.path.splitext(filename)[0]
     output_file = os.path.splitext(os.path.basename(filename))[0]
     extension = os.path.splitext(os.path.basename(filename))[1]
@@ -228,7 +359,7 @@ def check_for_existing_file(filename, archive_md5=None, dbg=False, verbose=False
                         print("Uncompressed reduction file exists")
                     return True
                 if os.path.exists(filename) and archive_md5 is not None:
-                    md5sum = md5(open(filename, 'rb').read()).hexdigest()
+                    md5sum = manifest.md5(os.path.basename(filename))
                     logger.debug("{} {} {}".format(filename, md5sum, archive_md5))
                     if md5sum == archive_md5:
                         if verbose:
@@ -236,7 +367,7 @@ def check_for_existing_file(filename, archive_md5=None, dbg=False, verbose=False
                         return True
             else:
                 if os.path.exists(filename) and archive_md5 is not None:
-                    md5sum = md5(open(filename, 'rb').read()).hexdigest()
+                    md5sum = manifest.md5(os.path.basename(filename))
                     logger.debug("{} {} {}".format(filename, md5sum, archive_md5))
                     if md5sum == archive_md5:
                         if verbose:
@@ -248,7 +379,7 @@ def check_for_existing_file(filename, archive_md5=None, dbg=False, verbose=False
                     return True
     elif ".tar.gz" in filename:  # check for existing tarballs
         if os.path.exists(filename) and archive_md5 is not None:
-                md5sum = md5(open(filename, 'rb').read()).hexdigest()
+                md5sum = manifest.md5(os.path.basename(filename))
                 logger.debug("{} {} {}".format(filename, md5sum, archive_md5))
                 if md5sum == archive_md5:
                     if verbose:
@@ -271,7 +402,76 @@ def check_for_bad_file(filename, reject_dir='Bad'):
     return reject_file
 
 
-def download_files(frames, data_path, verbose=False, dbg=False):
+def make_archive_session(num_workers=4):
+    """Returns a requests Session with a connection pool big enough to be
+    shared between <num_workers> download threads"""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = ssl_verify
+
+    return session
+
+
+class ArchiveDownloadError(Exception):
+    pass
+
+
+@retry(wait=wait_exponential(multiplier=2, min=4, max=10), stop=stop_after_attempt(3), reraise=True)
+def download_file(url, filename, archive_md5=None, session=None, chunk_size=1024*1024, timeout=60):
+    """Streams the file at <url> to <filename> in chunks of <chunk_size> bytes,
+    without holding it in memory. The data are written to <filename>.part
+    which is renamed to <filename> once complete; if a .part file is left over
+    from an interrupted download, it is resumed with a HTTP Range request.
+    If [archive_md5] is given, the MD5 sum is computed during the download and
+    a mismatch raises ArchiveDownloadError (after removing the partial file).
+    Returns the number of bytes downloaded."""
+
+    if session is None:
+        session = requests
+    part_filename = filename + '.part'
+    checksum = md5()
+    offset = 0
+    headers = {}
+    if os.path.exists(part_filename):
+        with open(part_filename, 'rb') as part_file:
+            for chunk in iter(lambda: part_file.read(chunk_size), b''):
+                checksum.update(chunk)
+                offset += len(chunk)
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+
+    num_bytes = 0
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code == 416:
+            # Range not satisfiable; start again from scratch next time
+            os.remove(part_filename)
+            raise ArchiveDownloadError("Could not resume download of %s" % filename)
+        resp.raise_for_status()
+        mode = 'ab'
+        if resp.status_code != 206:
+            # Server ignored the Range request (or there wasn't one)
+            mode = 'wb'
+            checksum = md5()
+            offset = 0
+        with open(part_filename, mode) as part_file:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                part_file.write(chunk)
+                checksum.update(chunk)
+                num_bytes += len(chunk)
+
+    if archive_md5 is not None and checksum.hexdigest() != archive_md5:
+        os.remove(part_filename)
+        raise ArchiveDownloadError("MD5 mismatch for %s (got %s, expected %s)" % (filename, checksum.hexdigest(), archive_md5))
+    os.replace(part_filename, filename)
+    logger.debug("Downloaded %d bytes (resumed from %d) to %s" % (num_bytes, offset, filename))
+
+    return num_bytes
+
+
+def download_files(frames, data_path, verbose=False, dbg=False, num_workers=4):
     """Downloads and saves to disk, the specified files from the new Science
     Archive. Returns a list of the frames that were downloaded.
     Takes a dictionary <frames> (keyed by reduction levels and produced by
@@ -280,24 +480,63 @@ def download_files(frames, data_path, verbose=False, dbg=False):
     files (e.g. -e10 quicklook files) will not be downloaded if a higher
     reduction level already exists and frames will not be downloaded if they
     already exist. If [verbose] is set to True, the filename of the downloaded
-    file will be printed."""
-
-    downloaded_frames = []
+    file will be printed.
+    Files are streamed to disk (and checked against the archive MD5 sum) by
+    [num_workers] threads sharing one HTTP session; files that fail to
+    download are logged and left out of the returned list."""
+
+    # Work out the output directories and bring their manifests up to date,
+    # computing any missing MD5 sums in parallel
+    manifests = {}
+    frame_files = []
     for reduction_lvl in frames.keys():
         logger.debug(reduction_lvl)
         frames_to_download = frames[reduction_lvl]
         for frame in frames_to_download:
-            logger.debug(frame['filename'])
             output_path = make_data_dir(data_path, frame)
-            filename = os.path.join(output_path, frame['filename'])
-            archive_md5 = frame['version_set'][-1]['md5']
-            if check_for_existing_file(filename, archive_md5, dbg, verbose) or check_for_bad_file(filename):
-                logger.info("Skipping existing file {}".format(frame['filename']))
-            else:
-                logger.info("Writing file to {}".format(filename))
-                downloaded_frames.append(filename)
-                with open(filename, 'wb') as f:
-                    f.write(requests.get(frame['url']).content)
+            if output_path not in manifests:
+                manifests[output_path] = DataManifest(output_path)
+            frame_files.append((frame, os.path.join(output_path, frame['filename'])))
+    for output_path, manifest in manifests.items():
+        filenames = [os.path.basename(f) for frame, f in frame_files if os.path.dirname(f) == output_path]
+        manifest.update(filenames, num_workers)
+
+    to_download = []
+    for frame, filename in frame_files:
+        logger.debug(frame['filename'])
+        manifest = manifests[os.path.dirname(filename)]
+        archive_md5 = frame['version_set'][-1]['md5']
+        if check_for_existing_file(filename, archive_md5, dbg, verbose, manifest) or check_for_bad_file(filename):
+            logger.info("Skipping existing file {}".format(frame['filename']))
+        elif filename not in [f[1] for f in to_download]:
+            to_download.append((frame['url'], filename, archive_md5))
+
+    downloaded_frames = []
+    if len(to_download) > 0:
+        num_workers = max(1, min(num_workers, len(to_download)))
+        session = make_archive_session(num_workers)
+
+        def fetch(item):
+            url, filename, archive_md5 = item
+            logger.info("Writing file to {}".format(filename))
+            try:
+                download_file(url, filename, archive_md5, session=session)
+            except (requests.exceptions.RequestException, ArchiveDownloadError, OSError) as e:
+                logger.error("Failed to download {}: {}".format(filename, e))
+                return None
+            # MD5 was verified during the download
+            manifests[os.path.dirname(filename)].add(os.path.basename(filename), archive_md5)
+            return filename
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for filename in executor.map(fetch, to_download):
+                if filename is not None:
+                    downloaded_frames.append(filename)
+        session.close()
+
+    for manifest in manifests.values():
+        manifest.save()
+
     return downloaded_frames
 
 
@@ -20,10 +20,11 @@ from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from astropy.wcs import WCS, FITSFixedWarning
 from urllib.parse import urljoin
+import numpy as np
 
-from core.models import Block, Frame, Candidate, SourceMeasurement, Body
+from core.models import Block, Frame, Candidate, SourceMeasurement, Body, detections_array_dtypes
 from astrometrics.ephem_subs import LCOGT_domes_to_site_codes, LCOGT_site_codes
-from astrometrics.time_subs import jd_utc2datetime
+from astrometrics.time_subs import jd_utc2isostrings
 from core.archive_subs import archive_login, check_for_archive_images, lco_api_call
 import logging
 
@@ -35,6 +36,7 @@ def measurements_from_block(blockid, bodyid=None):
     block = Block.objects.get(pk=blockid)
     frames = Frame.objects.filter(block=block, frametype__in=(Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE, Frame.STACK_FRAMETYPE)).values_list('id', flat=True)
     measures = SourceMeasurement.objects.filter(frame__in=frames, obs_mag__gt=0.0).order_by('-body', 'frame__midpoint')
+    measures = measures.select_related('frame', 'body')
     if bodyid:
         measures = measures.filter(body__id=bodyid)
     bodies = measures.values_list('body', flat=True).distinct()
@@ -42,6 +44,37 @@ def measurements_from_block(blockid, bodyid=None):
     return {'body': block.body, 'measures': measures, 'slot': block, 'extra_bodies': extra_bodies}
 
 
+def measurements_from_blocks(blockids, bodyid=None):
+    """Bulk version of measurements_from_block() for the Blocks in <blockids>
+    (optionally only for Body <bodyid>). The measurements, with their Frames
+    and Bodies, are fetched in a fixed number of queries however many Blocks
+    there are. Returns a list (in the order of <blockids>, skipping any that
+    don't exist) of dictionaries with the Block as 'slot', the Block's Body
+    as 'body' and the list of SourceMeasurements as 'measures', ordered as in
+    measurements_from_block()"""
+
+    blocks = Block.objects.filter(pk__in=blockids).select_related('body')
+    blocks = {block.pk: block for block in blocks}
+    frametypes = (Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE, Frame.STACK_FRAMETYPE)
+    measures = SourceMeasurement.objects.filter(frame__block__in=list(blocks.keys()), frame__frametype__in=frametypes, obs_mag__gt=0.0)
+    if bodyid:
+        measures = measures.filter(body__id=bodyid)
+    measures = measures.select_related('frame', 'body').order_by('frame__block', '-body', 'frame__midpoint')
+
+    block_measures = {}
+    for measure in measures:
+        block_measures.setdefault(measure.frame.block_id, []).append(measure)
+
+    data = []
+    for blockid in blockids:
+        block = blocks.get(blockid)
+        if block is None:
+            logger.warning("Could not find Block with pk={}".format(blockid))
+            continue
+        data.append({'body': block.body, 'measures': block_measures.get(blockid, []), 'slot': block})
+    return data
+
+
 def find_images_for_block(blockid):
     """
     Look up Frames and Candidates in Block.
@@ -65,18 +98,40 @@ def find_images_for_block(blockid):
     return frames_list, candidates, x_size, y_size
 
 
+def block_detections(blockid):
+    """Returns the Candidates for Block <blockid> (ordered by score) and a
+    single structured array of all their detections, with extra 'cand_index'
+    (the index of the detection's Candidate in the list) and 'time' (UTC
+    string of the 'jd_obs') columns"""
+
+    cands = list(Candidate.objects.filter(block__id=blockid).order_by('score'))
+    dets_list = [cand.unpack_dets() for cand in cands]
+    det_dtype = np.dtype(detections_array_dtypes())
+    dtype = np.dtype([('cand_index', 'i4')] + det_dtype.descr + [('time', 'U19')])
+    num_dets = sum(len(dets) for dets in dets_list)
+    detections = np.zeros(num_dets, dtype=dtype)
+    if num_dets > 0:
+        all_dets = np.concatenate(dets_list)
+        for name in det_dtype.names:
+            detections[name] = all_dets[name]
+        detections['cand_index'] = np.repeat(np.arange(len(cands)), [len(dets) for dets in dets_list])
+        detections['time'] = jd_utc2isostrings(detections['jd_obs'])
+
+    return cands, detections
+
+
 def candidates_by_block(blockid):
     targets = []
-    cands = Candidate.objects.filter(block__id=blockid).order_by('score')
-    for cand in cands:
-        coords = []
-        sky_coords = []
-        dets = cand.unpack_dets()
-        times = [jd_utc2datetime(x).strftime("%Y-%m-%d %H:%M:%S") for x in dets['jd_obs']]
-        d_zip = zip(dets['frame_number'], dets['x'], dets['y'], dets['ra'], dets['dec'], dets['mag'], times)
-        for a in d_zip:
-            coords.append({'x': a[1], 'y': a[2], 'time': a[6]})
-            sky_coords.append({'ra': a[3] * 15.0, 'dec': a[4], 'mag': a[5]})
+    cands, detections = block_detections(blockid)
+    # Detections are grouped by candidate so split at the changes of index
+    bounds = np.searchsorted(detections['cand_index'], np.arange(len(cands)+1))
+    ra_degs = detections['ra'] * 15.0
+    for i, cand in enumerate(cands):
+        dets = slice(bounds[i], bounds[i+1])
+        coords = [{'x': x, 'y': y, 'time': t} for x, y, t in
+                  zip(detections['x'][dets].tolist(), detections['y'][dets].tolist(), detections['time'][dets].tolist())]
+        sky_coords = [{'ra': ra, 'dec': dec, 'mag': mag} for ra, dec, mag in
+                      zip(ra_degs[dets].tolist(), detections['dec'][dets].tolist(), detections['mag'][dets].tolist())]
         motion = {'speed' : cand.convert_speed(), 'speed_raw' : cand.speed, 'pos_angle' : cand.sky_motion_pa}
         targets.append({'id': str(cand.id), 'coords': coords, 'sky_coords': sky_coords, 'motion': motion})
     return targets
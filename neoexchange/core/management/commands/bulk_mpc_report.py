@@ -0,0 +1,68 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2026 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Block
+from core.mpc_submit import write_bulk_report, BULK_REPORT_FORMATS
+
+
+class Command(BaseCommand):
+
+    help = 'Write MPC1992 or ADES PSV reports for all the observed Blocks of a night (or a list of Blocks)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', action="store", default=None, help='UTC date of the Blocks to report (YYYYMMDD)')
+        parser.add_argument('--blocks', action="store", nargs='+', type=int, default=None, help='Ids of the Blocks to report')
+        parser.add_argument('--body', action="store", type=int, default=None, help='Only report measurements of this Body id')
+        parser.add_argument('--format', action="store", default='mpc', choices=list(BULK_REPORT_FORMATS.keys()), help='Report format')
+        parser.add_argument('--unreported', action="store_true", help='Only report Blocks not yet reported to the MPC')
+        parser.add_argument('--separate', action="store_true", help='Write a report per Block into the output directory')
+        parser.add_argument('--output', action="store", default=None, help='Output file (or directory with --separate)')
+
+    def handle(self, *args, **options):
+        if options['blocks']:
+            blocks = Block.objects.filter(pk__in=options['blocks'])
+            default_name = 'blocks'
+        elif options['date']:
+            try:
+                obs_date = datetime.strptime(options['date'], '%Y%m%d')
+            except ValueError:
+                raise CommandError("Incorrect date format, should be YYYYMMDD")
+            blocks = Block.objects.filter(block_end__gte=obs_date, block_end__lt=obs_date + timedelta(days=1), num_observed__gte=1)
+            default_name = options['date']
+        else:
+            raise CommandError("Need one of --date or --blocks")
+        if options['unreported']:
+            blocks = blocks.filter(reported=False)
+        blockids = list(blocks.order_by('block_start').values_list('pk', flat=True))
+        if not blockids:
+            self.stdout.write("No Blocks found to report")
+            return
+
+        output_path = options['output']
+        if output_path is None:
+            output_path = 'report_' + default_name
+            if not options['separate']:
+                output_path += BULK_REPORT_FORMATS[options['format']]['extension']
+        output_path = os.path.abspath(output_path)
+
+        self.stdout.write("Writing %s report for %d Blocks to %s" % (options['format'], len(blockids), output_path))
+        report_files, num_lines = write_bulk_report(blockids, output_path, bodyid=options['body'],
+                                                    report_format=options['format'], combined=not options['separate'])
+        self.stdout.write("Wrote %d measurements to %d file(s)" % (num_lines, len(report_files)))
@@ -19,6 +19,7 @@ from datetime import datetime, timedelta
 from django.core.management.base import BaseCommand, CommandError
 
 from core.models import Block, CatalogSources, Frame
+from photometrics.source_store import migrate_frame_sources, delete_frame_sources
 
 class Command(BaseCommand):
 
@@ -27,9 +28,10 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('age', default=30, help='Age of the data to delete (30 days)')
         parser.add_argument('--delete', action="store_true", help='Whether to actually do the deletion')
+        parser.add_argument('--columnar', action="store_true", help='Move CatalogSources into the columnar store instead of deleting them')
 
     def handle(self, *args, **options):
-        usage = "Invalid usage. Usage: : %s age [30.0] [--delete]" % ( argv[1] )
+        usage = "Invalid usage. Usage: : %s age [30.0] [--delete] [--columnar]" % ( argv[1] )
 
         try:
             age = timedelta(days=float(options['age']))
@@ -41,12 +43,19 @@ class Command(BaseCommand):
         self.stdout.write("Found %d Blocks older than %.1f days" % (blocks.count(), age.total_seconds()/86400.0))
         if blocks.count() > 0:
             for block in blocks:
-                frames = Frame.objects.filter(block=block, frametype__in=[Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE]).values_list('id', flat=True)
+                frames = Frame.objects.filter(block=block, frametype__in=[Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE])
                 cat_sources = CatalogSources.objects.filter(frame__in=frames)
                 self.stdout.write("Found %6d CatalogSources for Block %5d (for %s)" % (cat_sources.count(), block.id, block.body.provisional_name))
-                if options['delete']:
+                if options['columnar']:
+                    self.stdout.write("Moving CatalogSources to columnar store")
+                    for frame in frames:
+                        migrate_frame_sources(frame, delete=options['delete'])
+                elif options['delete']:
                     self.stdout.write("Deleting CatalogSources")
                     cat_sources.delete()
+                    num_files = sum([delete_frame_sources(frame) for frame in frames.exclude(sources_file=None)])
+                    if num_files > 0:
+                        self.stdout.write("Deleted %d columnar source files" % num_files)
 
         # XXX Todo purge CatalogSources from non-reported Blocks that are 2 x age old
 
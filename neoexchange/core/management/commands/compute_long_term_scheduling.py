@@ -13,16 +13,18 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from os.path import expanduser
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Q
 from django.db import close_old_connections
 from django.forms.models import model_to_dict
 
 from astrometrics.sources_subs import fetch_yarkovsky_targets
-from astrometrics.ephem_subs import monitor_long_term_scheduling
+from astrometrics.ephem_cache import ephem_cache
+from astrometrics.ephem_subs import monitor_long_term_scheduling, darkness_times_table
 from core.models import Body
 
 
@@ -36,6 +38,7 @@ class Command(BaseCommand):
         parser.add_argument('--targetlist', action="store", default=None, help="File of targets to read (optional; set to 'FTP' to read from JPL site)")
         parser.add_argument('--start_date', default=datetime.utcnow().strftime('%Y-%m-%d'), help='Date to start ephemeris search in YYYY-MM-DD format')
         parser.add_argument('--date_range', type=int, default=30, help='Date range ephemeris search in days')
+        parser.add_argument('--cache_dir', default=settings.EPHEM_CACHE_DIR, help="Directory to keep darkness times and nightly summaries in between runs ('' to not keep them)")
 
     def handle(self, *args, **options):
         self.stdout.write("==== Computing scheduling dates %s ====" % (datetime.now().strftime('%Y-%m-%d %H:%M')))
@@ -56,13 +59,22 @@ class Command(BaseCommand):
         self.stdout.write("Combined target list")
         self.stdout.write("\n".join(target_list))
         self.stdout.write("========================")
+        # Darkness times are the same for all targets so compute them once.
+        # These and the nights already computed for the current elements of
+        # a target are kept in the ephemeris cache, which persists between
+        # runs in [cache_dir], so only new nights are computed.
+        if ephem_cache.use_backing_dir(options['cache_dir']) is None:
+            self.stdout.write("Not keeping nightly summaries between runs")
+        start_date = datetime.strptime(options['start_date'], '%Y-%m-%d')
+        darkness_times_table(options['site_code'], start_date, start_date + timedelta(days=options['date_range']))
+        ephem_cache.reset_stats()
         for obj_id in target_list:
             try:
                 target = Body.objects.get(name=obj_id)
             except Body.MultipleObjectsReturned:
                 target = Body.objects.get(name=obj_id, active=True)
             orbelems = model_to_dict(target)
-            visible_dates, emp_visible_dates, dark_and_up_time_all, max_alt_all = monitor_long_term_scheduling(options['site_code'], orbelems, datetime.strptime(options['start_date'], '%Y-%m-%d'), options['date_range'], options['dark_and_up_time_limit'])
+            visible_dates, emp_visible_dates, dark_and_up_time_all, max_alt_all = monitor_long_term_scheduling(options['site_code'], orbelems, start_date, options['date_range'], options['dark_and_up_time_limit'])
             self.stdout.write("Reading target %s" % obj_id)
             self.stdout.write("Visible dates:")
             for date in visible_dates:
@@ -84,3 +96,5 @@ class Command(BaseCommand):
                 x += 1
             self.stdout.write("========================")
             close_old_connections()
+        cache_stats = ephem_cache.stats()
+        self.stdout.write("Computed %d new nights, reused %d" % (cache_stats['misses'], cache_stats['hits'] + cache_stats['backing_hits']))
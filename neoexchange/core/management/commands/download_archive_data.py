@@ -49,6 +49,7 @@ class Command(BaseCommand):
         parser.add_argument('--spectraonly', default=False, action='store_true', help='Whether to only download spectra')
         parser.add_argument('--dlengimaging', default=False, action='store_true', help='Whether to download imaging for LCOEngineering')
         parser.add_argument('--numdays', action="store", default=0.0, type=float, help='How many extra days to look for')
+        parser.add_argument('--workers', action="store", default=4, type=int, help='Number of simultaneous downloads (default: 4)')
 
     def handle(self, *args, **options):
         usage = "Incorrect usage. Usage: %s [YYYYMMDD] [proposal code]" % ( argv[1] )
@@ -104,7 +105,7 @@ class Command(BaseCommand):
                 for red_lvl in all_frames.keys():
                     self.stdout.write("Found %d frames for reduction level: %s" % (len(all_frames[red_lvl]), red_lvl))
                 out_path = options['datadir']
-                dl_frames = download_files(all_frames, out_path, verbose)
+                dl_frames = download_files(all_frames, out_path, verbose, num_workers=options['workers'])
                 self.stdout.write("Downloaded %d frames" % (len(dl_frames)))
 
                 # unpack tarballs and make movie.
@@ -42,6 +42,87 @@ class Command(BaseCommand):
         parser.add_argument('--keep-temp-dir', action="store_true", help='Whether to remove the temporary directories')
         parser.add_argument('--object', action="store", help="Which object to analyze (replace spaces with underscores)")
         parser.add_argument('--skip-download', action="store_true", help='Whether to skip downloading data')
+        parser.add_argument('--workers', type=int, default=1, help='Number of SExtractor/SCAMP runs to make at once when refitting the catalogs of all the targets up front; the ingest, mtdlink and light curve steps still run one target at a time (default: 1)')
+
+    def target_catalogs(self, rock, dataroot):
+        """Returns the list of catalogs of the target in the <rock> directory
+        of <dataroot> that process_target() will run pipeline_astrometry on
+        (an empty list if it will be skipped)"""
+
+        datadir = os.path.join(dataroot, rock)
+        first_frame, last_frame = find_first_last_frames(get_fits_files(datadir))
+        if first_frame is None or last_frame is None or first_frame.block is None:
+            return []
+        body = first_frame.block.body
+        if body is None or body.epochofel is None:
+            return []
+        fits_files, fits_catalogs = pipeline_astrometry.Command().determine_images_and_catalogs(os.path.join(datadir, ''))
+
+        return fits_catalogs or []
+
+    def process_target(self, rock, dataroot, options):
+        """Pipeline process the frames of the target in the <rock> directory
+        of <dataroot>"""
+
+        datadir = os.path.join(dataroot, rock)
+        self.stdout.write('Processing target %s in %s' % (rock, datadir))
+
+# Step 3a: Check data is in DB
+        fits_files = get_fits_files(datadir)
+        self.stdout.write("Found %d FITS files in %s" % (len(fits_files), datadir))
+        first_frame, last_frame = find_first_last_frames(fits_files)
+        if first_frame is None or last_frame is None:
+            self.stderr.write("Couldn't determine first and last frames, skipping target")
+            return
+        self.stdout.write("Timespan %s->%s" % (first_frame.midpoint, last_frame.midpoint))
+# Step 3b: Calculate mean PA and speed
+        if first_frame.block:
+            body = first_frame.block.body
+            if body and body.epochofel:
+                elements = model_to_dict(body)
+                min_rate, max_rate, pa, deltapa = determine_rates_pa(first_frame.midpoint, last_frame.midpoint, elements, first_frame.sitecode)
+
+# Step 3c: Run pipeline_astrometry
+                mtdlink_args = "datadir=%s pa=%03d deltapa=%03d minrate=%.3f maxrate=%.3f" % (datadir, pa, deltapa, min_rate, max_rate)
+                skip_mtdlink = False
+                keep_temp_dir = False
+                if len(fits_files) > options['mtdlink_file_limit']:
+                    self.stdout.write("Too many frames to run mtd_link")
+                    skip_mtdlink = True
+                if options['keep_temp_dir']:
+                    keep_temp_dir = True
+# Compulsory arguments need to go here as a list
+                mtdlink_args = [datadir, pa, deltapa, min_rate, max_rate]
+
+# Optional arguments go here, minus the leading double minus signs and with
+# hyphens replaced by underscores for...reasons.
+# e.g. '--keep-temp-dir' becomes 'temp_dir'
+                mtdlink_kwargs = {'temp_dir': os.path.join(datadir, 'Temp'),
+                                  'skip_mtdlink': skip_mtdlink,
+                                  'keep_temp_dir': keep_temp_dir
+                                  }
+                self.stdout.write("Calling pipeline_astrometry with: %s %s" % (mtdlink_args, mtdlink_kwargs))
+                status = call_command('pipeline_astrometry', *mtdlink_args, **mtdlink_kwargs)
+                self.stderr.write("\n")
+            else:
+                self.stderr.write("Object %s does not have updated elements" % first_frame.block.current_name())
+
+# Step 4: Run Lightcurve Extraction
+            if body:
+                if first_frame.block.superblock.tracking_number == last_frame.block.superblock.tracking_number:
+                    status = call_command('lightcurve_extraction', int(first_frame.block.superblock.tracking_number),
+                                          '--single', '--date', options['date'])
+                else:
+                    tn_list = []
+                    for fits in fits_files:
+                        if fits.block.superblock.tracking_number not in tn_list:
+                            status = call_command('lightcurve_extraction', int(fits.block.superblock.tracking_number),
+                                                  '--single', '--date', options['date'])
+                            tn_list.append(fits.block.superblock.tracking_number)
+            else:
+                self.stderr.write("Block does not have a Body")
+        else:
+            self.stderr.write("No Block found for the object")
 
     def handle(self, *args, **options):
         usage = "Incorrect usage. Usage: %s --date [YYYYMMDD] --proposal [proposal code] --datadir [path]" % ( argv[1])
@@ -102,69 +183,32 @@ class Command(BaseCommand):
         print(objects)
 
 # Step 3: For each object:
+        rocks = []
         for rock in objects:
             # Skip if a specific object was specified on the commandline and this isn't it
             if options['object'] is not None:
                 if options['object'] not in rock:
                     continue
-            datadir = os.path.join(dataroot, rock)
-            self.stdout.write('Processing target %s in %s' % (rock, datadir))
-
-# Step 3a: Check data is in DB
-            fits_files = get_fits_files(datadir)
-            self.stdout.write("Found %d FITS files in %s" % (len(fits_files), datadir))
-            first_frame, last_frame = find_first_last_frames(fits_files)
-            if first_frame is None or last_frame is None:
-                self.stderr.write("Couldn't determine first and last frames, skipping target")
-                continue
-            self.stdout.write("Timespan %s->%s" % (first_frame.midpoint, last_frame.midpoint))
-# Step 3b: Calculate mean PA and speed
-            if first_frame.block:
-                body = first_frame.block.body
-                if body and body.epochofel:
-                    elements = model_to_dict(body)
-                    min_rate, max_rate, pa, deltapa = determine_rates_pa(first_frame.midpoint, last_frame.midpoint, elements, first_frame.sitecode)
-
-# Step 3c: Run pipeline_astrometry
-                    mtdlink_args = "datadir=%s pa=%03d deltapa=%03d minrate=%.3f maxrate=%.3f" % (datadir, pa, deltapa, min_rate, max_rate)
-                    skip_mtdlink = False
-                    keep_temp_dir = False
-                    if len(fits_files) > options['mtdlink_file_limit']:
-                        self.stdout.write("Too many frames to run mtd_link")
-                        skip_mtdlink = True
-                    if options['keep_temp_dir']:
-                        keep_temp_dir = True
-# Compulsory arguments need to go here as a list
-                    mtdlink_args = [datadir, pa, deltapa, min_rate, max_rate]
-
-# Optional arguments go here, minus the leading double minus signs and with
-# hyphens replaced by underscores for...reasons.
-# e.g. '--keep-temp-dir' becomes 'temp_dir'
-                    mtdlink_kwargs = {'temp_dir': os.path.join(datadir, 'Temp'),
-                                      'skip_mtdlink': skip_mtdlink,
-                                      'keep_temp_dir': keep_temp_dir
-                                      }
-                    self.stdout.write("Calling pipeline_astrometry with: %s %s" % (mtdlink_args, mtdlink_kwargs))
-                    status = call_command('pipeline_astrometry', *mtdlink_args, **mtdlink_kwargs)
-                    self.stderr.write("\n")
-                else:
-                    self.stderr.write("Object %s does not have updated elements" % first_frame.block.current_name())
-
-# Step 4: Run Lightcurve Extraction
-                if body:
-                    if first_frame.block.superblock.tracking_number == last_frame.block.superblock.tracking_number:
-                        status = call_command('lightcurve_extraction', int(first_frame.block.superblock.tracking_number),
-                                              '--single', '--date', options['date'])
-                    else:
-                        tn_list = []
-                        for fits in fits_files:
-                            if fits.block.superblock.tracking_number not in tn_list:
-                                status = call_command('lightcurve_extraction', int(fits.block.superblock.tracking_number),
-                                                      '--single', '--date', options['date'])
-                                tn_list.append(fits.block.superblock.tracking_number)
-                else:
-                    self.stderr.write("Block does not have a Body")
-            else:
-                self.stderr.write("No Block found for the object")
+            rocks.append(rock)
+        target_options = {key: options[key] for key in ('date', 'mtdlink_file_limit', 'keep_temp_dir')}
+        if options['workers'] > 1:
+            # Refit the catalogs of all the targets with SExtractor and SCAMP
+            # up to <workers> at once first. The new Frames are created here
+            # so pipeline_astrometry finds the refitted catalogs below. Only
+            # the refit is parallel; the rest of process_target() (ingest,
+            # mtdlink and light curves) writes to the DB throughout so still
+            # runs one target at a time.
+            catalogs = []
+            for rock in rocks:
+                temp_dir = os.path.join(dataroot, rock, 'Temp')
+                rock_catalogs = self.target_catalogs(rock, dataroot)
+                if len(rock_catalogs) > 0 and os.path.exists(temp_dir) is False:
+                    os.makedirs(temp_dir)
+                catalogs += [(catalog, temp_dir) for catalog in rock_catalogs]
+            self.stdout.write("Refitting %d catalogs with %d workers" % (len(catalogs), options['workers']))
+            configs_dir = os.path.abspath(os.path.join('photometrics', 'configs'))
+            pipeline_astrometry.refit_catalogs(configs_dir, catalogs, options['workers'])
+        for rock in rocks:
+            self.process_target(rock, dataroot, target_options)
 
         self.stdout.write("\n==== Completed download and process astrometry %s ====" % (datetime.now().strftime('%Y-%m-%d %H:%M')))
@@ -14,18 +14,13 @@ GNU General Public License for more details.
 """
 
 from datetime import datetime, timedelta, time
-from math import degrees, radians, floor, copysign
+from math import radians, floor
 from sys import exit
 import os
 import tempfile
 import stat
 import warnings
 
-try:
-    import pyslalib.slalib as S
-except:
-    pass
-from astroquery.jplhorizons import Horizons
 from astropy.wcs import FITSFixedWarning
 try:
     from astropy.stats import LombScargle
@@ -42,14 +37,16 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 
-from astrometrics.ephem_subs import compute_ephem, radec2strings, moon_alt_az, get_sitepos
+from astrometrics.ephem_subs import radec2strings
 from astrometrics.time_subs import datetime2mjd_utc
 from core.archive_subs import make_data_dir
 from core.models import Block, Frame, SuperBlock, SourceMeasurement, CatalogSources, DataProduct
 from core.utils import save_dataproduct
-from photometrics.catalog_subs import search_box, sanitize_object_name, \
-    open_fits_catalog, make_object_directory, increment_red_level
+from photometrics.catalog_subs import search_boxes, sanitize_object_name, \
+    read_fits_headers, make_object_directory, increment_red_level
 from photometrics.gf_movie import make_gif
+from photometrics.lightcurve_subs import predict_frame_positions, horizons_frame_positions, compute_frame_airmasses, \
+    select_best_source, source_separations
 from photometrics.photometry_subs import compute_fwhm, map_filter_to_wavelength
 
 
@@ -311,6 +308,28 @@ class Command(BaseCommand):
         alcdef_txt += 'ENDDATA\n'
         return alcdef_txt
 
+    def select_frames(self, block):
+        """Returns a list of the reduced frames of <block> to use, picking the
+        NEOx-reduced frames if they have at least as many zeropoints as the
+        BANZAI-reduced ones"""
+
+        frames_red = Frame.objects.filter(block=block.id, frametype__in=[Frame.BANZAI_RED_FRAMETYPE]).order_by('filter', 'midpoint')
+        frames_neox = Frame.objects.filter(block=block.id, frametype__in=[Frame.NEOX_RED_FRAMETYPE]).order_by('filter', 'midpoint')
+        if frames_neox.filter(zeropoint__isnull=False).count() >= frames_red.filter(zeropoint__isnull=False).count():
+            return list(frames_neox)
+        return list(frames_red)
+
+    def predict_positions(self, body, frames, ra_offset, dec_offset, horizons=False):
+        """Returns arrays of the predicted RA, Dec (radians) and magnitude of
+        <body> at the midpoints of all of <frames>, either from the orbital
+        elements or from JPL HORIZONS if [horizons] is True (falling back to
+        the orbital elements for any frames HORIZONS can't provide)"""
+
+        elements = model_to_dict(body)
+        if horizons is True:
+            return horizons_frame_positions(frames, body.current_name().replace('_', ' '), elements, ra_offset, dec_offset)
+        return predict_frame_positions(frames, elements, ra_offset, dec_offset)
+
     def handle(self, *args, **options):
 
         # Suppress incorrect FITSFixedWarnings
@@ -401,7 +420,22 @@ class Command(BaseCommand):
             if obs_date:
                 block_list = block_list.filter(when_observed__lt=obs_date+timedelta(days=2)).filter(when_observed__gt=obs_date)
             self.stdout.write("Analyzing SuperblockBlock# %s for %s" % (super_block.tracking_number, super_block.body.current_name()))
-            for block in block_list:
+
+            # Get all Useful frames from each block, then predict the target positions (with one
+            # ephemeris batch per site and Block), find the sources and compute the airmasses
+            # for all of the frames of the SuperBlock in one go
+            block_frames = [(block, self.select_frames(block)) for block in block_list]
+            sb_frames = [frame for block, frames_all_zp in block_frames for frame in frames_all_zp]
+            sb_ra, sb_dec, sb_mags = self.predict_positions(super_block.body, sb_frames, ra_offset, dec_offset, options['horizons'])
+            sb_sources = [[] for frame in sb_frames]
+            good_rows = np.flatnonzero(np.isfinite(sb_ra) & np.isfinite(sb_dec))
+            box_queries = [(sb_frames[i], sb_ra[i], sb_dec[i]) for i in good_rows]
+            for i, sources in zip(good_rows, search_boxes(box_queries, options['boxwidth'], max_ap_size=options['maxapsize'])):
+                sb_sources[i] = sources
+            sb_airmass = compute_frame_airmasses(sb_frames, sb_ra, sb_dec)
+
+            sb_index = 0
+            for block, frames_all_zp in block_frames:
                 block_mags = []
                 block_mag_errs = []
                 block_times = []
@@ -409,70 +443,35 @@ class Command(BaseCommand):
                 self.stdout.write("Analyzing Block# %d" % block.id)
 
                 obs_site = block.site
-                # Get all Useful frames from each block
-                frames_red = Frame.objects.filter(block=block.id, frametype__in=[Frame.BANZAI_RED_FRAMETYPE]).order_by('filter', 'midpoint')
-                frames_neox = Frame.objects.filter(block=block.id, frametype__in=[Frame.NEOX_RED_FRAMETYPE]).order_by('filter', 'midpoint')
-                if frames_neox.filter(zeropoint__isnull=False).count() >= frames_red.filter(zeropoint__isnull=False).count():
-                    frames_all_zp = frames_neox
-                else:
-                    frames_all_zp = frames_red
-                frames = frames_all_zp.filter(zeropoint__isnull=False, zeropoint__gte=0)
-                self.stdout.write("Found %d frames (of %d total) for Block# %d with good ZPs" % (frames.count(), frames_all_zp.count(), block.id))
+                block_rows = slice(sb_index, sb_index + len(frames_all_zp))
+                sb_index += len(frames_all_zp)
+                num_frames = len([frame for frame in frames_all_zp if frame.zeropoint is not None and frame.zeropoint >= 0])
+                self.stdout.write("Found %d frames (of %d total) for Block# %d with good ZPs" % (num_frames, len(frames_all_zp), block.id))
                 self.stdout.write("Searching within %.1f arcseconds and +/-%.2f delta magnitudes" % (options['boxwidth'], options['deltamag']))
-                total_frame_count += frames.count()
+                total_frame_count += num_frames
                 frame_data = []
-                if frames_all_zp.count() != 0:
-                    elements = model_to_dict(block.body)
+                if len(frames_all_zp) != 0:
                     filter_list = []
 
-                    for frame in frames_all_zp:
-                        # get predicted position and magnitude of target during time of each frame
-                        if options['horizons'] is True:
-                            t_jd = Time(frame.midpoint).jd
-                            obj = Horizons(block.body.current_name().replace('_', ' '),
-                               id_type='smallbody',
-                               epochs=t_jd,
-                               location=frame.sitecode)
-                            eph = obj.ephemerides()
-                            if len(eph) > 0:
-                                ra = eph['RA'].to(u.rad).value
-                                dec = eph['DEC'].to(u.rad).value
-                                try:
-                                    mag_estimate = eph['V']
-                                except KeyError:
-                                    mag_estimate = eph['Tmag']
-                        else:
-                            emp_line = compute_ephem(frame.midpoint, elements, frame.sitecode)
-                            ra = emp_line['ra']
-                            dec = emp_line['dec']
-                            mag_estimate = emp_line['mag']
-
-                        ra = S.sla_dranrm(ra + ra_offset)
-                        dec = copysign(S.sla_drange(dec + dec_offset), dec + dec_offset)
+                    for frame, ra, dec, mag_estimate, sources, airmass in zip(frames_all_zp, sb_ra[block_rows], sb_dec[block_rows],
+                                                                              sb_mags[block_rows], sb_sources[block_rows], sb_airmass[block_rows]):
                         (ra_string, dec_string) = radec2strings(ra, dec, ' ')
-                        # Find list of frame sources within search region of predicted coordinates
-                        sources = search_box(frame, ra, dec, options['boxwidth'], max_ap_size=options['maxapsize'])
                         midpoint_string = frame.midpoint.strftime('%Y-%m-%d %H:%M:%S')
                         self.stdout.write("%s %s %s V=%.1f %s (%d) %s" % (midpoint_string, ra_string, dec_string, mag_estimate, frame.sitecode, len(sources), frame.filename))
                         best_source = None
                         # Find source most likely to be target (Could Use Some Work)
                         if len(sources) != 0 and frame.zeropoint is not None:
-                            if len(sources) == 1:
-                                best_source = sources[0]
-                            elif len(sources) > 1:  # If more than 1 source, pick closest within deltamag
-                                min_sep = options['boxwidth'] * options['boxwidth']
-                                for source in sources:
-                                    sep = S.sla_dsep(ra, dec, radians(source.obs_ra), radians(source.obs_dec))
-                                    sep = degrees(sep) * 3600.0
+                            # Compare against the last matched magnitude so slow changes can be followed
+                            if len(block_mags) > 0:
+                                ref_mag = block_mags[-1]
+                            else:
+                                ref_mag = mag_estimate
+                            best_source = select_best_source(sources, ra, dec, ref_mag, options['boxwidth'], options['deltamag'])
+                            if len(sources) > 1 and options['verbosity'] > 1:
+                                seps, delta_mags = source_separations(sources, ra, dec, ref_mag)
+                                for source, sep, delta_mag in zip(sources, seps, delta_mags):
                                     src_ra_string, src_dec_string = radec2strings(radians(source.obs_ra), radians(source.obs_dec))
-                                    if len(block_mags) > 0:
-                                        delta_mag = abs(block_mags[-1] - source.obs_mag)
-                                    else:
-                                        delta_mag = abs(mag_estimate - source.obs_mag)
-                                    self.stdout.write("%s %s %s %s %.1f %.1f-%.1f %.1f" % ( ra_string, dec_string, src_ra_string, src_dec_string, sep, mag_estimate, source.obs_mag, delta_mag))
-                                    if sep < min_sep and delta_mag <= options['deltamag']:
-                                        min_sep = sep
-                                        best_source = source
+                                    self.stdout.write("%s %s %s %s %.1f %.1f-%.1f %.1f" % (ra_string, dec_string, src_ra_string, src_dec_string, sep, mag_estimate, source.obs_mag, delta_mag))
 
                             # Save target source and add to output files.
                             if best_source and best_source.obs_mag > 0.0 and abs(mag_estimate - best_source.obs_mag) <= 3 * options['deltamag']:
@@ -502,9 +501,7 @@ class Command(BaseCommand):
                                            'best_source': best_source})
                         alltimes.append(frame.midpoint)
                         fwhm.append(frame.fwhm)
-                        azimuth, altitude = moon_alt_az(frame.midpoint, ra, dec, *get_sitepos(frame.sitecode)[1:])
-                        zenith_distance = radians(90) - altitude
-                        air_mass.append(S.sla_airmas(zenith_distance))
+                        air_mass.append(airmass)
                         obs_site = frame.sitecode
                         catalog = frame.photometric_catalog
                         if catalog == 'GAIA-DR2':
@@ -528,11 +525,10 @@ class Command(BaseCommand):
                     if not options['nogif']:
                         data_path = make_data_dir(out_path, model_to_dict(frames_all_zp[0]))
                         red_paths = []
-                        for f in frames_all_zp:
-                            # This code predates the addition of Block.get_blockuid() which is why it needs
-                            # to look in the original e91 files
-                            fits_filepath = os.path.join(data_path, f.filename.replace('e92', 'e91').replace('-e72', ''))
-                            fits_header, fits_table, cattype = open_fits_catalog(fits_filepath, header_only=True)
+                        # This code predates the addition of Block.get_blockuid() which is why it needs
+                        # to look in the original e91 files
+                        fits_filepaths = [os.path.join(data_path, f.filename.replace('e92', 'e91').replace('-e72', '')) for f in frames_all_zp]
+                        for fits_filepath, (fits_header, cattype) in zip(fits_filepaths, read_fits_headers(fits_filepaths)):
                             object_name = fits_header.get('OBJECT', None)
                             block_id = fits_header.get('BLKUID', '').replace('/', '')
                             object_directory = ''
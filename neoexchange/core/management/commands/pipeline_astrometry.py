@@ -14,18 +14,60 @@ GNU General Public License for more details.
 """
 
 import os
+import shutil
 from datetime import datetime
 from glob import glob
 from sys import exit
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand, CommandError
 
-from core.views import check_catalog_and_refit, store_detections
+from core.views import check_catalog_and_refit, check_catalog_for_refit, refit_catalogs_wcs, \
+    record_refitted_catalog, store_detections
 from photometrics.catalog_subs import store_catalog_sources, make_sext_file, extract_sci_image
 from photometrics.external_codes import make_pa_rate_dict, run_mtdlink
 
 
+def refit_catalogs(configs_dir, catalogs, workers):
+    """Runs the equivalent of check_catalog_and_refit() for each of the
+    <catalogs> (a list of (catalog, temp_dir) tuples) with the SExtractor and
+    SCAMP runs of the catalogs in each temp_dir made by refit_catalogs_wcs().
+    The temp_dirs (e.g. of different targets) are refit alongside each other
+    with the <workers> shared between them. The DB checks and the creation of
+    the new Frames are done here in the calling process.
+    Returns a list of (new catalog or status, number of new Frames), one per
+    catalog in the same order as <catalogs>."""
+
+    checks = [check_catalog_for_refit(temp_dir, catalog, desired_catalog='GAIA-DR2') for catalog, temp_dir in catalogs]
+    refits = {}
+    for index, ((catalog, temp_dir), (status, header, fits_file)) in enumerate(zip(catalogs, checks)):
+        if status is None:
+            refits.setdefault(temp_dir, []).append((index, (catalog, fits_file, header)))
+    refitted = {}
+    if len(refits) > 0:
+        num_dirs = min(workers, len(refits))
+
+        def refit_temp_dir(temp_dir):
+            return refit_catalogs_wcs(configs_dir, temp_dir, [refit for index, refit in refits[temp_dir]],
+                                      desired_catalog='GAIA-DR2', max_workers=max(workers // num_dirs, 1))
+
+        with ThreadPoolExecutor(max_workers=num_dirs) as executor:
+            for temp_dir, new_catalogs in zip(refits, executor.map(refit_temp_dir, refits)):
+                refitted.update(zip([index for index, refit in refits[temp_dir]], new_catalogs))
+
+    results = []
+    for index, ((catalog, temp_dir), (status, header, fits_file)) in enumerate(zip(catalogs, checks)):
+        if status is not None:
+            results.append((status, 0))
+        elif type(refitted[index]) == int:
+            results.append((refitted[index], 0))
+        else:
+            results.append(record_refitted_catalog(catalog, refitted[index], header))
+
+    return results
+
+
 class Command(BaseCommand):
 
     help = """Perform pipeline processing on a set of FITS frames.
@@ -41,6 +83,7 @@ class Command(BaseCommand):
         parser.add_argument('--keep-temp-dir', action="store_true", help='Whether to remove the temporary dir')
         parser.add_argument('--temp-dir', dest='temp_dir', action="store", help='Name of the temporary directory to use')
         parser.add_argument('--skip-mtdlink', action="store_true", help='Whether to skip running mtdlink')
+        parser.add_argument('--workers', type=int, default=1, help='Number of SExtractor/SCAMP runs to make at once when refitting catalogs (default: 1)')
 
     def determine_images_and_catalogs(self, datadir, output=True):
 
@@ -97,11 +140,20 @@ class Command(BaseCommand):
         fits_file_list = []
 
         configs_dir = os.path.abspath(os.path.join('photometrics', 'configs'))
-        for catalog in fits_catalogs:
+        refit_results = None
+        if options['workers'] > 1 and len(fits_catalogs) > 1:
+            # Step 1 (in parallel): Determine if astrometric fit in catalogs
+            # is good and if not, refit using SExtractor and SCAMP.
+            self.stdout.write("Refitting %d catalogs with %d workers" % (len(fits_catalogs), options['workers']))
+            refit_results = refit_catalogs(configs_dir, [(catalog, temp_dir) for catalog in fits_catalogs], options['workers'])
+        for i, catalog in enumerate(fits_catalogs):
             # Step 1: Determine if astrometric fit in catalog is good and
             # if not, refit using SExtractor and SCAMP.
             self.stdout.write("Processing %s" % catalog)
-            new_catalog_or_status, num_new_frames_created = check_catalog_and_refit(configs_dir, temp_dir, catalog, desired_catalog='GAIA-DR2')
+            if refit_results is not None:
+                new_catalog_or_status, num_new_frames_created = refit_results[i]
+            else:
+                new_catalog_or_status, num_new_frames_created = check_catalog_and_refit(configs_dir, temp_dir, catalog, desired_catalog='GAIA-DR2')
 
             catalog_type = 'LCOGT'
             try:
@@ -171,7 +223,10 @@ class Command(BaseCommand):
             try:
                 files_to_remove = glob(os.path.join(temp_dir, '*'))
                 for file_to_rm in files_to_remove:
-                    os.remove(file_to_rm)
+                    if os.path.isdir(file_to_rm):
+                        shutil.rmtree(file_to_rm)
+                    else:
+                        os.remove(file_to_rm)
             except OSError:
                 self.stdout.write("Error removing files in temporary test directory %s" % temp_dir)
             try:
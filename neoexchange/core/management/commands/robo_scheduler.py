@@ -13,31 +13,64 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 """
 
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from math import degrees
+from threading import Lock
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
 
-from core.models import Body, Block
+from core.models import Body, Block, compute_bodies_ephem
 from core.views import schedule_check, schedule_submit, record_block
 from astrometrics.ephem_subs import format_emp_line, determine_sites_to_schedule, get_sitepos,\
     moon_ra_dec
 from astrometrics.sources_subs import get_site_status
 from pyslalib.slalib import sla_dsep
 
-def compute_moon_sep(date, object_ra, object_dec, site='500'):
+logger = logging.getLogger(__name__)
+
+
+def compute_moon_position(date, site='500'):
+    '''Compute the RA, Dec (in radians) of the Moon at time <date> from the specified
+    [site] (defaults to geocenter if not specified)'''
+
+    site_name, site_long, site_lat, site_hgt = get_sitepos(site)
+    moon_ra, moon_dec, diam = moon_ra_dec(date, site_long, site_lat, site_hgt)
+
+    return moon_ra, moon_dec
+
+def compute_moon_sep(date, object_ra, object_dec, site='500', moon_position=None):
     '''Compute the separation between an object at <object_ra>, <object_dec> and the Moon
     at time <date> from the specified [site] (defaults to geocenter if not specified.
+    The Moon's RA, Dec can be passed in as [moon_position] if it's already known.
     The separation is returned in degrees.'''
 
-    site_name, site_long, site_lat, site_hgt = get_sitepos(site)
-    moon_ra, moon_dec, diam = moon_ra_dec(date, site_long, site_lat, site_hgt)
+    if moon_position is None:
+        moon_position = compute_moon_position(date, site)
+    moon_ra, moon_dec = moon_position
     moon_obj_sep = sla_dsep(object_ra, object_dec, moon_ra, moon_dec)
     moon_obj_sep = degrees(moon_obj_sep)
 
     return moon_obj_sep
 
+def count_blocks(bodies, run_datetime):
+    '''Counts the active and the inactive but unreported (and observed) Blocks for
+    each of the <bodies> with one query each rather than two per Body.
+    Returns dictionaries of the counts keyed by Body id'''
+
+    blocks = Block.objects.filter(body__in=bodies).values('body').annotate(num=Count('id')).order_by()
+    active = blocks.filter(active=True, block_end__gte=run_datetime-timedelta(seconds=35*60))
+    not_found = blocks.filter(active=False, num_observed__gte=1, reported=False)
+    num_active = {row['body']: row['num'] for row in active}
+    num_not_found = {row['body']: row['num'] for row in not_found}
+
+    return num_active, num_not_found
+
 def filter_bodies(bodies, obs_date = datetime.utcnow(), bright_limit = 19.0, faint_limit = 22.0, spd_south_cut=95.0, speed_cutoff=5.0, moon_sep_cutoff=30.0, too=False):
     north_1m0_list = []
     north_0m4_list = []
@@ -47,18 +80,26 @@ def filter_bodies(bodies, obs_date = datetime.utcnow(), bright_limit = 19.0, fai
 
     run_datetime = datetime.utcnow()
 
+    # Compute the positions of all the bodies in one go and the things that
+    # are the same for all of them (Moon position, counts of Blocks) up front
+    bodies = list(bodies)
+    emp_lines = compute_bodies_ephem(bodies)
+    moon_position = compute_moon_position(obs_date, '500')
+    if too == False:
+        num_active_blocks, num_not_found_blocks = count_blocks(bodies, run_datetime)
+
     print(" Object     RA           Dec       Mag.   Speed  Moon Sep.")
     print("----------------------------------------------------------")
 
-    for body in bodies:
-        body_line = body.compute_position()
+    for body, body_emp_line in zip(bodies, emp_lines):
+        body_line = body.compute_position(emp_line=body_emp_line)
+        if not body_line:
+            continue
         vmag = body_line[2]
         spd = body_line[3]
         sky_motion = body_line[-2]
         sky_motion_pa = body_line[-1]
-        if not body_line:
-            continue
-        moon_sep = compute_moon_sep(obs_date, body_line[0], body_line[1], '500')
+        moon_sep = compute_moon_sep(obs_date, body_line[0], body_line[1], '500', moon_position)
         prefix = ' '
         suffix = ' '
         if moon_sep < moon_sep_cutoff:
@@ -89,8 +130,8 @@ def filter_bodies(bodies, obs_date = datetime.utcnow(), bright_limit = 19.0, fai
             schedule = False
         # Find number of active and inactive but unreported Blocks
         if too == False:
-            num_active = Block.objects.filter(body=body, active=True, block_end__gte=run_datetime-timedelta(seconds=35*60)).count()
-            num_not_found = Block.objects.filter(body=body, active=False, num_observed__gte=1, reported=False).count()
+            num_active = num_active_blocks.get(body.pk, 0)
+            num_not_found = num_not_found_blocks.get(body.pk, 0)
             if num_active >= 1:
                 status = "Already active"
                 schedule = False
@@ -119,23 +160,72 @@ def filter_bodies(bodies, obs_date = datetime.utcnow(), bright_limit = 19.0, fai
 
     return north_list, south_list
 
-def schedule_target_list(bodies_list, form_details, username):
+class RateLimiter(object):
+    '''Spaces out calls to wait() from any number of threads so they return at
+    least <min_interval> seconds apart'''
+
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self._next_time = 0.0
+        self._lock = Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+def schedule_target_list(bodies_list, form_details, username, max_workers=4, submit_interval=0.5):
+    '''Checks and schedules each of the targets in <bodies_list> with the
+    details in <form_details>. The requests are submitted to the portal from
+    up to [max_workers] threads at once, started at least [submit_interval]
+    seconds apart; the resulting Blocks are recorded from this thread, each
+    in its own transaction.
+    Returns the number and the list of names of the targets scheduled.'''
+
     num_scheduled = 0
     objects_scheduled = []
-    if bodies_list:
-        for target in bodies_list:
+    if not bodies_list:
+        return num_scheduled, objects_scheduled
+
+    # Checks are done in order as they may move the date on for later targets
+    checked_targets = []
+    for target in bodies_list:
+        data = schedule_check(form_details, target)
+        if datetime.strptime(data['end_time'], '%Y-%m-%dT%H:%M:%S') <= datetime.utcnow():
+            form_details['utc_date'] += timedelta(days=1)
             data = schedule_check(form_details, target)
-            if datetime.strptime(data['end_time'], '%Y-%m-%dT%H:%M:%S') <= datetime.utcnow():
-                form_details['utc_date'] += timedelta(days=1)
-                data = schedule_check(form_details, target)
 
-            data['start_time'] = datetime.strptime(data['start_time'],'%Y-%m-%dT%H:%M:%S')
-            data['end_time'] = datetime.strptime(data['end_time'],'%Y-%m-%dT%H:%M:%S')
+        data['start_time'] = datetime.strptime(data['start_time'],'%Y-%m-%dT%H:%M:%S')
+        data['end_time'] = datetime.strptime(data['end_time'],'%Y-%m-%dT%H:%M:%S')
+
+        print("%s@%s for %s->%s" % (target.current_name(), data['site_code'], data['start_time'], data['end_time']))
+        checked_targets.append((target, data))
+
+    rate_limiter = RateLimiter(submit_interval)
 
-            print("%s@%s for %s->%s" % (target.current_name(), data['site_code'], data['start_time'], data['end_time']))
-            tracking_num, sched_params = schedule_submit(data, target, username)
-            user = User.objects.get(username=username)
-            block_resp = record_block(tracking_num, sched_params, data, target, user)
+    def submit(target, data):
+        rate_limiter.wait()
+        try:
+            return schedule_submit(data, target, username)
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    user = User.objects.get(username=username)
+    num_workers = max(min(max_workers, len(checked_targets)), 1)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(submit, target, data) for target, data in checked_targets]
+        for (target, data), future in zip(checked_targets, futures):
+            try:
+                tracking_num, sched_params = future.result()
+            except Exception as e:
+                logger.error("Submission of %s failed: %s" % (target.current_name(), e))
+                continue
+            with transaction.atomic():
+                block_resp = record_block(tracking_num, sched_params, data, target, user)
 
             if block_resp:
                 num_scheduled += 1
@@ -167,6 +257,8 @@ class Command(BaseCommand):
         parser.add_argument('--object', default=None, type=str, help="Specific object to schedule")
         parser.add_argument('--skip_north', action="store_true", help="Whether to skip scheduling in the North")
         parser.add_argument('--skip_south', action="store_true", help="Whether to skip scheduling in the South")
+        parser.add_argument('--max_workers', default=4, type=int, help="Maximum number of requests to submit at once (4)")
+        parser.add_argument('--submit_interval', default=0.5, type=float, help="Minimum time between submitting requests (0.5 secs)")
 
     def handle(self, *args, **options):
         usage = "Incorrect usage. Usage: %s --date [YYYYMMDD[-HH]] --user [tlister@lcogt.net] --run"
@@ -276,7 +368,8 @@ class Command(BaseCommand):
                     do_south = False
                 # Schedule telescopes
                 if do_north:
-                    num_scheduled, objects_scheduled = schedule_target_list(north_list[tel_class], north_form, username)
+                    num_scheduled, objects_scheduled = schedule_target_list(north_list[tel_class], north_form, username,
+                                                                            options['max_workers'], options['submit_interval'])
                     self.stdout.write("Scheduled %d (%s) in the North at %s" % (num_scheduled, objects_scheduled, north_form['site_code']))
                 else:
                     if options['skip_north']:
@@ -284,7 +377,8 @@ class Command(BaseCommand):
                     else:
                         self.stdout.write("No %s sites in the North available for scheduling" % tel_class)
                 if do_south:
-                    num_scheduled, objects_scheduled = schedule_target_list(south_list[tel_class], south_form, username)
+                    num_scheduled, objects_scheduled = schedule_target_list(south_list[tel_class], south_form, username,
+                                                                            options['max_workers'], options['submit_interval'])
                     self.stdout.write("Scheduled %d (%s) in the South at %s" % (num_scheduled,  objects_scheduled, south_form['site_code']))
                 else:
                     if options['skip_south']:
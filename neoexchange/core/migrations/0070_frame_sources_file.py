@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0069_alter_block_site'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='frame',
+            name='sources_file',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Columnar CatalogSources file'),
+        ),
+    ]
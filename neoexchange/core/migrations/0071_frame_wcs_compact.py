@@ -0,0 +1,117 @@
+# Generated by Django 4.2.30 on 2026-10-17 09:12
+"""
+This is a Data Migration to convert the stored Frame WCS from base64-encoded
+pickles to the compact header card form written by serialize_wcs().
+https://docs.djangoproject.com/en/4.2/topics/migrations/#data-migrations
+The conversion functions are copies of those in core.models.frame at the
+time of writing so later changes there don't change what this migration does.
+"""
+
+import json
+from base64 import b64decode, b64encode
+from pickle import loads, dumps
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def wcs_to_header(wcs_object):
+    wcs_header = wcs_object.to_header()
+    # Add back missing NAXIS keywords, change back to CD matrix
+    wcs_header.insert(0, ("NAXIS", 2, "number of array dimensions"))
+    naxis1 = 0
+    naxis2 = 0
+    if wcs_object.pixel_shape is not None and wcs_object.naxis == 2:
+        naxis1 = wcs_object.pixel_shape[0]
+        naxis2 = wcs_object.pixel_shape[1]
+    wcs_header.insert(1, ("NAXIS1", naxis1, ""))
+    wcs_header.insert(2, ("NAXIS2", naxis2, ""))
+    wcs_header.remove("CDELT1")
+    wcs_header.remove("CDELT2")
+    # Some of these may be missing depending on whether there was any rotation
+    num_missing = 0
+    for pc in ['PC1_1', 'PC1_2', 'PC2_1', 'PC2_2']:
+        if pc in wcs_header:
+            wcs_header.rename_keyword(pc, pc.replace("PC", "CD"))
+        else:
+            num_missing += 1
+    # Check if there was no PC matrix at all, insert a unity CD matrix
+    if num_missing == 4:
+        cd_comment = "Coordinate transformation matrix element"
+        wcs_header.insert("CRVAL2", ("CD1_1", 1.0, cd_comment), after=True)
+        wcs_header.insert( "CD1_1", ("CD1_2", 0.0, cd_comment), after=True)
+        wcs_header.insert( "CD1_2", ("CD2_1", 0.0, cd_comment), after=True)
+        wcs_header.insert( "CD2_1", ("CD2_2", 1.0, cd_comment), after=True)
+
+    return wcs_header
+
+
+def serialize_wcs(wcs_object):
+    wcs_header = wcs_to_header(wcs_object)
+    # Values may be numpy scalars (e.g. from pixel_shape)
+    cards = [(card.keyword, getattr(card.value, 'item', lambda: card.value)()) for card in wcs_header.cards
+             if card.keyword not in ('', 'COMMENT', 'HISTORY')]
+    return json.dumps(cards, separators=(',', ':'))
+
+
+def deserialize_wcs(wcs_string):
+    wcs_header = fits.Header([tuple(card) for card in json.loads(wcs_string)])
+    return WCS(wcs_header)
+
+
+def unpickle_wcs(wcs_string):
+    wcs_bytes = b64decode(wcs_string.encode())
+    wcs_header = loads(wcs_bytes)
+    return WCS(wcs_header)
+
+
+def pickle_wcs(wcs_object):
+    wcs_header = wcs_to_header(wcs_object)
+    return b64encode(dumps(wcs_header, protocol=2)).decode()
+
+
+def convert_frame_wcs(apps, converter, needs_conversion):
+    Frame = apps.get_model('core', 'Frame')
+    # WCSField.from_db_value() returns the stored string without decoding it
+    frames = Frame.objects.exclude(wcs=None).values_list('pk', 'wcs')
+    batch = []
+    for pk, wcs_string in frames.iterator(chunk_size=BATCH_SIZE):
+        if needs_conversion(wcs_string):
+            batch.append((pk, converter(wcs_string)))
+        if len(batch) >= BATCH_SIZE:
+            update_frames(Frame, batch)
+            batch = []
+    update_frames(Frame, batch)
+
+
+def update_frames(Frame, batch):
+    # One UPDATE per Frame: bulk_update() would read the values back through
+    # the WCSField descriptor, turning them back into WCS objects that then get
+    # re-serialized in the current format
+    with transaction.atomic():
+        for pk, wcs_string in batch:
+            Frame.objects.filter(pk=pk).update(wcs=wcs_string)
+
+
+def compact_wcs(apps, schema_editor):
+    convert_frame_wcs(apps, lambda value: serialize_wcs(unpickle_wcs(value)),
+                      lambda value: not value.startswith('['))
+
+
+def pickle_compact_wcs(apps, schema_editor):
+    convert_frame_wcs(apps, lambda value: pickle_wcs(deserialize_wcs(value)),
+                      lambda value: value.startswith('['))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0070_frame_sources_file'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_wcs, pickle_compact_wcs)
+    ]
@@ -19,7 +19,8 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.forms.models import model_to_dict
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Sum, Count, Prefetch, Subquery, OuterRef
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.utils.functional import cached_property
 from django.contrib.contenttypes.fields import GenericRelation
@@ -56,6 +57,41 @@ SITE_CHOICES = (
 
 logger = logging.getLogger(__name__)
 
+
+def related_count(model, outer_field='block', **filters):
+    """Returns a Subquery expression counting the <model> instances (matching
+    <filters>) that point at the outer row through <outer_field>, for use in
+    annotate() so the count arrives with the outer query"""
+
+    counts = model.objects.filter(**{outer_field: OuterRef('pk')}, **filters).order_by()
+    counts = counts.values(outer_field).annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+
+class SuperBlockQuerySet(models.QuerySet):
+    def with_blocks(self, frame_counts=False):
+        """Fetches the targets and Proposal with the SuperBlocks and prefetches
+        their Blocks (annotated with their frame and candidate counts if
+        [frame_counts] is True) so that the per-SuperBlock summaries don't
+        need further queries"""
+
+        blocks = Block.objects.all()
+        if frame_counts:
+            blocks = blocks.with_frame_counts()
+        return self.select_related('body', 'calibsource', 'proposal').prefetch_related(Prefetch('block_set', queryset=blocks))
+
+
+class BlockQuerySet(models.QuerySet):
+    def with_frame_counts(self):
+        """Annotates the Blocks with the numbers of reduced and quicklook
+        Frames and Candidates, which are then used by num_red_frames(),
+        num_unique_red_frames() and num_candidates()"""
+
+        return self.annotate(red_frame_count=related_count(Frame, frametype=Frame.BANZAI_RED_FRAMETYPE),
+                             ql_frame_count=related_count(Frame, frametype=Frame.BANZAI_QL_FRAMETYPE),
+                             candidate_count=related_count(Candidate))
+
+
 class SuperBlock(models.Model):
 
     cadence         = models.BooleanField(default=False)
@@ -73,6 +109,8 @@ class SuperBlock(models.Model):
     active          = models.BooleanField(default=False)
     dataproduct     = GenericRelation(DataProduct, related_query_name='sblock')
 
+    objects = SuperBlockQuerySet.as_manager()
+
     @cached_property
     def get_blocks(self):
         """Return and Cache the queryset of all blocks connected to the SuperBlock"""
@@ -143,24 +181,22 @@ class SuperBlock(models.Model):
         return num_reported, bl.count()
 
     def get_last_observed(self):
-        last_observed = None
-        qs = Block.objects.filter(superblock=self.id, num_observed__gte=1)
-        if qs.count() > 0:
-            last_observed = qs.latest('when_observed').when_observed
+        bl = self.get_blocks
+        observed = [b.when_observed for b in bl if b.num_observed and b.num_observed >= 1 and b.when_observed is not None]
+        last_observed = max(observed, default=None)
 
         return last_observed
 
     def get_last_reported(self):
-        last_reported = None
-        qs = Block.objects.filter(superblock=self.id, reported=True)
-        if qs.count() > 0:
-            last_reported = qs.latest('when_reported').when_reported
+        bl = self.get_blocks
+        reported = [b.when_reported for b in bl if b.reported is True and b.when_reported is not None]
+        last_reported = max(reported, default=None)
 
         return last_reported
 
     def get_obstypes(self):
-        obstype = []
-        obstypes = Block.objects.filter(superblock=self.id).values_list('obstype', flat=True).distinct()
+        bl = self.get_blocks
+        obstypes = OrderedDict.fromkeys([b.obstype for b in bl])
 
         return ",".join([str(x) for x in obstypes])
 
@@ -221,6 +257,8 @@ class Block(models.Model):
     dataproduct     = GenericRelation(DataProduct, related_query_name='block')
     tracking_rate   = models.SmallIntegerField('Tracking Strategy', choices=RATE_CHOICES, blank=False, default=100)
 
+    objects = BlockQuerySet.as_manager()
+
     @cached_property
     def get_blockuid(self):
         """Return and Cache the BLKUID"""
@@ -289,16 +327,22 @@ class Block(models.Model):
 
     def num_red_frames(self):
         """Returns the total number of reduced frames (quicklook and fully reduced)"""
+        if hasattr(self, 'red_frame_count'):
+            return self.red_frame_count + self.ql_frame_count
         return self.frame_set.filter(frametype__in=[11, 91]).count()
 
     def num_unique_red_frames(self):
         """Returns the number of *unique* reduced frames (quicklook OR fully reduced)"""
-        reduced_frames = self.frame_set.filter(frametype=91)
-        ql_frames = self.frame_set.filter(frametype=11)
-        if reduced_frames.count() >= ql_frames.count():
-            total_exposure_number = reduced_frames.count()
+        if hasattr(self, 'red_frame_count'):
+            num_reduced_frames = self.red_frame_count
+            num_ql_frames = self.ql_frame_count
+        else:
+            num_reduced_frames = self.frame_set.filter(frametype=91).count()
+            num_ql_frames = self.frame_set.filter(frametype=11).count()
+        if num_reduced_frames >= num_ql_frames:
+            total_exposure_number = num_reduced_frames
         else:
-            total_exposure_number = ql_frames.count()
+            total_exposure_number = num_ql_frames
         return total_exposure_number
 
     def num_spectro_frames(self):
@@ -322,31 +366,31 @@ class Block(models.Model):
         return num_spectra
 
     def num_candidates(self):
+        if hasattr(self, 'candidate_count'):
+            return self.candidate_count
         return Candidate.objects.filter(block=self.id).count()
 
     def where_observed(self):
         where_observed=''
         if self.num_observed is not None:
             frames = Frame.objects.filter(block=self.id, frametype=Frame.BANZAI_RED_FRAMETYPE)
-            if frames.count() > 0:
-                # Code for producing full site strings + site codes e.g. 'W85'
-                # where_observed_qs = frames.distinct('sitecode')
-                # where_observed = ",".join([site.return_site_string() + " (" + site.sitecode + ")" for site in where_observed_qs])
-                # Alternative which doesn't need PostgreSQL DISTINCT ON <fieldname>
-                unique_sites = frames.values('sitecode').distinct()
-                where_observed = ",".join([frames.filter(sitecode=site['sitecode'])[0].return_site_string() + " (" + site['sitecode'] + ")" for site in unique_sites])
+            # Code for producing full site strings + site codes e.g. 'W85'
+            # Alternative which doesn't need PostgreSQL DISTINCT ON <fieldname>;
+            # the site string only depends on the site code so doesn't need
+            # a Frame from the database
+            unique_sites = frames.order_by().values_list('sitecode', flat=True).distinct()
+            where_observed = ",".join([Frame(sitecode=site).return_site_string() + " (" + site + ")" for site in unique_sites])
         return where_observed
 
     def which_instruments(self):
         which_instruments=''
         if self.num_observed is not None:
             frames = Frame.objects.filter(block=self.id, frametype=Frame.BANZAI_RED_FRAMETYPE)
-            if frames.count() > 0:
-                # which_instruments_qs = frames.distinct('instrument')
-                # which_instruments = ",".join([inst for inst in which_instruments_qs])
-                # Alternative which doesn't need PostgreSQL DISTINCT ON <fieldname>
-                unique_insts = frames.values_list('instrument', flat=True).distinct()
-                which_instruments = ",".join(unique_insts)
+            # which_instruments_qs = frames.distinct('instrument')
+            # which_instruments = ",".join([inst for inst in which_instruments_qs])
+            # Alternative which doesn't need PostgreSQL DISTINCT ON <fieldname>
+            unique_insts = frames.order_by().values_list('instrument', flat=True).distinct()
+            which_instruments = ",".join(unique_insts)
         return which_instruments
 
     class Meta:
@@ -17,10 +17,14 @@ import logging
 
 from astropy.time import Time
 from django.db import models
+from django.db.models import Count, Max, Q, Prefetch
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from django.forms.models import model_to_dict
 
-from astrometrics.ephem_subs import compute_ephem, comp_FOM, comp_sep
+from astrometrics.ephem_subs import compute_ephem, cached_compute_ephem, comp_FOM, comp_sep, compute_ephem_many, \
+    ephem_batch_to_list
+from astrometrics.ephem_cache import ephem_cache
 from astrometrics.albedo import asteroid_diameter
 
 
@@ -140,6 +144,33 @@ PHYSICAL_PARAMETER_QUALITIES = {"P": {-99: 'Debunked (0)',
 logger = logging.getLogger(__name__)
 
 
+class BodyQuerySet(models.QuerySet):
+    def with_block_info(self):
+        """Annotates the Bodies with the numbers of Blocks, observed Blocks and
+        reported Blocks, which are then used by get_block_info()"""
+
+        return self.annotate(num_blocks=Count('block', distinct=True),
+                             num_blocks_observed=Count('block', filter=Q(block__num_observed__gte=1), distinct=True),
+                             num_blocks_reported=Count('block', filter=Q(block__reported=True), distinct=True))
+
+    def with_cadence_info(self):
+        """Annotates the Bodies with the number of cadence SuperBlocks and the
+        end of the last active and inactive ones, which are then used by
+        get_cadence_info()"""
+
+        cadence = Q(superblock__cadence=True)
+        return self.annotate(num_cadence_sblocks=Count('superblock', filter=cadence, distinct=True),
+                             last_active_cadence_end=Max('superblock__block_end', filter=cadence & Q(superblock__active=True)),
+                             last_inactive_cadence_end=Max('superblock__block_end', filter=cadence & Q(superblock__active=False)))
+
+    def with_designations(self):
+        """Prefetches the preferred Designations of the Bodies, which are then
+        used by full_name()"""
+
+        designations = Designations.objects.filter(preferred=True).order_by('pk')
+        return self.prefetch_related(Prefetch('designations_set', queryset=designations, to_attr='preferred_designations'))
+
+
 class Body(models.Model):
     provisional_name    = models.CharField('Provisional MPC designation', max_length=15, blank=True, null=True, db_index=True)
     provisional_packed  = models.CharField('MPC name in packed format', max_length=7, blank=True, null=True, db_index=True)
@@ -175,6 +206,8 @@ class Body(models.Model):
     analysis_status     = models.IntegerField('Current Analysis Status', choices=STATUS_CHOICES, db_index=True, default=0)
     as_updated          = models.DateTimeField(blank=True, null=True, db_index=True)
 
+    objects = BodyQuerySet.as_manager()
+
     def _compute_period(self):
         period = None
         if self.eccentricity:
@@ -260,9 +293,14 @@ class Body(models.Model):
             return "Unknown"
 
     def full_name(self):
-        name = Designations.objects.filter(body=self.id).filter(desig_type='N').filter(preferred=True)
-        num = Designations.objects.filter(body=self.id).filter(desig_type='#').filter(preferred=True)
-        prov_dev = Designations.objects.filter(body=self.id).filter(desig_type='P').filter(preferred=True)
+        if hasattr(self, 'preferred_designations'):
+            name = [desig for desig in self.preferred_designations if desig.desig_type == 'N']
+            num = [desig for desig in self.preferred_designations if desig.desig_type == '#']
+            prov_dev = [desig for desig in self.preferred_designations if desig.desig_type == 'P']
+        else:
+            name = Designations.objects.filter(body=self.id).filter(desig_type='N').filter(preferred=True)
+            num = Designations.objects.filter(body=self.id).filter(desig_type='#').filter(preferred=True)
+            prov_dev = Designations.objects.filter(body=self.id).filter(desig_type='P').filter(preferred=True)
         fname = ''
         if num:
             fname += num[0].value
@@ -287,12 +325,19 @@ class Body(models.Model):
         else:
             return False
 
-    def compute_position(self, d=None):
+    def compute_position(self, d=None, emp_line=None):
+        """Compute the geocentric position at <d> (defaults to now). A precomputed
+        <emp_line> (e.g. from compute_bodies_ephem()) can be passed instead."""
+        # The ephemeris is cached so a page asking for the position and the
+        # distances of the same Body only computes it once; "now" is
+        # truncated to the minute so that calls in quick succession share it
+        bucket_size = 60 if d is None else None
         d = d or datetime.utcnow()
         if self.epochofel:
-            orbelems = model_to_dict(self)
-            sitecode = '500'
-            emp_line = compute_ephem(d, orbelems, sitecode, dbg=False, perturb=False, display=False)
+            if emp_line is None:
+                orbelems = model_to_dict(self)
+                sitecode = '500'
+                emp_line = cached_compute_ephem(d, orbelems, sitecode, perturb=False, bucket_size=bucket_size)
             if not emp_line:
                 return False
             else:
@@ -302,12 +347,15 @@ class Body(models.Model):
             # Catch the case where there is no Epoch
             return False
 
-    def compute_distances(self, d=None):
+    def compute_distances(self, d=None, emp_line=None):
+        # Cached as for compute_position()
+        bucket_size = 60 if d is None else None
         d = d or datetime.utcnow()
         if self.epochofel:
-            orbelems = model_to_dict(self)
-            sitecode = '500'
-            emp_line = compute_ephem(d, orbelems, sitecode, dbg=False, perturb=False, display=False)
+            if emp_line is None:
+                orbelems = model_to_dict(self)
+                sitecode = '500'
+                emp_line = cached_compute_ephem(d, orbelems, sitecode, perturb=False, bucket_size=bucket_size)
             if not emp_line:
                 return False
             else:
@@ -317,10 +365,12 @@ class Body(models.Model):
             # Catch the case where there is no Epoch
             return False
 
-    def compute_obs_window(self, d=None, dbg=False):
+    def compute_obs_window(self, d=None, dbg=False, ephem_lookup=None):
         """
         Compute rough window during which target may be observable based on when it is brighter than a
         given mag_limit amd further from the sun than sep_limit.
+        Ephemeris lines for the dates needed can be passed in as a dictionary
+        of {datetime: emp_line} in <ephem_lookup> (see compute_bodies_obs_window_ephem()).
         """
         if not isinstance(d, datetime):
             d = datetime.utcnow()
@@ -340,7 +390,10 @@ class Body(models.Model):
             # calculate the ephemeris for each step (delta_t) within the time span df.
             while i <= df / delta_t + 1:
 
-                ephem_out = compute_ephem(d, orbelems, sitecode, dbg=False, perturb=False, display=False)
+                if ephem_lookup is not None and d in ephem_lookup:
+                    ephem_out = ephem_lookup[d]
+                else:
+                    ephem_out = compute_ephem(d, orbelems, sitecode, dbg=False, perturb=False, display=False)
                 mag_dot = ephem_out['mag_dot']
                 separation = ephem_out['sun_sep']
                 vmag = ephem_out['mag']
@@ -415,12 +468,13 @@ class Body(models.Model):
             # Catch the case where there is no Epoch
             return False
 
-    def compute_FOM(self):
+    def compute_FOM(self, emp_line=None):
         d = datetime.utcnow()
         if self.epochofel:
             orbelems = model_to_dict(self)
-            sitecode = '500'
-            emp_line = compute_ephem(d, orbelems, sitecode, dbg=False, perturb=False, display=False)
+            if emp_line is None:
+                sitecode = '500'
+                emp_line = compute_ephem(d, orbelems, sitecode, dbg=False, perturb=False, display=False)
             if 'U' in orbelems['source_type'] and orbelems['not_seen'] is not None and orbelems['arc_length'] is not None and orbelems['score'] is not None:
                 FOM = comp_FOM(orbelems, emp_line)
                 return FOM
@@ -431,11 +485,18 @@ class Body(models.Model):
             return None
 
     def get_block_info(self):
-        blocks = self.block_set.all()
-        num_blocks = blocks.count()
+        if hasattr(self, 'num_blocks'):
+            num_blocks = self.num_blocks
+        else:
+            blocks = self.block_set.all()
+            num_blocks = blocks.count()
         if num_blocks > 0:
-            num_blocks_observed = blocks.filter(num_observed__gte=1).count()
-            num_blocks_reported = blocks.filter(reported=True).count()
+            if hasattr(self, 'num_blocks_observed'):
+                num_blocks_observed = self.num_blocks_observed
+                num_blocks_reported = self.num_blocks_reported
+            else:
+                num_blocks_observed = blocks.filter(num_observed__gte=1).count()
+                num_blocks_reported = blocks.filter(reported=True).count()
             observed = "%d/%d" % (num_blocks_observed, num_blocks)
             reported = "%d/%d" % (num_blocks_reported, num_blocks)
         else:
@@ -444,25 +505,34 @@ class Body(models.Model):
         return observed, reported
 
     def get_cadence_info(self):
-        cad_blocks = self.superblock_set.filter(cadence=True)
-        num_cad_blocks = cad_blocks.count()
+        if hasattr(self, 'num_cadence_sblocks'):
+            num_cad_blocks = self.num_cadence_sblocks
+            last_active_end = self.last_active_cadence_end
+            last_inactive_end = self.last_inactive_cadence_end
+        else:
+            cad_blocks = self.superblock_set.filter(cadence=True)
+            num_cad_blocks = cad_blocks.count()
+            last_active_end = last_inactive_end = None
+            if num_cad_blocks > 0:
+                active_sblocks = cad_blocks.filter(active=True)
+                if active_sblocks.count() > 0:
+                    last_active_end = active_sblocks.latest('block_end').block_end
+                else:
+                    last_inactive_end = cad_blocks.filter(active=False).latest('block_end').block_end
         if num_cad_blocks > 0:
-            active_sblocks = cad_blocks.filter(active=True)
             prefix = "Division by cucumber"
-            if active_sblocks.count() > 0:
-                last_sblock = active_sblocks.latest('block_end')
+            if last_active_end is not None:
                 prefix = "Active until"
-                if datetime.utcnow() > last_sblock.block_end:
+                if datetime.utcnow() > last_active_end:
                     prefix = "Inactive since"
-                block_time = last_sblock.block_end.strftime("%m/%d")
+                block_time = last_active_end.strftime("%m/%d")
             else:
                 # There are SBlocks but none are active
-                last_sblock = cad_blocks.filter(active=False).latest('block_end')
                 prefix = "Inactive"
                 block_time = ""
-                if datetime.utcnow() > last_sblock.block_end:
+                if datetime.utcnow() > last_inactive_end:
                     prefix = "Inactive since"
-                    block_time = last_sblock.block_end.strftime("%m/%d")
+                    block_time = last_inactive_end.strftime("%m/%d")
 
             scheduled = "{} {}".format(prefix, block_time)
             scheduled = scheduled.rstrip()
@@ -589,6 +659,56 @@ class Body(models.Model):
         return u'%s is %sactive' % (return_name, text)
 
 
+def compute_bodies_ephem(bodies, d=None, sitecode='500'):
+    """Computes the ephemeris of all the passed <bodies> (a list or QuerySet of
+    Body) at the single datetime <d> (defaults to now) in one vectorized pass
+    with compute_ephem_many().
+    Returns a list (in the same order as <bodies>) of compute_ephem()-style
+    dictionaries ({} for Bodies without elements or a computable position)
+    suitable for passing to Body.compute_position()/compute_FOM() etc."""
+
+    d = d or datetime.utcnow()
+    bodies = list(bodies)
+    with_elements = [body for body in bodies if body.epochofel]
+    emp = compute_ephem_many(d, [model_to_dict(body) for body in with_elements], sitecode)
+    emp_lines = dict(zip([body.pk for body in with_elements], ephem_batch_to_list(emp)))
+
+    return [emp_lines.get(body.pk, {}) for body in bodies]
+
+
+def compute_bodies_obs_window_ephem(bodies, d=None):
+    """Computes, for many <bodies> at once, the ephemerides needed by
+    Body.compute_obs_window() for all the dates it can step through.
+    Returns the start datetime and a list (in the same order as <bodies>)
+    of {datetime: emp_line} dictionaries to be passed as the `ephem_lookup`
+    to Body.compute_obs_window() along with the start datetime."""
+
+    if not isinstance(d, datetime):
+        d = datetime.utcnow()
+    # Must match the `df` and `delta_t` in Body.compute_obs_window()
+    df = 90
+    delta_t = 10
+    bodies = list(bodies)
+    dates = [d + timedelta(days=step) for step in range(0, df + delta_t, delta_t)]
+    ephems_by_date = [compute_bodies_ephem(bodies, ephem_date) for ephem_date in dates]
+
+    ephem_lookups = []
+    for i in range(len(bodies)):
+        ephem_lookups.append({ephem_date: ephems[i] for ephem_date, ephems in zip(dates, ephems_by_date)})
+
+    return d, ephem_lookups
+
+
+@receiver(models.signals.post_save, sender=Body)
+@receiver(models.signals.post_delete, sender=Body)
+def invalidate_ephem_cache(sender, instance, **kwargs):
+    """
+    Drops any cached ephemerides for the Body when it is saved (e.g. with new
+    elements from save_and_make_revision()) or deleted.
+    """
+    ephem_cache.invalidate(instance.pk)
+
+
 class Designations(models.Model):
     body        = models.ForeignKey(Body, on_delete=models.CASCADE)
     value       = models.CharField('Designation', blank=True, null=True, max_length=30, db_index=True)
@@ -10,8 +10,12 @@ but WITHOUT ANY WARRANTY; without even the implied warranty of
 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 """
+import json
+
+from astropy.io import fits
 from astropy.wcs import WCS
 from django.db import models
+from django.db.models.query_utils import DeferredAttribute
 from django.utils.encoding import force_str
 try:
     # cpython 2.x
@@ -20,9 +24,28 @@ except ImportError:
     from pickle import loads, dumps
 from base64 import b64decode, b64encode
 
+class WCSDescriptor(DeferredAttribute):
+    """Descriptor for WCSField which keeps the serialized value loaded from
+    the database and only turns it into an astropy WCS object the first
+    time the attribute is accessed"""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super(WCSDescriptor, self).__get__(instance, cls)
+        if isinstance(value, str):
+            value = self.field.to_python(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
 class WCSField(models.Field):
 
     description = "Store astropy.wcs objects"
+    descriptor_class = WCSDescriptor
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('editable', False)
@@ -35,9 +58,8 @@ class WCSField(models.Field):
         return name, path, args, kwargs
 
     def from_db_value(self, value, expression, connection):
-        if value is None:
-            return value
-        return unpickle_wcs(value)
+        # Deserialization is deferred to WCSDescriptor.__get__
+        return value
 
     def to_python(self, value):
         if isinstance(value, WCS):
@@ -46,18 +68,22 @@ class WCSField(models.Field):
         if value is None:
             return value
 
-        return unpickle_wcs(value)
+        return deserialize_wcs(value)
+
+    def pre_save(self, model_instance, add):
+        # Avoid decoding a WCS that was never accessed just to re-encode it
+        return model_instance.__dict__.get(self.attname)
 
     def get_prep_value(self, value):
-        return pickle_wcs(value)
+        return serialize_wcs(value)
 
     def get_db_prep_value(self, value, connection=None, prepared=False):
         if value is not None:
-            value = force_str(pickle_wcs(value))
+            value = force_str(serialize_wcs(value))
         return value
 
     def value_to_string(self, obj):
-        value = self.value_from_object(obj)
+        value = obj.__dict__.get(self.attname)
         return self.get_db_prep_value(value)
 
     def get_internal_type(self):
@@ -114,6 +140,7 @@ class Frame(models.Model):
     wcs         = WCSField('WCS info', blank=True, null=True, editable=False)
     astrometric_catalog = models.CharField('Astrometric catalog used', max_length=40, default=' ')
     photometric_catalog = models.CharField('Photometric catalog used', max_length=40, default=' ')
+    sources_file = models.CharField('Columnar CatalogSources file', max_length=255, blank=True, null=True)
 
     def get_x_size(self):
         x_size = None
@@ -284,6 +311,67 @@ class Frame(models.Model):
             name = "%s@%s" % ( self.midpoint, self.sitecode.rstrip())
         return name
 
+def wcs_to_header(wcs_object):
+    """Returns a FITS header for astropy WCS <wcs_object> with the NAXIS
+    keywords added back and the PC matrix turned back into a CD matrix. This
+    doesn't use WCS.to_header() directly as that loses needed information"""
+
+    wcs_header = wcs_object.to_header()
+    # Add back missing NAXIS keywords, change back to CD matrix
+    wcs_header.insert(0, ("NAXIS", 2, "number of array dimensions"))
+    naxis1 = 0
+    naxis2 = 0
+    if wcs_object.pixel_shape is not None and wcs_object.naxis == 2:
+        naxis1 = wcs_object.pixel_shape[0]
+        naxis2 = wcs_object.pixel_shape[1]
+    wcs_header.insert(1, ("NAXIS1", naxis1, ""))
+    wcs_header.insert(2, ("NAXIS2", naxis2, ""))
+    wcs_header.remove("CDELT1")
+    wcs_header.remove("CDELT2")
+    # Some of these may be missing depending on whether there was any rotation
+    num_missing = 0
+    for pc in ['PC1_1', 'PC1_2', 'PC2_1', 'PC2_2']:
+        if pc in wcs_header:
+            wcs_header.rename_keyword(pc, pc.replace("PC", "CD"))
+        else:
+            num_missing += 1
+    # Check if there was no PC matrix at all, insert a unity CD matrix
+    if num_missing == 4:
+        cd_comment = "Coordinate transformation matrix element"
+        wcs_header.insert("CRVAL2", ("CD1_1", 1.0, cd_comment), after=True)
+        wcs_header.insert( "CD1_1", ("CD1_2", 0.0, cd_comment), after=True)
+        wcs_header.insert( "CD1_2", ("CD2_1", 0.0, cd_comment), after=True)
+        wcs_header.insert( "CD2_1", ("CD2_2", 1.0, cd_comment), after=True)
+
+    return wcs_header
+
+
+def serialize_wcs(wcs_object):
+    """Turn an astropy WCS object into a compact string of the WCS header
+    keyword and value pairs (as a JSON list, without the comments). Strings
+    that are already serialized are passed through unchanged."""
+
+    if wcs_object is not None and isinstance(wcs_object, WCS):
+        wcs_header = wcs_to_header(wcs_object)
+        # Values may be numpy scalars (e.g. from pixel_shape)
+        cards = [(card.keyword, getattr(card.value, 'item', lambda: card.value)()) for card in wcs_header.cards
+                 if card.keyword not in ('', 'COMMENT', 'HISTORY')]
+        value = json.dumps(cards, separators=(',', ':'))
+    else:
+        value = wcs_object
+    return value
+
+
+def deserialize_wcs(wcs_string):
+    """Takes a string produced by serialize_wcs() (or the older pickle_wcs())
+    and turns it into an astropy WCS object"""
+
+    if wcs_string.startswith('['):
+        wcs_header = fits.Header([tuple(card) for card in json.loads(wcs_string)])
+        return WCS(wcs_header)
+    return unpickle_wcs(wcs_string)
+
+
 def unpickle_wcs(wcs_string):
     """Takes a pickled string and turns into an astropy WCS object"""
     wcs_bytes = wcs_string.encode()     # encode str to bytes
@@ -298,33 +386,7 @@ def pickle_wcs(wcs_object):
     pickle_protocol = 2
 
     if wcs_object is not None and isinstance(wcs_object, WCS):
-        wcs_header = wcs_object.to_header()
-        # Add back missing NAXIS keywords, change back to CD matrix
-        wcs_header.insert(0, ("NAXIS", 2, "number of array dimensions"))
-        naxis1 = 0
-        naxis2 = 0
-        if wcs_object.pixel_shape is not None and wcs_object.naxis == 2:
-            naxis1 = wcs_object.pixel_shape[0]
-            naxis2 = wcs_object.pixel_shape[1]
-        wcs_header.insert(1, ("NAXIS1", naxis1, ""))
-        wcs_header.insert(2, ("NAXIS2", naxis2, ""))
-        wcs_header.remove("CDELT1")
-        wcs_header.remove("CDELT2")
-        # Some of these may be missing depending on whether there was any rotation
-        num_missing = 0
-        for pc in ['PC1_1', 'PC1_2', 'PC2_1', 'PC2_2']:
-            if pc in wcs_header:
-                wcs_header.rename_keyword(pc, pc.replace("PC", "CD"))
-            else:
-                num_missing += 1
-        # Check if there was no PC matrix at all, insert a unity CD matrix
-        if num_missing == 4:
-            cd_comment = "Coordinate transformation matrix element"
-            wcs_header.insert("CRVAL2", ("CD1_1", 1.0, cd_comment), after=True)
-            wcs_header.insert( "CD1_1", ("CD1_2", 0.0, cd_comment), after=True)
-            wcs_header.insert( "CD1_2", ("CD2_1", 0.0, cd_comment), after=True)
-            wcs_header.insert( "CD2_1", ("CD2_2", 1.0, cd_comment), after=True)
-
+        wcs_header = wcs_to_header(wcs_object)
         value = dumps(wcs_header, protocol=pickle_protocol)
         value = b64encode(value).decode()
     else:
@@ -15,6 +15,7 @@ import warnings
 from math import pi, log10, sqrt, cos, ceil
 
 from django.db import models
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from astropy.wcs import FITSFixedWarning
 from astropy.wcs.utils import proj_plane_pixel_scales
@@ -27,6 +28,7 @@ import astrometrics.site_config as cfg
 
 from core.models.body import Body
 from core.models.frame import Frame
+from core.standards_index import standards_index
 
 logger = logging.getLogger(__name__)
 
@@ -435,3 +437,13 @@ class StaticSource(models.Model):
 
     def __str__(self):
         return "{} ({})".format(self.name, self.return_source_type())
+
+
+@receiver(models.signals.post_save, sender=StaticSource)
+@receiver(models.signals.post_delete, sender=StaticSource)
+def invalidate_standards_index(sender, instance, **kwargs):
+    """
+    Drops the in-memory index of calibration sources (used to find the best
+    flux standards and solar analogs) when a StaticSource changes.
+    """
+    standards_index.invalidate()
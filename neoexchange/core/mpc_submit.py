@@ -12,11 +12,31 @@ but WITHOUT ANY WARRANTY; without even the implied warranty of
 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 """
+import os
+import logging
+
 from django.template.loader import get_template
 from django.core.mail import send_mail
 from django.conf import settings
 
-from core.frames import measurements_from_block
+from core.models import SourceMeasurement
+from core.frames import measurements_from_block, measurements_from_blocks
+from photometrics.catalog_subs import sanitize_object_name
+
+logger = logging.getLogger(__name__)
+
+# Header template, text that only appears once at the top of a report, the
+# line formatter and the file extension for each of the bulk report formats
+BULK_REPORT_FORMATS = {
+    'mpc': {'header': 'core/mpc_email_header.txt',
+            'preamble': '',
+            'formatter': SourceMeasurement.format_mpc_line,
+            'extension': '.mpc'},
+    'ades_psv': {'header': 'core/mpc_ades_psv_header.txt',
+                 'preamble': '# version=2017\n',
+                 'formatter': SourceMeasurement.format_psv_line,
+                 'extension': '.psv'}
+    }
 
 
 def generate_message(blockid, bodyid):
@@ -35,6 +55,97 @@ def generate_ades_psv_message(blockid, bodyid):
     # Strip off last double newline but put one back again
     return message.rstrip() + '\n'
 
+def _bulk_report_format(report_format):
+    try:
+        return BULK_REPORT_FORMATS[report_format]
+    except KeyError:
+        raise ValueError("Unknown report format '{}'".format(report_format))
+
+
+def _report_header_key(report_format, data):
+    """Returns a key for the values that the header of <report_format> depends
+    on, so that Blocks sharing a site, instrument etc. share a rendered header"""
+
+    measure = data['measures'][0]
+    frame = measure.frame
+    if report_format == 'mpc':
+        return (frame.sitecode, frame.instrument, frame.astrometric_catalog, frame.map_filter(), data['slot'].current_name())
+    return (frame.sitecode, measure.format_psv_header())
+
+
+def bulk_report_sections(blockids, bodyid=None, report_format='mpc'):
+    """Generator which yields a (Block, header, lines) tuple for each of the
+    Blocks in <blockids> with measurements (optionally only for Body <bodyid>)
+    in <report_format> ('mpc' or 'ades_psv'). The measurements for all the
+    Blocks are fetched in one go, the header template is only rendered once
+    for each distinct site/instrument/catalog combination and the lines are
+    formatted directly rather than through the template."""
+
+    report = _bulk_report_format(report_format)
+    header_template = get_template(report['header'])
+    headers = {}
+    for data in measurements_from_blocks(blockids, bodyid):
+        if not data['measures']:
+            logger.warning("No measurements to report for Block {}".format(data['slot'].pk))
+            continue
+        key = _report_header_key(report_format, data)
+        header = headers.get(key)
+        if header is None:
+            header = header_template.render({'body': data['body'], 'measures': data['measures'][:1]})
+            headers[key] = header
+        lines = [report['formatter'](measure) for measure in data['measures']]
+        yield data['slot'], header, lines
+
+
+def generate_bulk_messages(blockids, bodyid=None, report_format='mpc'):
+    """Generator which yields (Block, message) for each of the Blocks in
+    <blockids> with measurements, where the message is the same as would be
+    produced by generate_message() (for [report_format]='mpc') or
+    generate_ades_psv_message() (for [report_format]='ades_psv')"""
+
+    preamble = _bulk_report_format(report_format)['preamble']
+    for block, header, lines in bulk_report_sections(blockids, bodyid, report_format):
+        message = preamble + header + '\n'.join(lines)
+        yield block, message.rstrip() + '\n'
+
+
+def write_bulk_report(blockids, output_path, bodyid=None, report_format='mpc', combined=True):
+    """Writes the reports in <report_format> ('mpc' or 'ades_psv') for all the
+    Blocks in <blockids> (optionally only for Body <bodyid>). If [combined] is
+    True, a single report (with a header before each Block's measurements) is
+    written to the file <output_path>, otherwise a report per Block is written
+    into the directory <output_path>. The reports are streamed to disk as they
+    are formatted.
+    Returns the list of files written and the total number of lines."""
+
+    report_files = []
+    num_lines = 0
+    report = _bulk_report_format(report_format)
+    sections = bulk_report_sections(blockids, bodyid, report_format)
+    if combined:
+        with open(output_path, 'w') as output_fh:
+            output_fh.write(report['preamble'])
+            for block, header, lines in sections:
+                output_fh.write(header)
+                for line in lines:
+                    output_fh.write(line + '\n')
+                num_lines += len(lines)
+        report_files.append(output_path)
+    else:
+        os.makedirs(output_path, exist_ok=True)
+        for block, header, lines in sections:
+            filename = "{}_{}{}".format(sanitize_object_name(block.current_name()), block.request_number, report['extension'])
+            filename = os.path.join(output_path, filename)
+            with open(filename, 'w') as output_fh:
+                output_fh.write(report['preamble'] + header)
+                for line in lines:
+                    output_fh.write(line + '\n')
+            num_lines += len(lines)
+            report_files.append(filename)
+
+    return report_files, num_lines
+
+
 def email_report_to_mpc(blockid, bodyid, email_sender=None, recipients=settings.EMAIL_MPC_RECIPIENTS):
     if not bodyid:
         return False
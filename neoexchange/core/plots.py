@@ -47,7 +47,7 @@ from bokeh.core.properties import Instance, String, List
 from bokeh.util.compiler import TypeScript
 
 from .models import Body, CatalogSources, StaticSource, Block, model_to_dict, PreviousSpectra
-from astrometrics.ephem_subs import horizons_ephem, call_compute_ephem, determine_darkness_times, get_sitepos,\
+from astrometrics.ephem_subs import horizons_ephem, cached_call_compute_ephem, determine_darkness_times, get_sitepos,\
     moon_ra_dec, target_rise_set, moonphase, dark_and_object_up, compute_dark_and_up_time, get_visibility,\
     compute_ephem, orbital_pos_from_true_anomaly, get_planetary_elements
 from astrometrics.time_subs import jd_utc2datetime
@@ -479,7 +479,7 @@ def build_visibility_source(body, site_list, site_code, color_list, d, alt_limit
         (moon_app_ra, moon_app_dec, diam) = moon_ra_dec(d, site_long, site_lat, site_hgt)
         moon_rise, moon_set, moon_max_alt, moon_vis_time = target_rise_set(d, moon_app_ra, moon_app_dec, site, 10, step_size, sun=False)
         moon_phase = moonphase(d, site_long, site_lat, site_hgt)
-        emp = call_compute_ephem(body_elements, d, d + timedelta(days=1), site, step_size, perturb=False)
+        emp = cached_call_compute_ephem(body_elements, d, d + timedelta(days=1), site, step_size, perturb=False)
         obj_up_emp = dark_and_object_up(emp, d, d + timedelta(days=1), 0, alt_limit=alt_limit)
         vis_time, emp_obj_up, set_time = compute_dark_and_up_time(obj_up_emp, step_size)
         obj_set = datetime_to_radians(d, set_time)
@@ -0,0 +1,143 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2014-2019 LCO
+
+standards_index.py -- In-memory index of calibration sources (StaticSources).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import time
+import logging
+from threading import RLock
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from astrometrics.ephem_subs import radec_to_unit_vectors
+
+logger = logging.getLogger(__name__)
+
+
+def vector_separations(vectors, ra, dec):
+    """Returns the angular separations (radians) of each of the unit <vectors>
+    from <ra>, <dec> (radians), computed the same way as sla_dsep()"""
+
+    target = radec_to_unit_vectors(np.degrees(ra), np.degrees(dec))[0]
+    cross = np.cross(vectors, target)
+    return np.arctan2(np.sqrt((cross * cross).sum(axis=1)), vectors.dot(target))
+
+
+def load_static_sources():
+    """Returns all of the StaticSources (in primary key order)"""
+
+    from core.models import StaticSource
+
+    return list(StaticSource.objects.order_by('pk'))
+
+
+class StandardsIndex(object):
+    """Array-backed index of calibration sources for finding the closest
+    standards to a position without looping over the StaticSource table.
+    The sources are fetched with <loader> on first use and held as arrays of
+    unit vectors, RA, Dec, source type and quality, along with the model
+    instances. The index is reloaded after invalidate() (called when a
+    StaticSource is saved or deleted) or after <timeout> seconds (to pick up
+    changes made by other processes). Sources that were read inside an
+    uncommitted transaction aren't kept, as the changes may be rolled back,
+    unless [cache_in_transactions] is True (e.g. for a fixed list of sources)."""
+
+    def __init__(self, loader=load_static_sources, timeout=3600, cache_in_transactions=False):
+        self.loader = loader
+        self.timeout = timeout
+        self.cache_in_transactions = cache_in_transactions
+        self._lock = RLock()
+        self._arrays = None
+        self._loaded_time = None
+        self.loads = 0
+
+    @classmethod
+    def from_sources(cls, sources):
+        """Returns an index of the given list (or QuerySet) of <sources>"""
+
+        sources = list(sources)
+        return cls(loader=lambda: sources, timeout=None, cache_in_transactions=True)
+
+    def can_cache(self):
+        return self.cache_in_transactions or not connection.in_atomic_block
+
+    def _expired(self):
+        return self.timeout is not None and time.time() - self._loaded_time > self.timeout
+
+    def _build(self, sources):
+        ra = np.array([source.ra for source in sources], dtype=float)
+        dec = np.array([source.dec for source in sources], dtype=float)
+        quality = [source.quality for source in sources]
+        return {'sources': sources,
+                'ra': ra,
+                'dec': dec,
+                'vectors': radec_to_unit_vectors(ra, dec).reshape(len(sources), 3),
+                'source_type': np.array([source.source_type for source in sources], dtype=int),
+                # Sources with no quality set don't pass any quality cut
+                'quality': np.array([q if q is not None else np.nan for q in quality], dtype=float)
+                }
+
+    def arrays(self):
+        """Returns the dictionary of index arrays, (re)loading if needed"""
+
+        with self._lock:
+            if self._arrays is not None and not self._expired():
+                return self._arrays
+            arrays = self._build(self.loader())
+            self.loads += 1
+            if self.can_cache():
+                self._arrays = arrays
+                self._loaded_time = time.time()
+            return arrays
+
+    def invalidate(self):
+        """Drops the index so it's reloaded on next use"""
+
+        with self._lock:
+            self._arrays = None
+            self._loaded_time = None
+
+    def closest(self, ra, dec, source_type=None, min_quality=None, dec_limits=None, max_ra_diff=None, num=None):
+        """Finds the standards closest to <ra>, <dec> (radians), optionally
+        only of [source_type], with quality of at least [min_quality], with
+        Dec. within [dec_limits] ([min, max] in degrees) and RA within
+        [max_ra_diff] hours of <ra>.
+        Returns a list of (StaticSource, separation in radians) in order of
+        increasing separation (with ties in primary key order), limited to
+        the closest [num] if given."""
+
+        arrays = self.arrays()
+        mask = np.ones(len(arrays['sources']), dtype=bool)
+        if source_type is not None:
+            mask &= arrays['source_type'] == source_type
+        if min_quality is not None:
+            with np.errstate(invalid='ignore'):
+                mask &= arrays['quality'] >= min_quality
+        if dec_limits is not None:
+            mask &= (arrays['dec'] >= dec_limits[0]) & (arrays['dec'] <= dec_limits[1])
+        if max_ra_diff is not None:
+            mask &= np.abs(arrays['ra'] - np.degrees(ra)) / 15.0 < max_ra_diff
+        rows = np.flatnonzero(mask)
+        separations = vector_separations(arrays['vectors'][rows], ra, dec)
+        order = np.argsort(separations, kind='stable')
+        if num is not None:
+            order = order[:num]
+
+        return [(arrays['sources'][rows[i]], separations[i]) for i in order]
+
+
+standards_index = StandardsIndex(timeout=getattr(settings, 'STANDARDS_INDEX_TIMEOUT', 3600))
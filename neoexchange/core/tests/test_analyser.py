@@ -13,7 +13,7 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 '''
 
-from mock import patch
+from mock import patch, Mock
 from django.test import TestCase
 from django.urls import reverse
 
@@ -129,6 +129,27 @@ class Test_Analyser(TestCase):
         self.assertEqual(sources2.count(),4)
         self.assertEqual(sources2[0].obs_ra, 341.30244)
 
+    @patch('analyser.views.Candidate.objects.get')
+    def test_bad_candidate_rolled_back(self, mock_get):
+        bad_candidate = Mock()
+        bad_candidate.unpack_dets.return_value = MockCandidate.unpack_dets()[0:1]
+        mock_get.side_effect = [MockCandidate, bad_candidate]
+
+        resp = analyser_to_source_measurement(self.test_block, [1,2], 1)
+
+        self.assertFalse(resp)
+        self.assertEqual(0, SourceMeasurement.objects.filter(frame__block=self.test_block).count())
+        self.assertEqual(1, Body.objects.count())
+
+    @patch('analyser.views.Candidate.objects.get', MockCandidate)
+    def test_discovery_flag(self):
+        resp = analyser_to_source_measurement(self.test_block, [1,2], 1)
+
+        self.assertTrue(resp)
+        new_body = Body.objects.exclude(pk=self.body.pk).get()
+        self.assertEqual(['*', ' '], [sm.flags for sm in SourceMeasurement.objects.filter(body=new_body).order_by('frame__midpoint')])
+        self.assertEqual([' ', ' '], [sm.flags for sm in SourceMeasurement.objects.filter(body=self.body)])
+
     def test_url_reverses(self):
         submit_url = reverse('block-submit-mpc', kwargs={'pk':self.test_block.pk, 'source':2})
         analyser_url = reverse('block-ast', kwargs={'pk':self.test_block.pk})
@@ -17,6 +17,9 @@ from datetime import datetime, timedelta
 from unittest import skipIf
 from hashlib import md5
 import tempfile
+import shutil
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 from mock import patch
 from django.test import TestCase
@@ -492,3 +495,210 @@ class TestMakeDataDir(TestCase):
         outpath = make_data_dir(data_dir, frame)
 
         self.assertEqual(expected_out_dir, outpath)
+
+
+class MockArchiveHandler(BaseHTTPRequestHandler):
+    """Stand-in for the archive's file server which supports Range requests"""
+
+    files = {}
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append((self.path, self.headers.get('Range')))
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadFiles(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        MockArchiveHandler.files = {}
+        MockArchiveHandler.requests_seen = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockArchiveHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+        self.frames = {'91': []}
+        for i in range(6):
+            filename = 'cpt1m013-fa14-20230520-%04d-e91.fits.fz' % (i+100)
+            data = os.urandom(100000 + i)
+            MockArchiveHandler.files['/' + filename] = data
+            self.frames['91'].append({'filename': filename,
+                                      'url': self.base_url + '/' + filename,
+                                      'version_set': [{'md5': md5(data).hexdigest()}]
+                                      })
+        self.out_dir = os.path.join(self.test_dir, '20230520')
+        # Don't wait between retries in tests
+        self.no_retry = patch('core.archive_subs.download_file', download_file.retry_with(stop=stop_after_attempt(1)))
+        self.no_retry.start()
+
+    def tearDown(self):
+        self.no_retry.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_download_all(self):
+        expected_files = [os.path.join(self.out_dir, frame['filename']) for frame in self.frames['91']]
+
+        dl_frames = download_files(self.frames, self.test_dir, num_workers=3)
+
+        self.assertEqual(expected_files, dl_frames)
+        for frame, filename in zip(self.frames['91'], dl_frames):
+            with open(filename, 'rb') as fh:
+                self.assertEqual(MockArchiveHandler.files['/' + frame['filename']], fh.read())
+        self.assertEqual([], [f for f in os.listdir(self.out_dir) if f.endswith('.part')])
+
+    def test_skip_existing(self):
+        download_files(self.frames, self.test_dir)
+        MockArchiveHandler.requests_seen = []
+
+        dl_frames = download_files(self.frames, self.test_dir)
+
+        self.assertEqual([], dl_frames)
+        self.assertEqual([], MockArchiveHandler.requests_seen)
+
+    def test_resume_partial(self):
+        frame = self.frames['91'][0]
+        data = MockArchiveHandler.files['/' + frame['filename']]
+        filename = os.path.join(self.out_dir, frame['filename'])
+        os.makedirs(self.out_dir)
+        with open(filename + '.part', 'wb') as fh:
+            fh.write(data[:40000])
+
+        num_bytes = download_file(frame['url'], filename, frame['version_set'][-1]['md5'])
+
+        self.assertEqual(len(data) - 40000, num_bytes)
+        self.assertEqual([('/' + frame['filename'], 'bytes=40000-')], MockArchiveHandler.requests_seen)
+        with open(filename, 'rb') as fh:
+            self.assertEqual(data, fh.read())
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+    def test_bad_md5(self):
+        self.frames['91'][1]['version_set'][-1]['md5'] = 'wibble'
+        expected_files = [os.path.join(self.out_dir, frame['filename']) for frame in self.frames['91']]
+        del expected_files[1]
+
+        dl_frames = download_files(self.frames, self.test_dir)
+
+        self.assertEqual(expected_files, dl_frames)
+        self.assertEqual(sorted([os.path.basename(f) for f in expected_files] + [DataManifest.MANIFEST_NAME]), sorted(os.listdir(self.out_dir)))
+
+    def test_rerun_no_file_reads(self):
+        download_files(self.frames, self.test_dir)
+
+        with patch('core.archive_subs.file_md5', side_effect=AssertionError("File was read")) as mock_md5:
+            dl_frames = download_files(self.frames, self.test_dir)
+
+        self.assertEqual([], dl_frames)
+        mock_md5.assert_not_called()
+        manifest = DataManifest(self.out_dir)
+        self.assertEqual(6, len(manifest.entries))
+        self.assertEqual(self.frames['91'][0]['version_set'][-1]['md5'], manifest.lookup(self.frames['91'][0]['filename']))
+
+    def test_existing_files_no_manifest(self):
+        os.makedirs(self.out_dir)
+        for frame in self.frames['91'][0:4]:
+            with open(os.path.join(self.out_dir, frame['filename']), 'wb') as fh:
+                fh.write(MockArchiveHandler.files['/' + frame['filename']])
+
+        dl_frames = download_files(self.frames, self.test_dir)
+
+        self.assertEqual([os.path.join(self.out_dir, frame['filename']) for frame in self.frames['91'][4:]], dl_frames)
+        self.assertEqual(6, len(DataManifest(self.out_dir).entries))
+
+    def test_missing_file(self):
+        self.frames['91'][2]['url'] = self.base_url + '/wibble.fits.fz'
+
+        dl_frames = download_files(self.frames, self.test_dir)
+
+        self.assertEqual(5, len(dl_frames))
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, self.frames['91'][2]['filename'])))
+
+
+class TestDataManifest(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.filenames = []
+        for i in range(4):
+            filename = 'cpt1m013-fa14-20230520-%04d-e91.fits.fz' % i
+            with open(os.path.join(self.test_dir, filename), 'wb') as fh:
+                fh.write(b'Delete me %d!' % i)
+            self.filenames.append(filename)
+        self.md5sums = [md5(b'Delete me %d!' % i).hexdigest() for i in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_file_md5(self):
+        self.assertEqual(self.md5sums[0], file_md5(os.path.join(self.test_dir, self.filenames[0]), chunk_size=4))
+
+    def test_red_level(self):
+        self.assertEqual('91', filename_red_level(self.filenames[0]))
+        self.assertEqual('', filename_red_level('LCOEngineering_0001651275_ftn_20181005_58397.tar.gz'))
+
+    def test_md5_recorded(self):
+        manifest = DataManifest(self.test_dir)
+
+        self.assertEqual(None, manifest.lookup(self.filenames[0]))
+        self.assertEqual(self.md5sums[0], manifest.md5(self.filenames[0]))
+        with patch('core.archive_subs.file_md5') as mock_md5:
+            self.assertEqual(self.md5sums[0], manifest.md5(self.filenames[0]))
+            mock_md5.assert_not_called()
+        self.assertEqual('91', manifest.entries[self.filenames[0]]['red_lvl'])
+
+    def test_changed_file(self):
+        manifest = DataManifest(self.test_dir)
+        manifest.md5(self.filenames[0])
+
+        with open(os.path.join(self.test_dir, self.filenames[0]), 'ab') as fh:
+            fh.write(b'more')
+
+        self.assertEqual(None, manifest.lookup(self.filenames[0]))
+        self.assertEqual(md5(b'Delete me 0!more').hexdigest(), manifest.md5(self.filenames[0]))
+
+    def test_update_save_reload(self):
+        manifest = DataManifest(self.test_dir)
+
+        num_computed = manifest.update(self.filenames + ['wibble.fits'], num_workers=2)
+        manifest.save()
+
+        self.assertEqual(4, num_computed)
+        new_manifest = DataManifest(self.test_dir)
+        self.assertEqual(self.md5sums, [new_manifest.lookup(f) for f in self.filenames])
+        self.assertEqual(0, new_manifest.update(self.filenames))
+
+    def test_save_drops_missing(self):
+        manifest = DataManifest(self.test_dir)
+        manifest.update(self.filenames)
+        os.remove(os.path.join(self.test_dir, self.filenames[1]))
+
+        manifest.save()
+
+        self.assertNotIn(self.filenames[1], DataManifest(self.test_dir).entries)
+
+    def test_check_for_existing_file(self):
+        manifest = DataManifest(self.test_dir)
+        filename = os.path.join(self.test_dir, self.filenames[2])
+
+        self.assertTrue(check_for_existing_file(filename, self.md5sums[2], manifest=manifest))
+        self.assertFalse(check_for_existing_file(filename, 'foo', manifest=manifest))
+        self.assertEqual(self.md5sums[2], manifest.lookup(self.filenames[2]))
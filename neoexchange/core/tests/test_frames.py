@@ -18,12 +18,15 @@ from datetime import datetime
 from django.test import TestCase
 from mock import patch, Mock
 from astropy.wcs import WCS
+import numpy as np
+from numpy.testing import assert_allclose
 
-from core.models import Body, Proposal, Block, SuperBlock, StaticSource
+from core.models import Body, Proposal, Block, SuperBlock, StaticSource, Candidate
 from neox.tests.mocks import mock_fetch_archive_frames, mock_archive_spectra_header,\
     mock_check_for_archive_images, mock_lco_api_call, mock_check_result_status,\
     mock_check_request_status_spectro
 from core.frames import *
+from astrometrics.time_subs import jd_utc2datetime
 
 # Disable logging during testing
 import logging
@@ -354,3 +357,69 @@ class TestFrameParamsFromHeader(TestCase):
         for key in expected_params:
             if key != 'wcs':
                 self.assertEqual(expected_params[key], frame_params[key], "Comparison failed on " + key)
+
+
+class TestCandidatesByBlock(TestCase):
+
+    def setUp(self):
+        body_params = {'provisional_name': 'N999r0q',
+                       'origin': 'M',
+                       'active': True
+                       }
+        self.body = Body.objects.create(**body_params)
+        proposal = Proposal.objects.create(code='LCO2016B-001', title='LCO NEO Follow-up Network')
+        sblock = SuperBlock.objects.create(body=self.body, proposal=proposal, block_start='2016-02-26 00:00:00',
+                                           block_end='2016-02-27 00:00:00', tracking_number='00042', active=True)
+        self.test_block = Block.objects.create(telclass='1m0', site='cpt', body=self.body, superblock=sblock,
+                                               block_start='2016-02-26 00:00:00', block_end='2016-02-27 00:00:00',
+                                               request_number='00042', num_exposures=3, exp_length=42.0, active=True)
+        self.dets_arrays = []
+        for cand_id, score in [(1, 2.5), (2, 1.1)]:
+            dets = np.zeros(3, dtype=np.dtype(detections_array_dtypes()))
+            dets['det_number'] = cand_id
+            dets['frame_number'] = [1, 2, 3]
+            dets['jd_obs'] = [2457444.656045, 2457444.657980, 2457444.659923]
+            dets['ra'] = 10.924317 + cand_id
+            dets['dec'] = [39.27700, 39.27793, 39.27887]
+            dets['x'] = [2103.245, 2103.468, 2104.491]
+            dets['y'] = 2043.0 + cand_id
+            dets['mag'] = 19.26
+            self.dets_arrays.append(dets)
+            Candidate.objects.create(block=self.test_block, cand_id=cand_id, score=score,
+                                     avg_midpoint=datetime(2016, 2, 26, 3, 46, 0), avg_x=2103.0, avg_y=2043.0,
+                                     avg_ra=163.86, avg_dec=39.28, avg_mag=19.26, speed=0.497, sky_motion_pa=90.4,
+                                     detections=dets.tobytes())
+
+    def test_block_detections(self):
+        cands, detections = block_detections(self.test_block.id)
+
+        self.assertEqual([2, 1], [cand.cand_id for cand in cands])
+        self.assertEqual(6, len(detections))
+        self.assertEqual([0, 0, 0, 1, 1, 1], detections['cand_index'].tolist())
+        self.assertEqual([2, 2, 2, 1, 1, 1], detections['det_number'].tolist())
+        self.assertEqual('2016-02-26 03:44:42', detections['time'][0])
+        assert_allclose(self.dets_arrays[1]['x'], detections['x'][0:3])
+
+    def test_no_candidates(self):
+        Candidate.objects.all().delete()
+
+        cands, detections = block_detections(self.test_block.id)
+
+        self.assertEqual([], cands)
+        self.assertEqual(0, len(detections))
+        self.assertEqual([], candidates_by_block(self.test_block.id))
+
+    def test_candidates_by_block(self):
+        targets = candidates_by_block(self.test_block.id)
+
+        self.assertEqual(2, len(targets))
+        for target, cand, dets in zip(targets, Candidate.objects.order_by('score'), self.dets_arrays[::-1]):
+            self.assertEqual(str(cand.id), target['id'])
+            self.assertEqual({'speed': cand.convert_speed(), 'speed_raw': 0.497, 'pos_angle': 90.4}, target['motion'])
+            times = [jd_utc2datetime(jd).strftime("%Y-%m-%d %H:%M:%S") for jd in dets['jd_obs']]
+            self.assertEqual(times, [coord['time'] for coord in target['coords']])
+            self.assertEqual(dets['x'].tolist(), [coord['x'] for coord in target['coords']])
+            self.assertEqual(dets['y'].tolist(), [coord['y'] for coord in target['coords']])
+            assert_allclose(dets['ra'] * 15.0, [coord['ra'] for coord in target['sky_coords']])
+            self.assertEqual(dets['dec'].tolist(), [coord['dec'] for coord in target['sky_coords']])
+
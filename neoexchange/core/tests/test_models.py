@@ -29,7 +29,8 @@ from neox.tests.mocks import MockDateTime
 # Import module to test
 from core.models import Body, Proposal, SuperBlock, Block, Frame, \
     SourceMeasurement, CatalogSources, Candidate, WCSField, PreviousSpectra,\
-    StaticSource
+    StaticSource, compute_bodies_ephem, compute_bodies_obs_window_ephem
+from core.models.frame import serialize_wcs, deserialize_wcs, pickle_wcs
 
 
 class TestBody(TestCase):
@@ -334,6 +335,49 @@ class TestBody(TestCase):
         self.assertEqual(obs_window[0], expected_start)
         self.assertEqual(obs_window[1], expected_end)
 
+    def test_compute_bodies_obs_window(self):
+        self.body.abs_mag = 19.0
+        self.body.save()
+        self.body2.abs_mag = 17.0
+        self.body2.save()
+        bodies = [self.body, self.body2, self.body3]
+        d = datetime(2015, 7, 1, 17, 0, 0)
+
+        d0, ephem_lookups = compute_bodies_obs_window_ephem(bodies, d)
+
+        self.assertEqual(d, d0)
+        self.assertEqual(len(bodies), len(ephem_lookups))
+        for body, ephem_lookup in zip(bodies, ephem_lookups):
+            expected_window = body.compute_obs_window(d=d)
+            obs_window = body.compute_obs_window(d0, ephem_lookup=ephem_lookup)
+            self.assertEqual(expected_window, obs_window)
+
+    def test_compute_bodies_ephem(self):
+        bodies = [self.body, self.body2]
+        d = datetime(2015, 7, 1, 17, 0, 0)
+
+        emp_lines = compute_bodies_ephem(bodies, d)
+
+        self.assertEqual(len(bodies), len(emp_lines))
+        for body, emp_line in zip(bodies, emp_lines):
+            expected_pos = body.compute_position(d)
+            position = body.compute_position(d, emp_line=emp_line)
+            # southpole_sep is derived from the rounded sexagesimal Dec in compute_ephem()
+            self.assertAlmostEqual(expected_pos[3], position[3], delta=0.0025)
+            for expected_value, value in zip(expected_pos[0:3] + expected_pos[4:], position[0:3] + position[4:]):
+                self.assertAlmostEqual(expected_value, value, 6)
+
+    def test_compute_bodies_ephem_no_elements(self):
+        self.body2.epochofel = None
+        bodies = [self.body, self.body2]
+
+        emp_lines = compute_bodies_ephem(bodies)
+
+        self.assertEqual(2, len(emp_lines))
+        self.assertNotEqual({}, emp_lines[0])
+        self.assertEqual({}, emp_lines[1])
+        self.assertFalse(self.body2.compute_position(emp_line=emp_lines[1]))
+
     def test_return_latest_measurement_no_ingest(self):
         expected_dt = self.body.ingest
         expected_type = 'Ingest Time'
@@ -1877,6 +1921,52 @@ class TestFrame(TestCase):
         self.assertEqual(self.w.pixel_shape[0], frame.wcs.pixel_shape[0])
         self.assertEqual(self.w.pixel_shape[1], frame.wcs.pixel_shape[1])
 
+    def test_lazy_WCS(self):
+        params = {  'sitecode'      : 'K93',
+                    'instrument'    : 'kb75',
+                    'filter'        : 'w',
+                    'filename'      : 'cpt1m012-kb75-20150713-0130-e10.fits',
+                    'exptime'       : 40.0,
+                    'midpoint'      : '2015-07-13 21:09:51',
+                    'block'         : self.test_block,
+                    'wcs'           : self.w
+                 }
+        Frame.objects.create(**params)
+
+        with patch('core.models.frame.deserialize_wcs', wraps=deserialize_wcs) as mock_deserialize:
+            frames = list(Frame.objects.all())
+            self.assertEqual(0, mock_deserialize.call_count)
+            frames[0].exptime = 30.0
+            frames[0].save()
+            self.assertEqual(0, mock_deserialize.call_count)
+
+            self.assertEqual(self.w.pixel_shape[0], frames[0].wcs.pixel_shape[0])
+            self.assertEqual(self.w.pixel_shape[1], frames[0].get_y_size())
+            self.assertEqual(1, mock_deserialize.call_count)
+
+        frame = Frame.objects.get(pk=frames[0].pk)
+        self.assertEqual(30.0, frame.exptime)
+        assert_allclose(self.w.wcs.cd, frame.wcs.wcs.cd, rtol=1e-8)
+
+    def test_old_pickled_WCS(self):
+        params = {  'sitecode'      : 'K93',
+                    'instrument'    : 'kb75',
+                    'filter'        : 'w',
+                    'filename'      : 'cpt1m012-kb75-20150713-0130-e10.fits',
+                    'exptime'       : 40.0,
+                    'midpoint'      : '2015-07-13 21:09:51',
+                    'block'         : self.test_block,
+                 }
+        frame = Frame.objects.create(**params)
+        Frame.objects.filter(pk=frame.pk).update(wcs=pickle_wcs(self.w))
+        self.assertFalse(Frame.objects.filter(pk=frame.pk).values_list('wcs', flat=True)[0].startswith('['))
+
+        frame.refresh_from_db()
+
+        assert_allclose(self.w.wcs.cd, frame.wcs.wcs.cd, rtol=1e-8)
+        self.assertEqual(self.w.pixel_shape[0], frame.get_x_size())
+        self.assertLess(len(serialize_wcs(frame.wcs)), len(pickle_wcs(frame.wcs)))
+
 
 class TestWCSField(TestCase):
 
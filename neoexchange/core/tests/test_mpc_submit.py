@@ -13,12 +13,17 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 """
 
+import os
+import shutil
+import tempfile
 from datetime import datetime
+from io import StringIO
 
+from django.core.management import call_command
 from django.test import TestCase
 
 from neox.tests.mocks import MockDateTime
-from core.models import Body, Proposal, SuperBlock, Block, Frame, SourceMeasurement
+from core.models import Body, Proposal, SuperBlock, Block, Frame, SourceMeasurement, StaticSource
 
 # Import module to test
 from core.mpc_submit import *
@@ -1549,3 +1554,114 @@ class TestGenerateADESPSVMessage(TestCase):
             i += 1
 
         self.assertEqual(exp_msg, message)
+
+
+class TestBulkReport(TestCase):
+
+    def setUp(self):
+        # Use the same Bodies, Blocks, Frames and SourceMeasurements
+        TestGenerateMessage.setUp(self)
+
+        self.blocks = [self.test_block, self.test_block_gaia, self.test_block2, self.test_block2ql,
+                       self.test_block3, self.test_block4]
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_mpc_messages(self):
+        messages = list(generate_bulk_messages([block.id for block in self.blocks]))
+
+        self.assertEqual(self.blocks, [block for block, message in messages])
+        for block, message in messages:
+            self.assertEqual(generate_message(block.id, block.body.id), message)
+
+    def test_ades_psv_messages(self):
+        messages = list(generate_bulk_messages([block.id for block in self.blocks], report_format='ades_psv'))
+
+        self.assertEqual(len(self.blocks), len(messages))
+        for block, message in messages:
+            self.assertEqual(generate_ades_psv_message(block.id, block.body.id), message)
+
+    def test_skips_missing_and_empty(self):
+        empty_block = Block.objects.create(superblock=self.test_sblock, body=self.body, request_number='10044')
+
+        messages = list(generate_bulk_messages([self.test_block.id, empty_block.id, 0, self.test_block4.id]))
+
+        self.assertEqual([self.test_block, self.test_block4], [block for block, message in messages])
+
+    def test_bad_format(self):
+        with self.assertRaises(ValueError):
+            list(generate_bulk_messages([self.test_block.id], report_format='wibble'))
+
+    def test_constant_queries(self):
+        with self.assertNumQueries(2):
+            list(generate_bulk_messages([block.id for block in self.blocks[0:2]], report_format='ades_psv'))
+        with self.assertNumQueries(2):
+            list(generate_bulk_messages([block.id for block in self.blocks], report_format='ades_psv'))
+
+    def test_write_combined(self):
+        output_file = os.path.join(self.test_dir, 'night.psv')
+
+        report_files, num_lines = write_bulk_report([block.id for block in self.blocks], output_file, report_format='ades_psv')
+
+        self.assertEqual([output_file], report_files)
+        self.assertEqual(len(self.blocks), num_lines)
+        with open(output_file, 'r') as fh:
+            report = fh.read()
+        self.assertEqual(1, report.count('# version=2017'))
+        self.assertEqual(len(self.blocks), report.count('# observatory'))
+        expected = generate_ades_psv_message(self.test_block.id, self.test_block.body.id)
+        self.assertTrue(report.startswith(expected))
+
+    def test_write_per_block(self):
+        report_files, num_lines = write_bulk_report([self.test_block.id, self.test_block4.id], self.test_dir, combined=False)
+
+        expected_files = [os.path.join(self.test_dir, 'N999r0q_10042.mpc'), os.path.join(self.test_dir, '2015XS54_0010117783.mpc')]
+        self.assertEqual(expected_files, report_files)
+        self.assertEqual(2, num_lines)
+        with open(expected_files[1], 'r') as fh:
+            self.assertEqual(generate_message(self.test_block4.id, self.body2.id), fh.read())
+
+    def test_write_per_block_no_body(self):
+        calib_source = StaticSource.objects.create(name='HD 12345', ra=157.5, dec=-32.75, vmag=9.0)
+        calib_block = Block.objects.create(superblock=self.test_sblock, calibsource=calib_source, request_number='10045')
+        frame = Frame.objects.create(sitecode='K93', instrument='kb75', filter='w', frametype=Frame.BANZAI_RED_FRAMETYPE,
+                                     midpoint=datetime(2015, 7, 13, 21, 19, 51), block=calib_block, astrometric_catalog="UCAC-4")
+        SourceMeasurement.objects.create(body=self.body, frame=frame, obs_ra=157.5, obs_dec=-32.75, obs_mag=21.5)
+
+        report_files, num_lines = write_bulk_report([self.test_block.id, calib_block.id], self.test_dir, combined=False)
+
+        expected_files = [os.path.join(self.test_dir, 'N999r0q_10042.mpc'), os.path.join(self.test_dir, 'HD12345_10045.mpc')]
+        self.assertEqual(expected_files, report_files)
+        self.assertEqual(2, num_lines)
+
+    def test_command_blocks(self):
+        output_file = os.path.join(self.test_dir, 'blocks.psv')
+        out = StringIO()
+
+        call_command('bulk_mpc_report', '--blocks', str(self.test_block.id), str(self.test_block4.id),
+                     '--format', 'ades_psv', '--output', output_file, stdout=out)
+
+        self.assertIn('Wrote 2 measurements to 1 file(s)', out.getvalue())
+        with open(output_file, 'r') as fh:
+            report = fh.read()
+        expected = generate_ades_psv_message(self.test_block.id, self.test_block.body.id)
+        self.assertTrue(report.startswith(expected))
+
+    def test_command_date(self):
+        out = StringIO()
+
+        call_command('bulk_mpc_report', '--date', '20151204', '--separate', '--output', self.test_dir, stdout=out)
+
+        self.assertIn('2015XS54_0010117783.mpc', os.listdir(self.test_dir))
+        self.assertNotIn('N999r0q_10042.mpc', os.listdir(self.test_dir))
+        with open(os.path.join(self.test_dir, '2015XS54_0010117783.mpc'), 'r') as fh:
+            self.assertEqual(generate_message(self.test_block4.id, self.body2.id), fh.read())
+
+    def test_command_no_blocks(self):
+        out = StringIO()
+
+        call_command('bulk_mpc_report', '--date', '20000101', stdout=out)
+
+        self.assertIn('No Blocks found', out.getvalue())
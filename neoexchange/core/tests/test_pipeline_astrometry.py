@@ -0,0 +1,330 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+import shutil
+import tempfile
+from glob import glob
+from datetime import datetime, timedelta
+from io import StringIO
+from mock import patch
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from django.core.management import call_command
+from django.test import TestCase
+
+from core.models import Body, Proposal, SuperBlock, Block, Frame, CatalogSources
+from core.management.commands import pipeline_astrometry
+
+# The stand-ins for SExtractor, SCAMP and friends below run in the batch
+# runners' worker threads so they only touch files, like the real ones.
+
+
+def fake_run_sextractor_make_catalog(configs_dir, dest_dir, fits_file):
+    # SExtractor always writes test_ldac.fits in its working directory
+    output_catalog = os.path.join(dest_dir, 'test_ldac.fits')
+    with open(output_catalog, 'w') as fh:
+        fh.write(fits_file)
+    new_ldac_catalog = os.path.join(dest_dir, os.path.basename(fits_file).replace('[SCI]', '').replace('.fits', '_ldac.fits'))
+    os.rename(output_catalog, new_ldac_catalog)
+    return 0, new_ldac_catalog
+
+
+def fake_run_sextractor(source_dir, dest_dir, fits_file, binary=None, catalog_type='ASCII', setup_dir=True):
+    with open(os.path.join(dest_dir, 'test_ldac.fits'), 'w') as fh:
+        fh.write(fits_file)
+    return 0
+
+
+def fake_get_reference_catalog(dest_dir, ra, dec, set_width, set_height, cat_name="GAIA-DR2"):
+    refcat = os.path.join(dest_dir, 'GAIA-DR2_150.00+20.00_30mx30m.cat')
+    with open(refcat, 'w') as fh:
+        fh.write(cat_name)
+    return refcat, 100
+
+
+def fake_run_scamp(source_dir, dest_dir, fits_catalog_path, refcatalog='GAIA-DR2.cat', **kwargs):
+    # SCAMP needs the reference catalog in the directory it is run from
+    if os.path.exists(os.path.join(dest_dir, os.path.basename(refcatalog))) is False:
+        return -99
+    with open(os.path.join(dest_dir, os.path.basename(fits_catalog_path).replace('.fits', '.head')), 'w') as fh:
+        fh.write(fits_catalog_path)
+    with open(os.path.join(dest_dir, 'scamp.xml'), 'w') as fh:
+        fh.write(fits_catalog_path)
+    return 0
+
+
+def fake_updateFITSWCS(fits_file, scamp_file, scamp_xml_file, fits_file_output):
+    if os.path.exists(scamp_file) is False or os.path.exists(scamp_xml_file) is False:
+        return -1, None
+    shutil.copy(fits_file, fits_file_output)
+    return 0, None
+
+
+class PipelineTestMixin(object):
+    """Sets up Frames and BANZAI-like images for running pipeline_astrometry
+    on with the external codes patched"""
+
+    def create_fake_banzai_file(self, filepath, object_name, block_id):
+        prihdr = fits.Header()
+        prihdr['OBJECT'] = object_name
+        prihdr['BLKUID'] = block_id
+        sci_hdu = fits.ImageHDU(np.zeros((4, 4), dtype=np.float32), header=prihdr.copy(), name='SCI')
+        fits.HDUList([fits.PrimaryHDU(header=prihdr), sci_hdu]).writeto(filepath)
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.addCleanup(shutil.rmtree, self.temp_dir, True)
+        self.dataroot = os.path.join(self.temp_dir, '20160802')
+        os.makedirs(self.dataroot)
+
+        proposal = Proposal.objects.create(code='LCO2016B-001', title='test', pi='test@lcogt.net', tag='LCOGT', active=True, download=True)
+        body_params = {'origin': 'M',
+                       'source_type': 'U',
+                       'elements_type': 'MPC_MINOR_PLANET',
+                       'active': True,
+                       'epochofel': datetime(2016, 7, 11),
+                       'orbinc': 6.35992,
+                       'longascnode': 108.82267,
+                       'argofperih': 202.15361,
+                       'eccentricity': 0.384586,
+                       'meandist': 2.3057577,
+                       'meananom': 352.55523,
+                       'abs_mag': 21.3,
+                       'slope': 0.15,
+                       }
+        wcs = WCS(naxis=2)
+        wcs.pixel_shape = (1000, 1000)
+        self.targets = []
+        for target_num in range(2):
+            body = Body.objects.create(provisional_name='P10w5z%d' % target_num, **body_params)
+            sblock = SuperBlock.objects.create(body=body, proposal=proposal, block_start=datetime(2016, 8, 1, 17),
+                                               block_end=datetime(2016, 8, 2, 4), tracking_number='001%d' % target_num)
+            block = Block.objects.create(body=body, superblock=sblock, telclass='1m0', site='cpt', request_number='101%d' % target_num,
+                                         block_start=datetime(2016, 8, 1, 17), block_end=datetime(2016, 8, 2, 4), num_observed=1)
+            block_id = '%d' % (1234560 + target_num)
+            rock_dir = os.path.join(self.dataroot, body.provisional_name + '_' + block_id)
+            for frame_num in range(3):
+                filename = 'cpt1m010-fa16-20160802-%04d-e91.fits' % (100 * target_num + frame_num)
+                self.create_fake_banzai_file(os.path.join(self.dataroot, filename), body.provisional_name, block_id)
+                Frame.objects.create(sitecode='K91', instrument='fa16', filter='w', filename=filename, exptime=60.0,
+                                     midpoint=datetime(2016, 8, 2, 2) + timedelta(minutes=10 * frame_num),
+                                     block=block, zeropoint=27.0, zeropoint_err=0.01, fwhm=2.0,
+                                     frametype=Frame.BANZAI_RED_FRAMETYPE, wcs=wcs)
+            self.targets.append(rock_dir)
+
+        self.mtdlink_calls = []
+        self.mtds_files = []
+
+    def fake_get_catalog_header(self, catfile, cattype):
+        frame = Frame.objects.get(filename=os.path.basename(catfile))
+        return {'site_code': frame.sitecode,
+                'instrument': frame.instrument,
+                'filter': frame.filter,
+                'exptime': frame.exptime,
+                'obs_midpoint': frame.midpoint,
+                'zeropoint': -99,
+                'zeropoint_err': -99,
+                'fwhm': frame.fwhm,
+                'astrometric_catalog': 'GAIA-DR2',
+                'astrometric_fit_status': 0,
+                'astrometric_fit_rms': 0.3,
+                'astrometric_fit_nstars': 22,
+                'field_center_ra': 150.0,
+                'field_center_dec': 20.0,
+                'field_width': '30m',
+                'field_height': '30m',
+                }
+
+    def fake_store_catalog_sources(self, new_catalog, catalog_type, std_zeropoint_tolerance=0.1, phot_cat_name=None):
+        frame = Frame.objects.get(filename=os.path.basename(new_catalog).replace('e92_ldac', 'e91'))
+        for i in range(2):
+            CatalogSources.objects.create(frame=frame, obs_x=100.0 * (i + 2), obs_y=200.0, obs_ra=150.0, obs_dec=20.0 + i / 3600.0,
+                                          obs_mag=17.0 + i, background=100.0, major_axis=2.0, minor_axis=1.8,
+                                          position_angle=30.0, ellipticity=0.1, flux_max=500.0, threshold=10.0)
+        return 2, 2
+
+    def fake_run_mtdlink(self, source_dir, dest_dir, fits_file_list, num_fits_files, param_file, pa_rate_dict, catfile_type):
+        self.mtdlink_calls.append((dest_dir, fits_file_list))
+        with open(os.path.join(dest_dir, os.path.basename(fits_file_list[0]).replace('.fits', '.mtds')), 'w') as fh:
+            fh.write('\n'.join(fits_file_list))
+        return 0
+
+    def fake_store_detections(self, mtds_file, dbg=False):
+        self.mtds_files.append(mtds_file)
+        return 0
+
+    def run_patched(self, func, *args, **kwargs):
+        patches = [patch('core.views.open_fits_catalog', side_effect=lambda catfile, header_only: (catfile, None, 'BANZAI')),
+                   patch('core.views.get_catalog_header', side_effect=self.fake_get_catalog_header),
+                   patch('core.views.run_sextractor_make_catalog', fake_run_sextractor_make_catalog),
+                   patch('core.views.get_reference_catalog', fake_get_reference_catalog),
+                   patch('core.views.run_scamp', fake_run_scamp),
+                   patch('core.views.updateFITSWCS', fake_updateFITSWCS),
+                   patch('photometrics.external_codes.find_binary', side_effect=lambda program: program),
+                   patch('photometrics.external_codes.run_sextractor', fake_run_sextractor),
+                   patch('photometrics.external_codes.run_scamp', fake_run_scamp),
+                   patch('core.management.commands.pipeline_astrometry.store_catalog_sources', side_effect=self.fake_store_catalog_sources),
+                   patch('core.management.commands.pipeline_astrometry.run_mtdlink', side_effect=self.fake_run_mtdlink),
+                   patch('core.management.commands.pipeline_astrometry.store_detections', side_effect=self.fake_store_detections),
+                   ]
+        for patcher in patches:
+            patcher.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for patcher in patches:
+                patcher.stop()
+
+    def results(self, temp_dirs):
+        """Returns the new catalog Frames, the .sext files and contents, the
+        mtdlink calls and the .mtds files looked up (with paths made relative
+        to <temp_dirs>) and then removes the Frames and CatalogSources so the
+        pipeline can be run again"""
+
+        def relative(path):
+            for temp_dir in temp_dirs:
+                path = path.replace(temp_dir, '<temp_dir%d>' % temp_dirs.index(temp_dir))
+            return path
+
+        new_frames = Frame.objects.filter(frametype=Frame.BANZAI_LDAC_CATALOG)
+        frames = sorted(new_frames.values_list('filename', 'block__request_number', 'astrometric_catalog'))
+        sext_files = {}
+        for temp_dir in temp_dirs:
+            for sext_file in glob(os.path.join(temp_dir, '*.sext')):
+                with open(sext_file) as fh:
+                    sext_files[relative(sext_file)] = fh.read()
+        mtdlink_calls = [(relative(dest_dir), [relative(fits_file) for fits_file in fits_file_list]) for dest_dir, fits_file_list in self.mtdlink_calls]
+        mtds_files = [(relative(mtds_file), os.path.exists(mtds_file)) for mtds_file in self.mtds_files]
+
+        new_frames.delete()
+        CatalogSources.objects.all().delete()
+        self.mtdlink_calls = []
+        self.mtds_files = []
+
+        return frames, sext_files, mtdlink_calls, mtds_files
+
+
+class TestPipelineAstrometry(PipelineTestMixin, TestCase):
+
+    def run_pipeline(self, workers):
+        datadir = self.targets[0]
+        os.makedirs(datadir, exist_ok=True)
+        for fits_file in glob(os.path.join(self.dataroot, 'cpt1m010-fa16-20160802-00??-e91.fits')):
+            shutil.copy(fits_file, datadir)
+        temp_dir = os.path.join(self.temp_dir, 'Temp_%d' % workers)
+        self.run_patched(call_command, 'pipeline_astrometry', datadir, 0, 45, 0.5, 2.0, temp_dir=temp_dir,
+                         keep_temp_dir=True, workers=workers, stdout=StringIO())
+        return temp_dir
+
+    def test_workers_match_serial(self):
+        serial_dir = self.run_pipeline(1)
+        expected_results = self.results([serial_dir])
+
+        parallel_dir = self.run_pipeline(2)
+        results = self.results([parallel_dir])
+
+        self.assertEqual(expected_results, results)
+
+    def test_workers(self):
+        temp_dir = self.run_pipeline(2)
+        frames, sext_files, mtdlink_calls, mtds_files = self.results([temp_dir])
+
+        self.assertEqual([('cpt1m010-fa16-20160802-%04d-e92_ldac.fits' % i, '1010', 'GAIA-DR2') for i in range(3)], frames)
+        self.assertEqual(['<temp_dir0>/cpt1m010-fa16-20160802-%04d-e91.sext' % i for i in range(3)], sorted(sext_files.keys()))
+        for sext_file in sext_files.values():
+            self.assertEqual(2, len(sext_file.splitlines()))
+        self.assertEqual([('<temp_dir0>', ['<temp_dir0>/cpt1m010-fa16-20160802-%04d-e91.fits' % i for i in range(3)])], mtdlink_calls)
+        self.assertEqual([('<temp_dir0>/cpt1m010-fa16-20160802-0000-e91.mtds', True)], mtds_files)
+        # The refitted images and catalogs are moved up out of the batch
+        # runners' working directories, which are removed
+        self.assertTrue(os.path.exists(os.path.join(temp_dir, 'cpt1m010-fa16-20160802-0000-e92.fits')))
+        self.assertTrue(os.path.exists(os.path.join(temp_dir, 'cpt1m010-fa16-20160802-0000-e92_ldac.fits')))
+        self.assertEqual([], [path for path in glob(os.path.join(temp_dir, '*')) if os.path.isdir(path)])
+
+    def test_refit_scamp_failure(self):
+        catalogs = sorted(glob(os.path.join(self.dataroot, 'cpt1m010-fa16-20160802-00??-e91.fits')))
+        temp_dir = os.path.join(self.temp_dir, 'Temp')
+        os.makedirs(temp_dir)
+
+        def refit_with_failing_scamp():
+            with patch('photometrics.external_codes.run_scamp', return_value=1):
+                return pipeline_astrometry.refit_catalogs(os.path.abspath(os.path.join('photometrics', 'configs')),
+                                                          [(catalog, temp_dir) for catalog in catalogs], 2)
+
+        results = self.run_patched(refit_with_failing_scamp)
+
+        # As with check_catalog_and_refit(), the catalog from the first
+        # SExtractor run is kept if SCAMP fails
+        self.assertEqual([(os.path.join(temp_dir, 'cpt1m010-fa16-20160802-%04d-e91_ldac.fits' % i), 1) for i in range(3)], results)
+        self.assertFalse(os.path.exists(os.path.join(temp_dir, 'cpt1m010-fa16-20160802-0000-e92.fits')))
+
+    def test_rerun_finds_refitted_catalogs(self):
+        temp_dir = self.run_pipeline(2)
+        num_frames = Frame.objects.count()
+        shutil.rmtree(temp_dir)
+
+        with patch('core.management.commands.pipeline_astrometry.refit_catalogs_wcs') as mock_refit:
+            temp_dir = self.run_pipeline(2)
+
+        mock_refit.assert_not_called()
+        self.assertEqual(num_frames, Frame.objects.count())
+
+
+class TestDownloadProcessData(PipelineTestMixin, TestCase):
+
+    def run_download_process(self, workers):
+        for rock_dir in self.targets:
+            shutil.rmtree(rock_dir, ignore_errors=True)
+
+        def fake_call_command(name, *args, **kwargs):
+            # Only run the astrometry pipeline, not the light curve extraction
+            if name == 'pipeline_astrometry':
+                return call_command(name, *args, stdout=StringIO(), **kwargs)
+
+        with patch('core.management.commands.download_process_data.call_command', side_effect=fake_call_command):
+            self.run_patched(call_command, 'download_process_data', '--date', '20160802', '--datadir', self.temp_dir,
+                             '--skip-download', '--keep-temp-dir', '--workers', str(workers), stdout=StringIO())
+        return [os.path.join(rock_dir, 'Temp') for rock_dir in self.targets]
+
+    def test_workers_match_serial(self):
+        serial_dirs = self.run_download_process(1)
+        expected_results = self.results(serial_dirs)
+
+        parallel_dirs = self.run_download_process(2)
+        results = self.results(parallel_dirs)
+
+        self.assertEqual(expected_results, results)
+        frames, sext_files, mtdlink_calls, mtds_files = results
+        self.assertEqual(6, len(frames))
+        self.assertEqual(6, len(sext_files))
+        self.assertEqual(['<temp_dir0>', '<temp_dir1>'], [dest_dir for dest_dir, fits_file_list in mtdlink_calls])
+        self.assertEqual([('<temp_dir0>/cpt1m010-fa16-20160802-0000-e91.mtds', True),
+                          ('<temp_dir1>/cpt1m010-fa16-20160802-0100-e91.mtds', True)], mtds_files)
+
+    def test_workers_refit_up_front(self):
+        with patch('core.management.commands.pipeline_astrometry.refit_catalogs', wraps=pipeline_astrometry.refit_catalogs) as mock_refit, \
+                patch('core.management.commands.pipeline_astrometry.refit_catalogs_wcs', wraps=pipeline_astrometry.refit_catalogs_wcs) as mock_refit_wcs:
+            temp_dirs = self.run_download_process(2)
+
+        # All six catalogs of both targets are refit up front, with the two
+        # targets' temp dirs sharing the workers
+        mock_refit.assert_called_once()
+        self.assertEqual(6, len(mock_refit.call_args[0][1]))
+        self.assertEqual(sorted(temp_dirs), sorted(call[0][1] for call in mock_refit_wcs.call_args_list))
+        self.assertEqual([1, 1], [call[1]['max_workers'] for call in mock_refit_wcs.call_args_list])
+        self.assertEqual(6, Frame.objects.filter(frametype=Frame.BANZAI_LDAC_CATALOG).count())
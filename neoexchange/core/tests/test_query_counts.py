@@ -0,0 +1,195 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.models import Body, Proposal, SuperBlock, Block, Frame, Candidate, Designations
+from core.views import build_unranked_list_params
+
+
+class QueryBudgetMixin(object):
+    """Mixin for TestCases to check that views and page builders stay within
+    a budget of database queries"""
+
+    @contextmanager
+    def assertMaxQueries(self, max_queries):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        num_queries = len(context.captured_queries)
+        if num_queries > max_queries:
+            queries = '\n'.join(['%d. %s' % (i+1, query['sql']) for i, query in enumerate(context.captured_queries)])
+            self.fail("%d queries executed, budget was %d:\n%s" % (num_queries, max_queries, queries))
+
+    def count_queries(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            func(*args, **kwargs)
+        return len(context.captured_queries)
+
+    def get_page(self, url, max_queries):
+        with self.assertMaxQueries(max_queries):
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return response
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        params = {'provisional_name': 'N999r0q',
+                  'abs_mag': 21.0,
+                  'slope': 0.15,
+                  'epochofel': datetime(2015, 3, 19),
+                  'meananom': 325.2636,
+                  'argofperih': 85.19251,
+                  'longascnode': 147.81325,
+                  'orbinc': 8.34739,
+                  'eccentricity': 0.1896865,
+                  'meandist': 1.2176312,
+                  'source_type': 'U',
+                  'elements_type': 'MPC_MINOR_PLANET',
+                  'active': True,
+                  'origin': 'M',
+                  }
+        self.body = Body.objects.create(**params)
+        self.proposal = Proposal.objects.create(code='LCO2015A-009', title='LCOGT NEO Follow-up Network')
+        self.user = User.objects.create_user(username='bart', password='simpson')
+        self.sblocks = []
+
+    def make_superblocks(self, num_sblocks, body=None, num_blocks=2, num_frames=3, cadence=False):
+        body = body or self.body
+        start = datetime(2015, 4, 20, 2, 0, 0)
+        for sb_num in range(num_sblocks):
+            sblock = SuperBlock.objects.create(body=body, proposal=self.proposal, cadence=cadence,
+                                               block_start=start, block_end=start + timedelta(hours=8),
+                                               tracking_number='%05d' % (len(self.sblocks) + 1), active=True)
+            for blk_num in range(num_blocks):
+                block = Block.objects.create(body=body, superblock=sblock, site='cpt', telclass='1m0',
+                                             block_start=sblock.block_start, block_end=sblock.block_end,
+                                             request_number='%05d%d' % (len(self.sblocks) + 1, blk_num),
+                                             num_exposures=num_frames, exp_length=60.0,
+                                             num_observed=1, when_observed=start + timedelta(hours=1), active=True,
+                                             reported=blk_num == 0, when_reported=start + timedelta(hours=2))
+                for frame_num in range(num_frames):
+                    for frametype in (Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE):
+                        Frame.objects.create(block=block, sitecode='K93', instrument='fa14', filter='w',
+                                             frametype=frametype, exptime=60.0,
+                                             midpoint=start + timedelta(minutes=frame_num))
+                Candidate.objects.create(block=block, cand_id=1, score=1.0, avg_midpoint=start,
+                                         avg_x=1.0, avg_y=1.0, avg_ra=1.0, avg_dec=1.0, speed=1.0,
+                                         sky_motion_pa=0.0)
+            self.sblocks.append(sblock)
+        return self.sblocks
+
+
+class TestSuperBlockListQueries(QueryBudgetTestCase):
+
+    def test_budget(self):
+        self.make_superblocks(20)
+
+        response = self.get_page(reverse('blocklist'), 4)
+
+        self.assertEqual(20, len(response.context['block_list']))
+
+    def test_constant_with_page_size(self):
+        self.make_superblocks(2)
+        few = self.count_queries(self.client.get, reverse('blocklist'))
+
+        self.make_superblocks(18)
+        many = self.count_queries(self.client.get, reverse('blocklist'))
+
+        self.assertEqual(few, many)
+
+
+class TestSuperBlockDetailQueries(QueryBudgetTestCase):
+
+    def test_budget(self):
+        sblock = self.make_superblocks(1, num_blocks=5)[0]
+        self.client.force_login(self.user)
+
+        response = self.get_page(reverse('block-view', kwargs={'pk': sblock.pk}), 6)
+
+        self.assertContains(response, 'Candidates (1)', count=5)
+
+    def test_frame_counts(self):
+        sblock = self.make_superblocks(1, num_blocks=3)[0]
+
+        sblock = SuperBlock.objects.with_blocks(frame_counts=True).get(pk=sblock.pk)
+        with self.assertNumQueries(0):
+            for block in sblock.block_set.all():
+                self.assertEqual(6, block.num_red_frames())
+                self.assertEqual(3, block.num_unique_red_frames())
+                self.assertEqual(1, block.num_candidates())
+            self.assertEqual((3, 3), sblock.get_num_observed())
+            self.assertEqual(datetime(2015, 4, 20, 3, 0, 0), sblock.get_last_observed())
+            self.assertEqual(datetime(2015, 4, 20, 4, 0, 0), sblock.get_last_reported())
+
+
+class TestBodyPageQueries(QueryBudgetTestCase):
+
+    def test_block_info(self):
+        self.make_superblocks(3)
+        expected = self.body.get_block_info()
+
+        with self.assertNumQueries(1):
+            body = Body.objects.with_block_info().get(pk=self.body.pk)
+            block_info = body.get_block_info()
+
+        self.assertEqual(('6/6', '3/6'), block_info)
+        self.assertEqual(expected, block_info)
+
+    def test_cadence_info(self):
+        self.make_superblocks(3, cadence=True)
+        expected = self.body.get_cadence_info()
+
+        with self.assertNumQueries(1):
+            body = Body.objects.with_cadence_info().get(pk=self.body.pk)
+            cadence_info = body.get_cadence_info()
+
+        self.assertEqual('Inactive since 04/20', cadence_info)
+        self.assertEqual(expected, cadence_info)
+
+    def test_full_name(self):
+        Designations.objects.create(body=self.body, value='2015 AB', desig_type='P', preferred=True)
+        Designations.objects.create(body=self.body, value='12345', desig_type='#', preferred=True)
+        Designations.objects.create(body=self.body, value='Wibble', desig_type='N', preferred=False)
+        expected = self.body.full_name()
+
+        with self.assertNumQueries(2):
+            body = Body.objects.with_designations().get(pk=self.body.pk)
+            full_name = body.full_name()
+
+        self.assertEqual('12345 (2015 AB)', full_name)
+        self.assertEqual(expected, full_name)
+
+    def test_ranking_constant(self):
+        self.make_superblocks(1)
+        few = self.count_queries(build_unranked_list_params)
+
+        for i in range(5):
+            body = Body.objects.get(pk=self.body.pk)
+            body.pk = None
+            body.provisional_name = 'N999r%02d' % i
+            body.save()
+            self.make_superblocks(2, body=body)
+        many = self.count_queries(build_unranked_list_params)
+
+        self.assertEqual(few, many)
@@ -0,0 +1,155 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+from mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, SimpleTestCase
+
+from core.models import Body, Block
+from core.management.commands.robo_scheduler import filter_bodies, count_blocks, schedule_target_list, \
+    RateLimiter
+
+
+class TestFilterBodies(TestCase):
+
+    def setUp(self):
+        params = {'abs_mag': 21.0,
+                  'slope': 0.15,
+                  'epochofel': datetime(2015, 3, 19),
+                  'meananom': 325.2636,
+                  'argofperih': 85.19251,
+                  'longascnode': 147.81325,
+                  'orbinc': 8.34739,
+                  'eccentricity': 0.1896865,
+                  'meandist': 1.2176312,
+                  'source_type': 'U',
+                  'elements_type': 'MPC_MINOR_PLANET',
+                  'active': True,
+                  'origin': 'M',
+                  }
+        self.bodies = [Body.objects.create(provisional_name='N999r0%d' % i, **params) for i in range(3)]
+        self.bodies.append(Body.objects.create(provisional_name='N999noel', source_type='U', active=True, origin='M'))
+        now = datetime.utcnow()
+        Block.objects.create(body=self.bodies[0], active=True, block_start=now, block_end=now + timedelta(hours=2))
+        for i in range(2):
+            Block.objects.create(body=self.bodies[1], active=False, num_observed=1, reported=False,
+                                 block_start=now - timedelta(days=1), block_end=now - timedelta(hours=20))
+        Block.objects.create(body=self.bodies[2], active=False, num_observed=1, reported=True,
+                             block_start=now - timedelta(days=1), block_end=now - timedelta(hours=20))
+
+    def test_count_blocks(self):
+        run_datetime = datetime.utcnow()
+
+        with self.assertNumQueries(2):
+            num_active, num_not_found = count_blocks(self.bodies, run_datetime)
+
+        for body in self.bodies:
+            expected_active = Block.objects.filter(body=body, active=True, block_end__gte=run_datetime-timedelta(seconds=35*60)).count()
+            expected_not_found = Block.objects.filter(body=body, active=False, num_observed__gte=1, reported=False).count()
+            self.assertEqual(expected_active, num_active.get(body.pk, 0))
+            self.assertEqual(expected_not_found, num_not_found.get(body.pk, 0))
+
+    def test_filter(self):
+        north_list, south_list = filter_bodies(Body.objects.all(), datetime.utcnow(), bright_limit=0.0, faint_limit=40.0,
+                                               speed_cutoff=1e6, moon_sep_cutoff=-1.0)
+
+        targets = north_list['0m4'] + north_list['1m0'] + south_list['0m4'] + south_list['1m0']
+        self.assertEqual([self.bodies[2]], targets)
+
+    def test_too(self):
+        north_list, south_list = filter_bodies(Body.objects.all(), datetime.utcnow(), bright_limit=0.0, faint_limit=40.0,
+                                               speed_cutoff=1e6, moon_sep_cutoff=-1.0, too=True)
+
+        targets = north_list['0m4'] + north_list['1m0'] + south_list['0m4'] + south_list['1m0']
+        self.assertEqual(set(self.bodies[0:3]), set(targets))
+
+
+class TestScheduleTargetList(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='bart', password='simpson')
+        self.targets = [Body.objects.create(provisional_name='N999r0%d' % i, source_type='U', active=True, origin='M')
+                        for i in range(6)]
+        self.form = {'site_code': 'K92', 'utc_date': (datetime.utcnow() + timedelta(days=1)).date(),
+                     'proposal_code': 'LCO2015A-009', 'too_mode': False}
+        self.running = 0
+        self.max_running = 0
+        self.lock = Lock()
+
+    def mock_check(self, form, target):
+        start = datetime.combine(form['utc_date'], datetime.min.time())
+        return {'site_code': form['site_code'],
+                'start_time': start.strftime('%Y-%m-%dT%H:%M:%S'),
+                'end_time': (start + timedelta(hours=8)).strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def mock_submit(self, data, target, username):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        if target.provisional_name == 'N999r03':
+            raise ValueError('Portal error')
+        return '%s_track' % target.provisional_name, {}
+
+    def run_schedule(self, **kwargs):
+        recorded = []
+
+        def mock_record(tracking_num, params, data, target, user):
+            recorded.append(tracking_num)
+            return True
+
+        with patch('core.management.commands.robo_scheduler.schedule_check', side_effect=self.mock_check), \
+                patch('core.management.commands.robo_scheduler.schedule_submit', side_effect=self.mock_submit), \
+                patch('core.management.commands.robo_scheduler.record_block', side_effect=mock_record):
+            num_scheduled, objects_scheduled = schedule_target_list(self.targets, self.form, 'bart', **kwargs)
+        return num_scheduled, objects_scheduled, recorded
+
+    def test_parallel(self):
+        num_scheduled, objects_scheduled, recorded = self.run_schedule(max_workers=3, submit_interval=0)
+
+        self.assertEqual(5, num_scheduled)
+        self.assertEqual(['N999r00', 'N999r01', 'N999r02', 'N999r04', 'N999r05'], objects_scheduled)
+        self.assertEqual(['N999r0%d_track' % i for i in (0, 1, 2, 4, 5)], recorded)
+        self.assertGreater(self.max_running, 1)
+        self.assertLessEqual(self.max_running, 3)
+
+    def test_serial(self):
+        num_scheduled, objects_scheduled, recorded = self.run_schedule(max_workers=1, submit_interval=0)
+
+        self.assertEqual(5, num_scheduled)
+        self.assertEqual(1, self.max_running)
+
+    def test_no_targets(self):
+        self.assertEqual((0, []), schedule_target_list([], self.form, 'bart'))
+
+
+class TestRateLimiter(SimpleTestCase):
+
+    def test_spacing(self):
+        limiter = RateLimiter(0.05)
+
+        times = []
+        for i in range(4):
+            limiter.wait()
+            times.append(time.monotonic())
+
+        for t1, t2 in zip(times, times[1:]):
+            self.assertGreaterEqual(t2 - t1, 0.045)
@@ -0,0 +1,131 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2015-2023 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+from math import radians
+
+import pyslalib.slalib as S
+from mock import patch
+from django.test import TestCase
+
+from core.models import StaticSource
+from core.standards_index import StandardsIndex, standards_index, vector_separations
+from astrometrics.ephem_subs import radec_to_unit_vectors
+
+
+class TestVectorSeparations(TestCase):
+
+    def test_matches_sla_dsep(self):
+        positions = [(0.0, 0.0), (359.9, -89.5), (150.0, 20.0), (150.00001, 20.0), (330.0, -30.0)]
+        ra = [radians(p[0]) for p in positions]
+        dec = [radians(p[1]) for p in positions]
+
+        seps = vector_separations(radec_to_unit_vectors([p[0] for p in positions], [p[1] for p in positions]),
+                                  radians(150.0), radians(20.0))
+
+        for r, d, sep in zip(ra, dec, seps):
+            self.assertAlmostEqual(S.sla_dsep(r, d, radians(150.0), radians(20.0)), sep, 14)
+
+
+class TestStandardsIndex(TestCase):
+
+    def setUp(self):
+        self.sources = []
+        for i, (ra, dec, source_type, quality) in enumerate([(150.0, 20.0, StaticSource.SOLAR_STANDARD, 0),
+                                                              (152.0, 20.0, StaticSource.SOLAR_STANDARD, 1),
+                                                              (151.0, 20.0, StaticSource.FLUX_STANDARD, 0),
+                                                              (151.0, 20.0, StaticSource.SOLAR_STANDARD, -1),
+                                                              (149.0, 40.0, StaticSource.SOLAR_STANDARD, None),
+                                                              (210.0, 21.0, StaticSource.SOLAR_STANDARD, 0),
+                                                              ]):
+            self.sources.append(StaticSource.objects.create(name='Std%d' % i, ra=ra, dec=dec, vmag=9.0,
+                                                            source_type=source_type, quality=quality))
+        self.ra = radians(150.4)
+        self.dec = radians(20.0)
+        standards_index.invalidate()
+        self.addCleanup(standards_index.invalidate)
+
+    def names(self, closest):
+        return [source.name for source, sep in closest]
+
+    def test_closest(self):
+        closest = standards_index.closest(self.ra, self.dec)
+
+        self.assertEqual(['Std0', 'Std2', 'Std3', 'Std1', 'Std4', 'Std5'], self.names(closest))
+        for source, sep in closest:
+            self.assertAlmostEqual(S.sla_dsep(radians(source.ra), radians(source.dec), self.ra, self.dec), sep, 14)
+
+    def test_filters(self):
+        closest = standards_index.closest(self.ra, self.dec, source_type=StaticSource.SOLAR_STANDARD, min_quality=0,
+                                          dec_limits=[-20.0, 30.0], max_ra_diff=1.0)
+
+        self.assertEqual(['Std0', 'Std1'], self.names(closest))
+
+    def test_num(self):
+        closest = standards_index.closest(self.ra, self.dec, source_type=StaticSource.SOLAR_STANDARD, num=2)
+
+        self.assertEqual(['Std0', 'Std3'], self.names(closest))
+
+    def test_from_sources(self):
+        index = StandardsIndex.from_sources(self.sources[4:])
+
+        with self.assertNumQueries(0):
+            closest = index.closest(self.ra, self.dec)
+
+        self.assertEqual(['Std4', 'Std5'], self.names(closest))
+
+    def test_from_sources_cached(self):
+        index = StandardsIndex.from_sources(self.sources[4:])
+
+        index.closest(self.ra, self.dec)
+        index.closest(self.ra, self.dec)
+
+        self.assertTrue(index.can_cache())
+        self.assertEqual(1, index.loads)
+
+    def test_empty(self):
+        index = StandardsIndex.from_sources([])
+
+        self.assertEqual([], index.closest(self.ra, self.dec))
+
+    def test_cached(self):
+        index = StandardsIndex(cache_in_transactions=True)
+
+        index.closest(self.ra, self.dec)
+        with self.assertNumQueries(0):
+            closest = index.closest(self.ra, self.dec, source_type=StaticSource.FLUX_STANDARD)
+
+        self.assertEqual(['Std2'], self.names(closest))
+        self.assertEqual(1, index.loads)
+
+    def test_invalidated_on_change(self):
+        with patch.object(standards_index, 'can_cache', return_value=True):
+            standards_index.closest(self.ra, self.dec)
+            self.sources[0].quality = -1
+            self.sources[0].save()
+            closest = standards_index.closest(self.ra, self.dec, min_quality=0)
+            self.sources[1].delete()
+            closest2 = standards_index.closest(self.ra, self.dec, min_quality=0)
+
+        self.assertEqual(['Std2', 'Std1', 'Std5'], self.names(closest))
+        self.assertEqual(['Std2', 'Std5'], self.names(closest2))
+
+    def test_not_cached_in_transaction(self):
+        index = StandardsIndex()
+
+        # Test cases run inside a transaction so nothing is kept
+        index.closest(self.ra, self.dec)
+        index.closest(self.ra, self.dec)
+
+        self.assertEqual(2, index.loads)
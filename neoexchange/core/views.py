@@ -67,7 +67,7 @@ from astrometrics.ast_subs import determine_asteroid_type, determine_time_of_per
     convert_ast_to_comet
 import astrometrics.site_config as cfg
 from astrometrics.albedo import asteroid_diameter
-from astrometrics.ephem_subs import call_compute_ephem, compute_ephem, \
+from astrometrics.ephem_subs import call_compute_ephem, cached_call_compute_ephem, compute_ephem, \
     determine_darkness_times, determine_slot_length, determine_exp_time_count, \
     MagRangeError, determine_spectro_slot_length, get_sitepos, read_findorb_ephem,\
     accurate_astro_darkness, get_visibility, determine_exp_count, determine_star_trails,\
@@ -80,7 +80,7 @@ from astrometrics.sources_subs import fetchpage_and_make_soup, packed_to_normal,
 from astrometrics.time_subs import extract_mpc_epoch, parse_neocp_date, \
     parse_neocp_decimal_date, get_semester_dates, jd_utc2datetime, datetime2st
 from photometrics.external_codes import run_sextractor, run_scamp, updateFITSWCS,\
-    read_mtds_file, unpack_tarball, run_findorb
+    read_mtds_file, unpack_tarball, run_findorb, run_sextractor_batch, run_scamp_batch
 from photometrics.catalog_subs import open_fits_catalog, get_catalog_header, \
     determine_filenames, increment_red_level, update_ldac_catalog_wcs, FITSHdrException, \
     get_reference_catalog, reset_database_connection, sanitize_object_name
@@ -90,6 +90,7 @@ from core.frames import create_frame, ingest_frames, measurements_from_block
 from core.mpc_submit import email_report_to_mpc
 from core.archive_subs import lco_api_call
 from core.utils import search
+from core.standards_index import StandardsIndex, standards_index
 from photometrics.SA_scatter import readSources, genGalPlane, plotScatter, \
     plotFormat
 from core.plots import spec_plot, lin_vis_plot, lc_plot
@@ -225,7 +226,7 @@ class BodyDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super(BodyDetailView, self).get_context_data(**kwargs)
         context['form'] = EphemQuery()
-        context['blocks'] = Block.objects.filter(body=self.object).order_by('block_start')
+        context['blocks'] = Block.objects.filter(body=self.object).select_related('superblock').order_by('block_start')
         context['taxonomies'] = SpectralInfo.objects.filter(body=self.object)
         context['spectra'] = sort_previous_spectra(self)
         lin_script, lin_div = lin_vis_plot(self.object)
@@ -330,6 +331,9 @@ class SuperBlockDetailView(DetailView):
     template_name = 'core/block_detail.html'
     model = SuperBlock
 
+    def get_queryset(self):
+        return super(SuperBlockDetailView, self).get_queryset().with_blocks(frame_counts=True)
+
 
 class SuperBlockTimeline(DetailView):
     template_name = 'core/block_timeline.html'
@@ -362,6 +366,11 @@ class SuperBlockListView(ListView):
     context_object_name = "block_list"
     paginate_by = 20
 
+    def get_queryset(self):
+        # Fetch the Blocks for the per-row summaries with the page rather
+        # than per SuperBlock
+        return super(SuperBlockListView, self).get_queryset().with_blocks()
+
 
 class BlockReport(LoginRequiredMixin, View):
 
@@ -854,7 +863,7 @@ def ephemeris(request):
         body_elements = model_to_dict(data['target'])
         dark_start, dark_end = determine_darkness_times(
             data['site_code'], data['utc_date'])
-        ephem_lines = call_compute_ephem(
+        ephem_lines = cached_call_compute_ephem(
             body_elements, dark_start, dark_end, data['site_code'], 900, data['alt_limit'])
     else:
         return render(request, 'core/home.html', {'form': form})
@@ -1955,13 +1964,15 @@ def build_unranked_list_params():
         latest = Body.objects.filter(active=True).latest('ingest')
         max_dt = latest.ingest
         min_dt = max_dt - timedelta(days=5)
-        newest = Body.objects.filter(ingest__range=(min_dt, max_dt), active=True)
+        newest = list(Body.objects.filter(ingest__range=(min_dt, max_dt), active=True).with_block_info())
+        # Compute the positions of all the bodies in one go
+        emp_lines = compute_bodies_ephem(newest)
         unranked = []
-        for body in newest:
+        for body, body_emp in zip(newest, emp_lines):
             body_dict = model_to_dict(body)
-            body_dict['FOM'] = body.compute_FOM()
+            body_dict['FOM'] = body.compute_FOM(emp_line=body_emp)
             body_dict['current_name'] = body.current_name()
-            emp_line = body.compute_position()
+            emp_line = body.compute_position(emp_line=body_emp)
             if not emp_line:
                 continue
             body_dict['ra'] = emp_line[0]
@@ -2005,11 +2016,14 @@ def build_characterization_list(disp=None):
     try:
         # If we change the definition of Characterization Target,
         # also update models.Body.characterization_target()
-        char_targets = get_characterization_targets()
+        char_targets = list(get_characterization_targets().with_designations().prefetch_related('previousspectra_set'))
+        # Compute the positions and observing windows of all the bodies in one go
+        emp_lines = compute_bodies_ephem(char_targets)
+        obs_start, obs_ephems = compute_bodies_obs_window_ephem(char_targets)
         unranked = []
-        for body in char_targets:
+        for body, body_emp, body_obs_ephem in zip(char_targets, emp_lines, obs_ephems):
             try:
-                spectra = PreviousSpectra.objects.filter(body=body)
+                spectra = body.previousspectra_set.all()
                 s_wav = s_vis_link = s_nir_link = ''
                 m_vis_link = m_nir_link = ''
                 m_wav = ""
@@ -2054,10 +2068,10 @@ def build_characterization_list(disp=None):
                     body_dict['obs_needed'] = 'LC'
                 else:
                     body_dict['obs_needed'] = 'Spec/LC'
-                emp_line = body.compute_position()
+                emp_line = body.compute_position(emp_line=body_emp)
                 if not emp_line:
                     continue
-                obs_dates = body.compute_obs_window()
+                obs_dates = body.compute_obs_window(obs_start, ephem_lookup=body_obs_ephem)
                 if obs_dates[0]:
                     body_dict['obs_sdate'] = obs_dates[0]
                     if obs_dates[0] == obs_dates[2]:
@@ -2109,9 +2123,12 @@ def build_lookproject_list(disp=None):
     params = {}
     # If we don't have any Body instances, return None instead of breaking
     try:
-        look_targets = Body.objects.filter(active=True, origin='O')
+        look_targets = list(Body.objects.filter(active=True, origin='O').with_cadence_info())
+        # Compute the positions and observing windows of all the bodies in one go
+        emp_lines = compute_bodies_ephem(look_targets)
+        obs_start, obs_ephems = compute_bodies_obs_window_ephem(look_targets)
         unranked = []
-        for body in look_targets:
+        for body, body_emp, body_obs_ephem in zip(look_targets, emp_lines, obs_ephems):
             try:
                 body_dict = model_to_dict(body)
                 body_dict['current_name'] = body.current_name()
@@ -2128,13 +2145,13 @@ def build_lookproject_list(disp=None):
                     body_dict['subtypes'] = ", ".join(subtypes)
                 body_dict['cadence_info'] = body.get_cadence_info()
                 # Compute ephemeris, distance and observability window
-                emp_line = body.compute_position()
+                emp_line = body.compute_position(emp_line=body_emp)
                 if not emp_line:
                     continue
-                dist_line = body.compute_distances()
+                dist_line = body.compute_distances(emp_line=body_emp)
                 if not dist_line:
                     continue
-                obs_dates = body.compute_obs_window()
+                obs_dates = body.compute_obs_window(obs_start, ephem_lookup=body_obs_ephem)
                 if obs_dates[0]:
                     body_dict['obs_sdate'] = obs_dates[0]
                     if obs_dates[0] == obs_dates[2]:
@@ -2169,9 +2186,11 @@ def build_lookproject_list(disp=None):
         latest = Body.objects.filter(source_type='C').latest('ingest')
         max_dt = latest.ingest
         min_dt = max_dt - timedelta(days=30)
-        newest_comets = Body.objects.filter(ingest__range=(min_dt, max_dt), source_type='C')
+        newest_comets = list(Body.objects.filter(ingest__range=(min_dt, max_dt), source_type='C'))
+        emp_lines = compute_bodies_ephem(newest_comets)
+        obs_start, obs_ephems = compute_bodies_obs_window_ephem(newest_comets)
         comets = []
-        for body in newest_comets:
+        for body, body_emp, body_obs_ephem in zip(newest_comets, emp_lines, obs_ephems):
             try:
                 body_dict = model_to_dict(body)
                 body_dict['current_name'] = body.current_name()
@@ -2183,10 +2202,10 @@ def build_lookproject_list(disp=None):
                     body_dict['subtypes'] = subtypes[0]
                 elif len(subtypes) > 1:
                     body_dict['subtypes'] = ", ".join(subtypes)
-                emp_line = body.compute_position()
+                emp_line = body.compute_position(emp_line=body_emp)
                 if not emp_line:
                     continue
-                obs_dates = body.compute_obs_window()
+                obs_dates = body.compute_obs_window(obs_start, ephem_lookup=body_obs_ephem)
                 if obs_dates[0]:
                     body_dict['obs_sdate'] = obs_dates[0]
                     if obs_dates[0] == obs_dates[2]:
@@ -3748,9 +3767,28 @@ def check_catalog_and_refit(configs_dir, dest_dir, catfile, dbg=False, desired_c
     is likely to be good and exits if not the case. A new source extraction
     is performed unless we find an existing Frame record for the catalog.
     The name of the newly created FITS LDAC catalog from this process is returned
-    or an integer status code if no fit was needed or could not be performed."""
+    or an integer status code if no fit was needed or could not be performed.
+    The work is split into check_catalog_for_refit(), refit_catalog_wcs() (which
+    doesn't touch the DB; refit_catalogs_wcs() is the batch version of it) and
+    record_refitted_catalog()."""
+
+    status, header, fits_file = check_catalog_for_refit(dest_dir, catfile, desired_catalog)
+    if status is not None:
+        return status, 0
+
+    new_ldac_catalog = refit_catalog_wcs(configs_dir, dest_dir, catfile, fits_file, header, desired_catalog)
+    if type(new_ldac_catalog) == int:
+        return new_ldac_catalog, 0
+
+    return record_refitted_catalog(catfile, new_ldac_catalog, header)
 
-    num_new_frames_created = 0
+
+def check_catalog_for_refit(dest_dir, catfile, desired_catalog=None):
+    """Opens <catfile> and checks whether it needs refitting by
+    refit_catalog_wcs(). Returns a tuple of (status, header, image file) where
+    status is None if a refit is needed, the path (in <dest_dir>) of the
+    existing refitted catalog if there is a Frame for one already, or an
+    integer error code otherwise."""
 
     # Open catalog, get header and check fit status
     fits_header, junk_table, cattype = open_fits_catalog(catfile, header_only=True)
@@ -3758,18 +3796,18 @@ def check_catalog_and_refit(configs_dir, dest_dir, catfile, dbg=False, desired_c
         header = get_catalog_header(fits_header, cattype)
     except FITSHdrException as e:
         logger.error("Bad header for %s (%s)" % (catfile, e))
-        return -1, num_new_frames_created
+        return -1, None, None
 
     # Downgrade check on bad fit to a logged warning as we're seeing a fair
     # number of instances where BANZAI fails but we can solve succesfully
     if header.get('astrometric_fit_status', None) != 0:
         logger.warning("Bad astrometric fit found in %s", catfile)
-    # return -1, num_new_frames_created
+    # return -1, None, None
 
     # Check catalog type
     if cattype != 'BANZAI':
         logger.error("Unable to process non-BANZAI data at this time")
-        return -99, num_new_frames_created
+        return -99, header, None
 
     # Check for matching catalog (solved with desired astrometric reference catalog)
     catfilename = os.path.basename(catfile).replace('.fits', '_ldac.fits')
@@ -3779,19 +3817,29 @@ def check_catalog_and_refit(configs_dir, dest_dir, catfile, dbg=False, desired_c
                                           astrometric_catalog=desired_catalog)
     if len(catalog_frames) != 0:
         logger.info("Found reprocessed frame in DB")
-        return os.path.abspath(os.path.join(dest_dir, catalog_frames[0].filename)), 0
+        return os.path.abspath(os.path.join(dest_dir, catalog_frames[0].filename)), header, None
 
     # Find image file for this catalog
     fits_file = find_matching_image_file(catfile)
     if fits_file is None:
         logger.error("Could not open matching image %s for catalog %s" % ( fits_file, catfile))
-        return -1, num_new_frames_created
+        return -1, header, None
+
+    return None, header, fits_file
+
+
+def refit_catalog_wcs(configs_dir, dest_dir, catfile, fits_file, header, desired_catalog=None):
+    """Makes a new FITS LDAC catalog in <dest_dir> from the image <fits_file>
+    (as found by check_catalog_for_refit() for <catfile>) with SExtractor and,
+    if <desired_catalog> is 'GAIA-DR2', refits the WCS against it with SCAMP
+    and re-extracts from the updated image. No DB access is made.
+    Returns the path of the new catalog or an integer error code."""
 
     # Make a new FITS_LDAC catalog from the frame
     status, new_ldac_catalog = run_sextractor_make_catalog(configs_dir, dest_dir, fits_file)
     if status != 0:
         logger.error("Execution of SExtractor failed")
-        return -4, 0
+        return -4
 
     # If desired catalog is GAIA-DR2, need to grab it ourselves as SCAMP does
     # not support it
@@ -3801,7 +3849,7 @@ def check_catalog_and_refit(configs_dir, dest_dir, catfile, dbg=False, desired_c
             cat_name=desired_catalog)
         if refcat is None or num_ref_srcs is None:
             logger.error("Could not obtain reference catalog for fits frame %s" % catfile)
-            return -6, num_new_frames_created
+            return -6
 
         scamp_status = run_scamp(configs_dir, dest_dir, new_ldac_catalog, refcatalog=refcat)
         logger.info("Return status for scamp: {}".format(scamp_status))
@@ -3837,19 +3885,98 @@ def check_catalog_and_refit(configs_dir, dest_dir, catfile, dbg=False, desired_c
             logger.debug("Filename after 2nd SExtractor= {}".format(new_ldac_catalog))
             if status != 0:
                 logger.error("Execution of second SExtractor failed")
-                return -4, 0
+                return -4
+
+    return new_ldac_catalog
+
+
+def refit_catalogs_wcs(configs_dir, dest_dir, refits, desired_catalog=None, max_workers=4):
+    """Batch version of refit_catalog_wcs() for the list of <refits>, tuples
+    of (catfile, fits_file, header) as found by check_catalog_for_refit().
+    Each stage is run over all the frames before the next, with the
+    SExtractor and SCAMP runs spread over up to [max_workers] working
+    directories by run_sextractor_batch() and run_scamp_batch(). No DB
+    access is made.
+    Returns a list of the new catalog paths or integer error codes, one per
+    refit in the same order as <refits>."""
+
+    # Make new FITS_LDAC catalogs from the frames
+    fits_files = [fits_file for catfile, fits_file, header in refits]
+    new_ldac_catalogs = []
+    for sext_result in run_sextractor_batch(configs_dir, dest_dir, fits_files, catalog_type='FITS_LDAC', max_workers=max_workers):
+        if sext_result['status'] != 0:
+            logger.error("Execution of SExtractor failed for %s" % sext_result['fits_file'])
+            new_ldac_catalogs.append(-4)
+        else:
+            new_ldac_catalogs.append(sext_result['catalog'])
+
+    # If desired catalog is GAIA-DR2, need to grab it ourselves as SCAMP does
+    # not support it
+    if desired_catalog != 'GAIA-DR2':
+        return new_ldac_catalogs
+    scamp_refits = []
+    for index, (catfile, fits_file, header) in enumerate(refits):
+        if type(new_ldac_catalogs[index]) == int:
+            continue
+        refcat, num_ref_srcs = get_reference_catalog(dest_dir, header['field_center_ra'],
+            header['field_center_dec'], header['field_width'], header['field_height'],
+            cat_name=desired_catalog)
+        if refcat is None or num_ref_srcs is None:
+            logger.error("Could not obtain reference catalog for fits frame %s" % catfile)
+            new_ldac_catalogs[index] = -6
+            continue
+        scamp_refits.append((index, refcat))
+    if len(scamp_refits) == 0:
+        return new_ldac_catalogs
+
+    scamp_results = run_scamp_batch(configs_dir, dest_dir, [new_ldac_catalogs[index] for index, refcat in scamp_refits],
+                                    refcatalogs=[refcat for index, refcat in scamp_refits], max_workers=max_workers)
+    updated_files = []
+    for (index, refcat), scamp_result in zip(scamp_refits, scamp_results):
+        logger.info("Return status for scamp: {}".format(scamp_result['status']))
+        if scamp_result['status'] != 0:
+            continue
+        # Update WCS in image file, stripping off now unneeded FITS extension
+        fits_file = refits[index][1].replace('[SCI]', '')
+        fits_file_output = os.path.join(dest_dir, increment_red_level(fits_file))
+        logger.info("Updating refitted WCS in image file: %s. Output to: %s" % (fits_file, fits_file_output))
+        status, new_header = updateFITSWCS(fits_file, scamp_result['head_file'], scamp_result['xml_file'], fits_file_output)
+        logger.info("Return status for updateFITSWCS: {}".format(status))
+        updated_files.append((index, fits_file_output))
+    if len(updated_files) == 0:
+        return new_ldac_catalogs
+
+    # Re-run SExtractor to make new FITS_LDAC catalogs from the updated frames
+    sext_results = run_sextractor_batch(configs_dir, dest_dir, [fits_file for index, fits_file in updated_files],
+                                        catalog_type='FITS_LDAC', max_workers=max_workers)
+    for (index, fits_file), sext_result in zip(updated_files, sext_results):
+        if sext_result['status'] != 0:
+            logger.error("Execution of second SExtractor failed for %s" % fits_file)
+            new_ldac_catalogs[index] = -4
+        else:
+            new_ldac_catalogs[index] = sext_result['catalog']
+
+    return new_ldac_catalogs
+
+
+def record_refitted_catalog(catfile, new_ldac_catalog, header):
+    """Creates the Frame for the <new_ldac_catalog> produced by
+    refit_catalog_wcs() from <catfile> (with catalog <header>).
+    Returns a tuple of the catalog path (or an integer error code) and the
+    number of new Frames created."""
+
     # Reset DB connection after potentially long-running process.
     reset_database_connection()
     # Find Block for original frame
     block = find_block_for_frame(catfile)
     if block is None:
         logger.error("Could not find block for fits frame %s" % catfile)
-        return -3, num_new_frames_created
+        return -3, 0
 
     # Check if we have a sitecode (none if this is a new instrument/telescope)
     if header.get('site_code', None) is None:
         logger.error("No sitecode found for fits frame %s" % catfile)
-        return -5, num_new_frames_created
+        return -5, 0
 
     # Create a new Frame entry for the new_ldac_catalog
     num_new_frames_created = make_new_catalog_entry(new_ldac_catalog, header, block)
@@ -4690,7 +4817,9 @@ def find_best_flux_standard(sitecode, utc_date=None, flux_standards=None, debug=
     close_standard = None
     close_params = {}
     if flux_standards is None:
-        flux_standards = StaticSource.objects.filter(source_type=StaticSource.FLUX_STANDARD)
+        index = standards_index
+    else:
+        index = StandardsIndex.from_sources(flux_standards)
 
     site_name, site_long, site_lat, site_hgt = get_sitepos(sitecode)
     if site_name != '?':
@@ -4708,17 +4837,16 @@ def find_best_flux_standard(sitecode, utc_date=None, flux_standards=None, debug=
 
         if debug:
             print("RA, Dec of zenith@midpoint:", stl, site_lat)
-        # Loop through list of standards, recording closest
-        min_sep = 360.0
-        for standard in flux_standards:
-            sep = S.sla_dsep(radians(standard.ra), radians(standard.dec), stl, site_lat)
-            if debug:
-                print("%10s %.7f %.7f %.3f %7.3f (%10s)" % (standard, standard.ra, standard.dec, sep, min_sep, close_standard))
-            if sep < min_sep:
-                min_sep = sep
-                close_standard = standard
-        close_params = model_to_dict(close_standard)
-        close_params['separation_rad'] = min_sep
+        # Find the standards closest to the zenith at the midpoint
+        source_type = StaticSource.FLUX_STANDARD if flux_standards is None else None
+        close_standards = index.closest(stl, site_lat, source_type=source_type)
+        if debug:
+            for standard, sep in close_standards:
+                print("%10s %.7f %.7f %.3f" % (standard, standard.ra, standard.dec, sep))
+        if close_standards:
+            close_standard, min_sep = close_standards[0]
+            close_params = model_to_dict(close_standard)
+            close_params['separation_rad'] = min_sep
     return close_standard, close_params
 
 
@@ -4737,7 +4865,13 @@ def find_best_solar_analog(ra_rad, dec_rad, site, ha_sep=4.0, num=None, solar_st
     else:
         num = 0
     if solar_standards is None:
-        solar_standards = StaticSource.objects.filter(source_type=StaticSource.SOLAR_STANDARD, quality__gte=0)
+        index = standards_index
+        source_type = StaticSource.SOLAR_STANDARD
+        min_quality = 0
+    else:
+        index = StandardsIndex.from_sources(solar_standards)
+        source_type = None
+        min_quality = None
 
     if site == 'E10':
         dec_lim = [-90.0, 20.0]
@@ -4746,16 +4880,14 @@ def find_best_solar_analog(ra_rad, dec_rad, site, ha_sep=4.0, num=None, solar_st
     else:
         dec_lim = [-20.0, 20.0]
 
-    close_standards = []
-    for standard in solar_standards:
-        ra_diff = abs(standard.ra - degrees(ra_rad)) / 15
-        sep = degrees(S.sla_dsep(radians(standard.ra), radians(standard.dec), ra_rad, dec_rad))
-        if debug:
-            print("%10s %1d %011.7f %+11.7f %7.3f %7.3f (%10s)" % (standard.name.replace("Landolt ", "") , standard.source_type, standard.ra, standard.dec, sep, ha_sep, close_standard))
-        if ra_diff < ha_sep and (dec_lim[0] <= standard.dec <= dec_lim[1]):
-            close_standards.append({"calib": standard, "separation": sep})
+    close_standards = [{"calib": standard, "separation": degrees(sep)} for standard, sep in
+                       index.closest(ra_rad, dec_rad, source_type=source_type, min_quality=min_quality,
+                                     dec_limits=dec_lim, max_ra_diff=ha_sep, num=max(num+1, 5))]
+    if debug:
+        for close_std in close_standards:
+            standard = close_std["calib"]
+            print("%10s %1d %011.7f %+11.7f %7.3f %7.3f" % (standard.name.replace("Landolt ", ""), standard.source_type, standard.ra, standard.dec, close_std["separation"], ha_sep))
     if close_standards:
-        close_standards.sort(key=itemgetter("separation"))
         close_standard = close_standards[num]["calib"]
         close_params = model_to_dict(close_standard)
         close_params['separation_deg'] = close_standards[num]["separation"]
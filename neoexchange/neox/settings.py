@@ -253,6 +253,48 @@ DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 if DATABASES['default']['ENGINE'] =='django.db.backends.mysql':
     DATABASES['default']['OPTIONS'] =  { 'init_command': "SET sql_mode='STRICT_TRANS_TABLES'" }
 
+##################
+# Cache settings #
+##################
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Ephemeris cache (astrometrics/ephem_cache.py): number of entries held in
+# each process and an optional shared (on-disk) backing tier
+EPHEM_CACHE_SIZE = int(os.environ.get('NEOX_EPHEM_CACHE_SIZE', 2048))
+EPHEM_CACHE_TIMEOUT = 7 * 86400
+EPHEM_CACHE_ALIAS = None
+if os.environ.get('NEOX_EPHEM_CACHE_DIR', None):
+    CACHES['ephem'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('NEOX_EPHEM_CACHE_DIR'),
+    }
+    EPHEM_CACHE_ALIAS = 'ephem'
+
+# JPL HORIZONS ephemeris cache (astrometrics/horizons_cache.py): tables are
+# also kept on disk if a directory is given. In offline mode, only cached
+# ephemerides are used (e.g. for replaying without network access)
+HORIZONS_CACHE_DIR = os.environ.get('NEOX_HORIZONS_CACHE_DIR', None)
+HORIZONS_CACHE_TIMEOUT = 86400
+HORIZONS_CACHE_OFFLINE = ast.literal_eval(os.environ.get('NEOX_HORIZONS_OFFLINE', 'False'))
+
+# Decoded frames for guide/frame movies (photometrics/gf_movie.py) are only
+# cached on disk if a directory is given
+GF_MOVIE_CACHE_DIR = os.environ.get('NEOX_GF_MOVIE_CACHE_DIR', None)
+
+# In-memory index of calibration sources (core/standards_index.py). It's
+# reloaded when a StaticSource is changed in this process or after this many
+# seconds (to pick up changes made elsewhere)
+STANDARDS_INDEX_TIMEOUT = 3600
+
+# Observation portal lookups (instrument filter lists and telescope states) are
+# cached for this many seconds (astrometrics/portal_cache.py)
+PORTAL_CACHE_TIMEOUT = 600
+
 ##################
 # Email settings #
 ##################
@@ -331,6 +373,15 @@ else:
     MEDIA_ROOT = os.getenv('MEDIA_ROOT', '/apophis/eng/media/')
     DATA_ROOT = os.getenv('DATA_ROOT', '/apophis/eng/rocks/')
 
+# Optional columnar store for CatalogSources (photometrics/source_store.py):
+# 'db' stores one row per detection, 'npz' one compressed file per Frame
+CATSOURCES_BACKEND = os.getenv('NEOX_CATSOURCES_BACKEND', 'db')
+CATSOURCES_DIR = os.getenv('NEOX_CATSOURCES_DIR', os.path.join(DATA_ROOT, 'catsources'))
+
+# Directory for the on-disk ephemeris cache used by batch jobs (e.g.
+# compute_long_term_scheduling) when no shared ephemeris cache is configured
+EPHEM_CACHE_DIR = os.getenv('NEOX_EPHEM_CACHE_DIR', os.path.join(DATA_ROOT, 'ephem_cache'))
+
 ##################
 # LOCAL SETTINGS #
 ##################
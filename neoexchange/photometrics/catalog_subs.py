@@ -17,16 +17,18 @@ GNU General Public License for more details.
 
 import logging
 import os
+import json
 from glob import glob
 import numpy as np
 from datetime import datetime, timedelta, UTC
-from math import sqrt, log10, log, degrees, cos
+from math import sqrt, log10, log, degrees, radians, cos, sin
 from collections import OrderedDict
 import time
 from requests.exceptions import ReadTimeout, ConnectTimeout, ConnectionError
 import re
 import warnings
 
+from scipy.spatial import cKDTree
 from astropy.utils.exceptions import AstropyDeprecationWarning
 from astropy.io import fits
 from astropy.table import Table
@@ -37,10 +39,14 @@ import astropy.coordinates as coord
 from astropy.wcs import WCS, FITSFixedWarning
 from astropy.wcs.utils import proj_plane_pixel_scales
 from astropy import __version__ as astropyversion
+from django.db import transaction
+from django.db.models import Q
 
-from astrometrics.ephem_subs import LCOGT_domes_to_site_codes
+from astrometrics.ephem_subs import LCOGT_domes_to_site_codes, radec_to_unit_vectors
 from astrometrics.time_subs import timeit
 from core.models import CatalogSources, Frame
+from photometrics.source_store import use_columnar_store, write_frame_sources, count_frame_sources, \
+    filter_frame_sources, frame_sources_tree, make_frame_sources
 
 warnings.simplefilter('ignore', category = AstropyDeprecationWarning)
 logger = logging.getLogger(__name__)
@@ -183,25 +189,21 @@ def get_vizier_catalog_table(ra, dec, set_width, set_height, cat_name="UCAC4", s
     return cat_table, cat_name
 
 
+def _column_as_array(column, fill_value=np.nan):
+    """Returns a (possibly masked) table column as a plain float array with
+    masked values replaced by [fill_value]"""
+
+    return np.ma.filled(np.ma.asarray(column, dtype=float), fill_value)
+
+
 def cross_match(FITS_table, cat_table, cat_name="UCAC4", cross_match_diff_threshold=0.001):
     """
     Cross matches RA and Dec for sources in two catalog tables. Every source in the shorter length catalog is cross
-    matched with a source in the longer length catalog. Cross matches with RA or Dec differences < 0.001 are not
-    included in the final output table. Outputs a table of RA, Dec, and r-mag for each cross-matched source.
+    matched with the nearest source on the sky in the longer length catalog (found using a KD-tree so all sources
+    are matched in one go). Cross matches with RA or Dec differences >= <cross_match_diff_threshold> (0.001 deg)
+    are not included in the final output table. Outputs a table of RA, Dec, and r-mag for each cross-matched source.
     """
 
-    ra_min_diff_threshold = 1.0
-    dec_min_diff_threshold = 1.0
-    ra_min_diff = ra_min_diff_threshold
-    dec_min_diff = dec_min_diff_threshold
-    dec_cat_1 = 0.0
-    dec_cat_2 = 0.0
-    ra_cat_1 = 0.0
-    ra_cat_2 = 0.0
-    rmag_cat_1 = 0.0
-    rmag_cat_2 = 0.0
-    cross_match_list = []
-
     if len(FITS_table) >= len(cat_table):
         table_1 = cat_table
         table_2 = FITS_table
@@ -248,72 +250,50 @@ def cross_match(FITS_table, cat_table, cat_name="UCAC4", cross_match_diff_thresh
             rmag_table_2 = table_2['rmag']
             flags_table_2 = table_2['RAJ2000'] * 0  # UCAC4 does not have flags, so copy RA table column and turn values all to zeros
             rmag_err_table_2 = table_2['e_rmag']
-    y = 0
-    logger.debug("TIME: Table lengths: {} {}".format(len(Dec_table_1), len(Dec_table_2)))
-    for value in Dec_table_1:
-        if flags_table_1[y] < 1:
-            # Convert masked elements to None to avoid warning error from Table.
-            if not np.ma.is_masked(rmag_table_1[y]):
-                rmag_table_1_temp = rmag_table_1[y]
-            else:
-                rmag_table_1_temp = None
-            z = 0
-            start = time.time()
-            for source in Dec_table_2:
-                if flags_table_2[z] < 1:
-                    if not np.ma.is_masked(rmag_table_2[z]):
-                        rmag_table_2_temp = rmag_table_2[z]
-                    else:
-                        rmag_table_2_temp = None
-                    if abs(source - value) < dec_min_diff:
-                        dec_min_diff = abs(source - value)
-                        ra_table_1_temp = RA_table_1[y]
-                        ra_table_2_temp = RA_table_2[z]
-                        if abs(ra_table_1_temp - ra_table_2_temp) < ra_min_diff:
-                            ra_min_diff = abs(ra_table_1_temp - ra_table_2_temp)
-                            dec_cat_1 = value
-                            dec_cat_2 = source
-                            ra_cat_1 = ra_table_1_temp
-                            ra_cat_2 = ra_table_2_temp
-                            rmag_cat_1 = rmag_table_1_temp
-                            rmag_cat_2 = rmag_table_2_temp
-                            if rmag_cat_1 is not None and rmag_cat_2 is not None and not np.isnan(rmag_cat_1) and not np.isnan(rmag_cat_2):
-                                rmag_diff = abs(rmag_cat_1 - rmag_cat_2)
-                            else:
-                                rmag_diff = None
-                            rmag_error = None
-                            # Calculate errors when possible, ignore when not.
-                            try:
-                                if table1_has_errs:
-                                    rmag_error = float(rmag_err_table_1[y]) / 100.0
-                                else:
-                                    rmag_error = float(rmag_err_table_2[z]) / 100.0
-                            except ValueError:
-                                rmag_error = None
-                z += 1
-            end = time.time()
-            if y <= 10:
-                logger.debug("TIME: inner loop took {:.2f} seconds".format(end-start))
-        if ra_min_diff < cross_match_diff_threshold and dec_min_diff < cross_match_diff_threshold:
-            cross_match_list.append((
-                ra_cat_1, ra_cat_2, ra_min_diff,
-                dec_cat_1, dec_cat_2, dec_min_diff,
-                rmag_cat_1 if rmag_cat_1 is not None else np.nan,
-                rmag_cat_2 if rmag_cat_2 is not None else np.nan,
-                rmag_error if rmag_error is not None else np.nan,
-                rmag_diff if rmag_diff is not None else np.nan,
-            ))
-            # Original line below, above is the same but with None values converted to np.nan for the output table and 
-            # to avoid warning errors from Table (produced by Claude)
-            # cross_match_list.append((ra_cat_1, ra_cat_2, ra_min_diff, dec_cat_1, dec_cat_2, dec_min_diff, rmag_cat_1, rmag_cat_2, rmag_error, rmag_diff))
-        y += 1
-        ra_min_diff = ra_min_diff_threshold
-        dec_min_diff = dec_min_diff_threshold
-
-    if len(cross_match_list) > 0:
-        cross_match_table = Table(rows=cross_match_list, names=('RA Cat 1', 'RA Cat 2', 'RA diff', 'Dec Cat 1', 'Dec Cat 2',
-                                                                'Dec diff', 'r mag Cat 1', 'r mag Cat 2', 'r mag err',
-                                                                'r mag diff'), dtype=('f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8'))
+    logger.debug("Table lengths: {} {}".format(len(Dec_table_1), len(Dec_table_2)))
+
+    # Only use unflagged sources with valid positions
+    good_1 = (_column_as_array(flags_table_1, fill_value=1) < 1) & np.isfinite(_column_as_array(RA_table_1))
+    good_2 = (_column_as_array(flags_table_2, fill_value=1) < 1) & np.isfinite(_column_as_array(RA_table_2))
+    index_1 = np.flatnonzero(good_1)
+    index_2 = np.flatnonzero(good_2)
+    cross_match_columns = []
+    if len(index_1) > 0 and len(index_2) > 0:
+        ra_1 = _column_as_array(RA_table_1)[index_1]
+        dec_1 = _column_as_array(Dec_table_1)[index_1]
+        ra_2 = _column_as_array(RA_table_2)[index_2]
+        dec_2 = _column_as_array(Dec_table_2)[index_2]
+
+        # Find the nearest source on the sky in the second catalog for every
+        # source in the first with a KD-tree of unit vectors. The search
+        # radius encloses the RA & Dec box used for the final match test.
+        tree = cKDTree(radec_to_unit_vectors(ra_2, dec_2))
+        max_chord = 2.0 * np.sin(np.radians(cross_match_diff_threshold * sqrt(2.0)) / 2.0)
+        dist, nearest = tree.query(radec_to_unit_vectors(ra_1, dec_1), k=1, distance_upper_bound=max_chord)
+        found = np.isfinite(dist)
+        nearest = np.where(found, nearest, 0)
+
+        ra_diff = np.abs((ra_1 - ra_2[nearest] + 180.0) % 360.0 - 180.0)
+        dec_diff = np.abs(dec_1 - dec_2[nearest])
+        matched = found & (ra_diff < cross_match_diff_threshold) & (dec_diff < cross_match_diff_threshold)
+        match_1 = index_1[matched]
+        match_2 = index_2[nearest[matched]]
+
+        rmag_cat_1 = _column_as_array(rmag_table_1)[match_1]
+        rmag_cat_2 = _column_as_array(rmag_table_2)[match_2]
+        # Errors are in units of 0.01 mag
+        if table1_has_errs:
+            rmag_error = _column_as_array(rmag_err_table_1)[match_1] / 100.0
+        else:
+            rmag_error = _column_as_array(rmag_err_table_2)[match_2] / 100.0
+        cross_match_columns = [ra_1[matched], ra_2[nearest[matched]], ra_diff[matched],
+                               dec_1[matched], dec_2[nearest[matched]], dec_diff[matched],
+                               rmag_cat_1, rmag_cat_2, rmag_error, np.abs(rmag_cat_1 - rmag_cat_2)]
+
+    if len(cross_match_columns) > 0 and len(cross_match_columns[0]) > 0:
+        cross_match_table = Table(cross_match_columns, names=('RA Cat 1', 'RA Cat 2', 'RA diff', 'Dec Cat 1', 'Dec Cat 2',
+                                                              'Dec diff', 'r mag Cat 1', 'r mag Cat 2', 'r mag err',
+                                                              'r mag diff'), dtype=('f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8'))
     else:
         logger.warning("Did not find any cross matches")
         cross_match_table = None
@@ -853,102 +833,291 @@ def fits_ldac_to_header(header_array):
     return header
 
 
-def open_fits_catalog(catfile, header_only=False):
+class CorruptCatalogError(OSError):
+    pass
+
+
+class FITSCatalogReader(object):
+    """Lazy reader for FITS source catalogs and frames (LCOGT, FITS_LDAC,
+    BANZAI, SWOPE etc.) specified by <catfile>. The file is memory-mapped and
+    HDU headers are only parsed when needed; table data are only touched
+    when table() or column() are called, which return NumPy views onto the
+    mapped file. HDU verification is only done if [verify] is True.
+    Use as a context manager or call open() and close()."""
+
+    def __init__(self, catfile, verify=False):
+        self.catfile = catfile
+        self.verify = verify
+        self.hdulist = None
+        self.cattype = None
+        self._header_index = None
+        self._table_index = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Opens the file and determines the catalog type. Raises IOError if
+        the file can't be opened and CorruptCatalogError if it is corrupt (or
+        fails verification, if requested)"""
+
+        self.hdulist = fits.open(self.catfile, memmap=True, lazy_load_hdus=True)
+        try:
+            if self.verify:
+                for hdu in self.hdulist:
+                    hdu.verify('exception')
+            self._classify()
+        except (OSError, fits.VerifyError) as e:
+            self.close()
+            raise CorruptCatalogError("Verification of FITS catalog {} failed ({})".format(self.catfile, e))
+
+    def close(self):
+        if self.hdulist is not None:
+            self.hdulist.close()
+            self.hdulist = None
+
+    def _index_of(self, extname):
+        try:
+            return self.hdulist.index_of(extname)
+        except KeyError:
+            return -1
+
+    def _classify(self):
+        """Works out the catalog type and which HDUs hold the header and table
+        from the number (and names) of the HDUs"""
+
+        hdulist = self.hdulist
+        num_hdus = len(hdulist)
+        if num_hdus == 2:
+            self.cattype = 'LCOGT'
+            self._header_index = 0
+            self._table_index = 1
+        elif num_hdus == 3 and hdulist[1].header.get('EXTNAME', None) == 'LDAC_IMHEAD':
+            # This is a FITS_LDAC catalog produced by SExtractor for SCAMP
+            self.cattype = 'FITS_LDAC'
+            if 'e92_ldac' in self.catfile or 'e12_ldac' in self.catfile:
+                self.cattype = 'BANZAI_LDAC'
+            self._header_index = 'LDAC'
+            self._table_index = 2
+        elif num_hdus == 4 or num_hdus == 3:
+            # New BANZAI-format data
+            self.cattype = 'BANZAI'
+            sci_index = self._index_of('SCI')
+            cat_index = self._index_of('CAT')
+            if sci_index != -1 and cat_index != -1:
+                self._header_index = sci_index
+                self._table_index = cat_index
+            elif sci_index != -1 and self._index_of('BPM') != -1 and self._index_of('ERR') != -1:
+                self.cattype = 'BANZAI_CALIB_MEF'
+                self._header_index = 'ALL'
+            else:
+                logger.error("Could not find SCI and CAT (or BPM and ERR) HDUs in file: %s" % self.catfile)
+        elif num_hdus == 1:
+            origin = hdulist[0].header.get('origin', None)
+            if origin is not None and origin == 'LCO/OCIW':
+                self.cattype = 'SWOPE'
+                hdr_name = 'PRIMARY'
+            else:
+                # BANZAI-format after extraction of image
+                self.cattype = 'BANZAI'
+                hdr_name = 'SCI'
+            sci_index = self._index_of(hdr_name)
+            if sci_index != -1:
+                self._header_index = sci_index
+            else:
+                logger.error(f"Could not find {hdr_name} HDU in file")
+        elif num_hdus == 5:
+            # Raw Sinistro image
+            self.cattype = 'RAW_MEF'
+            self._header_index = 'ALL'
+        else:
+            logger.error("Unexpected number of catalog HDUs in %s (Expected 1-5, got %d)" % (self.catfile, num_hdus))
+
+    def header(self):
+        """Returns the header of the catalog (a list of headers for
+        multi-extension frames) or {} if it couldn't be found"""
+
+        if self._header_index is None:
+            return {}
+        elif self._header_index == 'ALL':
+            return [hdu.header for hdu in self.hdulist]
+        elif self._header_index == 'LDAC':
+            return fits_ldac_to_header(self.hdulist[1].data[0][0])
+        return self.hdulist[self._header_index].header
+
+    def column_names(self):
+        """Returns the names of the table columns (without reading the table)"""
+
+        if self._table_index is None:
+            return []
+        return self.hdulist[self._table_index].columns.names
+
+    def table(self):
+        """Returns the catalog table (as a FITS_rec backed by the memory-mapped
+        file) or {} if there isn't one"""
+
+        if self._table_index is None:
+            return {}
+        return self.hdulist[self._table_index].data
+
+    def column(self, name):
+        """Returns column <name> of the catalog table as a NumPy array"""
+
+        if self._table_index is None:
+            raise KeyError(name)
+        return self.hdulist[self._table_index].data[name]
+
+
+def open_fits_catalog(catfile, header_only=False, verify=None):
     """Opens a FITS source catalog specified by <catfile> and returns the header,
     table data and catalog type. If [header_only]= is True, only the header is
-    returned, and <table> is set to an empty dictionary."""
+    returned, and <table> is set to an empty dictionary.
+    The HDUs are checked with verify('exception') if [verify] is True; by default
+    this is only done when the table is read (header-only reads just need the
+    headers to be parseable)."""
 
     header = {}
     table = {}
     cattype = None
 
+    if verify is None:
+        verify = not header_only
+    reader = FITSCatalogReader(catfile, verify=verify)
     try:
-        hdulist = fits.open(catfile)
+        reader.open()
+    except CorruptCatalogError:
+        logger.error("Verification of FITS catalog {} failed".format(catfile))
+        return header, table, 'CORRUPT'
     except IOError as e:
         logger.error("Unable to open FITS catalog %s (Reason=%s)" % (catfile, e))
         return header, table, cattype
 
-    # Verify HDUs first
-    try:
-        for hdu in hdulist:
-            hdu.verify('exception')
-    except OSError:
-        logger.error("Verification of FITS catalog {} failed".format(catfile))
-        return header, table, 'CORRUPT'
+    header = reader.header()
+    cattype = reader.cattype
+    if header_only is False:
+        table = reader.table()
+    reader.close()
 
-    if len(hdulist) == 2:
-        header = hdulist[0].header
-        cattype = 'LCOGT'
-        if header_only is False:
-            table = hdulist[1].data
-    elif len(hdulist) == 3 and hdulist[1].header.get('EXTNAME', None) == 'LDAC_IMHEAD':
-        # This is a FITS_LDAC catalog produced by SExtractor for SCAMP
-        if header_only is False:
-            table = hdulist[2].data
-        cattype = 'FITS_LDAC'
-        if 'e92_ldac' in catfile or 'e12_ldac' in catfile:
-            cattype = 'BANZAI_LDAC'
-        header_array = hdulist[1].data[0][0]
-        header = fits_ldac_to_header(header_array)
-    elif len(hdulist) == 4 or (len(hdulist) == 3 and hdulist[1].header.get('EXTNAME', None) != 'LDAC_IMHEAD'):
-        # New BANZAI-format data
-        cattype = 'BANZAI'
-        try:
-            sci_index = hdulist.index_of('SCI')
-        except KeyError:
-            sci_index = -1
-        try:
-            cat_index = hdulist.index_of('CAT')
-        except KeyError:
-            cat_index = -1
+    return header, table, cattype
+
+
+class FITSHeaderIndex(object):
+    """Persistent index of commonly used header keywords (INDEX_KEYWORDS) and
+    catalog types of the FITS files in directory <path>, so that repeated
+    scans of a directory (e.g. by sort_rocks()) don't need to re-open every
+    file. Entries are keyed on filename and only re-read if the file's size
+    or mtime change. The index is stored as JSON (INDEX_NAME) in the directory
+    when save() is called."""
+
+    INDEX_NAME = '.neox_header_index.json'
+    INDEX_KEYWORDS = ('OBJECT', 'BLKUID', 'TRACKNUM', 'REQNUM', 'GROUPID', 'PROPID',
+                      'OBSTYPE', 'DATE-OBS', 'MJD-OBS', 'EXPTIME', 'FILTER', 'SITEID',
+                      'TELID', 'INSTRUME', 'RLEVEL', 'ORIGIN', 'ORIGNAME')
+
+    def __init__(self, path):
+        self.path = path
+        self.index_file = os.path.join(path, self.INDEX_NAME)
+        self.entries = {}
+        self.changed = False
+        self.num_read = 0
         try:
-            bpm_index = hdulist.index_of('BPM')
-        except KeyError:
-            bpm_index = -1
+            with open(self.index_file, 'r') as fh:
+                self.entries = json.load(fh).get('files', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read header index {}: {}".format(self.index_file, e))
+
+    def _stat(self, filename):
         try:
-            err_index = hdulist.index_of('ERR')
-        except KeyError:
-            err_index = -1
+            st = os.stat(os.path.join(self.path, filename))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
 
-        if sci_index != -1 and cat_index != -1:
-            header = hdulist[sci_index].header
-            if header_only is False:
-                table = hdulist[cat_index].data
+    def _index_header(self, filename):
+        fits_header, fits_table, cattype = open_fits_catalog(os.path.join(self.path, filename), header_only=True)
+        self.num_read += 1
+        if isinstance(fits_header, list):
+            headers = fits_header
         else:
-            if sci_index != -1 and bpm_index != -1 and err_index != -1:
-                cattype = 'BANZAI_CALIB_MEF'
-                header = [hdu.header for hdu in hdulist]
-                table = {}
-            else:
-                logger.error("Could not find SCI and CAT (or BPM and ERR) HDUs in file: %s" % catfile)
-    elif len(hdulist) == 1:
-        origin = hdulist[0].header.get('origin', None)
-        if origin is not None and origin == 'LCO/OCIW':
-            cattype = 'SWOPE'
-            hdr_name = 'PRIMARY'
-        else:
-            # BANZAI-format after extraction of image
-            cattype = 'BANZAI'
-            hdr_name = 'SCI'
+            headers = [fits_header, ]
+        keywords = {}
+        for keyword in self.INDEX_KEYWORDS:
+            for header in headers:
+                if keyword in header:
+                    keywords[keyword] = header[keyword]
+                    break
+        return keywords, cattype
+
+    def header(self, filename):
+        """Returns a FITS Header of the indexed keywords of <filename> (within
+        the directory) and the catalog type (as returned by open_fits_catalog()),
+        only reading the file if it's not indexed or has changed.
+        Returns {}, None if the file doesn't exist."""
+
+        stat = self._stat(filename)
+        if stat is None:
+            return {}, None
+        entry = self.entries.get(filename)
+        if entry is None or entry['size'] != stat[0] or entry['mtime'] != stat[1]:
+            keywords, cattype = self._index_header(filename)
+            entry = {'size': stat[0], 'mtime': stat[1], 'cattype': cattype, 'header': keywords}
+            self.entries[filename] = entry
+            self.changed = True
+        if entry['cattype'] is None or entry['cattype'] == 'CORRUPT':
+            return {}, entry['cattype']
+        return fits.Header(list(entry['header'].items())), entry['cattype']
+
+    def save(self):
+        """Writes the index back to disk if it has changed"""
+
+        if not self.changed:
+            return
+        self.entries = {f: e for f, e in self.entries.items() if self._stat(f) is not None}
+        tmp_file = self.index_file + '.%d.tmp' % os.getpid()
         try:
-            sci_index = hdulist.index_of(hdr_name)
-        except KeyError:
-            sci_index = -1
+            with open(tmp_file, 'w') as fh:
+                json.dump({'version': 1, 'files': self.entries}, fh)
+            os.replace(tmp_file, self.index_file)
+            self.changed = False
+        except OSError as e:
+            logger.warning("Could not write header index {}: {}".format(self.index_file, e))
 
-        if sci_index != -1:
-            header = hdulist[sci_index].header
-        else:
-            logger.error(f"Could not find {hdr_name} HDU in file")
-    elif len(hdulist) == 5:
-        # Raw Sinistro image
-        cattype = 'RAW_MEF'
-        header = [hdu.header for hdu in hdulist]
-    else:
-        logger.error("Unexpected number of catalog HDUs in %s (Expected 1-5, got %d)" % (catfile, len(hdulist)))
 
-    hdulist.close()
+_header_indexes = {}
+
+
+def get_header_index(path):
+    """Returns the (per-process cached) FITSHeaderIndex for directory <path>"""
+
+    path = os.path.abspath(path)
+    if path not in _header_indexes:
+        _header_indexes[path] = FITSHeaderIndex(path)
+    return _header_indexes[path]
 
-    return header, table, cattype
+
+def read_fits_headers(fits_files):
+    """Returns a list of (header, catalog type) tuples for each of the passed
+    <fits_files> from the directory header indexes (see FITSHeaderIndex),
+    which are updated and saved. The headers only contain the indexed
+    keywords; use open_fits_catalog() for the full header."""
+
+    headers = []
+    indexes = []
+    for fits_filepath in fits_files:
+        header_index = get_header_index(os.path.dirname(fits_filepath))
+        headers.append(header_index.header(os.path.basename(fits_filepath)))
+        if header_index not in indexes:
+            indexes.append(header_index)
+    for header_index in indexes:
+        header_index.save()
+
+    return headers
 
 
 def convert_value(keyword, value):
@@ -1520,22 +1689,116 @@ def store_catalog_sources(catfile, catalog_type='LCOGT', std_zeropoint_tolerance
     return num_sources_created, num_in_table
 
 
+def catalog_source_params(source, frame):
+    """Returns a dictionary of CatalogSources field values for the <source> row
+    of a catalog table (as returned by get_catalog_items()) from <frame>"""
+
+    source_params = {   'frame': frame,
+                        'obs_x': source['ccd_x'],
+                        'obs_y': source['ccd_y'],
+                        'obs_ra': source['obs_ra'],
+                        'obs_dec': source['obs_dec'],
+                        'obs_mag': source['obs_mag'],
+                        'err_obs_ra': source['obs_ra_err'],
+                        'err_obs_dec': source['obs_dec_err'],
+                        'err_obs_mag': source['obs_mag_err'],
+                        'background': source['obs_sky_bkgd'],
+                        'major_axis': source['major_axis'],
+                        'minor_axis': source['minor_axis'],
+                        'position_angle': source['ccd_pa'],
+                        'ellipticity': 1.0-(source['minor_axis']/source['major_axis']),
+                        'aperture_size': 3.0,
+                        'flags': source['flags'],
+                        'flux_max': source['flux_max'],
+                        'threshold': source['threshold']
+                    }
+    return source_params
+
+
+# CatalogSources fields (other than the frame) that are compared and updated
+# when reconciling a catalog against the sources already stored for a frame
+CATSRC_FIELDS = ('obs_x', 'obs_y', 'obs_ra', 'obs_dec', 'obs_mag', 'err_obs_ra',
+                 'err_obs_dec', 'err_obs_mag', 'background', 'major_axis',
+                 'minor_axis', 'position_angle', 'ellipticity', 'aperture_size',
+                 'flags', 'flux_max', 'threshold')
+
+
+def catalog_source_key(obs_x, obs_y, precision=3):
+    """Returns the key used to match catalog rows with existing CatalogSources
+    for the same frame: the CCD position rounded to <precision> decimal places
+    (so float round-tripping through the DB doesn't produce a mismatch)"""
+
+    return (round(float(obs_x), precision), round(float(obs_y), precision))
+
+
+def _same_value(old_value, new_value):
+    if old_value is None or new_value is None:
+        return old_value is None and new_value is None
+    try:
+        return abs(float(old_value) - float(new_value)) <= 1e-9 * max(1.0, abs(float(new_value)))
+    except (TypeError, ValueError):
+        return old_value == new_value
+
+
+def reconcile_CatalogSources(table, frame, batch_size=500):
+    """Bulk reconciles the sources in <table> with the CatalogSources already
+    stored for <frame>. The existing sources are fetched in one query and
+    matched on CCD position (see catalog_source_key()); unmatched rows are
+    bulk created and matched rows with changed values are bulk updated, all
+    within a single transaction. Existing sources not in <table> are left
+    alone. Returns the number of sources created and updated."""
+
+    existing = {}
+    for cat_src in CatalogSources.objects.filter(frame=frame).only('id', *CATSRC_FIELDS).order_by('id'):
+        existing.setdefault(catalog_source_key(cat_src.obs_x, cat_src.obs_y), cat_src)
+
+    new_sources = []
+    changed_sources = []
+    for source in table:
+        source_params = catalog_source_params(source, frame)
+        key = catalog_source_key(source_params['obs_x'], source_params['obs_y'])
+        cat_src = existing.pop(key, None)
+        if cat_src is None:
+            new_sources.append(CatalogSources(**source_params))
+            continue
+        changed = False
+        for field in CATSRC_FIELDS:
+            if not _same_value(getattr(cat_src, field), source_params[field]):
+                setattr(cat_src, field, source_params[field])
+                changed = True
+        if changed:
+            changed_sources.append(cat_src)
+
+    with transaction.atomic():
+        if new_sources:
+            CatalogSources.objects.bulk_create(new_sources, batch_size=batch_size)
+        if changed_sources:
+            CatalogSources.objects.bulk_update(changed_sources, CATSRC_FIELDS, batch_size=batch_size)
+    logger.debug("Created %d and updated %d CatalogSources for %s" % (len(new_sources), len(changed_sources), frame))
+
+    return len(new_sources), len(changed_sources)
+
+
 def get_or_create_CatalogSources(table, frame):
 
     num_sources_created = 0
 
     num_in_table = len(table)
+    if use_columnar_store():
+        # Each frame's sources are a single file so just (re)write it whole
+        num_cat_sources = count_frame_sources(frame)
+        if num_in_table != num_cat_sources:
+            write_frame_sources(frame, [catalog_source_params(source, frame) for source in table])
+            num_sources_created = max(num_in_table - num_cat_sources, 0)
+        else:
+            logger.info("Number of sources in catalog match number in store; skipping")
+        return num_sources_created, num_in_table
+
     num_cat_sources = CatalogSources.objects.filter(frame=frame).count()
     if num_cat_sources == 0:
         new_sources = []
         for source in table:
-            new_source = CatalogSources(frame=frame, obs_x=source['ccd_x'], obs_y=source['ccd_y'],
-                                        obs_ra=source['obs_ra'], obs_dec=source['obs_dec'], obs_mag=source['obs_mag'],
-                                        err_obs_ra=source['obs_ra_err'], err_obs_dec=source['obs_dec_err'],
-                                        err_obs_mag=source['obs_mag_err'], background=source['obs_sky_bkgd'],
-                                        major_axis=source['major_axis'], minor_axis=source['minor_axis'],
-                                        position_angle=source['ccd_pa'], ellipticity=1.0-(source['minor_axis']/source['major_axis']),
-                                        aperture_size=3.0, flags=source['flags'], flux_max=source['flux_max'], threshold=source['threshold'])
+            new_source = CatalogSources(**catalog_source_params(source, frame))
             new_sources.append(new_source)
         try:
             with transaction.atomic():
@@ -1544,29 +1807,7 @@ def get_or_create_CatalogSources(table, frame):
             CatalogSources.objects.bulk_create(new_sources)
         num_sources_created = len(new_sources)
     elif num_in_table != num_cat_sources:
-        for source in table:
-            source_params = {   'frame': frame,
-                                'obs_x': source['ccd_x'],
-                                'obs_y': source['ccd_y'],
-                                'obs_ra': source['obs_ra'],
-                                'obs_dec': source['obs_dec'],
-                                'obs_mag': source['obs_mag'],
-                                'err_obs_ra': source['obs_ra_err'],
-                                'err_obs_dec': source['obs_dec_err'],
-                                'err_obs_mag': source['obs_mag_err'],
-                                'background': source['obs_sky_bkgd'],
-                                'major_axis': source['major_axis'],
-                                'minor_axis': source['minor_axis'],
-                                'position_angle': source['ccd_pa'],
-                                'ellipticity': 1.0-(source['minor_axis']/source['major_axis']),
-                                'aperture_size': 3.0,
-                                'flags': source['flags'],
-                                'flux_max': source['flux_max'],
-                                'threshold': source['threshold']
-                            }
-            cat_src, created = CatalogSources.objects.get_or_create(**source_params)
-            if created is True:
-                num_sources_created += 1
+        num_sources_created, num_sources_updated = reconcile_CatalogSources(table, frame)
     else:
         logger.info("Number of sources in catalog match number in DB; skipping")
 
@@ -1645,8 +1886,15 @@ def make_sext_dict_list(new_catalog, catalog_type, edge_trim_limit=75.0):
     except Frame.DoesNotExist:
         logger.error("Frame entry for fits file %s does not exist" % real_fits_filename)
         return -3, -3
-    sources = CatalogSources.objects.filter(frame__filename=real_fits_filename, obs_mag__gt=0.0, obs_x__gt=edge_trim_limit,
-                                            obs_x__lt=num_x_pixels-edge_trim_limit, obs_y__gt=edge_trim_limit, obs_y__lt=num_y_pixels-edge_trim_limit)
+    source_lookups = {'obs_mag__gt': 0.0,
+                      'obs_x__gt': edge_trim_limit,
+                      'obs_x__lt': num_x_pixels-edge_trim_limit,
+                      'obs_y__gt': edge_trim_limit,
+                      'obs_y__lt': num_y_pixels-edge_trim_limit}
+    if frame.sources_file:
+        sources = filter_frame_sources(frame, **source_lookups)
+    else:
+        sources = CatalogSources.objects.filter(frame__filename=real_fits_filename, **source_lookups)
     num_iter = 1
     for source in sources:
         sext_dict_list.append(make_sext_dict(source, num_iter))
@@ -1815,10 +2063,9 @@ def extract_sci_image(file_path, catalog_path):
     return fits_filename_path
 
 
-def search_box(frame, ra, dec, box_halfwidth=3.0, max_ap_size=None, dbg=False):
-    """Search CatalogSources for the passed Frame object for sources within a
-    box of <box_halfwidth> centered on <ra>, <dec>.
-    <ra>, <dec> are in radians, <box_halfwidth> is in arcseconds, default is 3.0"
+def box_limits(ra, dec, box_halfwidth=3.0):
+    """Returns the RA and Dec limits (ra_min, ra_max, dec_min, dec_max in degrees)
+    of a box of <box_halfwidth> (in arcseconds) centered on <ra>, <dec> (in radians)
     """
     box_halfwidth_deg = box_halfwidth / 3600.0
     ra_deg = degrees(ra)
@@ -1829,15 +2076,84 @@ def search_box(frame, ra, dec, box_halfwidth=3.0, max_ap_size=None, dbg=False):
     box_dec_max = dec_deg + box_halfwidth_deg
     dec_min = min(box_dec_min, box_dec_max)
     dec_max = max(box_dec_min, box_dec_max)
+
+    return ra_min, ra_max, dec_min, dec_max
+
+
+def search_box(frame, ra, dec, box_halfwidth=3.0, max_ap_size=None, dbg=False):
+    """Search CatalogSources (in the DB or the columnar store) for the passed
+    Frame object for sources within a box of <box_halfwidth> centered on <ra>, <dec>.
+    <ra>, <dec> are in radians, <box_halfwidth> is in arcseconds, default is 3.0"
+    """
+    ra_min, ra_max, dec_min, dec_max = box_limits(ra, dec, box_halfwidth)
     if dbg: 
         logger.debug("Searching %.4f->%.4f, %.4f->%.4f in %s" % (ra_min, ra_max, dec_min, dec_max, frame.filename))
 
-    sources = CatalogSources.objects.filter(frame=frame, obs_ra__range=(ra_min, ra_max), obs_dec__range=(dec_min, dec_max))
+    source_lookups = {'obs_ra__range': (ra_min, ra_max), 'obs_dec__range': (dec_min, dec_max)}
     if max_ap_size is not None:
-        sources = sources.filter(aperture_size__lte=max_ap_size)
+        source_lookups['aperture_size__lte'] = max_ap_size
+    if frame.sources_file:
+        return filter_frame_sources(frame, **source_lookups)
+    sources = CatalogSources.objects.filter(frame=frame, **source_lookups)
     return sources
 
 
+def search_boxes(queries, box_halfwidth=3.0, max_ap_size=None, chunk_size=100):
+    """Batch version of search_box(): <queries> is a list of (Frame, ra, dec)
+    tuples (<ra>, <dec> in radians) and a list of the sources within a box of
+    <box_halfwidth> (in arcseconds) of each is returned (in the same order).
+    Frames in the columnar store are searched with a cached per-frame KD-tree;
+    the rest are fetched from the DB in one query per <chunk_size> boxes
+    rather than one per frame."""
+
+    results = [[] for query in queries]
+    limits = [box_limits(ra, dec, box_halfwidth) for frame, ra, dec in queries]
+    # Chord length of a radius that encloses the whole box (with some margin)
+    radius = 2.0 * sin(radians(sqrt(2.0) * 1.01 * box_halfwidth / 3600.0) / 2.0)
+
+    db_queries = []
+    for i, (frame, ra, dec) in enumerate(queries):
+        if not frame.sources_file:
+            db_queries.append(i)
+            continue
+        tree, columns = frame_sources_tree(frame)
+        if tree is None:
+            continue
+        centre = [cos(dec) * cos(ra), cos(dec) * sin(ra), sin(dec)]
+        indices = np.array(sorted(tree.query_ball_point(centre, radius)), dtype=int)
+        if len(indices) == 0:
+            continue
+        ra_min, ra_max, dec_min, dec_max = limits[i]
+        obs_ra = columns['obs_ra'][indices]
+        obs_dec = columns['obs_dec'][indices]
+        mask = (obs_ra >= ra_min) & (obs_ra <= ra_max) & (obs_dec >= dec_min) & (obs_dec <= dec_max)
+        if max_ap_size is not None:
+            with np.errstate(invalid='ignore'):
+                mask &= columns['aperture_size'][indices] <= max_ap_size
+        results[i] = make_frame_sources(frame, columns, indices[mask])
+
+    for start in range(0, len(db_queries), chunk_size):
+        chunk = db_queries[start:start+chunk_size]
+        boxes = Q()
+        frame_queries = {}
+        for i in chunk:
+            frame = queries[i][0]
+            ra_min, ra_max, dec_min, dec_max = limits[i]
+            boxes |= Q(frame=frame, obs_ra__range=(ra_min, ra_max), obs_dec__range=(dec_min, dec_max))
+            frame_queries.setdefault(frame.pk, []).append(i)
+        sources = CatalogSources.objects.filter(boxes)
+        if max_ap_size is not None:
+            sources = sources.filter(aperture_size__lte=max_ap_size)
+        for source in sources.order_by('id'):
+            for i in frame_queries[source.frame_id]:
+                ra_min, ra_max, dec_min, dec_max = limits[i]
+                if ra_min <= source.obs_ra <= ra_max and dec_min <= source.obs_dec <= dec_max:
+                    source.frame = queries[i][0]
+                    results[i].append(source)
+
+    return results
+
+
 def get_fits_files(fits_path):
     """Look through a directory, uncompressing any fpacked files and return a
     list of all the .fits files"""
@@ -1953,8 +2269,8 @@ def sort_rocks(fits_files):
     <object name>_<block id #>"""
 
     objects = []
-    for fits_filepath in fits_files:
-        fits_header, fits_table, cattype = open_fits_catalog(fits_filepath, header_only=True)
+    fits_headers = read_fits_headers(fits_files)
+    for fits_filepath, (fits_header, cattype) in zip(fits_files, fits_headers):
         object_name = fits_header.get('OBJECT', None)
         block_id = fits_header.get('BLKUID', '').replace('/', '')
         if object_name:
@@ -1984,18 +2300,23 @@ def find_first_last_frames(fits_files):
 
     first_frame = Frame(midpoint=datetime.max)
     last_frame = Frame(midpoint=datetime.min)
-    for fits_filepath in fits_files:
-        fits_file = os.path.basename(fits_filepath)
-        try:
-            frame = Frame.objects.get(filename=fits_file, frametype__in=(Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE))
-        except Frame.DoesNotExist:
+    fits_filenames = [os.path.basename(fits_filepath) for fits_filepath in fits_files]
+    # Fetch all the Frames in one query rather than one per file
+    frames_by_name = {}
+    frames = Frame.objects.filter(filename__in=fits_filenames, frametype__in=(Frame.BANZAI_QL_FRAMETYPE, Frame.BANZAI_RED_FRAMETYPE))
+    for frame in frames:
+        frames_by_name.setdefault(frame.filename, []).append(frame)
+    for fits_file in fits_filenames:
+        matching_frames = frames_by_name.get(fits_file, [])
+        if len(matching_frames) == 0:
             logger.error("Cannot find Frame DB entry for %s" % fits_file)
             first_frame = last_frame = None
             break
-        except Frame.MultipleObjectsReturned:
+        elif len(matching_frames) > 1:
             logger.error("Found multiple entries in DB for %s" % fits_file)
             first_frame = last_frame = None
             break
+        frame = matching_frames[0]
         if frame.midpoint < first_frame.midpoint:
             first_frame = frame
         if frame.midpoint > last_frame.midpoint:
@@ -21,8 +21,10 @@ from datetime import datetime, timedelta
 from subprocess import call, PIPE, Popen, TimeoutExpired
 from collections import OrderedDict
 import warnings
-from shutil import unpack_archive
+from shutil import unpack_archive, move, rmtree
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 
 import astropy.units as u
 from astropy.io import fits
@@ -316,15 +318,17 @@ def add_l1filter(fits_file):
 
 
 #@timeit
-def run_sextractor(source_dir, dest_dir, fits_file, binary=None, catalog_type='ASCII', dbg=False):
+def run_sextractor(source_dir, dest_dir, fits_file, binary=None, catalog_type='ASCII', dbg=False, setup_dir=True):
     """Run SExtractor (using either the binary specified by [binary] or by
     looking for 'sex' in the PATH) on the passed <fits_file> with the results
     and any temporary files created in <dest_dir>. <source_dir> is the path
-    to the required config files."""
+    to the required config files. If [setup_dir] is False, <dest_dir> is
+    assumed to have already been setup by setup_sextractor_dir()."""
 
-    status = setup_sextractor_dir(source_dir, dest_dir, catalog_type)
-    if status != 0:
-        return status
+    if setup_dir:
+        status = setup_sextractor_dir(source_dir, dest_dir, catalog_type)
+        if status != 0:
+            return status
 
     binary = binary or find_binary("sex")
     if binary is None:
@@ -360,15 +364,17 @@ def run_sextractor(source_dir, dest_dir, fits_file, binary=None, catalog_type='A
 
 
 @timeit
-def run_scamp(source_dir, dest_dir, fits_catalog_path, refcatalog='GAIA-DR2.cat', binary=None, dbg=False, distort_degrees=None):
+def run_scamp(source_dir, dest_dir, fits_catalog_path, refcatalog='GAIA-DR2.cat', binary=None, dbg=False, distort_degrees=None, setup_dir=True):
     """Run SCAMP (using either the binary specified by [binary] or by
     looking for 'scamp' in the PATH) on the passed <fits_catalog_path> with the
     results and any temporary files created in <dest_dir>. <source_dir> is the
-    path to the required config files."""
+    path to the required config files. If [setup_dir] is False, <dest_dir> is
+    assumed to have already been setup by setup_scamp_dir()."""
 
-    status = setup_scamp_dir(source_dir, dest_dir)
-    if status != 0:
-        return status
+    if setup_dir:
+        status = setup_scamp_dir(source_dir, dest_dir)
+        if status != 0:
+            return status
 
     binary = binary or find_binary("scamp")
     if binary is None:
@@ -389,6 +395,10 @@ def run_scamp(source_dir, dest_dir, fits_catalog_path, refcatalog='GAIA-DR2.cat'
             if os.path.islink(fits_catalog):
                 os.unlink(fits_catalog)
                 os.symlink(fits_catalog_path, fits_catalog)
+        elif setup_dir is False and os.path.abspath(fits_catalog_path) != os.path.abspath(fits_catalog):
+            # Batch runs use a shared worker directory, so the link to the
+            # catalog won't have been made by an earlier run
+            os.symlink(fits_catalog_path, fits_catalog)
     cmdline = "%s %s -c %s %s" % ( binary, fits_catalog, scamp_config_file, options )
     cmdline = cmdline.rstrip()
 
@@ -409,6 +419,155 @@ def run_scamp(source_dir, dest_dir, fits_catalog_path, refcatalog='GAIA-DR2.cat'
     return retcode_or_cmdline
 
 
+def setup_worker_dirs(setup_func, source_dir, dest_dir, num_workers, **kwargs):
+    """Creates and sets up (using <setup_func>, e.g. setup_scamp_dir()) one
+    working directory per worker, named worker_<n> under <dest_dir>, so the
+    config files only need linking once per batch.
+    Returns a Queue of the working directory paths (for workers to take one
+    from and put back when done) or the (negative) status of a failed setup."""
+
+    work_dirs = Queue()
+    for worker in range(num_workers):
+        work_dir = os.path.join(dest_dir, 'worker_%d' % worker)
+        status = setup_func(source_dir, work_dir, **kwargs)
+        if status != 0:
+            return status
+        work_dirs.put(work_dir)
+
+    return work_dirs
+
+
+def run_batch(func, items, work_dirs, num_workers):
+    """Runs func(item, work_dir) for each of <items> in a pool of
+    <num_workers> threads (the real work is done by external binaries so the
+    GIL is not an issue). Each call takes a working directory from the
+    <work_dirs> Queue for its exclusive use while it runs.
+    Returns the list of results in the same order as <items>."""
+
+    def run_one(item):
+        work_dir = work_dirs.get()
+        try:
+            return func(item, work_dir)
+        finally:
+            work_dirs.put(work_dir)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(run_one, items))
+
+    return results
+
+
+def run_sextractor_batch(source_dir, dest_dir, fits_files, binary=None, catalog_type='ASCII', max_workers=4):
+    """Run SExtractor (using either the binary specified by [binary] or by
+    looking for 'sex' in the PATH) on each of the list of <fits_files> with up
+    to [max_workers] running at once. Each worker has its own working
+    directory under <dest_dir>, setup once from the config files in
+    <source_dir>. As SExtractor always writes the same catalog filename, the
+    catalog for each frame is moved to <dest_dir> and renamed after the frame
+    (e.g. foo-e91.fits -> foo-e91_ldac.fits for [catalog_type]='FITS_LDAC').
+    Returns a list of dictionaries, one per frame in the same order as
+    <fits_files>, with the 'fits_file', the 'status' (return code) and the
+    path of the 'catalog' produced (None if the run failed)."""
+
+    binary = find_binary(binary or "sex")
+    if binary is None:
+        logger.error("Could not locate 'sex' executable in PATH")
+        return [{'fits_file': fits_file, 'status': -42, 'catalog': None} for fits_file in fits_files]
+
+    num_workers = max(min(max_workers, len(fits_files)), 1)
+    work_dirs = setup_worker_dirs(setup_sextractor_dir, source_dir, dest_dir, num_workers, catalog_type=catalog_type)
+    if not isinstance(work_dirs, Queue):
+        return [{'fits_file': fits_file, 'status': work_dirs, 'catalog': None} for fits_file in fits_files]
+
+    sextractor_catalog = 'test.cat'
+    catalog_suffix = '.cat'
+    if catalog_type == 'FITS_LDAC':
+        sextractor_catalog = 'test_ldac.fits'
+        catalog_suffix = '_ldac.fits'
+
+    def run_one(fits_file, work_dir):
+        frame_status = {'fits_file': fits_file, 'status': None, 'catalog': None}
+        status = run_sextractor(source_dir, work_dir, fits_file, binary=binary, catalog_type=catalog_type, setup_dir=False)
+        frame_status['status'] = status
+        output_catalog = os.path.join(work_dir, sextractor_catalog)
+        if status == 0 and os.path.exists(output_catalog):
+            new_catalog = os.path.basename(fits_file).replace('[SCI]', '').replace('.fits', catalog_suffix)
+            new_catalog = os.path.join(dest_dir, new_catalog)
+            move(output_catalog, new_catalog)
+            frame_status['catalog'] = new_catalog
+        elif status == 0:
+            logger.error("SExtractor catalog not produced for %s" % fits_file)
+            frame_status['status'] = -4
+        return frame_status
+
+    results = run_batch(run_one, fits_files, work_dirs, num_workers)
+    while not work_dirs.empty():
+        rmtree(work_dirs.get(), ignore_errors=True)
+
+    return results
+
+
+def run_scamp_batch(source_dir, dest_dir, fits_catalogs, refcatalogs='GAIA-DR2.cat', binary=None, distort_degrees=None, max_workers=4):
+    """Run SCAMP (using either the binary specified by [binary] or by looking
+    for 'scamp' in the PATH) on each of the list of <fits_catalogs> with up to
+    [max_workers] running at once. Each worker has its own working directory
+    under <dest_dir>, setup once from the config files in <source_dir>.
+    [refcatalogs] is either a single reference catalog used for all
+    catalogs or a list of them, one per catalog, which are linked into the
+    working directories (paths without a directory are taken to be in
+    <dest_dir>).
+    The SCAMP output header (.head) and XML (renamed to <catalog>_scamp.xml)
+    files for each catalog are moved to <dest_dir>.
+    Returns a list of dictionaries, one per catalog in the same order as
+    <fits_catalogs>, with the 'fits_catalog', the 'status' (return code)
+    and the paths of the 'head_file' and 'xml_file' (None if not produced)."""
+
+    binary = find_binary(binary or "scamp")
+    if binary is None:
+        logger.error("Could not locate 'scamp' executable in PATH")
+        return [{'fits_catalog': catalog, 'status': -42, 'head_file': None, 'xml_file': None} for catalog in fits_catalogs]
+
+    if isinstance(refcatalogs, str):
+        refcatalogs = [refcatalogs] * len(fits_catalogs)
+
+    num_workers = max(min(max_workers, len(fits_catalogs)), 1)
+    work_dirs = setup_worker_dirs(setup_scamp_dir, source_dir, dest_dir, num_workers)
+    if not isinstance(work_dirs, Queue):
+        return [{'fits_catalog': catalog, 'status': work_dirs, 'head_file': None, 'xml_file': None} for catalog in fits_catalogs]
+
+    def run_one(catalog_and_refcat, work_dir):
+        fits_catalog, refcatalog = catalog_and_refcat
+        frame_status = {'fits_catalog': fits_catalog, 'status': None, 'head_file': None, 'xml_file': None}
+        # SCAMP is only given the name of the reference catalog so it needs
+        # linking into the worker directory it is run from (from <dest_dir>
+        # if the reference catalog doesn't have a path)
+        refcat_path = os.path.abspath(os.path.join(dest_dir, refcatalog))
+        work_refcat = os.path.join(work_dir, os.path.basename(refcatalog))
+        if os.path.exists(refcat_path) and refcat_path != os.path.abspath(work_refcat):
+            if os.path.lexists(work_refcat):
+                os.unlink(work_refcat)
+            os.symlink(refcat_path, work_refcat)
+        status = run_scamp(source_dir, work_dir, os.path.abspath(fits_catalog), refcatalog=refcatalog, binary=binary,
+                           distort_degrees=distort_degrees, setup_dir=False)
+        frame_status['status'] = status
+        catalog_root = os.path.splitext(os.path.basename(fits_catalog))[0]
+        head_file = os.path.join(work_dir, catalog_root + '.head')
+        if os.path.exists(head_file):
+            frame_status['head_file'] = os.path.join(dest_dir, catalog_root + '.head')
+            move(head_file, frame_status['head_file'])
+        xml_file = os.path.join(work_dir, 'scamp.xml')
+        if os.path.exists(xml_file):
+            frame_status['xml_file'] = os.path.join(dest_dir, catalog_root + '_scamp.xml')
+            move(xml_file, frame_status['xml_file'])
+        return frame_status
+
+    results = run_batch(run_one, list(zip(fits_catalogs, refcatalogs)), work_dirs, num_workers)
+    while not work_dirs.empty():
+        rmtree(work_dirs.get(), ignore_errors=True)
+
+    return results
+
+
 @timeit
 def run_mtdlink(source_dir, dest_dir, fits_file_list, num_fits_files, param_file, pa_rate_dict, catfile_type, binary=None, catalog_type='ASCII', dbg=False):
     """Run MTDLINK (using either the binary specified by [binary] or by
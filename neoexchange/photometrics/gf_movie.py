@@ -19,8 +19,10 @@ from math import degrees, cos, radians, copysign
 import matplotlib
 # Sometimes needed...
 #matplotlib.rcParams['agg.path.chunksize'] = 100
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Circle, Rectangle
+from PIL import Image
 from astropy.io import fits
 from astropy.wcs import WCS, FITSFixedWarning
 from django.conf import settings
@@ -31,6 +33,10 @@ from astropy.visualization import ZScaleInterval
 from datetime import datetime, timedelta
 import calendar
 import os
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from glob import glob
 import argparse
 import warnings
@@ -40,6 +46,7 @@ from django.core.files.storage import default_storage
 
 from photometrics.external_codes import unpack_tarball
 from photometrics.catalog_subs import unpack_sci_extension
+from photometrics.source_store import read_frame_sources
 from core.models import Block, Frame, CatalogSources
 from astrometrics.ephem_subs import horizons_ephem
 from astrometrics.time_subs import timeit
@@ -114,7 +121,293 @@ def get_header_info(fits_file):
     return obj, rn, site, inst, frame_type
 
 
-def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, progress=True, out_path="", show_reticle=False, center=None, plot_source=False, target_data=None, horizons_comp=False):
+def image_hdu(hdul):
+    """Returns the HDU of the science image in <hdul> (without reading or
+    decompressing its data)"""
+
+    try:
+        hdu = hdul['SCI']
+    except KeyError:
+        try:
+            hdu = hdul['COMPRESSED_IMAGE']
+        except KeyError:
+            hdu = hdul[0]
+    return hdu
+
+
+def open_image_hdu(hdul):
+    """Returns the header and data of the science image in <hdul>"""
+
+    hdu = image_hdu(hdul)
+    return hdu.header, hdu.data
+
+
+def frame_cache_path(fits_file, cache_dir, center=None, target=None):
+    """Returns the path in <cache_dir> of the cached decoded image of
+    <fits_file> for the [center] and [target] (RA, Dec) crop options. The name
+    includes the file's path, size and modification time so changed frames
+    are decoded again."""
+
+    st = os.stat(fits_file)
+    key = '|'.join([str(k) for k in (os.path.abspath(fits_file), st.st_size, st.st_mtime_ns, center, target)])
+    key_hash = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '{}_{}.npz'.format(os.path.basename(fits_file), key_hash))
+
+
+def decode_frame(fits_file, center=None, target=None):
+    """Does the FITS work for a movie frame: reads <fits_file>, crops it to
+    the central [center] arcmin (shifted towards [target] (RA, Dec in radians)
+    if given) and z-scales it into an 8-bit image.
+    Returns a dictionary of the 'image', the original 'header' (as a string),
+    the 'shape' of the full frame and the crop offsets."""
+
+    with fits.open(fits_file, ignore_missing_end=True) as hdul:
+        header_n, data = open_image_hdu(hdul)
+        header_n = header_n.copy()
+        data = data.copy()
+
+    shape = data.shape
+    x_frac = 0
+    y_frac = 0
+    x_offset = 0
+    y_offset = 0
+    scale_keyword = 'PIXSCALE'
+    if 'PIXSCALE' not in header_n:
+        scale_keyword = 'SCALE'
+    pixscale = header_n.get(scale_keyword, 1.0)
+    if center is not None:
+        width = (center * 60) / pixscale
+        y_frac = np.max(int((shape[0] - width) / 2), 0)
+        x_frac = np.max(int((shape[1] - width) / 2), 0)
+
+        # set data ranges
+        data_x_range = [x_frac, -(x_frac+1)]
+        data_y_range = [y_frac, -(y_frac+1)]
+        if target:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                wcs = WCS(header_n)
+            coord = SkyCoord(target[0], target[1], unit="rad")
+            x_pix, y_pix = skycoord_to_pixel(coord, wcs)
+            x_offset = int(x_pix - header_n['CRPIX1'])
+            y_offset = int(y_pix - header_n['CRPIX2'])
+            if abs(x_offset) > x_frac:
+                x_offset = int(copysign(x_frac, x_offset))
+            if abs(y_offset) > y_frac:
+                y_offset = int(copysign(y_frac, y_offset))
+            data_x_range = [x + x_offset for x in data_x_range]
+            data_y_range = [y + y_offset for y in data_y_range]
+            x_frac += x_offset
+            y_frac += y_offset
+        data = data[data_y_range[0]:data_y_range[1], data_x_range[0]:data_x_range[1]]
+
+    z_interval = ZScaleInterval().get_limits(data)  # set z-scale: responsible for vast majority of compute time
+    z_range = z_interval[1] - z_interval[0]
+    if z_range <= 0:
+        z_range = 1.0
+    image = np.clip((data - z_interval[0]) / z_range, 0.0, 1.0) * 255.0
+    image = np.round(np.nan_to_num(image)).astype(np.uint8)
+
+    return {'image': image,
+            'header': header_n.tostring(),
+            'shape': np.array(shape),
+            'x_frac': x_frac,
+            'y_frac': y_frac,
+            'x_offset': x_offset,
+            'y_offset': y_offset
+            }
+
+
+def load_decoded_frame(fits_file, cache_dir=None, center=None, target=None):
+    """Returns the decoded frame (see decode_frame()) for <fits_file> from the
+    frame cache in [cache_dir], decoding and caching it if needed. If
+    [cache_dir] is None, the frame is just decoded."""
+
+    if cache_dir is None:
+        return decode_frame(fits_file, center, target)
+    cache_path = frame_cache_path(fits_file, cache_dir, center, target)
+    try:
+        with np.load(cache_path) as npz:
+            decoded = {key: npz[key] for key in npz.files}
+        decoded['header'] = str(decoded['header'])
+        for key in ('x_frac', 'y_frac', 'x_offset', 'y_offset'):
+            decoded[key] = int(decoded[key])
+        return decoded
+    except (OSError, ValueError, KeyError):
+        pass
+
+    decoded = decode_frame(fits_file, center, target)
+    tmp_path = cache_path + '.{}.tmp.npz'.format(os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez_compressed(tmp_path, **decoded)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning("Could not cache decoded frame {}: {}".format(cache_path, e))
+    return decoded
+
+
+def render_frame(task):
+    """Renders one movie frame described by the dictionary <task> (built by
+    make_gif()) and returns it as PNG bytes. This runs in a worker process so
+    it only uses the matplotlib object API and doesn't touch the database;
+    the frame's sources ('sources'; an array of (obs_x, obs_y)), the target
+    position ('target') and the JPL ephemeris ('jpl') are looked up beforehand."""
+
+    # Warnings from drawing aren't useful and mustn't stop the movie
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return _render_frame(task)
+
+
+def _render_frame(task):
+    td = task['target']
+    target = None
+    if td and task['center'] is not None:
+        target = (td['ra'], td['dec'])
+    decoded = load_decoded_frame(task['fits_file'], task['cache_dir'], task['center'], target)
+    header_n = fits.Header.fromstring(decoded['header'])
+    image = decoded['image']
+    shape = decoded['shape']
+    x_frac = decoded['x_frac']
+    y_frac = decoded['y_frac']
+    x_offset = decoded['x_offset']
+    y_offset = decoded['y_offset']
+
+    # pull Date from Header
+    try:
+        date_obs = header_n['DATE-OBS']
+    except KeyError:
+        date_obs = header_n['DATE_OBS']
+    try:
+        date = datetime.strptime(date_obs, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        date = datetime.strptime(date_obs, '%Y-%m-%dT%H:%M:%S')
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    wcs = None
+    try:
+        # set wcs grid/axes
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            wcs = WCS(header_n)  # get wcs transformation
+            ax = fig.add_subplot(projection=wcs)
+        dec = ax.coords['dec']
+        # Disabling Automatic Labelling to stop 'pos.eq.dec' labels showing up
+        try:
+            dec.set_auto_axislabel(False)
+        except AttributeError:
+            dec.set_axislabel('')
+        dec.set_major_formatter('dd:mm')
+        dec.set_ticks_position('br')
+        dec.set_ticklabel_position('br')
+        dec.set_ticklabel(fontsize=10, exclude_overlapping=True)
+        ra = ax.coords['ra']
+        try:
+            ra.set_auto_axislabel(False)
+        except AttributeError:
+            ra.set_axislabel('')
+        ra.set_major_formatter('hh:mm:ss')
+        ra.set_ticks_position('lb')
+        ra.set_ticklabel_position('lb')
+        ra.set_ticklabel(fontsize=10, exclude_overlapping=True)
+        ax.coords.grid(color='black', ls='solid', alpha=0.5)
+    except InvalidTransformError:
+        fig.clear()
+        ax = fig.add_subplot()
+        ax.axis('off')
+
+    # finish up plot
+    title = task['title']
+    if title is None:
+        sup_title = f'REQ# {header_n["REQNUM"]} -- {header_n["OBJECT"]} at {header_n["SITEID"].upper()} ({header_n["INSTRUME"]}) -- Filter: {header_n["FILTER"]}'
+    else:
+        sup_title = title
+    framenum = header_n.get("FRAMENUM", None)
+    if framenum is None:
+        framenum = int(header_n["FILENAME"].replace('ccd', '').replace('c1', ''))
+    ax.set_title(sup_title + '\n' + f'UT Date: {date.strftime("%Y/%m/%d %H:%M:%S")} -- #{framenum:04d} '
+                                    f'({task["count"]} of {task["total"]})')
+
+    scale_keyword = 'PIXSCALE'
+    if 'PIXSCALE' not in header_n:
+        scale_keyword = 'SCALE'
+    pixscale = header_n.get(scale_keyword, 1.0)
+    if task['center'] is not None:
+        # Set new coordinates for Reference Pixel w/in smaller window
+        header_n['CRPIX1'] -= x_frac
+        header_n['CRPIX2'] -= y_frac
+
+    ax.imshow(image, cmap='gray', vmin=0, vmax=255)
+
+    # If first few frames, add 5" and 15" reticle
+    if task['reticle']:
+        if task['plot_source'] and (image.shape[1] > header_n['CRPIX1'] > 0) and (image.shape[0] > header_n['CRPIX2'] > 0):
+            ax.plot([header_n['CRPIX1']], [header_n['CRPIX2']], color='red', marker='+', linestyle=' ', label="Frame_Center")
+        else:
+            circle_5arcsec = Circle((header_n['CRPIX1'], header_n['CRPIX2']), 5/pixscale, fill=False, color='limegreen', linewidth=1.5)
+            circle_15arcsec = Circle((header_n['CRPIX1'], header_n['CRPIX2']), 15/pixscale, fill=False, color='lime', linewidth=1.5)
+            ax.add_artist(circle_5arcsec)
+            ax.add_artist(circle_15arcsec)
+
+    # add sources
+    sources = task['sources']
+    if task['plot_source'] and sources is not None and len(sources) > 0:
+        in_x = (sources[:, 0] >= x_frac) & (sources[:, 0] <= shape[1] - x_frac + 2 * x_offset)
+        in_y = (sources[:, 1] >= y_frac) & (sources[:, 1] <= shape[0] - y_frac + 2 * y_offset)
+        for obs_x, obs_y in sources[in_x & in_y]:
+            circle_source = Circle((obs_x - x_frac, obs_y - y_frac), 3/pixscale, fill=False, color='red', linewidth=1, alpha=.5)
+            ax.add_artist(circle_source)
+
+    # Highlight best target and search box
+    x_pix = header_n['CRPIX1']
+    y_pix = header_n['CRPIX2']
+    if td:
+        target_source = td.get('best_source', None)
+        if target_source:
+            target_circle = Circle((target_source[0] - x_frac, target_source[1] - y_frac), 3/pixscale, fill=False, color='limegreen', linewidth=1)
+            ax.add_artist(target_circle)
+        bw = td['bw']
+        bw /= pixscale
+        coord = SkyCoord(td['ra'], td['dec'], unit="rad")
+        x_pix, y_pix = skycoord_to_pixel(coord, wcs)
+        box_width = Rectangle((x_pix-bw-x_frac, y_pix-bw-y_frac), width=bw*2, height=bw*2, fill=False, color='yellow', linewidth=1, alpha=.5)
+        ax.add_artist(box_width)
+
+    # show the position of the JPL Horizons prediction relative to CRPIX if no target data.
+    if task['jpl'] is not None:
+        date_array, ephem_ra, ephem_dec = task['jpl']
+        jpl_ra = np.interp(calendar.timegm(date.timetuple()), date_array, ephem_ra)
+        jpl_dec = np.interp(calendar.timegm(date.timetuple()), date_array, ephem_dec)
+        jpl_coord = SkyCoord(jpl_ra, jpl_dec, unit="deg")
+        jpl_x_pix, jpl_y_pix = skycoord_to_pixel(jpl_coord, wcs)
+        if td and jpl_coord.separation(coord).arcsec > 3:
+            ax.plot([x_pix, jpl_x_pix], [y_pix, jpl_y_pix], color='lightblue', linestyle='-', linewidth=1, alpha=.5)
+            ax.plot([jpl_x_pix], [jpl_y_pix], color='blue', marker='x', linestyle=' ', label="JPL Prediction")
+        elif not td:
+            ax.plot([jpl_x_pix], [jpl_y_pix], color='blue', marker='x', linestyle=' ', label="JPL Prediction")
+
+    fig.tight_layout(pad=4)
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=90)
+    return buf.getvalue()
+
+
+def frame_source_positions(frame_obj):
+    """Returns an array of the (obs_x, obs_y) positions of the sources of
+    <frame_obj> from the columnar store or the database"""
+
+    if frame_obj.sources_file:
+        columns = read_frame_sources(frame_obj)
+        if not columns:
+            return np.empty((0, 2))
+        return np.column_stack((columns['obs_x'], columns['obs_y']))
+    positions = CatalogSources.objects.filter(frame=frame_obj).values_list('obs_x', 'obs_y')
+    return np.array(list(positions), dtype=float).reshape(-1, 2)
+
+
+def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, progress=True, out_path="", show_reticle=False, center=None, plot_source=False, target_data=None, horizons_comp=False, num_workers=None, cache_dir=None):
     """
     takes in list of .fits guide frames and turns them into a moving gif.
     <frames> = list of .fits frame paths
@@ -124,27 +417,28 @@ def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, progress=True,
     <init_fr> = frame rate for first 5 frames in ms/frame [default = 1000 ms/frame or 1fps]
     <show_reticle> = Bool to determine if reticle present for all guide frames.
     <center> = Display only Central region of frame with this many arcmin/side.
+    <num_workers> = [optional] number of processes to render frames with (defaults to up to 4)
+    <cache_dir> = [optional] directory for the decoded frame cache (defaults to settings.GF_MOVIE_CACHE_DIR)
     output = savefile (path of gif)
+    If there is a cache directory, frames are decoded (see decode_frame()) and
+    cached once, so re-running with a different frame rate or reticle option
+    only redraws them. Otherwise nothing is written apart from the movie.
     """
 
+    if cache_dir is None:
+        cache_dir = getattr(settings, 'GF_MOVIE_CACHE_DIR', None)
     if sort is True:
         fits_files = np.sort(frames)
     else:
         fits_files = frames
     path = out_path
 
+    # Slow down the first few frames by lengthening their display time
+    # rather than repeating them
     start_frames = 5
     copies = 1
     if init_fr and init_fr > fr and len(fits_files) > start_frames:
         copies = init_fr // fr
-        i = 0
-        while i < start_frames * copies:
-            c = 1
-            while c < copies:
-                fits_files = np.insert(fits_files, i, fits_files[i])
-                i += 1
-                c += 1
-            i += 1
 
     # pull out files that exist
     good_fits_files = [f for f in fits_files if os.path.exists(f)]
@@ -152,9 +446,8 @@ def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, progress=True,
     if len(good_fits_files) == 0:
         return "WARNING: COULD NOT FIND FITS FILES"
 
-    fig = plt.figure()
     warnings.simplefilter('ignore', category=FITSFixedWarning)
-    frame_query = Frame.objects.filter(filename__in=base_name_list).order_by('midpoint').prefetch_related('catalogsources_set')
+    frame_query = Frame.objects.filter(filename__in=base_name_list).order_by('midpoint')
     if frame_query:
         frame_obj = frame_query[0]
         end_frame = frame_query.last()
@@ -172,13 +465,7 @@ def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, progress=True,
             frame_type = 'guide'
     else:
         with fits.open(good_fits_files[0], ignore_missing_end=True) as hdul:
-            try:
-                header = hdul['SCI'].header
-            except KeyError:
-                try:
-                    header = hdul['COMPRESSED_IMAGE'].header
-                except KeyError:
-                    header = hdul[0].header
+            header = image_hdu(hdul).header
         obj_name = header['OBJECT']
         rn = header['REQNUM']
         sitecode = header['SITE']
@@ -187,206 +474,71 @@ def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, progress=True,
         else:
             frame_type = 'frame'
 
+    jpl = None
     if horizons_comp:
         # Get predicted JPL position of target in first frame
-
         try:
             ephem = horizons_ephem(obj_name, start, end, sitecode, ephem_step_size='1m')
             date_array = np.array([calendar.timegm(d.timetuple()) for d in ephem['datetime']])
+            if date_array.any():
+                jpl = (date_array, np.array(ephem['RA']), np.array(ephem['DEC']))
         except TypeError:
-            date_array = []
-
-    time_in = datetime.now()
-    x_offset = 0
-    y_offset = 0
-
-    def update(n):
-        """ this method is required to build FuncAnimation
-        <file> = frame currently being iterated
-        output: return plot.
-        """
-        # get data/Header from Fits
-        try:
-            with fits.open(good_fits_files[n], ignore_missing_end=True) as hdul:
-                try:
-                    header_n = hdul['SCI'].header
-                    data = hdul['SCI'].data
-                except KeyError:
-                    try:
-                        header_n = hdul['COMPRESSED_IMAGE'].header
-                        data = hdul['COMPRESSED_IMAGE'].data
-                    except KeyError:
-                        header_n = hdul[0].header
-                        data = hdul[0].data
-        except FileNotFoundError:
-            if progress:
-                logger.warning('Could not find Frame {}'.format(good_fits_files[n]))
-            return None
-
-        # pull Date from Header
-        try:
-            date_obs = header_n['DATE-OBS']
-        except KeyError:
-            date_obs = header_n['DATE_OBS']
-        try:
-            date = datetime.strptime(date_obs, '%Y-%m-%dT%H:%M:%S.%f')
-        except ValueError:
-            date = datetime.strptime(date_obs, '%Y-%m-%dT%H:%M:%S')
-        # reset plot
-        ax = plt.gca()
-        ax.clear()
-        ax.axis('off')
-
-        try:
-            # set wcs grid/axes
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                wcs = WCS(header_n)  # get wcs transformation
-                #ax = plt.gca(projection=wcs)
-                # Matplotlib deprecated above in 3.4
-                ax = plt.subplot(projection=wcs)
-            dec = ax.coords['dec']
-            # Disabling Automatic Labelling to stop 'pos.eq.dec' labels showing up
-            try:
-                dec.set_auto_axislabel(False)
-            except AttributeError:
-                dec.set_axislabel('')
-            dec.set_major_formatter('dd:mm')
-            dec.set_ticks_position('br')
-            dec.set_ticklabel_position('br')
-            dec.set_ticklabel(fontsize=10, exclude_overlapping=True)
-            ra = ax.coords['ra']
-            try:
-                ra.set_auto_axislabel(False)
-            except AttributeError:
-                ra.set_axislabel('')
-            ra.set_major_formatter('hh:mm:ss')
-            ra.set_ticks_position('lb')
-            ra.set_ticklabel_position('lb')
-            ra.set_ticklabel(fontsize=10, exclude_overlapping=True)
-            ax.coords.grid(color='black', ls='solid', alpha=0.5)
-        except InvalidTransformError:
             pass
-        # finish up plot
-        current_count = len(np.unique(good_fits_files[:n + 1]))
-
-        if title is None:
-            sup_title = f'REQ# {header_n["REQNUM"]} -- {header_n["OBJECT"]} at {header_n["SITEID"].upper()} ({header_n["INSTRUME"]}) -- Filter: {header_n["FILTER"]}'
-        else:
-            sup_title = title
-        framenum = header_n.get("FRAMENUM", None)
-        if framenum is None:
-            framenum = int(header_n["FILENAME"].replace('ccd', '').replace('c1', ''))
-        ax.set_title(sup_title + '\n' + f'UT Date: {date.strftime("%Y/%m/%d %H:%M:%S")} -- #{framenum:04d} '
-                                        f'({current_count} of'
-                                        f' {int(len(good_fits_files) - (copies - 1) * start_frames)})')
-
-        # Set frame to be center of chip in arcmin
-        shape = data.shape
-        x_frac = 0
-        y_frac = 0
-        scale_keyword = 'PIXSCALE'
-        if 'PIXSCALE' not in header_n:
-            scale_keyword = 'SCALE'
-        pixscale = header_n.get(scale_keyword, 1.0)
-        if center is not None:
-            width = (center * 60) / pixscale
-            y_frac = np.max(int((shape[0] - width) / 2), 0)
-            x_frac = np.max(int((shape[1] - width) / 2), 0)
-
-            # set data ranges
-            data_x_range = [x_frac, -(x_frac+1)]
-            data_y_range = [y_frac, -(y_frac+1)]
-            if target_data:
-                nonlocal x_offset
-                nonlocal y_offset
-                td = target_data[n]
-                coord = SkyCoord(td['ra'], td['dec'], unit="rad")
-                x_pix, y_pix = skycoord_to_pixel(coord, wcs)
-                x_offset = int(x_pix - header_n['CRPIX1'])
-                y_offset = int(y_pix - header_n['CRPIX2'])
-                if abs(x_offset) > x_frac:
-                    x_offset = int(copysign(x_frac, x_offset))
-                if abs(y_offset) > y_frac:
-                    y_offset = int(copysign(y_frac, y_offset))
-                data_x_range = [x + x_offset for x in data_x_range]
-                data_y_range = [y + y_offset for y in data_y_range]
-                x_frac += x_offset
-                y_frac += y_offset
-            data = data[data_y_range[0]:data_y_range[1], data_x_range[0]:data_x_range[1]]
-            # Set new coordinates for Reference Pixel w/in smaller window
-            header_n['CRPIX1'] -= x_frac
-            header_n['CRPIX2'] -= y_frac
-
-        z_interval = ZScaleInterval().get_limits(data)  # set z-scale: responsible for vast majority of compute time
-        plt.imshow(data, cmap='gray', vmin=z_interval[0], vmax=z_interval[1])
-
-        # If first few frames, add 5" and 15" reticle
-        if current_count < 6 and fr != init_fr or show_reticle:
-            if plot_source and (data.shape[1] > header_n['CRPIX1'] > 0) and (data.shape[0] > header_n['CRPIX2'] > 0):
-                plt.plot([header_n['CRPIX1']], [header_n['CRPIX2']], color='red', marker='+', linestyle=' ', label="Frame_Center")
-            else:
-                circle_5arcsec = plt.Circle((header_n['CRPIX1'], header_n['CRPIX2']), 5/pixscale, fill=False, color='limegreen', linewidth=1.5)
-                circle_15arcsec = plt.Circle((header_n['CRPIX1'], header_n['CRPIX2']), 15/pixscale, fill=False, color='lime', linewidth=1.5)
-                ax.add_artist(circle_5arcsec)
-                ax.add_artist(circle_15arcsec)
 
-        # add sources
-        if plot_source:
-            try:
-                frame_obj = Frame.objects.get(filename=os.path.basename(good_fits_files[n]))
-                sources = CatalogSources.objects.filter(frame=frame_obj, obs_y__range=(y_frac, shape[0] - y_frac + 2 * y_offset), obs_x__range=(x_frac, shape[1] - x_frac + 2 * x_offset))
-                for source in sources:
-                    circle_source = plt.Circle((source.obs_x - x_frac, source.obs_y - y_frac), 3/pixscale, fill=False, color='red', linewidth=1, alpha=.5)
-                    ax.add_artist(circle_source)
-            except Frame.DoesNotExist:
-                pass
-
-        # Highlight best target and search box
-        x_pix = header_n['CRPIX1']
-        y_pix = header_n['CRPIX2']
+    # Do the database lookups here as the frames are rendered in other processes
+    frames_by_name = {}
+    if plot_source:
+        for frame in frame_query:
+            frames_by_name.setdefault(frame.filename, frame)
+
+    tasks = []
+    seen_files = set()
+    for n, fits_file in enumerate(good_fits_files):
+        seen_files.add(fits_file)
+        current_count = len(seen_files)
+        td = None
         if target_data:
-            td = target_data[n]
-            target_source = td.get('best_source', None)
-            if target_source:
-                target_circle = plt.Circle((target_source.obs_x - x_frac, target_source.obs_y - y_frac), 3/pixscale, fill=False, color='limegreen', linewidth=1)
-                ax.add_artist(target_circle)
-            bw = td['bw']
-            bw /= pixscale
-            coord = SkyCoord(td['ra'], td['dec'], unit="rad")
-            # if target_source:
-            #     print(coord.separation(SkyCoord(target_source.obs_ra, target_source.obs_dec, unit="deg")).arcsec)
-            x_pix, y_pix = skycoord_to_pixel(coord, wcs)
-            box_width = plt.Rectangle((x_pix-bw-x_frac, y_pix-bw-y_frac), width=bw*2, height=bw*2, fill=False, color='yellow', linewidth=1, alpha=.5)
-            ax.add_artist(box_width)
-
-        # show the position of the JPL Horizons prediction relative to CRPIX if no target data.
-        if horizons_comp and date_array.any():
-            jpl_ra = np.interp(calendar.timegm(date.timetuple()), date_array, ephem['RA'])
-            jpl_dec = np.interp(calendar.timegm(date.timetuple()), date_array, ephem['DEC'])
-            jpl_coord = SkyCoord(jpl_ra, jpl_dec, unit="deg")
-            jpl_x_pix, jpl_y_pix = skycoord_to_pixel(jpl_coord, wcs)
-            if target_data and jpl_coord.separation(coord).arcsec > 3:
-                plt.plot([x_pix, jpl_x_pix], [y_pix, jpl_y_pix], color='lightblue', linestyle='-', linewidth=1, alpha=.5)
-                plt.plot([jpl_x_pix], [jpl_y_pix], color='blue', marker='x', linestyle=' ', label="JPL Prediction")
-            elif not target_data:
-                plt.plot([jpl_x_pix], [jpl_y_pix], color='blue', marker='x', linestyle=' ', label="JPL Prediction")
-
-        if progress:
-            print_progress_bar(n+1, len(good_fits_files), prefix='Creating Gif: Frame {}'.format(current_count), time_in=time_in)
-        return ax
-
-    ax1 = update(0)
-    plt.tight_layout(pad=4)
-
-    # takes in fig, update function, and frame rate set to fr
-    anim = FuncAnimation(fig, update, frames=len(good_fits_files), blit=False, interval=fr)
+            td = dict(target_data[n])
+            best_source = td.get('best_source', None)
+            if best_source:
+                td['best_source'] = (best_source.obs_x, best_source.obs_y)
+        sources = None
+        if plot_source and base_name_list[n] in frames_by_name:
+            sources = frame_source_positions(frames_by_name[base_name_list[n]])
+        tasks.append({'fits_file': fits_file,
+                      'cache_dir': cache_dir,
+                      'center': center,
+                      'title': title,
+                      'count': current_count,
+                      'total': len(good_fits_files),
+                      'reticle': current_count < 6 and fr != init_fr or show_reticle,
+                      'plot_source': plot_source,
+                      'sources': sources,
+                      'target': td,
+                      'jpl': jpl
+                      })
 
-    filename = os.path.join(path, sanitize_object_name(obj_name) + '_' + rn + '_{}movie.gif'.format(frame_type))
-    anim.save(filename, dpi=90, writer='imagemagick')
+    time_in = datetime.now()
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    pngs = []
+    if num_workers > 1 and len(tasks) > 1:
+        # Fork so the workers don't need to set up Django again
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            for png in executor.map(render_frame, tasks, chunksize=max(1, len(tasks) // (num_workers * 8))):
+                pngs.append(png)
+                if progress:
+                    print_progress_bar(len(pngs), len(tasks), prefix='Creating Gif: Frame {}'.format(len(pngs)), time_in=time_in)
+    else:
+        for task in tasks:
+            pngs.append(render_frame(task))
+            if progress:
+                print_progress_bar(len(pngs), len(tasks), prefix='Creating Gif: Frame {}'.format(len(pngs)), time_in=time_in)
 
-    plt.close('all')
-    # Save to default location because Matplotlib wants a string filename not File object
+    images = [Image.open(BytesIO(png)) for png in pngs]
+    durations = [fr * copies if n < start_frames else fr for n in range(len(images))]
+    filename = os.path.join(path, sanitize_object_name(obj_name) + '_' + rn + '_{}movie.gif'.format(frame_type))
+    images[0].save(filename, save_all=True, append_images=images[1:], duration=durations, loop=0)
 
     return filename
 
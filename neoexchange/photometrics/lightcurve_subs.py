@@ -21,7 +21,10 @@ import numpy as np
 from astropy.time import Time
 from astropy.wcs import FITSFixedWarning
 from astropy.table import Table, unique, Column
+from astropy.coordinates import angular_separation
 from core.models import Frame, CatalogSources, SourceMeasurement
+from astrometrics.ephem_subs import compute_ephem_batch, compute_airmass_batch, horizons_positions
+from photometrics.source_store import filter_frame_sources
 
 import logging
 
@@ -87,14 +90,18 @@ def create_table_from_srcmeasures(block):
     mag_tolerance = 0.01
     for i, src in enumerate(sources):
         t = Time(src.frame.midpoint)
-        catsrc = CatalogSources.objects.filter(frame=src.frame, obs_ra__range=(src.obs_ra-tolerance, src.obs_ra+tolerance),\
-            obs_dec__range=(src.obs_dec-tolerance, src.obs_dec+tolerance),\
-            obs_mag__range=(src.obs_mag-mag_tolerance, src.obs_mag+mag_tolerance))
+        source_lookups = {'obs_ra__range': (src.obs_ra-tolerance, src.obs_ra+tolerance),
+                          'obs_dec__range': (src.obs_dec-tolerance, src.obs_dec+tolerance),
+                          'obs_mag__range': (src.obs_mag-mag_tolerance, src.obs_mag+mag_tolerance)}
+        if src.frame.sources_file:
+            catsrc = filter_frame_sources(src.frame, **source_lookups)
+        else:
+            catsrc = CatalogSources.objects.filter(frame=src.frame, **source_lookups)
         flags = 0
-        if catsrc.count() == 1:
+        if len(catsrc) == 1:
             flags = catsrc[0].flags
         else:
-            logger.warning(f"Unexpected number of CatalogSources ({catsrc.count()}) found for {src.frame.filename}")
+            logger.warning(f"Unexpected number of CatalogSources ({len(catsrc)}) found for {src.frame.filename}")
         # print(i, src.frame.filename, t.jd, src.obs_mag, src.err_obs_mag,
                # src.frame.zeropoint,\
                # src.frame.zeropoint_err,\
@@ -192,3 +199,137 @@ def write_photompipe_file(table, filepath):
                         '# [9]: telescope/instrument\n' +
                         '# [10]: photometry method\n')
     return
+
+
+def group_frames_by_site(frames):
+    """Returns a dictionary of the indices into <frames> keyed by site code"""
+
+    site_rows = {}
+    for i, frame in enumerate(frames):
+        site_rows.setdefault(frame.sitecode, []).append(i)
+    return {site: np.array(rows) for site, rows in site_rows.items()}
+
+
+def group_frames_by_block(frames):
+    """Returns a dictionary of the indices into <frames> keyed by site code
+    and Block id, so each group covers (part of) a single night. Frames
+    without a Block are grouped by site code and UTC date instead"""
+
+    block_rows = {}
+    for i, frame in enumerate(frames):
+        if frame.block_id is not None:
+            key = (frame.sitecode, frame.block_id)
+        else:
+            key = (frame.sitecode, frame.midpoint.date())
+        block_rows.setdefault(key, []).append(i)
+    return {key: np.array(rows) for key, rows in block_rows.items()}
+
+
+def offset_positions(ra, dec, ra_offset=0.0, dec_offset=0.0):
+    """Vectorized version of applying offsets of <ra_offset>, <dec_offset> (in
+    radians) to positions <ra>, <dec> with sla_dranrm() and sla_drange()"""
+
+    ra = np.remainder(np.asarray(ra) + ra_offset, 2.0*np.pi)
+    dec = np.asarray(dec) + dec_offset
+    dec = np.copysign(np.remainder(dec + np.pi, 2.0*np.pi) - np.pi, dec)
+    return ra, dec
+
+
+def predict_frame_positions(frames, elements, ra_offset=0.0, dec_offset=0.0):
+    """Computes the predicted position and magnitude of the target with the
+    orbital <elements> at the midpoints of all of the <frames>, with one
+    vectorized ephemeris computation per site and Block rather than per frame
+    (so the elements are perturbed to the middle of each Block's night).
+    [ra_offset] and [dec_offset] (in radians) are added to the positions.
+    Returns NumPy arrays of RA, Dec (radians) and magnitude, which are NaN
+    for frames where the ephemeris couldn't be computed."""
+
+    ra = np.full(len(frames), np.nan)
+    dec = np.full(len(frames), np.nan)
+    mag = np.full(len(frames), np.nan)
+    for (sitecode, block), rows in group_frames_by_block(frames).items():
+        dates = np.array([frames[i].midpoint for i in rows], dtype='datetime64[us]')
+        emp = compute_ephem_batch(dates, elements, sitecode)
+        if len(emp) == 0:
+            logger.warning("Could not compute ephemeris for %d frames from %s" % (len(rows), sitecode))
+            continue
+        # Rows which couldn't be computed are dropped so match back up by time
+        # (the frames aren't necessarily in time order)
+        emp_rows = {date: i for i, date in enumerate(emp['date'])}
+        index = np.array([emp_rows.get(date, -1) for date in dates])
+        good = index >= 0
+        ra[rows[good]] = emp['ra'][index[good]]
+        dec[rows[good]] = emp['dec'][index[good]]
+        mag[rows[good]] = emp['mag'][index[good]]
+    ra, dec = offset_positions(ra, dec, ra_offset, dec_offset)
+
+    return ra, dec, mag
+
+
+def horizons_frame_positions(frames, obj_name, elements=None, ra_offset=0.0, dec_offset=0.0):
+    """Retrieves the position and magnitude of <obj_name> at the midpoints
+    of all of the <frames> from JPL HORIZONS, with one (cached) multi-epoch
+    query per site and chunk of epochs. Frames that HORIZONS doesn't return a
+    position for (e.g. when offline) fall back to the local ephemeris from
+    the orbital [elements], if given.
+    [ra_offset] and [dec_offset] (in radians) are added to the positions.
+    Returns NumPy arrays of RA, Dec (radians) and magnitude, as for
+    predict_frame_positions()."""
+
+    ra = np.full(len(frames), np.nan)
+    dec = np.full(len(frames), np.nan)
+    mag = np.full(len(frames), np.nan)
+    for sitecode, rows in group_frames_by_site(frames).items():
+        dates = np.array([frames[i].midpoint for i in rows], dtype='datetime64[us]')
+        ra[rows], dec[rows], mag[rows] = horizons_positions(obj_name, dates, sitecode)
+    missing = np.flatnonzero(~np.isfinite(ra) | ~np.isfinite(dec))
+    if len(missing) > 0 and elements is not None:
+        logger.warning("Using local ephemeris for %d frames without HORIZONS positions" % len(missing))
+        ra[missing], dec[missing], mag[missing] = predict_frame_positions([frames[i] for i in missing], elements)
+    ra, dec = offset_positions(ra, dec, ra_offset, dec_offset)
+
+    return ra, dec, mag
+
+
+def compute_frame_airmasses(frames, ra, dec):
+    """Computes the airmass of the predicted positions <ra>, <dec> (arrays in
+    radians) of the target at the midpoints of <frames>, with one vectorized
+    computation per site. Returns a NumPy array of airmasses."""
+
+    airmass = np.full(len(frames), np.nan)
+    for sitecode, rows in group_frames_by_site(frames).items():
+        dates = np.array([frames[i].midpoint for i in rows], dtype='datetime64[us]')
+        airmass[rows] = compute_airmass_batch(dates, ra[rows], dec[rows], sitecode)
+    return airmass
+
+
+def source_separations(sources, ra, dec, ref_mag):
+    """Returns arrays of the separations (in arcsec) of the <sources> from the
+    position <ra>, <dec> (radians) and of the absolute differences of their
+    magnitudes from <ref_mag>"""
+
+    src_ra = np.radians([source.obs_ra for source in sources])
+    src_dec = np.radians([source.obs_dec for source in sources])
+    src_mag = np.array([source.obs_mag for source in sources], dtype=float)
+    sep = np.degrees(angular_separation(ra, dec, src_ra, src_dec)) * 3600.0
+    delta_mag = np.abs(ref_mag - src_mag)
+    return sep, delta_mag
+
+
+def select_best_source(sources, ra, dec, ref_mag, box_halfwidth, deltamag):
+    """Picks the source from <sources> that is most likely to be the target
+    predicted to be at <ra>, <dec> (radians). If there is one source, it is
+    used; otherwise the closest source whose magnitude is within <deltamag>
+    of <ref_mag> (and which is within the square of <box_halfwidth>
+    arcseconds) is picked, with ties going to the first source.
+    Returns the best source (or None)"""
+
+    if len(sources) == 0:
+        return None
+    if len(sources) == 1:
+        return sources[0]
+    sep, delta_mag = source_separations(sources, ra, dec, ref_mag)
+    candidates = np.flatnonzero((sep < box_halfwidth * box_halfwidth) & (delta_mag <= deltamag))
+    if len(candidates) == 0:
+        return None
+    return sources[candidates[np.argmin(sep[candidates])]]
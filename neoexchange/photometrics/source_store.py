@@ -0,0 +1,270 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2014-2019 LCO
+
+source_store.py -- Columnar on-disk storage of CatalogSources.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+import logging
+from collections import OrderedDict
+from threading import RLock
+
+import numpy as np
+from scipy.spatial import cKDTree
+from django.conf import settings
+
+from astrometrics.ephem_subs import radec_to_unit_vectors
+from core.models import CatalogSources
+
+logger = logging.getLogger(__name__)
+
+# Columns stored for each source (i.e. all the CatalogSources fields except
+# the primary key and the Frame, which is implied by the file)
+SOURCE_COLUMNS = tuple(f.name for f in CatalogSources._meta.concrete_fields if f.name not in ('id', 'frame'))
+INT_COLUMNS = ('flags',)
+
+# Number of decoded per-frame tables held in memory
+_CACHE_SIZE = 64
+_cache = OrderedDict()
+_trees = OrderedDict()
+_cache_lock = RLock()
+
+
+def use_columnar_store():
+    """Returns True if new CatalogSources should be written to the columnar
+    store rather than the database (settings.CATSOURCES_BACKEND == 'npz')"""
+
+    return getattr(settings, 'CATSOURCES_BACKEND', 'db') == 'npz'
+
+
+def store_dir():
+    return getattr(settings, 'CATSOURCES_DIR', 'catsources')
+
+
+def frame_sources_filename(frame):
+    """Returns the path (relative to settings.CATSOURCES_DIR) of the sources
+    file for <frame>, grouped by night to keep directories small"""
+
+    return os.path.join(frame.midpoint.strftime('%Y%m%d'), '%d_sources.npz' % frame.pk)
+
+
+def frame_sources_path(frame):
+    """Returns the full path of the sources file of <frame> or None if it
+    doesn't have one"""
+
+    if not frame.sources_file:
+        return None
+    return os.path.join(store_dir(), frame.sources_file)
+
+
+def write_frame_sources(frame, sources):
+    """Writes <sources> (a list of dictionaries of CatalogSources field values,
+    as produced by catalog_subs.catalog_source_params(), or CatalogSources
+    instances) for <frame> to a compressed .npz file, replacing any previous
+    version, and records the file in Frame.sources_file.
+    Returns the number of sources written."""
+
+    columns = {}
+    for column in SOURCE_COLUMNS:
+        if len(sources) > 0 and isinstance(sources[0], dict):
+            values = [source.get(column, None) for source in sources]
+        else:
+            values = [getattr(source, column) for source in sources]
+        if column in INT_COLUMNS:
+            columns[column] = np.array([v if v is not None else 0 for v in values], dtype=np.int32)
+        else:
+            columns[column] = np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+
+    filename = frame_sources_filename(frame)
+    filepath = os.path.join(store_dir(), filename)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    # Write to a temporary file and rename so readers never see a partial file
+    tmp_filepath = filepath + '.tmp.npz'
+    np.savez_compressed(tmp_filepath, **columns)
+    os.replace(tmp_filepath, filepath)
+    with _cache_lock:
+        _cache.pop(filepath, None)
+
+    if frame.sources_file != filename:
+        frame.sources_file = filename
+        frame.save(update_fields=['sources_file'])
+    logger.debug("Wrote %d sources for %s to %s" % (len(sources), frame.filename, filepath))
+
+    return len(sources)
+
+
+def read_frame_sources(frame):
+    """Returns a dictionary of numpy arrays (keyed on SOURCE_COLUMNS) of the
+    sources stored for <frame>, or None if it has no sources file. Recently
+    read frames are kept in memory."""
+
+    filepath = frame_sources_path(frame)
+    if filepath is None:
+        return None
+    try:
+        mtime = os.path.getmtime(filepath)
+    except OSError:
+        logger.warning("Sources file %s for %s not found" % (filepath, frame.filename))
+        return None
+
+    with _cache_lock:
+        entry = _cache.get(filepath)
+        if entry is not None and entry[0] == mtime:
+            _cache.move_to_end(filepath)
+            return entry[1]
+
+    with np.load(filepath) as npz:
+        columns = {column: npz[column] for column in npz.files}
+    with _cache_lock:
+        _cache[filepath] = (mtime, columns)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return columns
+
+
+def radec_tree(ra, dec):
+    """Returns a KD-tree of the unit vectors of the positions <ra>, <dec>
+    (arrays in degrees) for fast cone and box searches"""
+
+    return cKDTree(radec_to_unit_vectors(ra, dec))
+
+
+def frame_sources_tree(frame):
+    """Returns the (cached) KD-tree of the positions of the sources stored
+    for <frame> along with the column arrays as returned by
+    read_frame_sources(), or (None, None) if <frame> has no sources file"""
+
+    columns = read_frame_sources(frame)
+    if not columns:
+        return None, None
+    filepath = frame_sources_path(frame)
+    with _cache_lock:
+        tree = _trees.get(filepath)
+        if tree is not None and tree[0] is columns:
+            return tree[1], columns
+    tree = radec_tree(columns['obs_ra'], columns['obs_dec'])
+    with _cache_lock:
+        _trees[filepath] = (columns, tree)
+        while len(_trees) > _CACHE_SIZE:
+            _trees.popitem(last=False)
+
+    return tree, columns
+
+
+def _lookup_mask(columns, lookup, value):
+    """Returns the boolean mask for a Django-style <lookup> (e.g. 'obs_x__gt',
+    'obs_ra__range') with <value> applied to <columns>"""
+
+    if '__' in lookup:
+        column, op = lookup.rsplit('__', 1)
+    else:
+        column, op = lookup, 'exact'
+    if column not in columns:
+        raise ValueError("Unknown column '%s'" % column)
+    data = columns[column]
+    # Comparisons against NaN (i.e. NULL) are False, as they would be in SQL
+    with np.errstate(invalid='ignore'):
+        if op == 'range':
+            return (data >= value[0]) & (data <= value[1])
+        elif op == 'gt':
+            return data > value
+        elif op == 'gte':
+            return data >= value
+        elif op == 'lt':
+            return data < value
+        elif op == 'lte':
+            return data <= value
+        elif op == 'exact':
+            return data == value
+    raise ValueError("Unsupported lookup '%s'" % lookup)
+
+
+def filter_frame_sources(frame, **lookups):
+    """Returns a list of (unsaved) CatalogSources for <frame> from the columnar
+    store that satisfy all of <lookups>, which take the same form as the
+    equivalent CatalogSources.objects.filter() (supported lookups are
+    range, gt, gte, lt, lte and exact). Returns [] if <frame> has no file."""
+
+    columns = read_frame_sources(frame)
+    if not columns:
+        return []
+    num_sources = len(columns[SOURCE_COLUMNS[0]])
+    mask = np.ones(num_sources, dtype=bool)
+    for lookup, value in lookups.items():
+        mask &= _lookup_mask(columns, lookup, value)
+
+    return make_frame_sources(frame, columns, np.flatnonzero(mask))
+
+
+def make_frame_sources(frame, columns, indices):
+    """Returns a list of (unsaved) CatalogSources for <frame> made from rows
+    <indices> of the column arrays <columns>"""
+
+    sources = []
+    for index in indices:
+        params = {}
+        for column in SOURCE_COLUMNS:
+            value = columns[column][index].item()
+            if column not in INT_COLUMNS and np.isnan(value):
+                value = None
+            params[column] = value
+        sources.append(CatalogSources(frame=frame, **params))
+
+    return sources
+
+
+def count_frame_sources(frame):
+    """Returns the number of sources in the columnar store for <frame>"""
+
+    columns = read_frame_sources(frame)
+    if not columns:
+        return 0
+    return len(columns[SOURCE_COLUMNS[0]])
+
+
+def delete_frame_sources(frame):
+    """Removes the sources file of <frame> (if any) and clears
+    Frame.sources_file. Returns True if a file was deleted."""
+
+    filepath = frame_sources_path(frame)
+    deleted = False
+    if filepath is not None:
+        with _cache_lock:
+            _cache.pop(filepath, None)
+        try:
+            os.remove(filepath)
+            deleted = True
+        except FileNotFoundError:
+            pass
+        frame.sources_file = None
+        frame.save(update_fields=['sources_file'])
+
+    return deleted
+
+
+def migrate_frame_sources(frame, delete=True):
+    """Copies the CatalogSources rows of <frame> from the database into the
+    columnar store, deleting the rows afterwards if <delete> is True.
+    Returns the number of sources moved."""
+
+    cat_sources = CatalogSources.objects.filter(frame=frame)
+    sources = list(cat_sources.values(*SOURCE_COLUMNS))
+    if len(sources) == 0:
+        return 0
+    num_written = write_frame_sources(frame, sources)
+    if delete:
+        cat_sources.delete()
+
+    return num_written
@@ -15,7 +15,7 @@ GNU General Public License for more details.
 
 from datetime import datetime, timedelta
 from unittest import skipIf, skip
-from math import sqrt, log10, log
+from math import sqrt, log10, log, radians
 import os
 from glob import glob
 import tempfile
@@ -672,6 +672,30 @@ class ZeropointUnitTest(TestCase):
         self.compare_tables(expected_cross_match_table, cross_match_table, 'r mag err', precision=2)
         self.compare_tables(expected_cross_match_table, cross_match_table, 'r mag diff')
 
+    def test_cross_match_RA_wrap(self):
+        # test sources either side of RA=0 are matched
+
+        table_cat_1_data = [(359.99995, 10.000010, 14.5, 0),
+                            (0.000030, 10.200000, 15.0, 0),
+                            (180.00000, 10.300000, 13.0, 0)]
+
+        table_cat_1 = Table(rows=table_cat_1_data, names=('obs_ra', 'obs_dec', 'obs_mag', 'flags'), dtype=('f8', 'f8', 'f8', 'i2'))
+
+        table_cat_2_data = [(0.000020, 10.000000, 14.4, 1),
+                            (359.99998, 10.200020, 15.2, 2),
+                            (10.000000, 10.300000, 13.0, 0),
+                            (20.000000, 10.400000, 12.0, 0)]
+
+        table_cat_2 = Table(rows=table_cat_2_data, names=('RAJ2000', 'DEJ2000', 'rmag', 'e_rmag'), dtype=('f8', 'f8', 'f8', 'f8'))
+
+        cross_match_table = cross_match(table_cat_1, table_cat_2)
+
+        self.assertEqual(2, len(cross_match_table))
+        assert_allclose([359.99995, 0.000030], cross_match_table['RA Cat 1'])
+        assert_allclose([0.000020, 359.99998], cross_match_table['RA Cat 2'])
+        assert_allclose([7.0e-5, 5.0e-5], cross_match_table['RA diff'], atol=1e-9)
+        assert_allclose([0.01, 0.02], cross_match_table['r mag err'])
+
     def test_get_zeropoint(self):
         # test zeropoint calculation
 
@@ -1567,6 +1591,153 @@ class OpenFITSCatalog(FITSUnitTest):
                 msg="Failure on %s (%s != %s)" % (key, expected_header[key], hdr[key]))
 
 
+class TestFindFirstLastFrames(TestCase):
+
+    def setUp(self):
+        self.fits_files = []
+        for i, hour in enumerate([3, 1, 2]):
+            filename = 'cpt1m013-fa14-20230520-%04d-e91.fits' % (i+100)
+            Frame.objects.create(sitecode='K92', instrument='fa14', filter='w', filename=filename,
+                                 midpoint=datetime(2023, 5, 20, hour, 0, 0), frametype=Frame.BANZAI_RED_FRAMETYPE)
+            self.fits_files.append(os.path.join('/tmp', filename))
+
+    def test_first_last(self):
+        with self.assertNumQueries(1):
+            first_frame, last_frame = find_first_last_frames(self.fits_files)
+
+        self.assertEqual(datetime(2023, 5, 20, 1, 0, 0), first_frame.midpoint)
+        self.assertEqual(datetime(2023, 5, 20, 3, 0, 0), last_frame.midpoint)
+
+    def test_missing_frame(self):
+        first_frame, last_frame = find_first_last_frames(self.fits_files + ['/tmp/wibble-e91.fits'])
+
+        self.assertEqual(None, first_frame)
+        self.assertEqual(None, last_frame)
+
+    def test_duplicate_frame(self):
+        Frame.objects.create(sitecode='K92', instrument='fa14', filter='w', filename=os.path.basename(self.fits_files[0]),
+                             midpoint=datetime(2023, 5, 20, 4, 0, 0), frametype=Frame.BANZAI_QL_FRAMETYPE)
+
+        first_frame, last_frame = find_first_last_frames(self.fits_files)
+
+        self.assertEqual(None, first_frame)
+        self.assertEqual(None, last_frame)
+
+
+class TestFITSHeaderIndex(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.test_file = os.path.join(self.test_dir, 'oracdr_test_catalog.fits')
+        shutil.copy(os.path.join('photometrics', 'tests', 'oracdr_test_catalog.fits'), self.test_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_header(self):
+        header_index = FITSHeaderIndex(self.test_dir)
+
+        header, cattype = header_index.header('oracdr_test_catalog.fits')
+
+        self.assertEqual('LCOGT', cattype)
+        self.assertEqual('252P', header.get('object'))
+        self.assertEqual('2016-02-22T19:16:42.664', header['DATE-OBS'])
+        self.assertEqual(1, header_index.num_read)
+
+    def test_missing_file(self):
+        header_index = FITSHeaderIndex(self.test_dir)
+
+        self.assertEqual(({}, None), header_index.header('wibble.fits'))
+
+    def test_persisted(self):
+        header_index = FITSHeaderIndex(self.test_dir)
+        header_index.header('oracdr_test_catalog.fits')
+        header_index.save()
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, FITSHeaderIndex.INDEX_NAME)))
+
+        header_index = FITSHeaderIndex(self.test_dir)
+        with patch('photometrics.catalog_subs.open_fits_catalog') as mock_open:
+            header, cattype = header_index.header('oracdr_test_catalog.fits')
+
+        mock_open.assert_not_called()
+        self.assertEqual('LCOGT', cattype)
+        self.assertEqual('252P', header.get('OBJECT'))
+
+    def test_changed_file(self):
+        header_index = FITSHeaderIndex(self.test_dir)
+        header_index.header('oracdr_test_catalog.fits')
+        with fits.open(self.test_file, mode='update') as hdulist:
+            hdulist[0].header['OBJECT'] = '123P'
+        st = os.stat(self.test_file)
+        os.utime(self.test_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+        header, cattype = header_index.header('oracdr_test_catalog.fits')
+
+        self.assertEqual('123P', header.get('OBJECT'))
+        self.assertEqual(2, header_index.num_read)
+
+    def test_read_fits_headers(self):
+        shutil.copy(os.path.join('photometrics', 'tests', 'ldac_test_catalog.fits'), self.test_dir)
+        fits_files = [self.test_file, os.path.join(self.test_dir, 'ldac_test_catalog.fits')]
+
+        headers = read_fits_headers(fits_files)
+
+        self.assertEqual(2, len(headers))
+        self.assertEqual('252P', headers[0][0].get('OBJECT'))
+        self.assertEqual('FITS_LDAC', headers[1][1])
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, FITSHeaderIndex.INDEX_NAME)))
+        self.assertEqual(headers, read_fits_headers(fits_files))
+
+
+class TestFITSCatalogReader(FITSUnitTest):
+
+    def test_lcogt_catalog(self):
+        with FITSCatalogReader(self.test_filename) as reader:
+            self.assertEqual('LCOGT', reader.cattype)
+            self.assertEqual(self.test_header['INSTRUME'], reader.header()['INSTRUME'])
+            self.assertIn('FLAGS', reader.column_names())
+            flags = reader.column('FLAGS')
+            self.assertEqual(len(self.test_table), len(flags))
+            self.assertEqual(self.table_num_flags0, len(where(flags == 0)[0]))
+
+    def test_ldac_catalog(self):
+        expected_x = 1758.0389801526617
+
+        with FITSCatalogReader(self.test_ldacfilename) as reader:
+            self.assertEqual('FITS_LDAC', reader.cattype)
+            self.assertEqual(fits_ldac_to_header(fits.getdata(self.test_ldacfilename, 1)[0][0]), reader.header())
+            self.assertAlmostEqual(expected_x, reader.column('XWIN_IMAGE')[-1], self.precision)
+
+    def test_no_table(self):
+        with FITSCatalogReader(self.test_swopefilename) as reader:
+            self.assertEqual('SWOPE', reader.cattype)
+            self.assertEqual([], reader.column_names())
+            self.assertEqual({}, reader.table())
+            with self.assertRaises(KeyError):
+                reader.column('flags')
+
+    def test_corrupt(self):
+        reader = FITSCatalogReader(self.test_bad_ldacfilename)
+
+        with self.assertRaises(CorruptCatalogError):
+            reader.open()
+        self.assertEqual(None, reader.hdulist)
+
+    def test_header_only_no_verify(self):
+        with patch('astropy.io.fits.verify._Verify.verify') as mock_verify:
+            hdr, tbl, cattype = open_fits_catalog(self.test_ldacfilename, header_only=True)
+            self.assertEqual('FITS_LDAC', cattype)
+            mock_verify.assert_not_called()
+            hdr, tbl, cattype = open_fits_catalog(self.test_ldacfilename, header_only=True, verify=True)
+            self.assertTrue(mock_verify.called)
+
+    def test_header_only_corrupt(self):
+        hdr, tbl, cattype = open_fits_catalog(self.test_bad_ldacfilename, header_only=True)
+
+        self.assertEqual({}, hdr)
+        self.assertEqual('CORRUPT', cattype)
+
+
 class TestConvertValues(FITSUnitTest):
 
     def test_dateobs_conversion(self):
@@ -2920,6 +3091,137 @@ class UpdateFrameZeropointTest(FITSUnitTest):
         self.assertEqual(frame.photometric_catalog, 'UCAC4')
 
 
+class TestGetOrCreateCatalogSources(TestCase):
+
+    def setUp(self):
+        frame_params = {'sitecode': 'K92',
+                        'instrument': 'fa14',
+                        'filter': 'w',
+                        'filename': 'cpt1m013-fa14-20230520-0100-e91.fits',
+                        'exptime': 120.0,
+                        'midpoint': datetime(2023, 5, 20, 22, 30, 0),
+                        'frametype': Frame.BANZAI_RED_FRAMETYPE
+                        }
+        self.test_frame = Frame.objects.create(**frame_params)
+
+        names = ('ccd_x', 'ccd_y', 'obs_ra', 'obs_dec', 'obs_mag', 'obs_ra_err', 'obs_dec_err', 'obs_mag_err',
+                 'obs_sky_bkgd', 'major_axis', 'minor_axis', 'ccd_pa', 'flags', 'flux_max', 'threshold')
+        rows = []
+        for i in range(10):
+            rows.append((100.0 + i*10.123456, 200.0 + i*5.5, 150.0 + i*0.001, -20.0 - i*0.001, 15.0 + i*0.1,
+                         1e-5, 1e-5, 0.01, 1200.0, 2.0, 1.5, 45.0, 0, 500.0, 30.0))
+        self.table = Table(rows=rows, names=names)
+
+    def test_new_frame(self):
+        num_created, num_in_table = get_or_create_CatalogSources(self.table, self.test_frame)
+
+        self.assertEqual(10, num_created)
+        self.assertEqual(10, num_in_table)
+        self.assertEqual(10, CatalogSources.objects.filter(frame=self.test_frame).count())
+
+    def test_same_number_skipped(self):
+        get_or_create_CatalogSources(self.table, self.test_frame)
+        self.table['obs_mag'] += 1.0
+
+        num_created, num_in_table = get_or_create_CatalogSources(self.table, self.test_frame)
+
+        self.assertEqual(0, num_created)
+        self.assertEqual(15.0, CatalogSources.objects.get(frame=self.test_frame, obs_x=100.0).obs_mag)
+
+    def test_partial_frame(self):
+        get_or_create_CatalogSources(self.table[0:6], self.test_frame)
+
+        num_created, num_in_table = get_or_create_CatalogSources(self.table, self.test_frame)
+
+        self.assertEqual(4, num_created)
+        self.assertEqual(10, num_in_table)
+        self.assertEqual(10, CatalogSources.objects.filter(frame=self.test_frame).count())
+
+    def test_reconcile_updates(self):
+        get_or_create_CatalogSources(self.table[0:6], self.test_frame)
+        self.table['obs_mag'][1] = 12.5
+        self.table['flags'][2] = 4
+
+        with self.assertNumQueries(5):
+            num_created, num_updated = reconcile_CatalogSources(self.table, self.test_frame)
+
+        self.assertEqual(4, num_created)
+        self.assertEqual(2, num_updated)
+        sources = CatalogSources.objects.filter(frame=self.test_frame).order_by('obs_x')
+        self.assertEqual(10, sources.count())
+        self.assertEqual(12.5, sources[1].obs_mag)
+        self.assertEqual(4, sources[2].flags)
+        self.assertEqual(15.0, sources[0].obs_mag)
+
+    def test_reconcile_keeps_unmatched(self):
+        get_or_create_CatalogSources(self.table, self.test_frame)
+
+        num_created, num_updated = reconcile_CatalogSources(self.table[5:], self.test_frame)
+
+        self.assertEqual(0, num_created)
+        self.assertEqual(0, num_updated)
+        self.assertEqual(10, CatalogSources.objects.filter(frame=self.test_frame).count())
+
+
+class TestSearchBoxes(TestCase):
+
+    def setUp(self):
+        frame_params = {'sitecode': 'K92',
+                        'instrument': 'fa14',
+                        'filter': 'w',
+                        'exptime': 120.0,
+                        'frametype': Frame.BANZAI_RED_FRAMETYPE
+                        }
+        self.frames = []
+        for i in range(3):
+            frame = Frame.objects.create(filename='cpt1m013-fa14-20230520-%04d-e91.fits' % i,
+                                         midpoint=datetime(2023, 5, 20, 22, 30+i, 0), **frame_params)
+            self.frames.append(frame)
+            for j in range(5):
+                CatalogSources.objects.create(frame=frame, obs_x=100.0*j, obs_y=100.0*j, obs_ra=150.0 + j*0.001 + i*0.0001,
+                                              obs_dec=-20.0, obs_mag=15.0, background=1200.0, major_axis=2.0,
+                                              minor_axis=1.5, position_angle=45.0, ellipticity=0.25, aperture_size=3.0*j)
+
+    def test_matches_search_box(self):
+        queries = [(frame, radians(150.0021), radians(-20.0)) for frame in self.frames]
+
+        with self.assertNumQueries(1):
+            results = search_boxes(queries, 2.0)
+
+        self.assertEqual(3, len(results))
+        for (frame, ra, dec), sources in zip(queries, results):
+            expected_sources = search_box(frame, ra, dec, 2.0)
+            self.assertEqual([s.id for s in expected_sources], [s.id for s in sources])
+            self.assertEqual(1, len(sources))
+            self.assertEqual(frame, sources[0].frame)
+        self.assertEqual(200.0, results[1][0].obs_x)
+
+    def test_max_ap_size(self):
+        queries = [(self.frames[0], radians(150.0015), radians(-20.0))]
+
+        results = search_boxes(queries, 4.0)
+        self.assertEqual([100.0, 200.0], [s.obs_x for s in results[0]])
+
+        results = search_boxes(queries, 4.0, max_ap_size=4.0)
+        self.assertEqual([100.0], [s.obs_x for s in results[0]])
+
+    def test_no_sources(self):
+        queries = [(self.frames[0], radians(150.0021), radians(-20.0)), (self.frames[1], radians(10.0), radians(20.0))]
+
+        results = search_boxes(queries, 2.0)
+
+        self.assertEqual(1, len(results[0]))
+        self.assertEqual([], results[1])
+
+    def test_chunks(self):
+        queries = [(frame, radians(150.0021), radians(-20.0)) for frame in self.frames]
+
+        with self.assertNumQueries(2):
+            results = search_boxes(queries, 2.0, chunk_size=2)
+
+        self.assertEqual([1, 1, 1], [len(sources) for sources in results])
+
+
 class MakeSEXTFileTest(FITSUnitTest):
 
     def setUp(self):
@@ -15,6 +15,7 @@ GNU General Public License for more details.
 
 import os
 import platform
+import shutil
 from glob import glob
 import tempfile
 from unittest import skipIf
@@ -555,6 +556,152 @@ class TestSExtractorRunner(ExternalCodeUnitTest):
             self.assertTrue(os.path.exists(test_file), msg=config_file + ' is missing')
 
 
+class TestBatchRunners(ExternalCodeUnitTest):
+
+    # These tests use stub shell scripts in place of the real SExtractor and
+    # SCAMP binaries which just write the expected output files.
+    def setUp(self):
+        super(TestBatchRunners, self).setUp()
+        self.bin_dir = tempfile.mkdtemp(prefix='tmp_neox_bin_')
+        self.sex_stub = self.make_stub('sex', 'case "$1" in *bad*) exit 1;; esac\necho "$1" > test.cat')
+        # The SCAMP stub fails unless the reference catalog is in its working directory
+        self.scamp_stub = self.make_stub('scamp', '[ -f "$7" ] || exit 3\ncat "$7" > "${1%.*}.head"\necho "$1" > scamp.xml')
+        self.fits_files = []
+        for frame in range(6):
+            fits_file = os.path.join(self.test_dir, 'cpt1m010-fa16-20160225-%04d-e91.fits' % frame)
+            open(fits_file, 'w').close()
+            self.fits_files.append(fits_file)
+
+    def tearDown(self):
+        for stub in (self.sex_stub, self.scamp_stub):
+            os.remove(stub)
+        os.rmdir(self.bin_dir)
+        super(TestBatchRunners, self).tearDown()
+
+    def make_stub(self, name, script):
+        stub = os.path.join(self.bin_dir, name)
+        with open(stub, 'w') as stub_fh:
+            stub_fh.write('#!/bin/sh\n' + script + '\n')
+        os.chmod(stub, 0o755)
+        return stub
+
+    def test_sextractor_batch(self):
+
+        results = run_sextractor_batch(self.source_dir, self.test_dir, self.fits_files, binary=self.sex_stub, max_workers=3)
+
+        self.assertEqual(len(self.fits_files), len(results))
+        for fits_file, result in zip(self.fits_files, results):
+            expected_catalog = fits_file.replace('.fits', '.cat')
+            self.assertEqual(fits_file, result['fits_file'])
+            self.assertEqual(0, result['status'])
+            self.assertEqual(expected_catalog, result['catalog'])
+            with open(expected_catalog, 'r') as cat_fh:
+                self.assertEqual(fits_file, cat_fh.read().strip())
+        self.assertEqual([], glob(os.path.join(self.test_dir, 'worker_*')))
+
+    def test_sextractor_batch_failure(self):
+        bad_fits_file = os.path.join(self.test_dir, 'bad-e91.fits')
+        fits_files = [self.fits_files[0], bad_fits_file, self.fits_files[1]]
+
+        results = run_sextractor_batch(self.source_dir, self.test_dir, fits_files, binary=self.sex_stub, max_workers=2)
+
+        self.assertEqual([0, 1, 0], [result['status'] for result in results])
+        self.assertEqual(None, results[1]['catalog'])
+        self.assertEqual(self.fits_files[1].replace('.fits', '.cat'), results[2]['catalog'])
+
+    def test_sextractor_batch_no_binary(self):
+
+        results = run_sextractor_batch(self.source_dir, self.test_dir, self.fits_files[0:2], binary='wibble')
+
+        self.assertEqual([-42, -42], [result['status'] for result in results])
+
+    def test_scamp_batch_no_binary(self):
+
+        results = run_scamp_batch(self.source_dir, self.test_dir, self.fits_files[0:2], binary='wibble')
+
+        self.assertEqual([-42, -42], [result['status'] for result in results])
+
+    def test_sextractor_batch_bad_srcdir(self):
+
+        results = run_sextractor_batch('wibble', self.test_dir, self.fits_files[0:2], binary=self.sex_stub)
+
+        self.assertEqual([-1, -1], [result['status'] for result in results])
+
+    def test_scamp_batch(self):
+        catalogs = [fits_file.replace('.fits', '_ldac.fits') for fits_file in self.fits_files]
+        refcats = ['refcat_%d.cat' % i for i in range(len(catalogs))]
+        for refcat in refcats:
+            with open(os.path.join(self.test_dir, refcat), 'w') as refcat_fh:
+                refcat_fh.write(refcat)
+
+        results = run_scamp_batch(self.source_dir, self.test_dir, catalogs, refcatalogs=refcats, binary=self.scamp_stub, max_workers=4)
+
+        self.assertEqual(len(catalogs), len(results))
+        for catalog, refcat, result in zip(catalogs, refcats, results):
+            expected_head_file = catalog.replace('.fits', '.head')
+            expected_xml_file = catalog.replace('.fits', '_scamp.xml')
+            self.assertEqual(catalog, result['fits_catalog'])
+            self.assertEqual(0, result['status'])
+            self.assertEqual(expected_head_file, result['head_file'])
+            self.assertEqual(expected_xml_file, result['xml_file'])
+            # Check each frame got the right reference catalog and XML file
+            with open(expected_head_file, 'r') as head_fh:
+                self.assertEqual(refcat, head_fh.read().strip())
+            with open(expected_xml_file, 'r') as xml_fh:
+                self.assertEqual(os.path.basename(catalog), os.path.basename(xml_fh.read().strip()))
+        self.assertEqual([], glob(os.path.join(self.test_dir, 'worker_*')))
+
+
+    def test_scamp_batch_refcat_path(self):
+        catalogs = [fits_file.replace('.fits', '_ldac.fits') for fits_file in self.fits_files[0:3]]
+        refcat_dir = tempfile.mkdtemp(prefix='tmp_neox_refcat_')
+        self.addCleanup(shutil.rmtree, refcat_dir)
+        refcat = os.path.join(refcat_dir, 'GAIA-DR2_150.00+20.00_30mx30m.cat')
+        with open(refcat, 'w') as refcat_fh:
+            refcat_fh.write('GAIA-DR2')
+
+        results = run_scamp_batch(self.source_dir, self.test_dir, catalogs, refcatalogs=refcat, binary=self.scamp_stub, max_workers=2)
+
+        self.assertEqual([0, 0, 0], [result['status'] for result in results])
+        for result in results:
+            with open(result['head_file'], 'r') as head_fh:
+                self.assertEqual('GAIA-DR2', head_fh.read().strip())
+
+    def test_run_scamp_links_catalog(self):
+        catalog_dir = tempfile.mkdtemp(prefix='tmp_neox_cat_')
+        self.addCleanup(shutil.rmtree, catalog_dir)
+        catalog = os.path.join(catalog_dir, 'cpt1m010-fa16-20160225-0000-e91_ldac.fits')
+        setup_scamp_dir(self.source_dir, self.test_dir)
+
+        run_scamp(self.source_dir, self.test_dir, catalog, binary=self.scamp_stub, dbg=True, setup_dir=False)
+
+        self.assertEqual(catalog, os.readlink(os.path.join(self.test_dir, os.path.basename(catalog))))
+
+    def test_run_scamp_no_self_link(self):
+        catalog = os.path.join(self.test_dir, 'cpt1m010-fa16-20160225-0000-e91_ldac.fits')
+        setup_scamp_dir(self.source_dir, self.test_dir)
+
+        run_scamp(self.source_dir, self.test_dir, catalog, binary=self.scamp_stub, dbg=True, setup_dir=False)
+
+        self.assertFalse(os.path.lexists(catalog))
+
+    def test_run_scamp_setup_dir_no_link(self):
+        catalog_dir = tempfile.mkdtemp(prefix='tmp_neox_cat_')
+        self.addCleanup(shutil.rmtree, catalog_dir)
+        catalog = os.path.join(catalog_dir, 'cpt1m010-fa16-20160225-0000-e91_ldac.fits')
+
+        run_scamp(self.source_dir, self.test_dir, catalog, binary=self.scamp_stub, dbg=True)
+
+        self.assertFalse(os.path.lexists(os.path.join(self.test_dir, os.path.basename(catalog))))
+
+    def test_scamp_batch_missing_refcat(self):
+        catalogs = [fits_file.replace('.fits', '_ldac.fits') for fits_file in self.fits_files[0:2]]
+
+        results = run_scamp_batch(self.source_dir, self.test_dir, catalogs, refcatalogs='wibble.cat', binary=self.scamp_stub)
+
+        self.assertEqual([3, 3], [result['status'] for result in results])
+
+
 class TestFindOrbRunner(ExternalCodeUnitTest):
 
     # These test use a fake binary name and set dbg=True to echo the generated
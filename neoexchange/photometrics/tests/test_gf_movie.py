@@ -0,0 +1,156 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2018-2019 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from mock import patch
+from PIL import Image
+from astropy.io import fits
+from django.test import TestCase
+
+from photometrics.gf_movie import *
+
+
+class TestMakeGif(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.frames = []
+        for framenum in range(1, 8):
+            header = fits.Header()
+            header['OBJECT'] = '2021 SO2'
+            header['REQNUM'] = '2673997'
+            header['SITE'] = 'elp'
+            header['SITEID'] = 'elp'
+            header['INSTRUME'] = 'fa05'
+            header['FILTER'] = 'w'
+            header['OBSTYPE'] = 'EXPOSE'
+            header['FRAMENUM'] = framenum
+            header['DATE-OBS'] = '2021-10-08T01:{:02d}:17.144'.format(framenum)
+            header['PIXSCALE'] = 0.778
+            header['CTYPE1'] = 'RA---TAN'
+            header['CTYPE2'] = 'DEC--TAN'
+            header['CRPIX1'] = 100.0
+            header['CRPIX2'] = 100.0
+            header['CRVAL1'] = 150.0
+            header['CRVAL2'] = -30.0
+            header['CD1_1'] = -0.778 / 3600.0
+            header['CD1_2'] = 0.0
+            header['CD2_1'] = 0.0
+            header['CD2_2'] = 0.778 / 3600.0
+            rng = np.random.default_rng(framenum)
+            data = rng.normal(1000.0, 30.0, (200, 200)).astype(np.float32)
+            filename = os.path.join(self.test_dir, 'elp1m008-fa05-20211007-{:04d}-e91.fits'.format(framenum))
+            fits.writeto(filename, data, header)
+            self.frames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_no_files(self):
+        self.assertEqual("WARNING: COULD NOT FIND FITS FILES", make_gif([os.path.join(self.test_dir, 'wibble.fits')]))
+
+    def test_make_gif(self):
+        movie_file = make_gif(self.frames, out_path=self.test_dir, progress=False, num_workers=1)
+
+        self.assertEqual(os.path.join(self.test_dir, '2021SO2_2673997_framemovie.gif'), movie_file)
+        with Image.open(movie_file) as gif:
+            self.assertEqual(7, gif.n_frames)
+            durations = []
+            for n in range(gif.n_frames):
+                gif.seek(n)
+                durations.append(gif.info['duration'])
+        # First frames are held for init_fr rather than being repeated
+        self.assertEqual([1000] * 5 + [100] * 2, durations)
+
+    def test_no_cache_by_default(self):
+        make_gif(self.frames, out_path=self.test_dir, progress=False, num_workers=1)
+
+        self.assertEqual(sorted([os.path.basename(f) for f in self.frames] + ['2021SO2_2673997_framemovie.gif']),
+                         sorted(os.listdir(self.test_dir)))
+
+    def test_cache_setting(self):
+        cache_dir = os.path.join(self.test_dir, 'cache')
+
+        with self.settings(GF_MOVIE_CACHE_DIR=cache_dir):
+            make_gif(self.frames, out_path=self.test_dir, progress=False, num_workers=1)
+
+        self.assertEqual(7, len(os.listdir(cache_dir)))
+
+    def test_cache_reused(self):
+        cache_dir = os.path.join(self.test_dir, 'cache')
+        make_gif(self.frames, out_path=self.test_dir, progress=False, num_workers=1, center=1, cache_dir=cache_dir)
+        self.assertEqual(7, len(os.listdir(cache_dir)))
+
+        with patch('photometrics.gf_movie.decode_frame') as mock_decode:
+            movie_file = make_gif(self.frames, fr=200, init_fr=200, show_reticle=True, out_path=self.test_dir,
+                                  progress=False, num_workers=1, center=1, cache_dir=cache_dir)
+
+        mock_decode.assert_not_called()
+        with Image.open(movie_file) as gif:
+            self.assertEqual(7, gif.n_frames)
+
+    def test_no_frame_data_read_for_title(self):
+        cache_dir = os.path.join(self.test_dir, 'cache')
+        make_gif(self.frames, out_path=self.test_dir, progress=False, num_workers=1, cache_dir=cache_dir)
+
+        # With the frames cached, only the header of the first frame is read
+        with patch('photometrics.gf_movie.open_image_hdu') as mock_open:
+            make_gif(self.frames, out_path=self.test_dir, progress=False, num_workers=1, cache_dir=cache_dir)
+
+        mock_open.assert_not_called()
+
+    def test_cache_invalidated(self):
+        cache_dir = os.path.join(self.test_dir, 'cache')
+        make_gif(self.frames[0:1], out_path=self.test_dir, progress=False, num_workers=1, cache_dir=cache_dir)
+        cache_path = frame_cache_path(self.frames[0], cache_dir)
+        self.assertTrue(os.path.exists(cache_path))
+
+        with fits.open(self.frames[0], mode='update') as hdul:
+            hdul[0].data[0:10, 0:10] = 5000.0
+        st = os.stat(self.frames[0])
+        os.utime(self.frames[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+        self.assertNotEqual(cache_path, frame_cache_path(self.frames[0], cache_dir))
+
+    def test_decode_frame_center(self):
+        decoded = decode_frame(self.frames[0], center=1)
+
+        # 1 arcmin at 0.778"/pixel = 77 pixels, leaving 61 pixels each side
+        self.assertEqual(61, decoded['x_frac'])
+        self.assertEqual(np.uint8, decoded['image'].dtype)
+        self.assertEqual((200 - 61 - 62, 200 - 61 - 62), decoded['image'].shape)
+        self.assertEqual([200, 200], decoded['shape'].tolist())
+
+    def test_parallel_matches_serial(self):
+        serial_dir = os.path.join(self.test_dir, 'serial')
+        parallel_dir = os.path.join(self.test_dir, 'parallel')
+        os.makedirs(serial_dir)
+        os.makedirs(parallel_dir)
+
+        serial_file = make_gif(self.frames, out_path=serial_dir, progress=False, num_workers=1,
+                               cache_dir=os.path.join(self.test_dir, 'cache1'))
+        parallel_file = make_gif(self.frames, out_path=parallel_dir, progress=False, num_workers=2,
+                                 cache_dir=os.path.join(self.test_dir, 'cache2'))
+
+        with Image.open(serial_file) as serial_gif, Image.open(parallel_file) as parallel_gif:
+            self.assertEqual(serial_gif.n_frames, parallel_gif.n_frames)
+            for n in range(serial_gif.n_frames):
+                serial_gif.seek(n)
+                parallel_gif.seek(n)
+                self.assertEqual(list(serial_gif.convert('RGB').getdata()), list(parallel_gif.convert('RGB').getdata()))
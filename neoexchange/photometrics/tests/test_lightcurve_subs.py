@@ -3,13 +3,18 @@ import shutil
 import tempfile
 from glob import glob
 from datetime import datetime, timedelta
+from math import radians, degrees
 
 import numpy as np
+import pyslalib.slalib as S
+from mock import Mock, patch
 from astropy.table import Column
 from astropy.time import Time
 from astropy.wcs import WCS
 
-from core.models import Body, SuperBlock, Block, Frame, SourceMeasurement
+from astrometrics.ephem_subs import compute_ephem, compute_ephem_batch, compute_airmass_batch
+from astrometrics.horizons_cache import HorizonsCache
+from core.models import Body, SuperBlock, Block, Frame, SourceMeasurement, CatalogSources
 from photometrics.lightcurve_subs import *
 
 from django.test import SimpleTestCase, TestCase
@@ -246,3 +251,149 @@ class TestCreateTableFromSrcMeasure(TestCase):
                 assert_array_equal(expected_table[column], table[column])
             else:
                 assert_allclose(expected_table[column], table[column], rtol=1e-4, err_msg=f"Compare failure on column: {column}")
+
+
+class TestFramePositions(SimpleTestCase):
+
+    def setUp(self):
+        self.elements = {'provisional_name': 'N999r0q',
+                         'name': None,
+                         'abs_mag': 21.0,
+                         'slope': 0.15,
+                         'epochofel': datetime(2015, 3, 19, 0, 0, 0),
+                         'meananom': 325.2636,
+                         'argofperih': 85.19251,
+                         'longascnode': 147.81325,
+                         'orbinc': 8.34739,
+                         'eccentricity': 0.1896865,
+                         'meandist': 1.2176312,
+                         'elements_type': 'MPC_MINOR_PLANET',
+                         }
+        start = datetime(2015, 4, 21, 3, 0, 0)
+        self.frames = []
+        for i in range(8):
+            sitecode = 'K91' if i % 2 == 0 else 'V37'
+            self.frames.append(Frame(sitecode=sitecode, midpoint=start + timedelta(minutes=7 * i)))
+
+    def test_matches_compute_ephem(self):
+        ra, dec, mag = predict_frame_positions(self.frames, self.elements)
+
+        for i, frame in enumerate(self.frames):
+            emp = compute_ephem(frame.midpoint, self.elements, frame.sitecode)
+            self.assertAlmostEqual(emp['ra'], ra[i], 7)
+            self.assertAlmostEqual(emp['dec'], dec[i], 7)
+            self.assertAlmostEqual(emp['mag'], mag[i], 4)
+
+    def test_unordered_blocks(self):
+        # Interleaved filters and two nights, with the frames out of time order
+        frames = []
+        for block_id, start in ((1, datetime(2015, 4, 21, 3, 0, 0)), (2, datetime(2015, 5, 1, 2, 0, 0))):
+            for i in range(6):
+                obs_filter = 'rp' if i % 2 == 0 else 'gp'
+                frames.append(Frame(sitecode='K91', filter=obs_filter, block_id=block_id,
+                                    midpoint=start + timedelta(minutes=11 * (i // 2) + 3 * (i % 2))))
+        frames = [frames[i] for i in (5, 0, 9, 3, 11, 1, 6, 4, 8, 2, 10, 7)]
+
+        with patch('photometrics.lightcurve_subs.compute_ephem_batch', wraps=compute_ephem_batch) as mock_ephem:
+            ra, dec, mag = predict_frame_positions(frames, self.elements)
+
+        self.assertEqual(2, mock_ephem.call_count)
+        for i, frame in enumerate(frames):
+            emp = compute_ephem(frame.midpoint, self.elements, frame.sitecode)
+            self.assertAlmostEqual(emp['ra'], ra[i], 7)
+            self.assertAlmostEqual(emp['dec'], dec[i], 7)
+            self.assertAlmostEqual(emp['mag'], mag[i], 4)
+
+    def test_offsets(self):
+        ra_offset = radians(10.0/3600.0)
+        dec_offset = radians(-5.0/3600.0)
+
+        ra, dec, mag = predict_frame_positions(self.frames, self.elements)
+        off_ra, off_dec, off_mag = predict_frame_positions(self.frames, self.elements, ra_offset, dec_offset)
+
+        for i in range(len(self.frames)):
+            self.assertAlmostEqual(S.sla_dranrm(ra[i] + ra_offset), off_ra[i], 12)
+            self.assertAlmostEqual(S.sla_drange(dec[i] + dec_offset), off_dec[i], 12)
+        assert_array_equal(mag, off_mag)
+
+    def test_offset_wrap(self):
+        ra, dec = offset_positions([radians(359.99)], [radians(-45.0)], radians(0.02), 0.0)
+
+        self.assertAlmostEqual(radians(0.01), ra[0], 12)
+        self.assertAlmostEqual(radians(-45.0), dec[0], 12)
+
+    def test_airmasses(self):
+        ra, dec, mag = predict_frame_positions(self.frames, self.elements)
+
+        airmass = compute_frame_airmasses(self.frames, ra, dec)
+
+        for i, frame in enumerate(self.frames):
+            expected = compute_airmass_batch([frame.midpoint, ], ra[i], dec[i], frame.sitecode)[0]
+            self.assertAlmostEqual(expected, airmass[i], 7)
+
+
+class TestHorizonsFramePositions(SimpleTestCase):
+
+    def setUp(self):
+        TestFramePositions.setUp(self)
+        self.fetcher = Mock(return_value=None)
+
+    def test_offline_fallback(self):
+        cache = HorizonsCache(fetcher=self.fetcher, offline=True)
+
+        with patch('astrometrics.ephem_subs.horizons_cache', cache):
+            ra, dec, mag = horizons_frame_positions(self.frames, 'N999r0q', self.elements)
+
+        self.fetcher.assert_not_called()
+        expected_ra, expected_dec, expected_mag = predict_frame_positions(self.frames, self.elements)
+        assert_allclose(expected_ra, ra)
+        assert_allclose(expected_dec, dec)
+        assert_allclose(expected_mag, mag)
+
+    def test_one_query_per_site(self):
+        cache = HorizonsCache(fetcher=self.fetcher)
+
+        with patch('astrometrics.ephem_subs.horizons_cache', cache):
+            ra, dec, mag = horizons_frame_positions(self.frames, 'N999r0q')
+
+        self.assertEqual(2, self.fetcher.call_count)
+        self.assertEqual(['K91', 'V37'], sorted([call[0][3] for call in self.fetcher.call_args_list]))
+        self.assertTrue(np.isnan(ra).all())
+
+
+class TestSelectBestSource(SimpleTestCase):
+
+    def setUp(self):
+        self.ra = radians(150.0)
+        self.dec = radians(-30.0)
+        self.sources = [CatalogSources(obs_ra=150.0 + 2.0/3600.0, obs_dec=-30.0, obs_mag=18.0),
+                        CatalogSources(obs_ra=150.0, obs_dec=-30.0 + 1.0/3600.0, obs_mag=19.5),
+                        CatalogSources(obs_ra=150.0, obs_dec=-30.0 - 1.5/3600.0, obs_mag=18.1),
+                        ]
+
+    def test_none(self):
+        self.assertEqual(None, select_best_source([], self.ra, self.dec, 18.0, 3.0, 0.5))
+
+    def test_single(self):
+        self.assertEqual(self.sources[1], select_best_source(self.sources[1:2], self.ra, self.dec, 18.0, 3.0, 0.5))
+
+    def test_closest_within_deltamag(self):
+        best_source = select_best_source(self.sources, self.ra, self.dec, 18.0, 3.0, 0.5)
+
+        self.assertEqual(self.sources[2], best_source)
+
+    def test_closest(self):
+        best_source = select_best_source(self.sources, self.ra, self.dec, 19.0, 3.0, 2.0)
+
+        self.assertEqual(self.sources[1], best_source)
+
+    def test_no_match(self):
+        self.assertEqual(None, select_best_source(self.sources, self.ra, self.dec, 15.0, 3.0, 0.5))
+
+    def test_separations(self):
+        seps, delta_mags = source_separations(self.sources, self.ra, self.dec, 18.0)
+
+        for source, sep, delta_mag in zip(self.sources, seps, delta_mags):
+            expected_sep = degrees(S.sla_dsep(self.ra, self.dec, radians(source.obs_ra), radians(source.obs_dec))) * 3600.0
+            self.assertAlmostEqual(expected_sep, sep, 8)
+            self.assertAlmostEqual(abs(18.0 - source.obs_mag), delta_mag, 10)
@@ -0,0 +1,153 @@
+"""
+NEO exchange: NEO observing portal for Las Cumbres Observatory
+Copyright (C) 2014-2019 LCO
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+"""
+
+import os
+import tempfile
+import shutil
+from datetime import datetime
+from math import radians
+
+from django.test import TestCase, override_settings
+from astropy.table import Table
+
+from core.models import Frame, CatalogSources
+from photometrics.catalog_subs import get_or_create_CatalogSources, search_box, search_boxes, \
+    catalog_source_params
+from photometrics.source_store import *
+
+
+class TestSourceStore(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='tmp_neox_')
+        self.settings_override = override_settings(CATSOURCES_DIR=self.test_dir, CATSOURCES_BACKEND='npz')
+        self.settings_override.enable()
+
+        frame_params = {'sitecode': 'K92',
+                        'instrument': 'fa14',
+                        'filter': 'w',
+                        'filename': 'cpt1m013-fa14-20230520-0100-e91.fits',
+                        'exptime': 120.0,
+                        'midpoint': datetime(2023, 5, 20, 22, 30, 0),
+                        'frametype': Frame.BANZAI_RED_FRAMETYPE
+                        }
+        self.test_frame = Frame.objects.create(**frame_params)
+
+        names = ('ccd_x', 'ccd_y', 'obs_ra', 'obs_dec', 'obs_mag', 'obs_ra_err', 'obs_dec_err', 'obs_mag_err',
+                 'obs_sky_bkgd', 'major_axis', 'minor_axis', 'ccd_pa', 'flags', 'flux_max', 'threshold')
+        rows = []
+        for i in range(10):
+            rows.append((100.0 + i*10.0, 200.0 + i*5.5, 150.0 + i*0.001, -20.0 - i*0.001, 15.0 + i*0.1,
+                         1e-5, 1e-5, 0.01, 1200.0, 2.0, 1.5, 45.0, i % 2, 500.0, 30.0))
+        self.table = Table(rows=rows, names=names)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_use_columnar_store(self):
+        self.assertTrue(use_columnar_store())
+        with self.settings(CATSOURCES_BACKEND='db'):
+            self.assertFalse(use_columnar_store())
+
+    def test_write_read(self):
+        sources = [catalog_source_params(source, self.test_frame) for source in self.table]
+
+        num_written = write_frame_sources(self.test_frame, sources)
+
+        self.assertEqual(10, num_written)
+        self.test_frame.refresh_from_db()
+        self.assertEqual(os.path.join('20230520', '%d_sources.npz' % self.test_frame.pk), self.test_frame.sources_file)
+        self.assertTrue(os.path.exists(frame_sources_path(self.test_frame)))
+        columns = read_frame_sources(self.test_frame)
+        self.assertEqual(set(SOURCE_COLUMNS), set(columns.keys()))
+        self.assertAlmostEqual(150.009, columns['obs_ra'][9], 9)
+        self.assertEqual(1, columns['flags'][9])
+        self.assertEqual(10, count_frame_sources(self.test_frame))
+
+    def test_no_file(self):
+        self.assertEqual(None, read_frame_sources(self.test_frame))
+        self.assertEqual([], filter_frame_sources(self.test_frame, obs_mag__gt=0.0))
+        self.assertEqual(0, count_frame_sources(self.test_frame))
+
+    def test_filter(self):
+        write_frame_sources(self.test_frame, [catalog_source_params(source, self.test_frame) for source in self.table])
+
+        sources = filter_frame_sources(self.test_frame, obs_x__gt=120.0, obs_x__lte=150.0, flags=1)
+
+        self.assertEqual(2, len(sources))
+        self.assertTrue(isinstance(sources[0], CatalogSources))
+        self.assertEqual(self.test_frame, sources[0].frame)
+        self.assertEqual(130.0, sources[0].obs_x)
+        self.assertEqual(150.0, sources[1].obs_x)
+        self.assertAlmostEqual(1.0-(1.5/2.0), sources[0].ellipticity, 9)
+
+    def test_filter_bad_lookup(self):
+        write_frame_sources(self.test_frame, [catalog_source_params(source, self.test_frame) for source in self.table])
+
+        with self.assertRaises(ValueError):
+            filter_frame_sources(self.test_frame, wibble__gt=1.0)
+        with self.assertRaises(ValueError):
+            filter_frame_sources(self.test_frame, obs_x__contains=1.0)
+
+    def test_get_or_create(self):
+        num_created, num_in_table = get_or_create_CatalogSources(self.table[0:6], self.test_frame)
+        self.assertEqual(6, num_created)
+
+        num_created, num_in_table = get_or_create_CatalogSources(self.table, self.test_frame)
+
+        self.assertEqual(4, num_created)
+        self.assertEqual(10, num_in_table)
+        self.assertEqual(0, CatalogSources.objects.filter(frame=self.test_frame).count())
+        self.assertEqual(10, count_frame_sources(self.test_frame))
+
+    def test_search_box(self):
+        get_or_create_CatalogSources(self.table, self.test_frame)
+
+        sources = search_box(self.test_frame, radians(150.002), radians(-20.002), 2.0)
+
+        self.assertEqual(1, len(sources))
+        self.assertEqual(120.0, sources[0].obs_x)
+
+    def test_search_boxes(self):
+        get_or_create_CatalogSources(self.table, self.test_frame)
+        queries = [(self.test_frame, radians(150.002), radians(-20.002)),
+                   (self.test_frame, radians(150.0071), radians(-20.0071)),
+                   (self.test_frame, radians(10.0), radians(20.0))]
+
+        results = search_boxes(queries, 2.0, max_ap_size=5.0)
+
+        self.assertEqual(3, len(results))
+        for (frame, ra, dec), sources in zip(queries, results):
+            expected_sources = search_box(frame, ra, dec, 2.0)
+            self.assertEqual([s.obs_x for s in expected_sources], [s.obs_x for s in sources])
+        self.assertEqual([120.0], [s.obs_x for s in results[0]])
+        self.assertEqual([170.0], [s.obs_x for s in results[1]])
+        self.assertEqual([], search_boxes(queries[0:1], 2.0, max_ap_size=2.0)[0])
+
+    def test_migrate_delete(self):
+        with self.settings(CATSOURCES_BACKEND='db'):
+            get_or_create_CatalogSources(self.table, self.test_frame)
+        self.assertEqual(10, CatalogSources.objects.filter(frame=self.test_frame).count())
+
+        num_moved = migrate_frame_sources(self.test_frame)
+
+        self.assertEqual(10, num_moved)
+        self.assertEqual(0, CatalogSources.objects.filter(frame=self.test_frame).count())
+        self.assertEqual(10, count_frame_sources(self.test_frame))
+
+        self.assertTrue(delete_frame_sources(self.test_frame))
+        self.assertEqual(None, self.test_frame.sources_file)
+        self.assertEqual([], os.listdir(os.path.join(self.test_dir, '20230520')))